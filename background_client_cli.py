@@ -35,14 +35,24 @@ def main():
             stop_background_client()
 
         elif sys.argv[1] == 'list_active_transfers':
-            list_transfers()
+            list_transfers(False, sys.argv[2:])
 
         elif sys.argv[1] == 'list_completed_transfers':
-            list_transfers(True)
+            list_transfers(True, sys.argv[2:])
+
+        elif sys.argv[1] == 'list_changes':
+            list_changes(sys.argv[2] if len(sys.argv) > 2 else 0)
+
+        elif sys.argv[1] == 'get_transfer':
+            if len(sys.argv) > 2:
+                get_transfer(sys.argv[2])
+
+            else:
+                print("No transfer ID specified. Use 'background_client_cli.py help' for usage instructions.")
 
         elif sys.argv[1] == 'add_transfer':
             if len(sys.argv) > 2:
-                add_transfer(sys.argv[2])
+                add_transfer(sys.argv[2], sys.argv[3:])
 
             else:
                 print("No transfer data specified. Use 'background_client_cli.py help' for usage instructions.")
@@ -54,6 +64,37 @@ def main():
             else:
                 print("No transfer ID specified. Use 'background_client_cli.py help' for usage instructions.")
 
+        elif sys.argv[1] in ('pause_transfer', 'resume_transfer'):
+            if len(sys.argv) > 2:
+                pause_transfer(sys.argv[2], sys.argv[1] == 'resume_transfer')
+
+            else:
+                print("No transfer ID specified. Use 'background_client_cli.py help' for usage instructions.")
+
+        elif sys.argv[1] == 'set_priority':
+            if len(sys.argv) > 3:
+                set_priority(sys.argv[2], sys.argv[3])
+
+            else:
+                print("No transfer ID or priority specified. Use 'background_client_cli.py help' for usage "
+                      "instructions.")
+
+        elif sys.argv[1] == 'worker_pools':
+            worker_pools()
+
+        elif sys.argv[1] == 'set_worker_pool':
+            if len(sys.argv) > 3:
+                set_worker_pool(sys.argv[2], sys.argv[3])
+
+            else:
+                print("No pool name or settings specified. Use 'background_client_cli.py help' for usage instructions.")
+
+        elif sys.argv[1] == 'admission_status':
+            admission_status()
+
+        elif sys.argv[1] == 'metrics':
+            print_metrics()
+
         elif sys.argv[1] == 'help':
             print_help()
 
@@ -61,30 +102,47 @@ def main():
             print("Unknown command. Use 'background_client_cli.py help' for usage instructions.")
 
 
-def list_transfers(completed=False):
+def list_transfers(completed=False, filters=None):
     """
     Lists the currently active transfers in the background client
+
+    :param completed: whether to list the completed instead of the active transfers
+    :param filters: list of filters formatted as key:value, for the keys status, owner, offset and limit
     """
 
+    command_data = {}
+
+    for item in filters or []:
+        parts = item.split(':')
+
+        if len(parts) != 2 or parts[0] not in ('status', 'owner', 'offset', 'limit'):
+            print("Incorrect filter '%s' given, please call 'background_client_cli.py help' for the syntax" % item)
+            return
+
+        command_data[parts[0]] = parts[1]
+
     if completed:
-        command_response = send_command('list_completed_transfers')
+        command_response = send_command('list_completed_transfers', command_data)
 
     else:
-        command_response = send_command('list_active_transfers')
+        command_response = send_command('list_active_transfers', command_data)
 
     if command_response['status'] == 'ok':
 
         if len(command_response['data']) > 0:
-            print('----------------------------------------------------------------------')
-            print('Task added             Task status    Task ID')
-            print('----------------------------------------------------------------------')
+            print('---------------------------------------------------------------------------------------------------')
+            print('Task added             Task status    Priority    Owner          Task ID')
+            print('---------------------------------------------------------------------------------------------------')
             for item in command_response['data']:
                 print('%s    ' % item['task_added'], end='')
-                print(item['task_status'], end='')
-                for i in range(0, 15 - len(item['task_status'])):
-                    print(' ', end='')
+                print('%-15s' % item['task_status'], end='')
+                print('%-12s' % item.get('task_priority'), end='')
+                print('%-15s' % item.get('task_owner'), end='')
                 print(item['task_id'])
 
+            if 'total' in command_response and command_response['total'] > len(command_response['data']):
+                print("Listed %s of %s transfers" % (len(command_response['data']), command_response['total']))
+
         else:
             if completed:
                 print("No transfers completed")
@@ -95,13 +153,73 @@ def list_transfers(completed=False):
         print("An error occurred while listing transfers: %s" % command_response['error_message'])
 
 
-def add_transfer(transfer_data):
+def list_changes(since):
+    """
+    List the transfers that changed since a version of the task administration
+
+    :param since: version returned by a previous call, or 0 to list all transfers
+    """
+
+    command_response = send_command('list_changes', {'since': since})
+
+    if command_response['status'] != 'ok':
+        print("An error occurred while listing the changes: %s" % command_response['error_message'])
+        return
+
+    data = command_response['data']
+
+    if data['reset']:
+        print("Changes since the given version are no longer available, listing all transfers")
+
+    for change in ('added', 'updated'):
+        for item in data[change]:
+            print('%-9s%-15s%s' % (change, item['task_status'], item['task_id']))
+
+    for task_id in data['removed']:
+        print('%-9s%-15s%s' % ('removed', '', task_id))
+
+    print("Current version: %s" % data['version'])
+
+
+def get_transfer(task_id):
+    """
+    Show the details of a transfer
+
+    :param task_id: task_id of the transfer
+    """
+
+    command_response = send_command('get_transfer', {'task_id': task_id})
+
+    if command_response['status'] == 'ok':
+        for [key, value] in command_response['data'].items():
+            print('%-16s%s' % (key, value if value is not None else '-'))
+
+    else:
+        print("An error occurred while retrieving the transfer: %s" % command_response['error_message'])
+
+
+def add_transfer(transfer_data, options=None):
     """
     Add a transfer
 
     :param transfer_data: parameters for the transfer
+    :param options: list of scheduling options formatted as key:value, for the keys priority, owner, deadline and
+        expected_size
     """
 
+    # Parse the scheduling options first
+    command_data = {}
+
+    for option in options or []:
+        parts = option.split(':')
+
+        if len(parts) != 2 or parts[0] not in ('priority', 'owner', 'deadline', 'expected_size'):
+            print("Incorrect transfer option '%s' given, please call 'background_client_cli.py help' for the syntax"
+                  % option)
+            return
+
+        command_data[parts[0]] = parts[1]
+
     # Dictionary for the transfer parameters
     transfer_parameters = {}
 
@@ -144,11 +262,16 @@ def add_transfer(transfer_data):
             print("File '%s' not found" % transfer_data)
             return
 
-    command_response = send_command('add_transfer', transfer_parameters)
+    command_data['transfer_data'] = transfer_parameters
+
+    command_response = send_command('add_transfer', command_data)
 
     if command_response['status'] == 'ok':
         print("The transfer was successfully added with task_id %s" % command_response['data']['task_id'])
 
+    elif command_response.get('retry_after') is not None:
+        print("%s. Please retry in %s seconds." % (command_response['error_message'], command_response['retry_after']))
+
     else:
         print("An error occurred while adding the transfer: %s" % command_response['error_message'])
 
@@ -157,7 +280,7 @@ def cancel_transfer(task_id):
     """
     Cancel a transfer
 
-    :param task_id: task_id of the transfer to be cancelled. Only queued transfers can be cancelled
+    :param task_id: task_id of the transfer to be cancelled. Active transfers are stopped and deleted at the API.
     """
 
     command_response = send_command('cancel_transfer', {'task_id': task_id})
@@ -169,6 +292,131 @@ def cancel_transfer(task_id):
         print("An error occurred while cancelling the transfer: %s" % command_response['error_message'])
 
 
+def pause_transfer(task_id, resume=False):
+    """
+    Pause an active transfer, or resume a paused transfer
+
+    :param task_id: task_id of the transfer
+    :param resume: whether to resume instead of pause the transfer
+    """
+
+    if resume:
+        command_response = send_command('resume_transfer', {'task_id': task_id})
+    else:
+        command_response = send_command('pause_transfer', {'task_id': task_id})
+
+    if command_response['status'] == 'ok':
+        print("The transfer was successfully %s" % ('resumed' if resume else 'paused'))
+
+    else:
+        print("An error occurred while %s the transfer: %s" % ('resuming' if resume else 'pausing',
+                                                              command_response['error_message']))
+
+
+def set_priority(task_id, priority):
+    """
+    Change the priority of a queued transfer
+
+    :param task_id: task_id of the transfer
+    :param priority: the new priority, transfers with a higher priority are started first
+    """
+
+    command_response = send_command('set_priority', {'task_id': task_id, 'priority': priority})
+
+    if command_response['status'] == 'ok':
+        print("The priority of the transfer was successfully changed")
+
+    else:
+        print("An error occurred while changing the priority: %s" % command_response['error_message'])
+
+
+def worker_pools():
+    """
+    List the worker pools of the background client and their state
+    """
+
+    print_worker_pools(send_command('get_worker_pools'))
+
+
+def set_worker_pool(pool, settings):
+    """
+    Reconfigure a worker pool of the background client
+
+    :param pool: name of the pool, either 'connection' or 'transfer'
+    :param settings: comma separated key-value pairs separated by colons, for the keys size, elastic, min_size and
+        max_size
+    """
+
+    command_data = {'pool': pool}
+
+    for item in ''.join(settings.split()).split(','):
+        parts = item.split(':')
+
+        if len(parts) != 2:
+            print("Incorrect pool settings given, please call 'background_client_cli.py help' for the syntax")
+            return
+
+        command_data[parts[0]] = parts[1]
+
+    print_worker_pools(send_command('set_worker_pool', command_data))
+
+
+def admission_status():
+    """
+    Show the admission limits of the background client and the number of admitted and rejected transfers
+    """
+
+    command_response = send_command('admission_status')
+
+    if command_response['status'] == 'ok':
+        data = command_response['data']
+
+        print('Queued transfers:          %s / %s' % (data['queued'], data['max_queued'] or 'unlimited'))
+        print('Max queued per owner:      %s' % (data['max_queued_per_owner'] or 'unlimited'))
+        print('Min free disk space:       %s bytes' % data['min_free_disk_space'])
+        print('Reserved disk space:       %s bytes' % data['reserved_disk_space'])
+        print('Admitted transfers:        %s' % data['admitted'])
+        print('Rejected transfers:        %s' % data['rejected_total'])
+        for [reason, count] in sorted(data['rejected'].items()):
+            print('    %-22s%s' % (reason, count))
+
+    else:
+        print("An error occurred while retrieving the admission status: %s" % command_response['error_message'])
+
+
+def print_metrics():
+    """
+    Print the metrics of the background client in the Prometheus text format
+    """
+
+    command_response = send_command('metrics')
+
+    if command_response['status'] == 'ok':
+        print(command_response['data'], end='')
+
+    else:
+        print("An error occurred while retrieving the metrics: %s" % command_response['error_message'])
+
+
+def print_worker_pools(command_response):
+    """
+    Print the state of the worker pools as returned by the background client
+
+    :param command_response: response to the get_worker_pools or set_worker_pool command
+    """
+
+    if command_response['status'] == 'ok':
+        print('----------------------------------------------------------------------')
+        print('Pool           Size    Busy    Elastic    Min size    Max size')
+        print('----------------------------------------------------------------------')
+        for [name, pool] in sorted(command_response['data'].items()):
+            print('%-15s%-8s%-8s%-11s%-12s%s' % (name, pool['size'], pool['busy'], pool['elastic'], pool['min_size'],
+                                                 pool['max_size']))
+
+    else:
+        print("An error occurred while configuring the worker pools: %s" % command_response['error_message'])
+
+
 def start_background_client():
     """
     Start the background client. Checks whether it is already running first.
@@ -255,11 +503,30 @@ def print_help():
     print("./background_client_cli.py.py status                    - Check whether the background client is running")
     print("./background_client_cli.py.py start                     - Start the background client")
     print("./background_client_cli.py.py stop                      - Stop the background client")
-    print("./background_client_cli.py.py list_active_transfers     - List the currently active transfers")
-    print("./background_client_cli.py.py list_completed_transfers  - List the completed transfers since the background "
+    print("./background_client_cli.py.py list_active_transfers [filters]")
+    print("                                                       - List the currently active transfers")
+    print("./background_client_cli.py.py list_completed_transfers [filters]")
+    print("                                                       - List the completed transfers since the background "
           "client was started")
-    print("./background_client_cli.py.py add_transfer <parameters> - Start a new transfer")
-    print("./background_client_cli.py.py cancel_transfer <task id> - Cancel a transfer")
+    print("./background_client_cli.py.py get_transfer <task id>    - Show the details of a transfer")
+    print("./background_client_cli.py.py list_changes [version]    - List the transfers that changed since the given "
+          "version")
+    print("./background_client_cli.py.py add_transfer <parameters> [options]")
+    print("                                                       - Start a new transfer")
+    print("./background_client_cli.py.py cancel_transfer <task id> - Cancel a queued or active transfer")
+    print("./background_client_cli.py.py pause_transfer <task id>  - Pause an active transfer")
+    print("./background_client_cli.py.py resume_transfer <task id> - Resume a paused transfer")
+    print("./background_client_cli.py.py set_priority <task id> <priority>")
+    print("                                                       - Change the priority of a queued transfer")
+    print("./background_client_cli.py.py worker_pools              - List the connection and transfer worker pools")
+    print("./background_client_cli.py.py set_worker_pool <pool> <settings>")
+    print("                                                       - Reconfigure a worker pool, for example: "
+          "set_worker_pool transfer size:10 or set_worker_pool transfer elastic:true,min_size:2,max_size:20")
+    print("./background_client_cli.py.py admission_status          - Show the admission limits and rejected transfers")
+    print("./background_client_cli.py.py metrics                   - Show the metrics in the Prometheus text format")
+    print()
+    print("Transfer listings can be filtered with status:<status> and owner:<owner>, and paginated with offset:<number> "
+          "and limit:<number>, for example: list_completed_transfers status:failed limit:20")
     print()
     print("Parameter format for a new transfer")
     print("-----------------------------------")
@@ -277,6 +544,18 @@ def print_help():
     print()
     print("./background_client_cli.py.py add_transfer transfer_data.txt")
     print()
+    print("Scheduling options can be added after the parameters, as separate key-value pairs separated by colons:")
+    print()
+    print("priority:<number>  - transfers with a higher priority are started first, the default priority is 0")
+    print("owner:<name>       - transfers of different owners share the transfer threads fairly")
+    print("deadline:<seconds> - start the transfer with precedence when the deadline approaches")
+    print("expected_size:<bytes> - projected size of the result, used to check the free disk space")
+    print()
+    print("./background_client_cli.py.py add_transfer transfer_data.txt priority:10 owner:operational deadline:3600")
+    print()
+    print("When the background client is overloaded, new transfers are rejected with the number of seconds after which "
+          "to retry.")
+    print()
     print("Where the file 'transfer_data.txt' would contain:")
     print()
     print("class: s2")
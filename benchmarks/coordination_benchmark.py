@@ -0,0 +1,183 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+"""
+Benchmark of the host-wide coordination of requests. A number of independent processes, each with its own
+ECMWFDataServer and the same credentials, retrieve requests in parallel from the mock ECMWF API server. The server
+records how many requests were queued or active at the same time and the highest number of submissions within a
+minute, which should stay within the coordinated limits, and the time the processes took.
+
+Usage: python -m benchmarks.coordination_benchmark [--processes N] [--requests N] [--max-requests N] [--scenarios LIST]
+"""
+
+import argparse
+import multiprocessing
+import shutil
+import sys
+import tempfile
+import time
+
+from ecmwfapi import ECMWFDataServer
+from ecmwfapi.host_coordinator import host_coordinator
+
+from .mock_server import MockApiServer
+
+
+scenarios = ('uncoordinated', 'coordinated')
+
+
+class CountingServer(MockApiServer):
+    """
+    Mock server that records the number of requests in flight and the submission times
+    """
+
+    def __init__(self, **options):
+
+        super().__init__(**options)
+
+        self.peak_in_flight = 0
+        self.submit_times = []
+
+    def submit(self, payload):
+
+        name = super().submit(payload)
+
+        with self._lock:
+            in_flight = sum(1 for request in self._requests.values() if self.status(request) != 'complete')
+            self.peak_in_flight = max(self.peak_in_flight, in_flight)
+            self.submit_times.append(time.time())
+
+        return name
+
+    def reset(self):
+        with self._lock:
+            self.peak_in_flight = 0
+            self.submit_times = []
+
+    def peak_submission_rate(self):
+        """
+        :return: highest number of submissions within a minute
+        """
+
+        times = sorted(self.submit_times)
+        start = 0
+        peak = 0
+
+        for [index, moment] in enumerate(times):
+            while times[start] <= moment - 60:
+                start += 1
+            peak = max(peak, index - start + 1)
+
+        return peak
+
+
+def run_process(server_url, settings, requests, parallel):
+    """
+    Retrieve the requests as an independent script would, with the coordination settings of the scenario
+    """
+
+    data_server = ECMWFDataServer(server_url, 'benchmark', 'benchmark@localhost', custom_log=lambda *args: None,
+                                  custom_log_level=True)
+    host_coordinator.configure(**settings)
+
+    results = data_server.retrieve_parallel([{'dataset': 'benchmark', 'target': None} for _ in range(requests)],
+                                            parallel)
+
+    sys.exit(0 if all(stats.status == 'completed' for stats in results) else 1)
+
+
+def run_scenario(name, server, arguments):
+    """
+    :return: dictionary with the results
+    """
+
+    directory = tempfile.mkdtemp(prefix='ecmwfapi-benchmark-')
+    settings = {'directory': directory, 'max_requests': arguments.max_requests if name == 'coordinated' else 0,
+                'submission_rate': arguments.submission_rate if name == 'coordinated' else 0,
+                'submission_burst': arguments.submission_burst}
+
+    server.reset()
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=run_process, args=(server.url, settings, arguments.requests,
+                                                           arguments.parallel))
+                 for _ in range(arguments.processes)]
+
+    start_time = time.time()
+
+    try:
+        for process in processes:
+            process.start()
+
+        for process in processes:
+            process.join()
+
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        'scenario': name,
+        'requests': arguments.processes * arguments.requests,
+        'failed': sum(1 for process in processes if process.exitcode != 0),
+        'elapsed': time.time() - start_time,
+        'peak_in_flight': server.peak_in_flight,
+        'peak_submission_rate': server.peak_submission_rate(),
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Host-wide request coordination benchmark")
+    parser.add_argument('--processes', type=int, default=4, help="number of independent processes")
+    parser.add_argument('--requests', type=int, default=3, help="number of requests per process")
+    parser.add_argument('--parallel', type=int, default=3, help="number of parallel requests per process")
+    parser.add_argument('--max-requests', type=int, default=3, help="host-wide limit of requests in flight")
+    parser.add_argument('--submission-rate', type=float, default=0, help="host-wide limit of submissions per "
+                                                                          "minute, 0 for no limit")
+    parser.add_argument('--submission-burst', type=float, default=1, help="submissions that can be made at once")
+    parser.add_argument('--active-delay', type=float, default=6, help="seconds a request is active at the server")
+    parser.add_argument('--file-size', type=int, default=65536, help="size of each result in bytes")
+    parser.add_argument('--scenarios', default=','.join(scenarios),
+                        help="comma separated scenarios, from %s" % ', '.join(scenarios))
+    arguments = parser.parse_args()
+
+    selected = [name.strip() for name in arguments.scenarios.split(',') if name.strip()]
+    for name in selected:
+        if name not in scenarios:
+            parser.error("Unknown scenario %s" % name)
+
+    server = CountingServer(active_delay=arguments.active_delay, poll_interval=1, latency=0.005,
+                            file_size=arguments.file_size).start()
+
+    try:
+        results = [run_scenario(name, server, arguments) for name in selected]
+
+    finally:
+        server.stop()
+
+    print("%s processes with %s requests each, %s parallel per process, limit of %s requests in flight and %s "
+          "submissions per minute" % (arguments.processes, arguments.requests, arguments.parallel,
+                                      arguments.max_requests, arguments.submission_rate or 'unlimited'))
+    print('-' * 80)
+    print('%-16s%-10s%-8s%-11s%-17s%-18s'
+          % ('Scenario', 'Requests', 'Failed', 'Time (s)', 'Peak in flight', 'Peak per minute'))
+    print('-' * 80)
+    for result in results:
+        print('%-16s%-10s%-8s%-11.2f%-17s%-18s'
+              % (result['scenario'], result['requests'], result['failed'], result['elapsed'],
+                 result['peak_in_flight'], result['peak_submission_rate']))
+    print('-' * 80)
+
+    return 1 if any(result['failed'] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
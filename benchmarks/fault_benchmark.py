@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+"""
+Robustness benchmark of the transfers. Runs requests through retrieve while the fault proxy injects the faults of a
+profile between the client and the mock ECMWF API server. Reports per profile how many requests failed, how many
+completed requests produced a file that differs from the data of the server, the effective throughput and the retries
+of the client.
+
+Usage: python -m benchmarks.fault_benchmark [--requests N] [--file-size BYTES] [--profiles LIST]
+"""
+
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+
+from ecmwfapi import ECMWFDataServer
+from ecmwfapi.api_connection import api_cache
+
+from .fault_proxy import FaultProxy, profiles, scripts
+from .mock_server import MockApiServer, expected_data
+from .transfer_benchmark import create_requests
+
+
+default_profiles = ['clean', 'resets', 'stalls', 'truncated_ranges', 'wrong_content_range', 'data_server_errors',
+                    'api_server_errors', 'slow_network', 'bandwidth_collapse', 'flaky_then_clean']
+
+
+def run_profile(name, server, arguments):
+    """
+    Run the requests through a fresh proxy with the given profile or script
+
+    :return: dictionary with the results
+    """
+
+    proxy = FaultProxy(server.url, profile='clean', seed=arguments.seed).start()
+    directory = tempfile.mkdtemp(prefix='ecmwfapi-faults-')
+    requests = create_requests(directory, arguments.requests)
+    expected = expected_data(0, arguments.file_size)
+    api_cache.clear()
+
+    # The API URL of the proxy, the path is forwarded as is
+    data_server = ECMWFDataServer('%s/v1' % proxy.url, 'benchmark', 'benchmark@localhost',
+                                  custom_log=lambda *args: None, custom_log_level=True)
+
+    if name in scripts:
+        proxy.run_script(name)
+    else:
+        proxy.set_profile(name)
+
+    start_time = time.time()
+
+    try:
+        results = data_server.retrieve(requests)
+        elapsed = time.time() - start_time
+
+        corrupt = 0
+        correct_bytes = 0
+
+        for [request, stats] in zip(requests, results):
+            if stats.status != 'completed':
+                continue
+
+            try:
+                with open(request['target'], 'rb') as file:
+                    data = file.read()
+
+            except OSError:
+                data = None
+
+            if data == expected:
+                correct_bytes += len(data)
+            else:
+                corrupt += 1
+
+    finally:
+        proxy.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        'profile': name,
+        'requests': len(requests),
+        'failed': len([stats for stats in results if stats.status != 'completed']),
+        'corrupt': corrupt,
+        'elapsed': elapsed,
+        'throughput': correct_bytes / elapsed if elapsed > 0 else 0,
+        'block_retries': sum(stats.block_retries for stats in results),
+        'api_retries': sum(stats.api_retries for stats in results),
+        'injected': sum(value for [key, value] in proxy.statistics.items() if key != 'requests'),
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Transfer robustness benchmark with injected faults")
+    parser.add_argument('--requests', type=int, default=3, help="number of requests per profile")
+    parser.add_argument('--file-size', type=int, default=4194304, help="size of each result in bytes")
+    parser.add_argument('--poll-interval', type=int, default=0, help="seconds between status polls")
+    parser.add_argument('--seed', type=int, default=1, help="seed of the fault injection")
+    parser.add_argument('--profiles', default=','.join(default_profiles),
+                        help="comma separated profiles and scripts, from %s"
+                             % ', '.join(sorted(profiles) + sorted(scripts)))
+    arguments = parser.parse_args()
+
+    selected = [name.strip() for name in arguments.profiles.split(',') if name.strip()]
+    for name in selected:
+        if name not in profiles and name not in scripts:
+            parser.error("Unknown profile %s" % name)
+
+    server = MockApiServer(poll_interval=arguments.poll_interval, file_size=arguments.file_size).start()
+
+    try:
+        results = [run_profile(name, server, arguments) for name in selected]
+
+    finally:
+        server.stop()
+
+    print("%s requests of %s bytes per profile" % (arguments.requests, arguments.file_size))
+    print('-' * 104)
+    print('%-22s%-10s%-8s%-9s%-11s%-12s%-15s%-13s%-10s'
+          % ('Profile', 'Requests', 'Failed', 'Corrupt', 'Time (s)', 'MB/s', 'Block retries', 'API retries',
+             'Injected'))
+    print('-' * 104)
+    for result in results:
+        print('%-22s%-10s%-8s%-9s%-11.2f%-12.2f%-15s%-13s%-10s'
+              % (result['profile'], result['requests'], result['failed'], result['corrupt'], result['elapsed'],
+                 result['throughput'] / 1048576, result['block_retries'], result['api_retries'],
+                 result['injected']))
+    print('-' * 104)
+    print("MB/s counts the bytes of correct files only")
+
+    return 1 if any(result['corrupt'] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
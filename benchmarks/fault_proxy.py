@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+"""
+HTTP proxy that injects network and server faults between the client and an upstream server, normally the mock ECMWF
+API server. The Host header of the client is passed on, so links generated by the mock server point back at the proxy.
+
+Faults are described by a profile, a dictionary with the following keys:
+- paths: which requests are affected, one of [data, api, all]. Data requests are the result downloads.
+- reset_rate: fraction of the responses that are cut off halfway through the body by a connection reset
+- stall_rate, stall_seconds: fraction of the responses that are delayed, and the delay
+- truncate_rate: fraction of the responses of which only the first half of the body is sent, with a matching
+  Content-Length, so the response looks complete
+- wrong_range_rate: fraction of the range responses that contain a different range of the same length than requested,
+  announced by the Content-Range header
+- error_rate, error_burst: fraction of the requests that start a burst of 503 responses, and the length of a burst
+- bandwidth: maximum number of bytes per second per response, no limit if zero
+
+A scenario script is a list of [start second, profile] phases, applied in order from the moment the script is started.
+
+Usage: python -m benchmarks.fault_proxy --upstream http://127.0.0.1:8080 [--port PORT] [--profile NAME]
+"""
+
+import argparse
+import http.client
+import http.server
+import json
+import random
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+
+
+default_profile = {
+    'paths': 'data',
+    'reset_rate': 0.0,
+    'stall_rate': 0.0,
+    'stall_seconds': 0.0,
+    'truncate_rate': 0.0,
+    'wrong_range_rate': 0.0,
+    'error_rate': 0.0,
+    'error_burst': 1,
+    'bandwidth': 0
+}
+
+# Named fault profiles and scenario scripts
+profiles = {
+    'clean': {},
+    'resets': {'reset_rate': 0.2},
+    'stalls': {'stall_rate': 0.2, 'stall_seconds': 1.5},
+    'stall_timeouts': {'stall_rate': 0.1, 'stall_seconds': 35},
+    'truncated_ranges': {'truncate_rate': 0.1},
+    'wrong_content_range': {'wrong_range_rate': 0.1},
+    'data_server_errors': {'error_rate': 0.05, 'error_burst': 3},
+    'api_server_errors': {'paths': 'api', 'error_rate': 0.1, 'error_burst': 2},
+    'slow_network': {'bandwidth': 1048576},
+}
+
+scripts = {
+    'bandwidth_collapse': [[0, {}], [0.2, {'bandwidth': 262144}], [2, {}]],
+    'flaky_then_clean': [[0, {'reset_rate': 0.3, 'stall_rate': 0.1, 'stall_seconds': 1}], [3, {}]],
+}
+
+
+def make_profile(profile):
+    """
+    :param profile: name of a profile or a dictionary with the faults
+    :return: complete profile dictionary
+    """
+
+    if isinstance(profile, str):
+        try:
+            profile = profiles[profile]
+
+        except KeyError:
+            raise ValueError("Unknown fault profile %s" % profile)
+
+    unknown = set(profile) - set(default_profile)
+    if unknown:
+        raise ValueError("Unknown fault settings: %s" % ', '.join(sorted(unknown)))
+
+    result = dict(default_profile)
+    result.update(profile)
+
+    if result['paths'] not in ('data', 'api', 'all'):
+        raise ValueError("The paths of a fault profile should be one of data, api, all")
+
+    return result
+
+
+class FaultProxy:
+    """
+    Fault injecting HTTP proxy, running in a background thread
+    """
+
+    def __init__(self, upstream, host='127.0.0.1', port=0, profile='clean', seed=None):
+        """
+        Initialise the proxy
+
+        :param upstream: URL of the upstream server, for example http://127.0.0.1:8080
+        :param host: address to listen on
+        :param port: port to listen on, a free port is selected if zero
+        :param profile: name of a profile or a dictionary with the faults to inject
+        :param seed: seed of the random generator deciding which faults are injected
+        """
+
+        parts = urllib.parse.urlsplit(upstream)
+        self.upstream_host = parts.hostname
+        self.upstream_port = parts.port or 80
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._profile = make_profile(profile)
+        self._burst_remaining = 0
+        self._script_thread = None
+        self._script_stop = threading.Event()
+
+        self.statistics = {'requests': 0, 'resets': 0, 'stalls': 0, 'truncated': 0, 'wrong_ranges': 0,
+                           'server_errors': 0}
+
+        self._server = _ThreadingHttpServer((host, port), _ProxyHandler)
+        self._server.proxy = self
+        self._thread = None
+
+    @property
+    def url(self):
+        """
+        :return: base URL of the proxy, which replaces the host of the upstream server in URLs
+        """
+
+        return 'http://%s:%s' % self._server.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='FaultProxy', daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+        self._script_stop.set()
+
+        self._server.shutdown()
+        self._server.server_close()
+
+        if self._thread is not None:
+            self._thread.join()
+
+    def set_profile(self, profile):
+        """
+        Replace the active fault profile
+
+        :param profile: name of a profile or a dictionary with the faults to inject
+        """
+
+        profile = make_profile(profile)
+
+        with self._lock:
+            self._profile = profile
+            self._burst_remaining = 0
+
+    def run_script(self, script):
+        """
+        Apply the phases of a scenario script in the background, starting now
+
+        :param script: name of a script, or list of [start second, profile] phases
+        """
+
+        if isinstance(script, str):
+            script = scripts[script]
+
+        phases = [[start, make_profile(profile)] for [start, profile] in script]
+
+        def run():
+            start_time = time.time()
+
+            for [start, profile] in phases:
+                if self._script_stop.wait(max(start_time + start - time.time(), 0)):
+                    return
+
+                with self._lock:
+                    self._profile = profile
+                    self._burst_remaining = 0
+
+        self._script_stop.clear()
+        self._script_thread = threading.Thread(target=run, name='FaultProxyScript', daemon=True)
+        self._script_thread.start()
+
+    def choose_faults(self, is_data):
+        """
+        Decide which faults to inject in a response
+
+        :param is_data: whether the request is a result download
+        :return: dictionary with the selected faults, and the stall and bandwidth settings
+        """
+
+        with self._lock:
+            profile = self._profile
+            self.statistics['requests'] += 1
+
+            faults = {'bandwidth': profile['bandwidth'], 'stall': 0, 'error': False, 'reset': False,
+                      'truncate': False, 'wrong_range': False}
+
+            if profile['paths'] != 'all' and (profile['paths'] == 'data') != is_data:
+                return faults
+
+            if self._burst_remaining > 0:
+                self._burst_remaining -= 1
+                faults['error'] = True
+
+            elif self._random.random() < profile['error_rate']:
+                self._burst_remaining = profile['error_burst'] - 1
+                faults['error'] = True
+
+            if faults['error']:
+                self.statistics['server_errors'] += 1
+                return faults
+
+            if self._random.random() < profile['stall_rate']:
+                faults['stall'] = profile['stall_seconds']
+                self.statistics['stalls'] += 1
+
+            choice = self._random.random()
+
+            for [name, counter] in (['reset', 'resets'], ['truncate', 'truncated'], ['wrong_range', 'wrong_ranges']):
+                rate = profile['%s_rate' % name]
+
+                if choice < rate:
+                    faults[name] = True
+                    self.statistics[counter] += 1
+                    break
+
+                choice -= rate
+
+            return faults
+
+
+class _ThreadingHttpServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _ProxyHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._forward('GET')
+
+    def do_HEAD(self):
+        self._forward('HEAD')
+
+    def do_POST(self):
+        self._forward('POST')
+
+    def do_DELETE(self):
+        self._forward('DELETE')
+
+    def _forward(self, method):
+        proxy = self.server.proxy
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length > 0 else None
+
+        faults = proxy.choose_faults(urllib.parse.urlsplit(self.path).path.startswith('/data/'))
+
+        if faults['stall'] > 0:
+            time.sleep(faults['stall'])
+
+        if faults['error']:
+            return self._send(503, [['Content-Type', 'text/plain']], b'Service Unavailable', method)
+
+        # Forward the request, keeping the Host header of the client
+        connection = http.client.HTTPConnection(proxy.upstream_host, proxy.upstream_port, timeout=60)
+
+        try:
+            connection.putrequest(method, self.path, skip_host=True, skip_accept_encoding=True)
+            for [name, value] in self.headers.items():
+                if name.lower() not in ('connection', 'keep-alive', 'proxy-connection'):
+                    connection.putheader(name, value)
+            connection.endheaders(body)
+
+            response = connection.getresponse()
+            content = response.read()
+            status = response.status
+            headers = [[name, value] for [name, value] in response.getheaders()
+                       if name.lower() not in ('connection', 'keep-alive', 'transfer-encoding', 'content-length')]
+
+        except (OSError, http.client.HTTPException):
+            self.close_connection = True
+            return
+
+        finally:
+            connection.close()
+
+        if method == 'HEAD':
+            headers.append(['Content-Length', response.getheader('Content-Length', '0')])
+            return self._send(status, headers, b'', method, faults['bandwidth'])
+
+        if faults['reset'] and len(content) > 1:
+            return self._reset(status, headers, content)
+
+        if faults['truncate'] and len(content) > 1:
+            content = content[:len(content) // 2]
+
+        if faults['wrong_range'] and status == 206 and len(content) > 1:
+            content = self._shift_range(headers, content)
+
+        self._send(status, headers, content, method, faults['bandwidth'])
+
+    def _send(self, status, headers, content, method, bandwidth=0):
+        self.send_response(status)
+
+        has_length = False
+        for [name, value] in headers:
+            has_length = has_length or name.lower() == 'content-length'
+            self.send_header(name, value)
+
+        if not has_length:
+            self.send_header('Content-Length', str(len(content)))
+
+        self.end_headers()
+
+        if method != 'HEAD':
+            self._write_paced(content, bandwidth)
+
+    def _write_paced(self, content, bandwidth):
+        if bandwidth <= 0:
+            self.wfile.write(content)
+            return
+
+        start_time = time.time()
+        chunk_size = max(min(bandwidth // 10, 65536), 1024)
+
+        for offset in range(0, len(content), chunk_size):
+            self.wfile.write(content[offset:offset + chunk_size])
+
+            delay = (offset + chunk_size) / bandwidth - (time.time() - start_time)
+            if delay > 0:
+                time.sleep(delay)
+
+    def _reset(self, status, headers, content):
+        """
+        Announce the full body, send half of it and reset the connection
+        """
+
+        self.send_response(status)
+        for [name, value] in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+
+        self.wfile.write(content[:len(content) // 2])
+        self.wfile.flush()
+
+        # Linger with a zero timeout, so closing sends a reset instead of a regular shutdown
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.close_connection = True
+
+    @staticmethod
+    def _shift_range(headers, content):
+        """
+        Replace the body by a different range of the same length, and announce it in the Content-Range header
+        """
+
+        shift = len(content) // 3 or 1
+
+        for header in headers:
+            if header[0].lower() == 'content-range':
+                try:
+                    [unit, value] = header[1].split(' ', 1)
+                    [positions, total] = value.split('/', 1)
+                    [first, last] = [int(position) + shift for position in positions.split('-', 1)]
+                    header[1] = '%s %s-%s/%s' % (unit, first, last, total)
+
+                except ValueError:
+                    pass
+
+        return content[shift:] + content[:shift]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Fault injecting HTTP proxy")
+    parser.add_argument('--upstream', required=True, help="URL of the upstream server")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on")
+    parser.add_argument('--port', type=int, default=8081, help="port to listen on")
+    parser.add_argument('--profile', default='clean',
+                        help="fault profile or script, one of %s" % ', '.join(sorted(profiles) + sorted(scripts)))
+    parser.add_argument('--profile-file', help="JSON file with a fault profile dictionary or a scenario script list")
+    parser.add_argument('--seed', type=int, default=None, help="seed of the fault injection")
+    arguments = parser.parse_args()
+
+    proxy = FaultProxy(arguments.upstream, arguments.host, arguments.port, seed=arguments.seed).start()
+
+    if arguments.profile_file:
+        with open(arguments.profile_file) as file:
+            profile = json.load(file)
+
+    else:
+        profile = arguments.profile
+
+    try:
+        if isinstance(profile, list) or profile in scripts:
+            proxy.run_script(profile)
+        else:
+            proxy.set_profile(profile)
+
+    except (KeyError, ValueError) as e:
+        proxy.stop()
+        parser.error(str(e))
+
+    print("Proxying %s at %s, stop with Ctrl-C" % (arguments.upstream, proxy.url))
+
+    try:
+        while True:
+            time.sleep(3600)
+
+    except KeyboardInterrupt:
+        pass
+
+    proxy.stop()
+    print(json.dumps(proxy.statistics, indent=4))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,606 @@
+#!/usr/bin/env python
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+"""
+Benchmark harness with stored baselines. Runs micro benchmarks of the client against local stand-ins, stores the samples
+as a JSON baseline keyed by machine and commit, and compares runs. A metric is flagged as a regression when it became
+worse by more than the threshold and a permutation test on the samples shows that the difference is significant.
+
+Benchmarks:
+- block_download: custom_http download throughput per block size and thread count, from the mock API server
+- reassembly_memory: peak memory allocated while reassembling a parallel download
+- socket_round_trip: latency of a SocketConnection request and response through a SocketServer
+- command_throughput: background client commands per second handled by connection handlers over sockets
+- log_overhead: time per Log call in the logging thread
+- startup: time to import the package and the background client in a new interpreter
+
+Usage: python -m benchmarks.harness run [--benchmarks LIST] [--repeat N] [--quick] [--save] [--compare [COMMIT]]
+       python -m benchmarks.harness compare BASELINE CURRENT
+       python -m benchmarks.harness list
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import queue
+import random
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+# The background client packages are imported relative to the ecmwfapi directory
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'ecmwfapi'))
+
+from background_client.connection_handler import ConnectionHandler
+from background_client.socket_communication import SocketConnection, SocketServer
+from background_client.task_registry import TaskRegistry
+from background_client.task_scheduler import TaskScheduler
+from ecmwfapi import custom_http
+from ecmwfapi.log import Log
+
+from .mock_server import MockApiServer
+
+
+root_directory = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+default_baseline_directory = os.path.join(root_directory, 'benchmarks', 'baselines')
+
+# Benchmark functions by name, registered with the benchmark decorator
+benchmarks = {}
+
+
+def benchmark(function):
+    benchmarks[function.__name__] = function
+    return function
+
+
+class NullLog:
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class Results:
+    """
+    Samples of the metrics of a benchmark run
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, name, value, unit, better):
+        """
+        :param name: name of the metric
+        :param value: sample value
+        :param unit: unit of the metric
+        :param better: whether higher or lower values are better, one of [higher, lower]
+        """
+
+        metric = self.metrics.setdefault(name, {'unit': unit, 'better': better, 'samples': []})
+        metric['samples'].append(value)
+
+
+@benchmark
+def block_download(results, repeat, quick):
+
+    file_size = 8388608 if quick else 33554432
+    block_sizes = [262144, 1048576] if quick else [262144, 1048576, 4194304]
+    thread_counts = [1, 4] if quick else [1, 4, 8]
+
+    # The digests of the mock server would dominate the measurement
+    server = MockApiServer(file_size=file_size, digests=False).start()
+
+    try:
+        name = server.submit({})
+        url = '%s/data/%s' % (server.url.rsplit('/', 1)[0], name)
+
+        for block_size in block_sizes:
+            for threads in thread_counts:
+                for _ in range(repeat):
+                    with open(os.devnull, 'wb') as file, contextlib.redirect_stdout(io.StringIO()):
+                        start_time = time.perf_counter()
+
+                        if threads == 1:
+                            custom_http.robust_get_file(url, file, block_size)
+                        else:
+                            custom_http.robust_get_file_parallel(url, file, block_size, threads=threads)
+
+                        elapsed = time.perf_counter() - start_time
+
+                    results.add('throughput_%sk_%st' % (block_size // 1024, threads), file_size / elapsed / 1048576,
+                                'MB/s', 'higher')
+
+    finally:
+        server.stop()
+
+
+@benchmark
+def reassembly_memory(results, repeat, quick):
+
+    file_size = 16777216 if quick else 67108864
+    server = MockApiServer(file_size=file_size, digests=False).start()
+
+    try:
+        name = server.submit({})
+        url = '%s/data/%s' % (server.url.rsplit('/', 1)[0], name)
+
+        for _ in range(repeat):
+            with open(os.devnull, 'wb') as file, contextlib.redirect_stdout(io.StringIO()):
+                tracemalloc.start()
+
+                try:
+                    custom_http.robust_get_file_parallel(url, file, 1048576, threads=8)
+                    peak = tracemalloc.get_traced_memory()[1]
+
+                finally:
+                    tracemalloc.stop()
+
+            results.add('peak_memory', peak / 1048576, 'MB', 'lower')
+
+    finally:
+        server.stop()
+
+
+def _start_socket_server():
+    """
+    Start a socket server on a free port
+
+    :return: tuple with the server, its thread, its port and the queue in which it places new connections
+    """
+
+    server = SocketServer('127.0.0.1', 0)
+    port = server.connection.getsockname()[1]
+    connection_queue = queue.Queue()
+
+    thread = threading.Thread(target=server.run, args=(connection_queue,), daemon=True)
+    thread.start()
+
+    return server, thread, port, connection_queue
+
+
+def _stop_socket_server(server, thread):
+    server.stop()
+    thread.join()
+    server.shutdown()
+
+
+@benchmark
+def socket_round_trip(results, repeat, quick):
+
+    [server, server_thread, port, connection_queue] = _start_socket_server()
+
+    def echo():
+        while True:
+            connection = connection_queue.get()
+            if connection is None:
+                return
+
+            connection.send(connection.receive())
+            connection.close()
+
+    thread = threading.Thread(target=echo, daemon=True)
+    thread.start()
+
+    message = json.dumps({'command': 'list_active_transfers', 'data': {'limit': 50}})
+    count = 200 if quick else 1000
+
+    try:
+        for _ in range(repeat):
+            latencies = []
+
+            for _ in range(count):
+                start_time = time.perf_counter()
+
+                connection = SocketConnection('127.0.0.1', port)
+                connection.send(message)
+                connection.receive()
+                connection.close()
+
+                latencies.append(time.perf_counter() - start_time)
+
+            latencies.sort()
+            results.add('latency_p50', latencies[len(latencies) // 2] * 1000000, 'us', 'lower')
+            results.add('latency_p99', latencies[int(len(latencies) * 0.99)] * 1000000, 'us', 'lower')
+
+    finally:
+        connection_queue.put(None)
+        thread.join()
+        _stop_socket_server(server, server_thread)
+
+
+@benchmark
+def command_throughput(results, repeat, quick):
+
+    [server, server_thread, port, connection_queue] = _start_socket_server()
+
+    registry = TaskRegistry()
+    scheduler = TaskScheduler(0)
+    handlers = [ConnectionHandler(NullLog(), connection_queue, ['127.0.0.1'], registry, scheduler, lambda: None)
+                for _ in range(4)]
+
+    for handler in handlers:
+        handler.start()
+
+    duration = 1 if quick else 3
+    clients = 8
+
+    def client(stop, counts, index):
+        generator = random.Random(index)
+
+        while not stop.is_set():
+            if generator.random() < 0.2:
+                command = {'command': 'add_transfer', 'data': {'transfer_data': {'target': 'benchmark'},
+                                                               'owner': 'owner%s' % index}}
+            else:
+                command = {'command': 'list_active_transfers', 'data': {'limit': 50}}
+
+            connection = SocketConnection('127.0.0.1', port)
+            connection.send(json.dumps(command))
+            connection.receive()
+            connection.close()
+
+            counts[index] += 1
+
+    try:
+        for _ in range(repeat):
+            stop = threading.Event()
+            counts = [0] * clients
+            threads = [threading.Thread(target=client, args=(stop, counts, index)) for index in range(clients)]
+
+            start_time = time.perf_counter()
+            for thread in threads:
+                thread.start()
+
+            time.sleep(duration)
+            stop.set()
+
+            for thread in threads:
+                thread.join()
+
+            results.add('commands_per_second', sum(counts) / (time.perf_counter() - start_time), 'commands/s',
+                        'higher')
+
+    finally:
+        for _ in handlers:
+            connection_queue.put(None)
+
+        for handler in handlers:
+            handler.join()
+
+        _stop_socket_server(server, server_thread)
+
+
+@benchmark
+def log_overhead(results, repeat, quick):
+
+    count = 10000 if quick else 50000
+
+    for [name, settings] in (['async', {}], ['sync', {'asynchronous': False}],
+                             ['hidden', {'display_info_messages': False}]):
+        for _ in range(repeat):
+            log = Log(repeat_interval=0, queue_size=count + 1, **settings)
+
+            with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+                start_time = time.perf_counter()
+
+                for index in range(count):
+                    log.info("Benchmark message %s" % index)
+
+                elapsed = time.perf_counter() - start_time
+                log.flush()
+
+            results.add('%s_call' % name, elapsed / count * 1000000, 'us', 'lower')
+
+
+@benchmark
+def startup(results, repeat, quick):
+
+    statements = {
+        'import_ecmwfapi': 'import ecmwfapi',
+        'import_background_client': "import sys; sys.path.insert(0, 'ecmwfapi'); import ECMWFBackgroundClient",
+    }
+
+    for [name, statement] in statements.items():
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            subprocess.check_call([sys.executable, '-c', statement], cwd=root_directory)
+            results.add(name, (time.perf_counter() - start_time) * 1000, 'ms', 'lower')
+
+
+def get_machine_id():
+    """
+    :return: identifier of the machine, from the host name, the platform and the processor
+    """
+
+    description = '%s|%s|%s|%s' % (platform.node(), platform.platform(), platform.processor(), os.cpu_count())
+    return '%s-%s' % (platform.node() or 'unknown', hashlib.sha1(description.encode('utf-8')).hexdigest()[:8])
+
+
+def get_commit():
+    """
+    :return: short hash of the checked out commit, suffixed with -dirty if there are uncommitted changes
+    """
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=root_directory,
+                                         stderr=subprocess.DEVNULL).decode('utf-8').strip()
+        changes = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                          cwd=root_directory, stderr=subprocess.DEVNULL).decode('utf-8').strip()
+
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+    return commit + ('-dirty' if changes else '')
+
+
+def run(selected, repeat, quick):
+    """
+    Run the selected benchmarks
+
+    :return: run dictionary with the metrics per benchmark
+    """
+
+    run_results = {
+        'machine': get_machine_id(),
+        'commit': get_commit(),
+        'created': time.time(),
+        'python': platform.python_version(),
+        'repeat': repeat,
+        'quick': quick,
+        'benchmarks': {},
+    }
+
+    for name in selected:
+        print("Running %s" % name, file=sys.stderr)
+
+        results = Results()
+        benchmarks[name](results, repeat, quick)
+        run_results['benchmarks'][name] = results.metrics
+
+    return run_results
+
+
+def permutation_p_value(first, second, permutations=2000, seed=0):
+    """
+    Two-sided permutation test on the difference of the means of two samples
+
+    :return: probability of a difference at least as large as observed if both samples come from the same distribution
+    """
+
+    observed = abs(sum(first) / len(first) - sum(second) / len(second))
+    combined = list(first) + list(second)
+    generator = random.Random(seed)
+    extreme = 0
+
+    for _ in range(permutations):
+        generator.shuffle(combined)
+        left = combined[:len(first)]
+        right = combined[len(first):]
+
+        if abs(sum(left) / len(left) - sum(right) / len(right)) >= observed - 1e-12:
+            extreme += 1
+
+    return (extreme + 1) / (permutations + 1)
+
+
+def compare(baseline, current, threshold=0.1, alpha=0.05):
+    """
+    Compare the metrics of two runs
+
+    :param baseline: run dictionary of the baseline
+    :param current: run dictionary of the current run
+    :param threshold: minimum relative change to consider
+    :param alpha: significance level of the permutation test
+    :return: list of [benchmark, metric, baseline mean, current mean, relative change, p-value, verdict]
+    """
+
+    comparisons = []
+
+    for [name, metrics] in sorted(current['benchmarks'].items()):
+        for [metric, values] in sorted(metrics.items()):
+            try:
+                baseline_samples = baseline['benchmarks'][name][metric]['samples']
+
+            except KeyError:
+                continue
+
+            samples = values['samples']
+            baseline_mean = sum(baseline_samples) / len(baseline_samples)
+            mean = sum(samples) / len(samples)
+            change = (mean - baseline_mean) / baseline_mean if baseline_mean else 0.0
+
+            # Positive when the metric became worse
+            worse = change if values['better'] == 'lower' else -change
+
+            if min(len(samples), len(baseline_samples)) < 2:
+                p_value = None
+            else:
+                p_value = permutation_p_value(baseline_samples, samples)
+
+            verdict = 'ok'
+            if abs(change) > threshold and p_value is not None and p_value < alpha:
+                verdict = 'regression' if worse > 0 else 'improvement'
+
+            comparisons.append([name, metric, baseline_mean, mean, change, p_value, verdict])
+
+    return comparisons
+
+
+def baseline_path(directory, machine, commit):
+    return os.path.join(directory, machine, '%s.json' % commit)
+
+
+def find_baseline(directory, machine, commit=None, exclude=None):
+    """
+    Find a stored baseline of the machine
+
+    :param commit: commit of the baseline, the most recent baseline is used if None
+    :param exclude: commit to skip when selecting the most recent baseline
+    :return: path of the baseline, or None
+    """
+
+    if commit is not None:
+        path = baseline_path(directory, machine, commit)
+        return path if os.path.exists(path) else None
+
+    machine_directory = os.path.join(directory, machine)
+
+    try:
+        paths = [os.path.join(machine_directory, name) for name in os.listdir(machine_directory)
+                 if name.endswith('.json') and name[:-5] != exclude]
+
+    except OSError:
+        return None
+
+    return max(paths, key=os.path.getmtime) if paths else None
+
+
+def load_run(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def print_run(run_results):
+    print("Machine %s, commit %s, %s repetitions" % (run_results['machine'], run_results['commit'],
+                                                    run_results['repeat']))
+    print('-' * 90)
+    print('%-22s%-30s%-14s%-14s%-10s' % ('Benchmark', 'Metric', 'Mean', 'Min', 'Unit'))
+    print('-' * 90)
+    for [name, metrics] in sorted(run_results['benchmarks'].items()):
+        for [metric, values] in sorted(metrics.items()):
+            samples = values['samples']
+            print('%-22s%-30s%-14.4g%-14.4g%-10s' % (name, metric, sum(samples) / len(samples), min(samples),
+                                                      values['unit']))
+    print('-' * 90)
+
+
+def print_comparison(comparisons, baseline, current):
+    print("Baseline %s (%s) against %s (%s)" % (baseline['commit'], baseline['machine'], current['commit'],
+                                                current['machine']))
+    print('-' * 110)
+    print('%-22s%-30s%-14s%-14s%-10s%-10s%-10s' % ('Benchmark', 'Metric', 'Baseline', 'Current', 'Change', 'p',
+                                                   'Verdict'))
+    print('-' * 110)
+    for [name, metric, baseline_mean, mean, change, p_value, verdict] in comparisons:
+        print('%-22s%-30s%-14.4g%-14.4g%-10s%-10s%-10s'
+              % (name, metric, baseline_mean, mean, '%+.1f%%' % (change * 100),
+                 '-' if p_value is None else '%.3f' % p_value, verdict.upper() if verdict == 'regression' else verdict))
+    print('-' * 110)
+
+
+def main():
+
+    # Options shared by all actions
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--baseline-directory', default=default_baseline_directory,
+                        help="directory of the stored baselines")
+    common.add_argument('--machine', default=None, help="machine identifier, determined automatically by default")
+
+    parser = argparse.ArgumentParser(description="Benchmark harness with stored baselines")
+    subparsers = parser.add_subparsers(dest='action')
+
+    run_parser = subparsers.add_parser('run', help="run benchmarks", parents=[common])
+    run_parser.add_argument('--benchmarks', default=','.join(sorted(benchmarks)),
+                            help="comma separated benchmarks, from %s" % ', '.join(sorted(benchmarks)))
+    run_parser.add_argument('--repeat', type=int, default=5, help="number of samples per metric")
+    run_parser.add_argument('--quick', action='store_true', help="use smaller workloads")
+    run_parser.add_argument('--save', action='store_true', help="store the results as baseline of this commit")
+    run_parser.add_argument('--compare', nargs='?', const='', default=None, metavar='COMMIT',
+                            help="compare with the baseline of a commit, or with the most recent baseline")
+    run_parser.add_argument('--output', help="also write the results to this file")
+
+    compare_parser = subparsers.add_parser('compare', help="compare two stored result files", parents=[common])
+    compare_parser.add_argument('baseline', help="result file of the baseline")
+    compare_parser.add_argument('current', help="result file to compare")
+
+    subparsers.add_parser('list', help="list the benchmarks and the stored baselines of this machine", parents=[common])
+
+    for subparser in (run_parser, compare_parser):
+        subparser.add_argument('--threshold', type=float, default=0.1,
+                               help="minimum relative change to flag, default 0.1")
+        subparser.add_argument('--alpha', type=float, default=0.05, help="significance level, default 0.05")
+
+    arguments = parser.parse_args()
+
+    if arguments.action is None:
+        parser.print_help()
+        return 1
+
+    machine = arguments.machine or get_machine_id()
+
+    if arguments.action == 'list':
+        print("Benchmarks: %s" % ', '.join(sorted(benchmarks)))
+
+        machine_directory = os.path.join(arguments.baseline_directory, machine)
+        names = sorted(os.listdir(machine_directory)) if os.path.isdir(machine_directory) else []
+        print("Baselines of %s: %s" % (machine, ', '.join(name[:-5] for name in names) or 'none'))
+        return 0
+
+    if arguments.action == 'compare':
+        baseline = load_run(arguments.baseline)
+        current = load_run(arguments.current)
+
+    else:
+        selected = [name.strip() for name in arguments.benchmarks.split(',') if name.strip()]
+        for name in selected:
+            if name not in benchmarks:
+                parser.error("Unknown benchmark %s" % name)
+
+        if arguments.repeat < 1:
+            parser.error("The number of repetitions should be positive")
+
+        current = run(selected, arguments.repeat, arguments.quick)
+        current['machine'] = machine
+        print_run(current)
+
+        if arguments.output:
+            with open(arguments.output, 'w') as file:
+                json.dump(current, file, indent=2)
+
+        if arguments.save:
+            path = baseline_path(arguments.baseline_directory, machine, current['commit'])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            with open(path, 'w') as file:
+                json.dump(current, file, indent=2)
+
+            print("Stored baseline %s" % path)
+
+        if arguments.compare is None:
+            return 0
+
+        path = find_baseline(arguments.baseline_directory, machine, arguments.compare or None, current['commit'])
+        if path is None:
+            print("No baseline found to compare with")
+            return 0
+
+        baseline = load_run(path)
+
+    comparisons = compare(baseline, current, arguments.threshold, arguments.alpha)
+    print_comparison(comparisons, baseline, current)
+
+    regressions = [item for item in comparisons if item[6] == 'regression']
+    if regressions:
+        print("%s significant regressions" % len(regressions))
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
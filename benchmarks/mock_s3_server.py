@@ -0,0 +1,527 @@
+#!/usr/bin/env python
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+"""
+Stand-in for an S3-compatible object store, to test and benchmark uploads to object storage offline. Implements the
+path-style requests used by the object store client: single object uploads, the multipart upload API (create, upload
+part, list parts, list uploads, complete and abort) and downloading objects. Objects are kept in memory.
+
+Requests are checked like S3 does: the AWS signature version 4 of every request, the Content-MD5 of uploads, and on
+completion the order, ETags and minimum size of the parts. Buckets are created on first use. Uploads of parts can be
+failed after a number of parts to simulate an interrupted transfer.
+
+Usage: python -m benchmarks.mock_s3_server [--port PORT] [--access-key KEY] [--secret-key SECRET] ...
+"""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import http.server
+import itertools
+import json
+import random
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
+
+
+class MockS3Server:
+    """
+    Mock S3-compatible object store, served by a thread
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, access_key='benchmark', secret_key='benchmark-secret',
+                 region='us-east-1', latency=0.0, error_rate=0.0, min_part_size=5242880, seed=None):
+        """
+        :param host: address to listen on
+        :param port: port to listen on, a free port is selected if zero
+        :param access_key: access key ID accepted by the server
+        :param secret_key: secret access key of the access key
+        :param region: region expected in the signatures
+        :param latency: number of seconds every response is delayed
+        :param error_rate: fraction of the requests that fail with HTTP status 500
+        :param min_part_size: minimum size of the parts of a multipart upload, except the last
+        :param seed: seed of the random generator deciding which requests fail
+        """
+
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.latency = latency
+        self.error_rate = error_rate
+        self.min_part_size = min_part_size
+
+        # Part uploads fail with an error once this number of parts has been uploaded, if not None
+        self.fail_after_parts = None
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._upload_ids = itertools.count(1)
+
+        # Objects by [bucket, key], and incomplete uploads by ID as dictionaries with the bucket, key, initiation time
+        # and the parts as [ETag, data] by part number
+        self.objects = {}
+        self.uploads = {}
+
+        self.statistics = {
+            'http_requests': 0,
+            'objects_put': 0,
+            'uploads_created': 0,
+            'parts_uploaded': 0,
+            'bytes_received': 0,
+            'uploads_completed': 0,
+            'uploads_aborted': 0,
+            'signature_errors': 0,
+            'errors_injected': 0,
+        }
+
+        self._server = _ThreadingHttpServer((host, port), _RequestHandler)
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def url(self):
+        """
+        :return: endpoint URL to configure in the client
+        """
+
+        return 'http://%s:%s' % self._server.server_address[:2]
+
+    def start(self):
+        """
+        Start serving in a background thread
+        """
+
+        self._thread = threading.Thread(target=self._server.serve_forever, name='MockS3Server', daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+        """
+        Stop serving and close the socket
+        """
+
+        self._server.shutdown()
+        self._server.server_close()
+
+        if self._thread is not None:
+            self._thread.join()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.statistics[name] += value
+
+    def inject_error(self):
+        """
+        :return: whether the current request should fail
+        """
+
+        if self.error_rate <= 0:
+            return False
+
+        with self._lock:
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.statistics['errors_injected'] += 1
+
+        return failed
+
+    def get_object(self, bucket, key):
+        """
+        :return: content of an object, or None if it does not exist
+        """
+
+        with self._lock:
+            return self.objects.get((bucket, key))
+
+    def verify_signature(self, method, path, query, headers, body):
+        """
+        Verify the AWS signature version 4 of a request
+
+        :return: None if the signature is valid, otherwise the reason it is not
+        """
+
+        authorization = headers.get('Authorization', '')
+        if not authorization.startswith('AWS4-HMAC-SHA256 '):
+            return "Missing signature"
+
+        fields = dict(item.strip().split('=', 1) for item in authorization[len('AWS4-HMAC-SHA256 '):].split(','))
+
+        try:
+            [access_key, date, region, service, terminator] = fields['Credential'].split('/')
+            signed_headers = fields['SignedHeaders'].split(';')
+            signature = fields['Signature']
+
+        except (KeyError, ValueError):
+            return "Malformed authorization header"
+
+        if access_key != self.access_key:
+            return "Unknown access key %s" % access_key
+
+        if region != self.region or service != 's3' or terminator != 'aws4_request':
+            return "Invalid credential scope"
+
+        payload_hash = headers.get('x-amz-content-sha256')
+        if payload_hash != hashlib.sha256(body).hexdigest():
+            return "The payload hash does not match the body"
+
+        canonical_query = '&'.join('%s=%s' % (urllib.parse.quote(name, safe='-_.~'),
+                                              urllib.parse.quote(value, safe='-_.~'))
+                                   for [name, value] in sorted(query))
+        canonical_headers = ''.join('%s:%s\n' % (name, (headers.get(name) or '').strip()) for name in signed_headers)
+
+        canonical_request = '\n'.join([method, urllib.parse.quote(path, safe='/~'), canonical_query, canonical_headers,
+                                       ';'.join(signed_headers), payload_hash])
+
+        amz_date = headers.get('x-amz-date', '')
+        scope = '/'.join([date, region, service, terminator])
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                                    hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+
+        key = ('AWS4' + self.secret_key).encode('utf-8')
+        for item in (date, region, service, terminator):
+            key = hmac.new(key, item.encode('utf-8'), hashlib.sha256).digest()
+
+        if not hmac.compare_digest(hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest(),
+                                   signature):
+            return "The signature does not match"
+
+        return None
+
+    def put_object(self, bucket, key, data):
+        with self._lock:
+            self.objects[(bucket, key)] = data
+            self.statistics['objects_put'] += 1
+            self.statistics['bytes_received'] += len(data)
+
+    def create_upload(self, bucket, key):
+        """
+        :return: ID of the new upload
+        """
+
+        with self._lock:
+            upload_id = 'upload-%s' % next(self._upload_ids)
+            self.uploads[upload_id] = {'bucket': bucket, 'key': key, 'initiated': time.time(), 'parts': {}}
+            self.statistics['uploads_created'] += 1
+
+        return upload_id
+
+    def upload_part(self, upload_id, part_number, data):
+        """
+        :return: ETag of the part, or None if part uploads are failing
+        """
+
+        with self._lock:
+            if self.fail_after_parts is not None and self.statistics['parts_uploaded'] >= self.fail_after_parts:
+                return None
+
+            etag = '"%s"' % hashlib.md5(data).hexdigest()
+            self.uploads[upload_id]['parts'][part_number] = [etag, data]
+            self.statistics['parts_uploaded'] += 1
+            self.statistics['bytes_received'] += len(data)
+
+        return etag
+
+    def complete_upload(self, upload_id, parts):
+        """
+        Assemble the object from the given parts
+
+        :param parts: list of [part number, ETag]
+        :return: None if completed, otherwise the reason the parts are invalid
+        """
+
+        with self._lock:
+            upload = self.uploads[upload_id]
+
+            if not parts:
+                return "No parts given"
+
+            numbers = [number for [number, _] in parts]
+            if numbers != sorted(set(numbers)):
+                return "The parts are not in ascending order"
+
+            data = []
+            for [index, [number, etag]] in enumerate(parts):
+                part = upload['parts'].get(number)
+
+                if part is None or part[0] != etag:
+                    return "Part %s was not uploaded or its ETag differs" % number
+
+                if index < len(parts) - 1 and len(part[1]) < self.min_part_size:
+                    return "Part %s is smaller than the minimum part size" % number
+
+                data.append(part[1])
+
+            self.objects[(upload['bucket'], upload['key'])] = b''.join(data)
+            del self.uploads[upload_id]
+            self.statistics['uploads_completed'] += 1
+
+        return None
+
+    def abort_upload(self, upload_id):
+        with self._lock:
+            if self.uploads.pop(upload_id, None) is not None:
+                self.statistics['uploads_aborted'] += 1
+
+
+class _ThreadingHttpServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def mock(self):
+        return self.server.mock
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_HEAD(self):
+        self._handle('HEAD')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def _handle(self, method):
+        """
+        Route a request to its operation, after verifying the signature and applying the latency and error injection
+        """
+
+        mock = self.mock
+        mock.count('http_requests')
+
+        # Read the request body first, so the connection stays usable
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length > 0 else b''
+
+        if mock.latency > 0:
+            time.sleep(mock.latency)
+
+        split = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.unquote(split.path)
+        query_items = urllib.parse.parse_qsl(split.query, keep_blank_values=True)
+        query = dict(query_items)
+
+        reason = mock.verify_signature(method, path, query_items, self.headers, body)
+        if reason is not None:
+            mock.count('signature_errors')
+            return self._send_error(403, 'SignatureDoesNotMatch', reason)
+
+        if mock.inject_error():
+            return self._send_error(500, 'InternalError', "Injected error")
+
+        [bucket, _, key] = path.lstrip('/').partition('/')
+
+        if not bucket:
+            return self._send_error(400, 'InvalidRequest', "No bucket given")
+
+        if not key:
+            if method == 'GET' and 'uploads' in query:
+                return self._list_uploads(bucket, query.get('prefix', ''))
+
+            return self._send_error(405, 'MethodNotAllowed', "Unsupported bucket operation")
+
+        upload_id = query.get('uploadId')
+
+        if upload_id is not None:
+            with mock._lock:
+                upload = mock.uploads.get(upload_id)
+
+            if upload is None or (upload['bucket'], upload['key']) != (bucket, key):
+                return self._send_error(404, 'NoSuchUpload', "Unknown upload %s" % upload_id)
+
+        if method == 'POST' and 'uploads' in query:
+            upload_id = mock.create_upload(bucket, key)
+            return self._send_xml(200, '<InitiateMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key>'
+                                       '<UploadId>%s</UploadId></InitiateMultipartUploadResult>'
+                                  % (bucket, key, upload_id))
+
+        if method == 'PUT':
+            if not self._check_md5(body):
+                return self._send_error(400, 'BadDigest', "The Content-MD5 does not match the body")
+
+            if upload_id is None:
+                mock.put_object(bucket, key, body)
+                return self._send_empty(200, {'ETag': '"%s"' % hashlib.md5(body).hexdigest()})
+
+            try:
+                part_number = int(query['partNumber'])
+
+            except (KeyError, ValueError):
+                return self._send_error(400, 'InvalidArgument', "Invalid part number")
+
+            etag = mock.upload_part(upload_id, part_number, body)
+            if etag is None:
+                return self._send_error(400, 'InjectedFailure', "Part uploads are failing")
+
+            return self._send_empty(200, {'ETag': etag})
+
+        if method == 'POST' and upload_id is not None:
+            try:
+                parts = [[int(_child_text(part, 'PartNumber')), _child_text(part, 'ETag')]
+                         for part in ElementTree.fromstring(body) if _local_name(part.tag) == 'Part']
+
+            except (ElementTree.ParseError, TypeError, ValueError):
+                return self._send_error(400, 'MalformedXML', "Invalid part list")
+
+            reason = mock.complete_upload(upload_id, parts)
+            if reason is not None:
+                return self._send_error(400, 'InvalidPart', reason)
+
+            etag = '"%s"' % hashlib.md5(mock.get_object(bucket, key)).hexdigest()
+            return self._send_xml(200, '<CompleteMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key>'
+                                       '<ETag>%s</ETag></CompleteMultipartUploadResult>' % (bucket, key, etag))
+
+        if method == 'GET' and upload_id is not None:
+            return self._list_parts(upload_id, int(query.get('part-number-marker') or 0),
+                                    int(query.get('max-parts') or 1000))
+
+        if method == 'DELETE' and upload_id is not None:
+            mock.abort_upload(upload_id)
+            return self._send_empty(204)
+
+        if method in ('GET', 'HEAD'):
+            data = mock.get_object(bucket, key)
+            if data is None:
+                return self._send_error(404, 'NoSuchKey', "Unknown key %s" % key)
+
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('ETag', '"%s"' % hashlib.md5(data).hexdigest())
+            self.end_headers()
+
+            if method == 'GET':
+                self.wfile.write(data)
+
+            return
+
+        return self._send_error(405, 'MethodNotAllowed', "Unsupported operation %s %s" % (method, path))
+
+    def _list_parts(self, upload_id, marker, max_parts):
+        with self.mock._lock:
+            parts = sorted((number, part[0], len(part[1])) for [number, part] in
+                           self.mock.uploads[upload_id]['parts'].items() if number > marker)
+
+        truncated = len(parts) > max_parts
+        parts = parts[:max_parts]
+
+        content = ''.join('<Part><PartNumber>%s</PartNumber><ETag>%s</ETag><Size>%s</Size></Part>' % part
+                          for part in parts)
+        if truncated:
+            content += '<NextPartNumberMarker>%s</NextPartNumberMarker>' % parts[-1][0]
+
+        self._send_xml(200, '<ListPartsResult><UploadId>%s</UploadId><IsTruncated>%s</IsTruncated>%s</ListPartsResult>'
+                       % (upload_id, 'true' if truncated else 'false', content))
+
+    def _list_uploads(self, bucket, prefix):
+        with self.mock._lock:
+            uploads = sorted((upload['initiated'], upload_id, upload['key']) for [upload_id, upload] in
+                             self.mock.uploads.items() if upload['bucket'] == bucket and upload['key'].startswith(prefix))
+
+        content = ''.join('<Upload><Key>%s</Key><UploadId>%s</UploadId><Initiated>%s</Initiated></Upload>'
+                          % (key, upload_id, time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(initiated)) +
+                             '.%03dZ' % (initiated % 1 * 1000))
+                          for [initiated, upload_id, key] in uploads)
+
+        self._send_xml(200, '<ListMultipartUploadsResult><Bucket>%s</Bucket>%s</ListMultipartUploadsResult>'
+                       % (bucket, content))
+
+    def _check_md5(self, body):
+        digest = self.headers.get('Content-MD5')
+
+        return digest is None or digest == base64.b64encode(hashlib.md5(body).digest()).decode('ascii')
+
+    def _send_xml(self, code, content):
+        data = ('<?xml version="1.0" encoding="UTF-8"?>\n' + content).encode('utf-8')
+
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+
+        self.wfile.write(data)
+
+    def _send_empty(self, code, headers=None):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        for [name, value] in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def _send_error(self, code, error_code, message):
+        self._send_xml(code, '<Error><Code>%s</Code><Message>%s</Message></Error>' % (error_code, message))
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _child_text(element, name):
+    for child in element:
+        if _local_name(child.tag) == name:
+            return child.text
+
+    return None
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Mock S3-compatible object store")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on")
+    parser.add_argument('--port', type=int, default=9000, help="port to listen on")
+    parser.add_argument('--access-key', default='benchmark', help="access key ID accepted by the server")
+    parser.add_argument('--secret-key', default='benchmark-secret', help="secret access key")
+    parser.add_argument('--latency', type=float, default=0, help="seconds every response is delayed")
+    parser.add_argument('--error-rate', type=float, default=0, help="fraction of requests that fail")
+    parser.add_argument('--seed', type=int, default=None, help="seed of the error injection")
+    arguments = parser.parse_args()
+
+    server = MockS3Server(arguments.host, arguments.port, arguments.access_key, arguments.secret_key,
+                          latency=arguments.latency, error_rate=arguments.error_rate, seed=arguments.seed)
+    server.start()
+
+    print("Serving the mock object store at %s, stop with Ctrl-C" % server.url)
+
+    try:
+        while True:
+            time.sleep(3600)
+
+    except KeyboardInterrupt:
+        pass
+
+    server.stop()
+    print(json.dumps(server.statistics, indent=4))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
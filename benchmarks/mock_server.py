@@ -0,0 +1,500 @@
+#!/usr/bin/env python
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+"""
+Stand-in for the ECMWF web API, to benchmark the client offline and reproducibly. Implements the endpoints used by the
+API connection: who-am-i, news, submitting a request, polling its status, deleting it and downloading the result with
+ranged GET requests. Requests are queued and active for a configurable period, responses are delayed by a fixed latency
+and result downloads are limited to a bandwidth per connection. A fraction of the requests can be failed by closing the
+connection without a response.
+
+The result of a request is generated on the fly and only depends on the offset, see expected_data. The size of a result
+is the file size of the server, unless the request contains a mock_file_size parameter.
+
+Usage: python -m benchmarks.mock_server [--port PORT] [--queue-delay SECONDS] [--bandwidth BYTES] ...
+"""
+
+import argparse
+import base64
+import hashlib
+import http.server
+import itertools
+import json
+import random
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+
+
+# Pattern the result data is generated from. Its length is not a power of two, so blocks at different offsets differ.
+_PATTERN = bytes((index * 7 + 13) % 251 for index in range(65521))
+
+
+def expected_data(start, end):
+    """
+    Get the result data the server sends for a byte range
+
+    :param start: offset of the first byte
+    :param end: offset after the last byte
+    :return: bytes of the range
+    """
+
+    length = len(_PATTERN)
+    chunks = []
+
+    while start < end:
+        offset = start % length
+        size = min(length - offset, end - start)
+        chunks.append(_PATTERN[offset:offset + size])
+        start += size
+
+    return b''.join(chunks)
+
+
+class MockApiServer:
+    """
+    Mock ECMWF API server, running in a background thread
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, queue_delay=0.0, active_delay=0.0, poll_interval=1, latency=0.0,
+                 bandwidth=0, error_rate=0.0, file_size=10485760, full_name='Benchmark User', news='', seed=None,
+                 digests=True):
+        """
+        Initialise the server
+
+        :param host: address to listen on
+        :param port: port to listen on, a free port is selected if zero
+        :param queue_delay: number of seconds a request is queued after it has been submitted
+        :param active_delay: number of seconds a request is active before it is complete
+        :param poll_interval: number of seconds the client is asked to wait between status polls, sent as retry-after
+        :param latency: number of seconds every response is delayed
+        :param bandwidth: maximum number of bytes per second sent per result download, no limit if zero
+        :param error_rate: fraction of the requests that are failed by closing the connection without a response
+        :param file_size: size in bytes of the results
+        :param full_name: name reported by who-am-i
+        :param news: news reported by the news endpoint
+        :param seed: seed of the random generator deciding which requests fail
+        :param digests: whether to announce the MD5 digest of results as ETag, and of ranges as Content-MD5
+        """
+
+        self.queue_delay = queue_delay
+        self.active_delay = active_delay
+        self.poll_interval = poll_interval
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.file_size = file_size
+        self.full_name = full_name
+        self.news = news
+        self.digests = digests
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._request_ids = itertools.count(1)
+
+        # Submitted requests by name, as dictionaries with the submit time and result size
+        self._requests = {}
+
+        self.statistics = {
+            'http_requests': 0,
+            'submitted': 0,
+            'deleted': 0,
+            'blocks': 0,
+            'bytes_sent': 0,
+            'errors_injected': 0
+        }
+
+        self._server = _ThreadingHttpServer((host, port), _RequestHandler)
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def url(self):
+        """
+        :return: API URL to configure in the client
+        """
+
+        return 'http://%s:%s/v1' % self._server.server_address[:2]
+
+    def start(self):
+        """
+        Start serving in a background thread
+        """
+
+        self._thread = threading.Thread(target=self._server.serve_forever, name='MockApiServer', daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+        """
+        Stop serving and close the socket
+        """
+
+        self._server.shutdown()
+        self._server.server_close()
+
+        if self._thread is not None:
+            self._thread.join()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.statistics[name] += value
+
+    def inject_error(self):
+        """
+        :return: whether the current request should fail
+        """
+
+        if self.error_rate <= 0:
+            return False
+
+        with self._lock:
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.statistics['errors_injected'] += 1
+
+        return failed
+
+    def submit(self, payload):
+        """
+        Register a new request
+
+        :param payload: request parameters
+        :return: name of the request
+        """
+
+        try:
+            file_size = int(payload.get('mock_file_size', self.file_size))
+
+        except (AttributeError, ValueError):
+            file_size = self.file_size
+
+        with self._lock:
+            name = 'mock-%s' % next(self._request_ids)
+            self._requests[name] = self.create_request(payload, file_size)
+            self.statistics['submitted'] += 1
+
+        return name
+
+    def create_request(self, payload, file_size):
+        """
+        Create the state of a submitted request. Called with the lock held.
+
+        :param payload: request parameters
+        :param file_size: size of the result in bytes
+        :return: dictionary with the submit time, the result size and the number of seconds the request is queued and
+            active
+        """
+
+        return {'submitted': time.time(), 'size': file_size, 'queue_delay': self.queue_delay,
+                'active_delay': self.active_delay}
+
+    def get_request(self, name):
+        with self._lock:
+            return self._requests.get(name)
+
+    def delete(self, name):
+        with self._lock:
+            self.statistics['deleted'] += 1
+            return self._requests.pop(name, None) is not None
+
+    def status(self, request):
+        """
+        :param request: request as registered by submit
+        :return: status of the request, in [queued, active, complete]
+        """
+
+        elapsed = time.time() - request['submitted']
+
+        if elapsed < request['queue_delay']:
+            return 'queued'
+
+        if elapsed < request['queue_delay'] + request['active_delay']:
+            return 'active'
+
+        return 'complete'
+
+    def retry_after(self, request):
+        """
+        :param request: request as registered by submit
+        :return: number of seconds the client is asked to wait before polling the status again
+        """
+
+        return self.poll_interval
+
+    def result_delay(self, request, start):
+        """
+        :param request: request as registered by submit
+        :param start: offset of the requested range
+        :return: number of seconds to wait before sending a range of the result
+        """
+
+        return 0
+
+    def fail_result(self, request, start):
+        """
+        :param request: request as registered by submit
+        :param start: offset of the requested range
+        :return: whether to fail the download of a range of the result
+        """
+
+        return False
+
+
+class _ThreadingHttpServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def mock(self):
+        return self.server.mock
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_HEAD(self):
+        self._handle('HEAD')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def _handle(self, method):
+        """
+        Route a request to its endpoint, after applying the latency and the error injection
+        """
+
+        mock = self.mock
+        mock.count('http_requests')
+
+        # Read the request body first, so the connection stays usable
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length > 0 else b''
+
+        if mock.latency > 0:
+            time.sleep(mock.latency)
+
+        if mock.inject_error():
+            self.close_connection = True
+            return
+
+        # The client appends the message offset as a query string, prefixed by a slash
+        path = urllib.parse.urlsplit(self.path).path.rstrip('/')
+        parts = path.strip('/').split('/')
+
+        if parts[:1] == ['data'] and len(parts) == 2 and method in ('GET', 'HEAD'):
+            return self._send_result(parts[1], method)
+
+        if parts[:1] != ['v1']:
+            return self._send_json(404, {'error': "Unknown path %s" % path})
+
+        if parts[1:] == ['who-am-i'] and method == 'GET':
+            return self._send_json(200, {'uid': 'benchmark', 'full_name': mock.full_name})
+
+        if len(parts) == 4 and parts[1] == 'datasets' and parts[3] == 'news' and method == 'GET':
+            return self._send_json(200, {'news': mock.news})
+
+        if len(parts) == 4 and parts[1] == 'datasets' and parts[3] == 'requests' and method == 'POST':
+            try:
+                payload = json.loads(body.decode('utf-8'))
+
+            except ValueError:
+                return self._send_json(400, {'error': "Invalid request payload"})
+
+            name = mock.submit(payload)
+            request = mock.get_request(name)
+            location = '%s/%s' % (self._base_url(), '/'.join(parts + [name]))
+
+            return self._send_json(202, {'name': name, 'status': mock.status(request)},
+                                   {'Location': location, 'Retry-After': str(mock.retry_after(request))})
+
+        if len(parts) == 5 and parts[1] == 'datasets' and parts[3] == 'requests':
+            name = parts[4]
+
+            if method == 'DELETE':
+                mock.delete(name)
+                return self._send_json(200, {})
+
+            request = mock.get_request(name)
+            if request is None:
+                return self._send_json(404, {'error': "Unknown request %s" % name})
+
+            status = mock.status(request)
+            content = {'name': name, 'status': status}
+
+            if status == 'complete':
+                content['href'] = '%s/data/%s' % (self._base_url(), name)
+                content['size'] = request['size']
+                return self._send_json(200, content)
+
+            # The client takes the location of every 202 response as the address to poll
+            return self._send_json(202, content, {'Location': '%s%s' % (self._base_url(), path),
+                                                  'Retry-After': str(mock.retry_after(request))})
+
+        return self._send_json(404, {'error': "Unknown endpoint %s %s" % (method, path)})
+
+    def _base_url(self):
+        """
+        URL the client reached the server at, so locations and result links pass through the same proxy
+        """
+
+        host = self.headers.get('Host')
+        if host:
+            return 'http://%s' % host
+
+        return 'http://%s:%s' % self.server.server_address[:2]
+
+    def _send_json(self, code, content, headers=None):
+        data = json.dumps(content).encode('utf-8')
+
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for [name, value] in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        self.wfile.write(data)
+
+    def _send_result(self, name, method):
+        """
+        Send (a range of) the result of a request
+        """
+
+        request = self.mock.get_request(name)
+        if request is None:
+            return self._send_json(404, {'error': "Unknown result %s" % name})
+
+        size = request['size']
+        start = 0
+        end = size
+
+        range_header = self.headers.get('Range')
+        if range_header is not None:
+            try:
+                [first, last] = range_header.split('=', 1)[1].split('-', 1)
+                start = int(first)
+                end = min(int(last) + 1, size) if last else size
+
+            except (IndexError, ValueError):
+                return self._send_json(416, {'error': "Invalid range %s" % range_header})
+
+        if method == 'GET':
+            delay = self.mock.result_delay(request, start)
+            if delay > 0:
+                time.sleep(delay)
+
+            if self.mock.fail_result(request, start):
+                self.mock.count('errors_injected')
+                self.close_connection = True
+                return
+
+        self.send_response(206 if range_header is not None else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Accept-Ranges', 'bytes')
+
+        if self.mock.digests:
+            if 'etag' not in request:
+                request['etag'] = hashlib.md5(expected_data(0, size)).hexdigest()
+            self.send_header('ETag', '"%s"' % request['etag'])
+
+            if range_header is not None and method == 'GET':
+                digest = hashlib.md5(expected_data(start, end)).digest()
+                self.send_header('Content-MD5', base64.b64encode(digest).decode('ascii'))
+
+        self.send_header('Content-Length', str(max(end - start, 0)))
+        if range_header is not None:
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end - 1, size))
+        self.end_headers()
+
+        if method == 'HEAD':
+            return
+
+        self.mock.count('blocks')
+        self._send_paced(start, end)
+
+    def _send_paced(self, start, end):
+        """
+        Send result data, limited to the bandwidth of the server
+        """
+
+        bandwidth = self.mock.bandwidth
+        chunk_size = 65536
+        start_time = time.time()
+        sent = 0
+
+        while start < end:
+            chunk = expected_data(start, min(start + chunk_size, end))
+            self.wfile.write(chunk)
+
+            start += len(chunk)
+            sent += len(chunk)
+
+            if bandwidth > 0:
+                delay = sent / bandwidth - (time.time() - start_time)
+                if delay > 0:
+                    time.sleep(delay)
+
+        self.mock.count('bytes_sent', sent)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Mock ECMWF web API server")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on")
+    parser.add_argument('--port', type=int, default=8080, help="port to listen on")
+    parser.add_argument('--queue-delay', type=float, default=0, help="seconds a request is queued")
+    parser.add_argument('--active-delay', type=float, default=0, help="seconds a request is active")
+    parser.add_argument('--poll-interval', type=int, default=1, help="seconds between status polls")
+    parser.add_argument('--latency', type=float, default=0, help="seconds every response is delayed")
+    parser.add_argument('--bandwidth', type=int, default=0, help="bytes per second per download, 0 for no limit")
+    parser.add_argument('--error-rate', type=float, default=0, help="fraction of requests that fail")
+    parser.add_argument('--file-size', type=int, default=10485760, help="size of the results in bytes")
+    parser.add_argument('--seed', type=int, default=None, help="seed of the error injection")
+    arguments = parser.parse_args()
+
+    server = MockApiServer(arguments.host, arguments.port, arguments.queue_delay, arguments.active_delay,
+                           arguments.poll_interval, arguments.latency, arguments.bandwidth, arguments.error_rate,
+                           arguments.file_size, seed=arguments.seed)
+    server.start()
+
+    print("Serving the mock ECMWF API at %s, stop with Ctrl-C" % server.url)
+
+    try:
+        while True:
+            time.sleep(3600)
+
+    except KeyboardInterrupt:
+        pass
+
+    server.stop()
+    print(json.dumps(server.statistics, indent=4))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
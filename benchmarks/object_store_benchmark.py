@@ -0,0 +1,200 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+"""
+Benchmark of uploading results to object storage, against the mock ECMWF API server and the mock object store. Retrieves
+results to a local file, to an s3://bucket/key target, and to both at once, and reports the time and the peak memory
+allocated by the transfer, measured in a separate process so the mock servers are not counted. The resume scenario interrupts the upload after a number of parts and retrieves the result
+again, which should only upload the missing parts. The uploaded objects are verified against the data the API server
+generated.
+
+Usage: python -m benchmarks.object_store_benchmark [--file-size BYTES] [--part-size BYTES] [--scenarios LIST]
+"""
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from ecmwfapi import ECMWFDataServer
+from ecmwfapi.api_connection import api_cache
+
+from .mock_s3_server import MockS3Server
+from .mock_server import MockApiServer, expected_data
+
+
+scenarios = ('file', 's3', 'fanout', 'resume')
+
+
+def create_data_server(api_server, arguments):
+    """
+    :return: ECMWFDataServer uploading to the mock object store with the benchmark options
+    """
+
+    data_server = ECMWFDataServer(api_server.url, 'benchmark', 'benchmark@localhost', custom_log=lambda *args: None,
+                                  custom_log_level=True)
+    data_server.object_store_options.update(part_size=arguments.part_size, upload_threads=arguments.upload_threads)
+
+    return data_server
+
+
+def retrieve(api_server, arguments, target):
+    """
+    Retrieve one result in a child process, and measure the peak memory allocated by the child meanwhile
+
+    :return: list with the transfer statistics as dictionary, the elapsed time and the peak memory in bytes
+    """
+
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+
+    process = context.Process(target=_retrieve, args=(api_server, arguments, target, results))
+    process.start()
+    result = results.get()
+    process.join()
+
+    return result
+
+
+def _retrieve(api_server, arguments, target, results):
+    api_cache.clear()
+    data_server = create_data_server(api_server, arguments)
+
+    tracemalloc.start()
+    start_time = time.time()
+
+    [stats] = data_server.retrieve({'dataset': 'benchmark', 'target': target})
+    elapsed = time.time() - start_time
+    peak_memory = tracemalloc.get_traced_memory()[1]
+
+    tracemalloc.stop()
+
+    results.put([stats.to_dict(), elapsed, peak_memory])
+
+
+def run_scenario(name, api_server, s3_server, arguments):
+    """
+    :return: dictionary with the results
+    """
+
+    directory = tempfile.mkdtemp(prefix='ecmwfapi-benchmark-')
+    file_target = os.path.join(directory, 'result')
+    key = 'results/%s' % name
+    s3_target = 's3://benchmark/%s' % key
+
+    parts_before = s3_server.statistics['parts_uploaded']
+    resumed_parts = 0
+
+    try:
+        if name == 'resume':
+            # The first attempt fails after the given number of parts and leaves an incomplete upload behind
+            s3_server.fail_after_parts = parts_before + arguments.fail_after_parts
+
+            try:
+                [interrupted, _, _] = retrieve(api_server, arguments, s3_target)
+
+            finally:
+                s3_server.fail_after_parts = None
+
+            if interrupted['status'] == 'completed':
+                raise RuntimeError("The interrupted upload did not fail")
+
+            parts_before = s3_server.statistics['parts_uploaded']
+
+        target = {'file': file_target, 's3': s3_target, 'fanout': [file_target, s3_target],
+                  'resume': s3_target}[name]
+        [stats, elapsed, peak_memory] = retrieve(api_server, arguments, target)
+
+        expected = expected_data(0, arguments.file_size)
+        corrupt = 0
+
+        if name in ('file', 'fanout'):
+            with open(file_target, 'rb') as file:
+                corrupt += file.read() != expected
+
+        if name != 'file':
+            corrupt += s3_server.get_object('benchmark', key) != expected
+            resumed_parts = sum(sink.get('resumed_parts', 0) for sink in stats['sinks'] or [])
+
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        'scenario': name,
+        'status': stats['status'],
+        'corrupt': corrupt,
+        'elapsed': elapsed,
+        'throughput': arguments.file_size / elapsed if elapsed > 0 else 0,
+        'peak_memory': peak_memory,
+        'uploaded_parts': s3_server.statistics['parts_uploaded'] - parts_before,
+        'resumed_parts': resumed_parts,
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Object storage upload benchmark against the mock servers")
+    parser.add_argument('--file-size', type=int, default=67108864, help="size of the result in bytes")
+    parser.add_argument('--part-size', type=int, default=8388608, help="size of the upload parts in bytes")
+    parser.add_argument('--upload-threads', type=int, default=4, help="number of parts uploaded at the same time")
+    parser.add_argument('--fail-after-parts', type=int, default=3, help="parts uploaded before the resume scenario "
+                                                                        "interrupts the upload")
+    parser.add_argument('--latency', type=float, default=0.005, help="seconds every response is delayed")
+    parser.add_argument('--s3-latency', type=float, default=0.02, help="seconds every object store response is "
+                                                                       "delayed")
+    parser.add_argument('--scenarios', default=','.join(scenarios),
+                        help="comma separated scenarios, from %s" % ', '.join(scenarios))
+    arguments = parser.parse_args()
+
+    selected = [name.strip() for name in arguments.scenarios.split(',') if name.strip()]
+    for name in selected:
+        if name not in scenarios:
+            parser.error("Unknown scenario %s" % name)
+
+    api_server = MockApiServer(latency=arguments.latency, file_size=arguments.file_size).start()
+    s3_server = MockS3Server(latency=arguments.s3_latency).start()
+
+    # The data servers read the object store endpoint and credentials from the environment
+    os.environ.update({'AWS_ENDPOINT_URL': s3_server.url, 'AWS_ACCESS_KEY_ID': s3_server.access_key,
+                       'AWS_SECRET_ACCESS_KEY': s3_server.secret_key})
+
+    try:
+        results = [run_scenario(name, api_server, s3_server, arguments) for name in selected]
+
+    finally:
+        api_server.stop()
+        s3_server.stop()
+
+    print("Result of %s bytes, parts of %s bytes, %s upload threads, object store latency %s s"
+          % (arguments.file_size, arguments.part_size, arguments.upload_threads, arguments.s3_latency))
+    print('-' * 100)
+    print('%-12s%-12s%-9s%-11s%-10s%-18s%-16s%-14s'
+          % ('Scenario', 'Status', 'Corrupt', 'Time (s)', 'MB/s', 'Peak memory (MB)', 'Uploaded parts',
+             'Resumed parts'))
+    print('-' * 100)
+    for result in results:
+        print('%-12s%-12s%-9s%-11.2f%-10.2f%-18.1f%-16s%-14s'
+              % (result['scenario'], result['status'], result['corrupt'], result['elapsed'],
+                 result['throughput'] / 1048576, result['peak_memory'] / 1048576.0, result['uploaded_parts'],
+                 result['resumed_parts']))
+    print('-' * 100)
+    print("Object store: %s" % ', '.join('%s=%s' % item for item in sorted(s3_server.statistics.items())))
+
+    return 1 if any(result['status'] != 'completed' or result['corrupt'] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
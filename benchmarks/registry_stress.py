@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+"""
+Stress benchmark of the task registry of the background client. Client threads add, list, inspect and cancel transfers
+through the connection handler, while transfer threads take tasks from the scheduler and complete them as the transfer
+handlers do, without downloading anything. Reports the throughput per operation and any errors raised by the threads.
+
+Usage: python -m benchmarks.registry_stress [--clients N] [--transfers N] [--duration SECONDS]
+"""
+
+import argparse
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+# The background client packages are imported relative to the ecmwfapi directory
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'ecmwfapi'))
+
+from background_client.admission_control import AdmissionRejectedError
+from background_client.connection_handler import ConnectionHandler, ConnectionHandlerError
+from background_client.task_registry import TaskRegistry
+from background_client.task_scheduler import TaskScheduler
+
+
+class NullLog:
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class Counters:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.operations = {}
+        self.errors = []
+
+    def count(self, operation):
+        with self._lock:
+            self.operations[operation] = self.operations.get(operation, 0) + 1
+
+    def error(self, message):
+        with self._lock:
+            self.errors.append(message)
+
+
+def client_thread(handler, stop, counters, owner):
+    """
+    Mix of client commands: mostly listings, and a steady stream of new and cancelled transfers
+    """
+
+    version = 0
+    added = []
+
+    while not stop.is_set():
+        choice = random.random()
+
+        try:
+            if choice < 0.3:
+                try:
+                    added.append(handler.add_transfer({'transfer_data': {'target': 'benchmark'}, 'owner': owner,
+                                                       'priority': random.randint(0, 3)}))
+                    counters.count('add_transfer')
+
+                except AdmissionRejectedError:
+                    counters.count('add_transfer_rejected')
+
+            elif choice < 0.5:
+                handler.list_transfers(False, {'limit': 50})
+                counters.count('list_active_transfers')
+
+            elif choice < 0.65:
+                handler.list_transfers(True, {'owner': owner, 'limit': 50})
+                counters.count('list_completed_transfers')
+
+            elif choice < 0.85:
+                version = handler.list_changes({'since': version})['version']
+                counters.count('list_changes')
+
+            elif added:
+                task_id = added.pop(random.randrange(len(added)))
+
+                if choice < 0.95:
+                    handler.get_transfer(task_id)
+                    counters.count('get_transfer')
+
+                else:
+                    try:
+                        handler.cancel_transfer(task_id)
+                        counters.count('cancel_transfer')
+
+                    except ConnectionHandlerError:
+                        # The transfer completed in the meantime
+                        counters.count('cancel_transfer_completed')
+
+        except Exception as e:
+            counters.error("%s: %s" % (type(e).__name__, e))
+
+
+def transfer_thread(registry, scheduler, stop, counters, transfer_time):
+    """
+    Follows the task life cycle of the transfer handler
+    """
+
+    while not stop.is_set():
+        try:
+            task_id = scheduler.get(timeout=0.1)
+
+        except queue.Empty:
+            continue
+
+        try:
+            with registry.lock(task_id):
+                control = registry.get(task_id).task_control
+
+                if not control.is_cancelled():
+                    registry.set_status(task_id, 'active')
+
+            if transfer_time > 0:
+                time.sleep(random.uniform(0, 2 * transfer_time))
+
+            registry.complete(task_id, 'cancelled' if control.is_cancelled() else 'completed')
+            counters.count('transfer')
+
+        except Exception as e:
+            counters.error("%s: %s" % (type(e).__name__, e))
+
+        scheduler.task_done()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Stress benchmark of the background client task registry")
+    parser.add_argument('--clients', type=int, default=16, help="number of concurrent client threads")
+    parser.add_argument('--transfers', type=int, default=8, help="number of transfer threads")
+    parser.add_argument('--owners', type=int, default=4, help="number of task owners")
+    parser.add_argument('--duration', type=float, default=10, help="duration of the benchmark in seconds")
+    parser.add_argument('--transfer-time', type=float, default=0.001, help="average duration of a transfer")
+    parser.add_argument('--history', type=int, default=10000, help="number of completed tasks to keep")
+    parser.add_argument('--lock-stripes', type=int, default=64, help="number of task locks in the registry")
+    arguments = parser.parse_args()
+
+    registry = TaskRegistry(arguments.history, lock_stripes=arguments.lock_stripes)
+    scheduler = TaskScheduler(1000)
+    handler = ConnectionHandler(NullLog(), queue.Queue(), [], registry, scheduler, lambda: None)
+
+    stop = threading.Event()
+    counters = Counters()
+
+    threads = [threading.Thread(target=client_thread, args=(handler, stop, counters, 'owner%s' % (i % arguments.owners)))
+               for i in range(arguments.clients)]
+    threads += [threading.Thread(target=transfer_thread,
+                                 args=(registry, scheduler, stop, counters, arguments.transfer_time))
+                for _ in range(arguments.transfers)]
+
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+
+    time.sleep(arguments.duration)
+    stop.set()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.time() - start_time
+
+    print("%s client threads, %s transfer threads, %.1f seconds" % (arguments.clients, arguments.transfers, elapsed))
+    print('----------------------------------------------------------------------')
+    print('Operation                       Count          Per second')
+    print('----------------------------------------------------------------------')
+    for [operation, count] in sorted(counters.operations.items()):
+        print('%-32s%-15s%.1f' % (operation, count, count / elapsed))
+    print('----------------------------------------------------------------------')
+    print("Active tasks: %s, completed tasks: %s, registry version: %s"
+          % (registry.count(), registry.count(True), registry.version))
+    print("Errors: %s" % len(counters.errors))
+
+    for message in sorted(set(counters.errors))[:20]:
+        print("    %s" % message)
+
+    return 1 if counters.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+"""
+Compares the scheduling of retrieve_parallel and the background client on the workload of a recorded session. The
+recorded requests are submitted to both against the replay server, and the makespan and request latencies are reported.
+
+A session is recorded by registering ecmwfapi.tracing.SessionRecorder while the client runs, or with --record, which
+records a synthetic session against the mock server.
+
+Usage: python -m benchmarks.replay_benchmark SESSION [--speed FACTOR] [--parallel N] [--scenarios LIST]
+       python -m benchmarks.replay_benchmark SESSION --record [--requests N]
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from ecmwfapi import ECMWFDataServer
+from ecmwfapi.api_connection import api_cache
+from ecmwfapi.tracing import SessionRecorder
+
+from .mock_server import MockApiServer
+from .replay_server import ReplayServer, load_session
+from .transfer_benchmark import format_seconds, percentile, run_background, run_retrieve_parallel
+
+
+scenarios = {
+    'retrieve_parallel': run_retrieve_parallel,
+    'background': run_background,
+}
+
+
+def record_synthetic_session(path, count, seed):
+    """
+    Record a session with requests of varying size and queue time against the mock server
+    """
+
+    generator = random.Random(seed)
+    server = MockApiServer(poll_interval=1).start()
+    directory = tempfile.mkdtemp(prefix='ecmwfapi-record-')
+    recorder = SessionRecorder(path)
+
+    try:
+        data_server = ECMWFDataServer(server.url, 'benchmark', 'benchmark@localhost', custom_log=lambda *args: None,
+                                      custom_log_level=True)
+        recorder.start()
+
+        for index in range(count):
+            server.queue_delay = generator.uniform(0, 3)
+            server.active_delay = generator.uniform(0, 2)
+            data_server.retrieve({'dataset': 'benchmark', 'step': index, 'target': os.path.join(directory, 'result'),
+                                  'mock_file_size': generator.randint(1, 16) * 524288})
+
+    finally:
+        recorder.stop()
+        server.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run_scenario(name, server, session, parallel):
+
+    directory = tempfile.mkdtemp(prefix='ecmwfapi-replay-')
+    requests = []
+
+    for [index, recorded] in enumerate(server.recorded):
+        request = dict(recorded.get('payload') or {'dataset': recorded['dataset']})
+        request['target'] = os.path.join(directory, 'result-%s' % index)
+        requests.append(request)
+
+    server.reset()
+    api_cache.clear()
+    start_time = time.time()
+
+    try:
+        results = scenarios[name](server, requests, parallel)
+        elapsed = time.time() - start_time
+
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if name == 'background':
+        failed = len([record for record in results if record.task_status != 'completed'])
+        latencies = [record.task_completed - record.task_added for record in results]
+
+    else:
+        failed = len([stats for stats in results if stats.status != 'completed'])
+        latencies = [stats.end_time - stats.start_time for stats in results]
+
+    return {
+        'scenario': name,
+        'requests': len(requests),
+        'failed': failed,
+        'makespan': elapsed,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'latency_max': percentile(latencies, 100),
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Replay benchmark of the transfer scheduling")
+    parser.add_argument('session', help="JSON file written by the session recorder")
+    parser.add_argument('--record', action='store_true', help="record a synthetic session against the mock server")
+    parser.add_argument('--requests', type=int, default=8, help="number of requests of a synthetic session")
+    parser.add_argument('--seed', type=int, default=1, help="seed of a synthetic session")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed factor")
+    parser.add_argument('--parallel', type=int, default=4, help="number of parallel transfers")
+    parser.add_argument('--scenarios', default=','.join(sorted(scenarios)),
+                        help="comma separated scenarios, from %s" % ', '.join(sorted(scenarios)))
+    arguments = parser.parse_args()
+
+    if arguments.record:
+        record_synthetic_session(arguments.session, arguments.requests, arguments.seed)
+        print("Recorded %s requests in %s" % (arguments.requests, arguments.session))
+        return 0
+
+    selected = [name.strip() for name in arguments.scenarios.split(',') if name.strip()]
+    for name in selected:
+        if name not in scenarios:
+            parser.error("Unknown scenario %s" % name)
+
+    try:
+        session = load_session(arguments.session)
+        server = ReplayServer(session, arguments.speed).start()
+
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    try:
+        results = [run_scenario(name, server, session, arguments.parallel) for name in selected]
+
+    finally:
+        server.stop()
+
+    print("%s recorded requests, %sx speed, %s parallel" % (len(server.recorded), arguments.speed, arguments.parallel))
+    print('-' * 80)
+    print('%-20s%-10s%-8s%-14s%-10s%-10s%-10s' % ('Scenario', 'Requests', 'Failed', 'Makespan (s)', 'Req p50',
+                                                  'Req p95', 'Req max'))
+    print('-' * 80)
+    for result in results:
+        print('%-20s%-10s%-8s%-14.2f%-10s%-10s%-10s'
+              % (result['scenario'], result['requests'], result['failed'], result['makespan'],
+                 format_seconds(result['latency_p50']), format_seconds(result['latency_p95']),
+                 format_seconds(result['latency_max'])))
+    print('-' * 80)
+
+    return 1 if any(result['failed'] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+"""
+Serves a session recorded with ecmwfapi.tracing.SessionRecorder, so the client can be benchmarked against the shape of
+real traffic without reaching the ECMWF API. Every submitted request is matched to a recorded request, by its parameters
+if they were recorded and otherwise in the recorded order. The request is then queued and active as long as recorded,
+asks for the recorded retry-after values and has a result of the recorded size, of which the blocks are delayed and
+failed as recorded. All delays are divided by the speed of the replay.
+
+Usage: python -m benchmarks.replay_server SESSION [--speed FACTOR] [--port PORT]
+"""
+
+import argparse
+import bisect
+import json
+import sys
+import time
+
+from .mock_server import MockApiServer
+
+
+def load_session(path):
+    """
+    Load a recorded session
+
+    :param path: JSON file written by the session recorder
+    :return: session dictionary
+    """
+
+    with open(path) as file:
+        session = json.load(file)
+
+    if not isinstance(session, dict) or session.get('version') != 1 or not isinstance(session.get('requests'), list):
+        raise ValueError("%s is not a recorded session" % path)
+
+    return session
+
+
+def median(values):
+    values = sorted(value for value in values if value is not None)
+    return values[len(values) // 2] if values else 0
+
+
+class ReplayServer(MockApiServer):
+    """
+    Mock ECMWF API server that replays a recorded session
+    """
+
+    def __init__(self, session, speed=1.0, host='127.0.0.1', port=0):
+        """
+        Initialise the server
+
+        :param session: session dictionary, see load_session
+        :param speed: replay speed, 2 replays the session twice as fast as recorded
+        :param host: address to listen on
+        :param port: port to listen on, a free port is selected if zero
+        """
+
+        if speed <= 0:
+            raise ValueError("The replay speed should be positive")
+
+        self.session = session
+        self.speed = speed
+        self.recorded = [request for request in session['requests'] if request.get('size') is not None]
+
+        if not self.recorded:
+            raise ValueError("The session contains no completed downloads")
+
+        # The API latency is applied to every response, which includes the submission and the status polls
+        latency = median(request.get('submit_latency') for request in self.recorded) / speed
+
+        MockApiServer.__init__(self, host, port, latency=latency)
+
+        self._next = 0
+        self._matched = set()
+
+    def reset(self):
+        """
+        Start matching submitted requests from the first recorded request again
+        """
+
+        with self._lock:
+            self._next = 0
+            self._matched = set()
+
+    def create_request(self, payload, file_size):
+
+        index = self._match(payload)
+        recorded = self.recorded[index]
+
+        # The request is queued until the first other status, and active until the result is complete
+        queue_delay = 0
+        active_delay = 0
+        for [status, offset] in recorded['statuses']:
+            if status == 'complete':
+                active_delay = offset - queue_delay
+                break
+
+            if status != 'queued' and queue_delay == 0:
+                queue_delay = offset
+
+        offsets = []
+        position = 0
+        for block in recorded['blocks']:
+            offsets.append(position)
+            position += block[1]
+
+        return {
+            'submitted': time.time(),
+            'size': recorded['size'],
+            'queue_delay': queue_delay / self.speed,
+            'active_delay': max(active_delay, 0) / self.speed,
+            'retry_after': list(recorded['retry_after']),
+            'blocks': recorded['blocks'],
+            'block_offsets': offsets,
+            'attempts': {},
+        }
+
+    def retry_after(self, request):
+
+        with self._lock:
+            if request['retry_after']:
+                value = request['retry_after'].pop(0)
+            else:
+                value = 1
+
+        return max(int(round((value or 0) / self.speed)), 0)
+
+    def result_delay(self, request, start):
+
+        block = self._block(request, start)
+        return block[0] / self.speed if block is not None else 0
+
+    def fail_result(self, request, start):
+
+        block = self._block(request, start)
+        if block is None:
+            return False
+
+        with self._lock:
+            attempts = request['attempts'].get(start, 0)
+            request['attempts'][start] = attempts + 1
+
+        return attempts < block[2]
+
+    def _match(self, payload):
+        """
+        Select the recorded request for a submitted request. Called with the lock held.
+
+        :param payload: request parameters
+        :return: index of the recorded request
+        """
+
+        stripped = {key: value for [key, value] in payload.items() if key != 'target'}
+
+        for [index, recorded] in enumerate(self.recorded):
+            if index not in self._matched and recorded.get('payload') == stripped:
+                self._matched.add(index)
+                return index
+
+        while self._next in self._matched:
+            self._next += 1
+
+        if self._next >= len(self.recorded):
+            self._next = 0
+            self._matched = set()
+
+        index = self._next
+        self._matched.add(index)
+        self._next += 1
+
+        return index
+
+    @staticmethod
+    def _block(request, start):
+        """
+        :return: recorded block [latency, size, retries] of the range starting at the given offset, or None
+        """
+
+        offsets = request['block_offsets']
+        if not offsets:
+            return None
+
+        index = max(bisect.bisect_right(offsets, start) - 1, 0)
+        return request['blocks'][index]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Replay a recorded ECMWF API session")
+    parser.add_argument('session', help="JSON file written by the session recorder")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed factor")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on")
+    parser.add_argument('--port', type=int, default=8080, help="port to listen on")
+    arguments = parser.parse_args()
+
+    try:
+        server = ReplayServer(load_session(arguments.session), arguments.speed, arguments.host, arguments.port)
+
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    server.start()
+
+    print("Replaying %s requests at %sx speed at %s, stop with Ctrl-C"
+          % (len(server.recorded), arguments.speed, server.url))
+
+    try:
+        while True:
+            time.sleep(3600)
+
+    except KeyboardInterrupt:
+        pass
+
+    server.stop()
+    print(json.dumps(server.statistics, indent=4))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+"""
+End to end transfer benchmark against the mock ECMWF API server. Runs a number of requests through retrieve,
+retrieve_parallel and the transfer handlers of the background client, and reports the throughput and the latency of the
+requests and of the block downloads. The downloaded files are verified against the data the server generated.
+
+Usage: python -m benchmarks.transfer_benchmark [--requests N] [--parallel N] [--file-size BYTES] [--scenarios LIST]
+"""
+
+import argparse
+import contextlib
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import time
+
+# The background client packages are imported relative to the ecmwfapi directory
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'ecmwfapi'))
+
+from background_client.connection_handler import ConnectionHandler
+from background_client.task_registry import TaskRegistry
+from background_client.task_scheduler import TaskScheduler
+from background_client.transfer_handler import TransferHandler
+from background_client.worker_pool import WorkerPool
+from ecmwfapi import ECMWFDataServer
+from ecmwfapi.api_connection import api_cache
+
+from .mock_server import MockApiServer, expected_data
+
+
+scenarios = ('retrieve', 'retrieve_parallel', 'background')
+
+
+class NullLog:
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def percentile(values, p):
+    """
+    :param values: list of numbers
+    :param p: percentile in [0, 100]
+    :return: nearest rank percentile, or None if there are no values
+    """
+
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def create_requests(directory, count):
+    return [{'dataset': 'benchmark', 'target': os.path.join(directory, 'result-%s' % index)} for index in range(count)]
+
+
+def verify_targets(requests, file_size):
+    """
+    :return: number of targets that do not contain the expected data
+    """
+
+    expected = expected_data(0, file_size)
+    corrupt = 0
+
+    for request in requests:
+        try:
+            with open(request['target'], 'rb') as file:
+                if file.read() != expected:
+                    corrupt += 1
+
+        except OSError:
+            corrupt += 1
+
+    return corrupt
+
+
+def run_retrieve(server, requests, parallel):
+    data_server = ECMWFDataServer(server.url, 'benchmark', 'benchmark@localhost', custom_log=lambda *args: None,
+                                  custom_log_level=True)
+    return data_server.retrieve(requests)
+
+
+def run_retrieve_parallel(server, requests, parallel):
+    data_server = ECMWFDataServer(server.url, 'benchmark', 'benchmark@localhost', custom_log=lambda *args: None,
+                                  custom_log_level=True)
+    return data_server.retrieve_parallel(requests, parallel)
+
+
+def run_background(server, requests, parallel):
+    """
+    Submit the requests through a connection handler and process them with a pool of transfer handlers, as the
+    background client does. The transfer handlers read the API credentials from the environment.
+
+    :return: list of the completed task records
+    """
+
+    os.environ.update({'ECMWF_API_URL': server.url, 'ECMWF_API_KEY': 'benchmark',
+                       'ECMWF_API_EMAIL': 'benchmark@localhost'})
+
+    registry = TaskRegistry()
+    scheduler = TaskScheduler(len(requests) + 1)
+    handler = ConnectionHandler(NullLog(), queue.Queue(), [], registry, scheduler, lambda: None)
+
+    pool = WorkerPool('Transfer', NullLog(), lambda: TransferHandler(NullLog(), registry, scheduler), scheduler,
+                      parallel)
+
+    task_ids = [handler.add_transfer(request) for request in requests]
+
+    # The data servers of the transfer handlers log to stdout
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        pool.start()
+
+        while registry.count() > 0:
+            time.sleep(0.05)
+
+        pool.stop()
+
+    return [registry.get(task_id) for task_id in task_ids]
+
+
+def run_scenario(name, server, arguments):
+    """
+    Run a scenario in a fresh directory, without user details cached from earlier scenarios
+
+    :return: dictionary with the results
+    """
+
+    directory = tempfile.mkdtemp(prefix='ecmwfapi-benchmark-')
+    requests = create_requests(directory, arguments.requests)
+    api_cache.clear()
+
+    bytes_before = server.statistics['bytes_sent']
+    start_time = time.time()
+
+    try:
+        results = globals()['run_%s' % name](server, requests, arguments.parallel)
+        elapsed = time.time() - start_time
+        corrupt = verify_targets(requests, arguments.file_size)
+
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if name == 'background':
+        failed = [record for record in results if record.task_status != 'completed']
+        latencies = [record.task_completed - record.task_added for record in results]
+        block_latencies = []
+
+    else:
+        failed = [stats for stats in results if stats.status != 'completed']
+        latencies = [stats.end_time - stats.start_time for stats in results]
+        block_latencies = [latency for stats in results for [latency, _] in stats.blocks]
+
+    transferred = server.statistics['bytes_sent'] - bytes_before
+
+    return {
+        'scenario': name,
+        'requests': len(requests),
+        'failed': len(failed),
+        'corrupt': corrupt,
+        'elapsed': elapsed,
+        'throughput': transferred / elapsed if elapsed > 0 else 0,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'block_p50': percentile(block_latencies, 50),
+        'block_p95': percentile(block_latencies, 95),
+    }
+
+
+def format_seconds(value):
+    return '-' if value is None else '%.3f' % value
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Transfer benchmark against the mock ECMWF API server")
+    parser.add_argument('--requests', type=int, default=8, help="number of requests per scenario")
+    parser.add_argument('--parallel', type=int, default=4, help="number of parallel transfers")
+    parser.add_argument('--file-size', type=int, default=8388608, help="size of each result in bytes")
+    parser.add_argument('--queue-delay', type=float, default=0, help="seconds a request is queued at the server")
+    parser.add_argument('--active-delay', type=float, default=0, help="seconds a request is active at the server")
+    parser.add_argument('--poll-interval', type=int, default=1, help="seconds between status polls")
+    parser.add_argument('--latency', type=float, default=0.005, help="seconds every response is delayed")
+    parser.add_argument('--bandwidth', type=int, default=0, help="bytes per second per download, 0 for no limit")
+    parser.add_argument('--error-rate', type=float, default=0, help="fraction of server requests that fail")
+    parser.add_argument('--seed', type=int, default=1, help="seed of the error injection")
+    parser.add_argument('--scenarios', default=','.join(scenarios),
+                        help="comma separated scenarios, from %s" % ', '.join(scenarios))
+    arguments = parser.parse_args()
+
+    selected = [name.strip() for name in arguments.scenarios.split(',') if name.strip()]
+    for name in selected:
+        if name not in scenarios:
+            parser.error("Unknown scenario %s" % name)
+
+    server = MockApiServer(queue_delay=arguments.queue_delay, active_delay=arguments.active_delay,
+                           poll_interval=arguments.poll_interval, latency=arguments.latency,
+                           bandwidth=arguments.bandwidth, error_rate=arguments.error_rate,
+                           file_size=arguments.file_size, seed=arguments.seed).start()
+
+    try:
+        results = [run_scenario(name, server, arguments) for name in selected]
+
+    finally:
+        server.stop()
+
+    print("%s requests of %s bytes, %s parallel, server latency %s s, bandwidth %s B/s, error rate %s"
+          % (arguments.requests, arguments.file_size, arguments.parallel, arguments.latency,
+             arguments.bandwidth or 'unlimited', arguments.error_rate))
+    print('-' * 110)
+    print('%-20s%-10s%-8s%-9s%-11s%-14s%-10s%-10s%-10s%-10s'
+          % ('Scenario', 'Requests', 'Failed', 'Corrupt', 'Time (s)', 'MB/s', 'Req p50', 'Req p95', 'Block p50',
+             'Block p95'))
+    print('-' * 110)
+    for result in results:
+        print('%-20s%-10s%-8s%-9s%-11.2f%-14.2f%-10s%-10s%-10s%-10s'
+              % (result['scenario'], result['requests'], result['failed'], result['corrupt'], result['elapsed'],
+                 result['throughput'] / 1048576, format_seconds(result['latency_p50']),
+                 format_seconds(result['latency_p95']), format_seconds(result['block_p50']),
+                 format_seconds(result['block_p95'])))
+    print('-' * 110)
+    print("Server: %s" % ', '.join('%s=%s' % item for item in sorted(server.statistics.items())))
+
+    return 1 if any(result['failed'] or result['corrupt'] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,12 +10,23 @@
 # (C) Copyright 2017 Ricardo Persoon.
 
 
+import os
 import queue
 import signal
+import sys
 
-from background_client.connection_handler import ConnectionHandler, ConnectionHandlerError
+# Required to import the configuration of the ecmwfapi package
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/..')
+
+from background_client.admission_control import AdmissionController, AdmissionControlError
+from background_client.connection_handler import ConnectionHandler
 from background_client.socket_communication import SocketServer, SocketServerError
-from background_client.transfer_handler import TransferHandler, TransferHandlerError
+from background_client.task_registry import TaskRegistry, TaskRegistryError
+from background_client.task_scheduler import TaskScheduler
+from background_client.transfer_handler import TransferHandler
+from background_client.worker_pool import WorkerPool, WorkerPoolError
+from ecmwfapi.config import config, ConfigError
+from ecmwfapi.metrics import metrics, MetricsServer, MetricsError
 from log import *
 
 server_instance = None
@@ -39,6 +50,92 @@ def stop():
     server_instance.stop()
 
 
+def get_setting(name, default, item_type='int'):
+    """
+    Get a setting from the background_client section of the configuration file, falling back to a default value if it
+    is not configured
+
+    :param name: name of the setting
+    :param default: value to use if the setting is not configured
+    :param item_type: datatype of the setting, in [int, boolean, none]
+    :return: the setting value
+    """
+
+    try:
+        if item_type == 'boolean':
+            return config.get_boolean(name, 'background_client')
+
+        if item_type == 'none':
+            return config.get(name, 'background_client')
+
+        return config.get_int(name, 'background_client')
+
+    except (ConfigError, ValueError):
+        return default
+
+
+def get_owner_weights(log_handle):
+    """
+    Get the fair share weights of task owners from the configuration file. The weights are configured as a comma
+    separated list of owner:weight pairs.
+
+    :param log_handle: logging handler
+    :return: dictionary with the weight per owner
+    """
+
+    owner_weights = {}
+
+    try:
+        setting = config.get('owner_weights', 'background_client')
+
+    except ConfigError:
+        return owner_weights
+
+    for item in ''.join(setting.split()).split(','):
+        if len(item) == 0:
+            continue
+
+        parts = item.split(':')
+
+        try:
+            if len(parts) != 2 or float(parts[1]) <= 0:
+                raise ValueError
+
+            owner_weights[parts[0]] = float(parts[1])
+
+        except ValueError:
+            log_handle.warning("Ignoring invalid owner weight '%s' in configuration file" % item)
+
+    return owner_weights
+
+
+def finish_transfers(task_registry, task_queue, log_handle):
+    """
+    Resume the paused transfers and wait until the transfer threads have processed all queued transfers. Should be
+    called after the connection handlers stopped, so no transfers are added or paused anymore.
+
+    :param task_registry: TaskRegistry of the transfers
+    :param task_queue: TaskScheduler consumed by the transfer threads
+    :param log_handle: logging handler
+    """
+
+    [paused, _] = task_registry.list(task_status='paused')
+
+    for record in paused:
+        with task_registry.lock(record.task_id):
+            try:
+                if task_registry.get(record.task_id).task_status == 'paused':
+                    record.task_control.resume()
+                    task_registry.set_status(record.task_id, 'active')
+
+            # The transfer completed in the meantime
+            except TaskRegistryError:
+                pass
+
+    log_handle.info("Finishing %s queued and %s paused transfers before stopping" % (task_queue.qsize(), len(paused)))
+    task_queue.join()
+
+
 def main():
 
     global server_instance
@@ -51,42 +148,103 @@ def main():
         print("Failed to start log: %s" % e)
         return
 
-    # Define the task storage / administration
-    active_task_storage = {}
-    completed_task_storage = {}
+    # Load the configuration file
+    try:
+        config.load(os.path.join(os.path.dirname(__file__), 'config.ini'))
 
-    # Create a task queue
-    task_queue = queue.Queue(1000)
+    except ConfigError as e:
+        log_handle.warning("Failed to load configuration file, using default settings: %s" % e)
 
-    # Create a queue containing new connections, maximum size 25
-    connection_queue = queue.Queue(25)
+    try:
+        log_handle.load_settings()
+
+    except LogError as e:
+        log_handle.warning("Invalid log settings in configuration file: %s" % e)
+
+    # Define the task storage / administration, with a bounded history of completed tasks
+    task_registry = TaskRegistry(get_setting('history_max_tasks', 10000), get_setting('history_max_age', 0))
+
+    # Create a task queue, which hands out tasks by priority and shares the transfer threads fairly between owners
+    task_queue = TaskScheduler(get_setting('task_queue_size', 1000), get_owner_weights(log_handle),
+                               get_setting('deadline_margin', 300), get_setting('default_priority', 0))
+
+    # New transfers are rejected with a retry hint instead of blocking when the queue or the target disk is full
+    try:
+        admission_controller = AdmissionController(task_queue, task_registry,
+                                                   get_setting('max_queued_per_owner', 0),
+                                                   get_setting('min_free_disk_space', 0),
+                                                   get_setting('default_task_size', 0),
+                                                   get_setting('admission_retry_after', 60))
+
+    except AdmissionControlError as e:
+        log_handle.error("Invalid admission control settings: %s" % e)
+        exit(-1)
+
+    # Create a queue containing new connections
+    connection_queue = queue.Queue(get_setting('connection_queue_size', 25))
 
     allowed_ips = ['127.0.0.1']
 
-    # Start 8 threads to handle connections
-    connection_threads = []
-    for i in range(8):
+    # The worker pools can be reconfigured at runtime through the connection handlers
+    worker_pools = {}
+
+    def create_connection_handler():
+        return ConnectionHandler(log_handle, connection_queue, allowed_ips, task_registry, task_queue, stop,
+                                 worker_pools, admission_controller)
+
+    def create_transfer_handler():
+        return TransferHandler(log_handle, task_registry, task_queue)
+
+    # Start the threads to handle connections and to process transfers
+    try:
+        connection_threads = get_setting('connection_threads', 8)
+        worker_pools['connection'] = WorkerPool('Connection', log_handle, create_connection_handler,
+                                                connection_queue, connection_threads)
+
+        transfer_threads = get_setting('transfer_threads', 5)
+        worker_pools['transfer'] = WorkerPool('Transfer', log_handle, create_transfer_handler, task_queue,
+                                              transfer_threads,
+                                              min_size=get_setting('min_transfer_threads', 1),
+                                              max_size=get_setting('max_transfer_threads', transfer_threads),
+                                              elastic=get_setting('elastic_transfer_threads', False, 'boolean'),
+                                              elastic_interval=get_setting('elastic_interval', 30))
+
+    except WorkerPoolError as e:
+        log_handle.error("Invalid worker pool configuration: %s" % e)
+        exit(-1)
+
+    for [name, pool] in worker_pools.items():
         try:
-            thread = ConnectionHandler(log_handle, connection_queue, allowed_ips, active_task_storage,
-                                       completed_task_storage, task_queue, stop)
-            thread.start()
-            connection_threads.append(thread)
+            pool.start()
 
-        except ConnectionHandlerError as e:
-            log_handle.error("Failed to start connection handler: %s" % e)
+        except WorkerPoolError as e:
+            log_handle.error("Failed to start %s handlers: %s" % (name, e))
             exit(-1)
 
-    # Start 5 threads to process transfers
-    process_threads = []
-    for i in range(5):
+    # State of the background client, determined when the metrics are collected
+    metrics.gauge('ecmwfapi_background_tasks', "Number of tasks by status, including the completed tasks kept in the "
+                  "history", ('status',), lambda: {(status,): count for status, count in
+                                                   task_registry.status_counts().items()})
+    metrics.gauge('ecmwfapi_background_queue_depth', "Number of queued tasks", function=task_queue.qsize)
+    metrics.gauge('ecmwfapi_background_active_connections', "Number of client connections being handled",
+                  function=lambda: worker_pools['connection'].get_status()['busy'])
+    metrics.gauge('ecmwfapi_background_busy_transfer_threads', "Number of transfer threads processing a task",
+                  function=lambda: worker_pools['transfer'].get_status()['busy'])
+
+    # The metrics are also available through the metrics socket command, so failing to serve them is not fatal
+    metrics_server = None
+    metrics_port = get_setting('metrics_port', 0)
+
+    if metrics_port > 0:
+        metrics_server = MetricsServer(metrics, get_setting('metrics_host', '127.0.0.1', 'none'), metrics_port)
+
         try:
-            thread = TransferHandler(log_handle, active_task_storage, completed_task_storage, task_queue)
-            thread.start()
-            process_threads.append(thread)
+            metrics_server.start()
+            log_handle.info("Serving metrics on port %s" % metrics_port)
 
-        except TransferHandlerError as e:
-            log_handle.error("Failed to start transfer handler: %s" % e)
-            exit(-1)
+        except MetricsError as e:
+            log_handle.warning(str(e))
+            metrics_server = None
 
     # Start the server instance
     try:
@@ -100,19 +258,18 @@ def main():
     # Stop the server when running completes
     server_instance.shutdown()
 
-    # Send poison pills to connection handler threads
-    for _ in range(8):
-        connection_queue.put(None)
+    # Stop the connection handler threads, so transfers are no longer added or changed
+    worker_pools['connection'].stop()
 
-    for i in range(8):
-        connection_threads[i].join()
+    # The registry does not outlive the process, so the queued transfers are processed before the transfer threads stop.
+    # Paused transfers can no longer be resumed by a client, so they are resumed to let them finish.
+    finish_transfers(task_registry, task_queue, log_handle)
+    worker_pools['transfer'].stop()
 
-    # Send poison pills to transfer processing threads
-    for _ in range(5):
-        task_queue.put(None)
+    if metrics_server is not None:
+        metrics_server.stop()
 
-    for i in range(5):
-        process_threads[i].join()
+    log_handle.flush()
 
 if __name__ == "__main__":
     main()
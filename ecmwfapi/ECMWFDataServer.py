@@ -17,16 +17,29 @@ import os
 import queue
 import threading
 import time
+import weakref
 
 from .api_connection import *
+from .bandwidth_limiter import BandwidthLimiterError, bandwidth_limiter, parse_schedule
 from .config import *
+from .custom_http import CustomHttpError, block_scheduler, create_http_handle
+from .file_writer import FileWriter, FileWriterError
+from .host_coordinator import HostCoordinatorError, host_coordinator
 from .log import *
+from .transfer_control import TransferCancelledError
+from .transfer_statistics import TransferStatistics, TransferStatisticsError, write_statistics
+from . import tracing
 
 
 class ECMWFDataServer:
 
+    # Modification time of the configuration file when the components shared by all servers of the process were last
+    # configured from it
+    _global_settings_signature = None
+    _global_settings_lock = threading.Lock()
+
     def __init__(self, api_url=None, api_key=None, api_email=None, verbose=False, custom_log=None,
-                 custom_log_level=False):
+                 custom_log_level=False, statistics_file=None):
         """
         :param api_url: ECMWF API url
         :param api_key: authentication API key
@@ -35,29 +48,95 @@ class ECMWFDataServer:
         :param custom_log: custom logging function. If not specified, build-in logging class will be used
         :param custom_log_level: whether the provided custom logging function accepts a 2nd parameter with the log
             call that specifies the logging level. If not, only 1 parameter string is passed for logging
+        :param statistics_file: file to which the statistics of every request are appended, as CSV if the name ends
+            with .csv and as JSON lines otherwise. If not specified, the statistics_file setting in the configuration
+            file is used.
         """
 
-        # Load the configuration file
-        try:
-            config.load(os.path.join(os.path.dirname(__file__), 'config.ini'))
+        # Credentials passed by the caller take precedence over the configured credentials
+        self._api_arguments = [api_url, api_key, api_email]
+        self._statistics_file_argument = statistics_file
+        self.statistics_file = None
 
-        except ConfigError as e:
-            raise DataServerError("Failed to load configuration file config.ini: %s" % e)
+        self._config_path = os.path.join(os.path.dirname(__file__), 'config.ini')
+        self._settings_lock = threading.RLock()
+        self._settings_signature = None
+
+        # Logging through the build-in logging class is configured when the settings are loaded
+        self.log_handle = None
 
-        # Initialise the logging
         if custom_log is None:
             self.log_level = True
+            self.log_handle = Log()
+            self.log_method = self.log_handle.log
 
-            display_info_messages = config.get_boolean('display_info_messages', 'log')
-            display_warning_messages = config.get_boolean('display_warning_messages', 'log')
-            display_error_messages = config.get_boolean('display_error_messages', 'log')
-
-            self.log_method = Log(display_info_messages, display_warning_messages, display_error_messages).log
+            # The writer thread of the log is stopped when the server is closed or discarded
+            self._close_log = weakref.finalize(self, self.log_handle.close)
 
         else:
+            self._close_log = None
             self.log_level = custom_log_level
             self.log_method = custom_log
 
+        self.api_url = None
+        self.api_key = None
+        self.api_email = None
+        self.disable_ssl_validation = False
+        self.download_threads = 1
+        self.file_writer_options = {}
+        self.object_store_options = {}
+
+        # HTTP handle per thread, reused by all requests of this server so the connections to the API are kept open
+        self._http_handles = threading.local()
+
+        self.transfer_queue = None
+
+        self._load_settings()
+
+        self.log("ECMWF API python library %s initialised" % config.get('version', 'client'), 'info')
+
+    def refresh(self, force=False):
+        """
+        Reload the configuration and the API credentials if the configuration file, the ~/.ecmwfapirc file or the
+        credentials in the environment have changed since they were loaded. Called before every retrieval, so a server
+        can be kept for the lifetime of a process.
+
+        :param force: whether to reload even if nothing seems to have changed, for example after an authentication error
+        :return: whether the credentials changed
+        """
+
+        with self._settings_lock:
+            if not force and self._get_settings_signature() == self._settings_signature:
+                return False
+
+            credentials = (self.api_url, self.api_key, self.api_email)
+            self._load_settings()
+
+            return credentials != (self.api_url, self.api_key, self.api_email)
+
+    def _load_settings(self):
+        """
+        Load the configuration file and determine the API credentials. The HTTP handles are dropped when the SSL
+        settings change, the components shared by all servers are only configured when the configuration file changed.
+        """
+
+        signature = self._get_settings_signature()
+
+        try:
+            config.load(self._config_path)
+
+        except ConfigError as e:
+            raise DataServerError("Failed to load configuration file config.ini: %s" % e)
+
+        if self.log_handle is not None:
+            try:
+                self.log_handle.load_settings()
+
+            except LogError as e:
+                raise DataServerError("Invalid log settings in config.ini: %s" % e)
+
+        [api_url, api_key, api_email] = self._api_arguments
+
         # If API credentials are not passed, try to retrieve the API credentials from the configuration file first
         if api_url is None or api_key is None or api_email is None:
 
@@ -81,13 +160,185 @@ class ECMWFDataServer:
                 self.log("Failed to retrieve ECMWF API key: %s" % e, 'error')
                 raise DataServerError("Failed to retrieve ECMWF API key from all sources: %s" % e)
 
+        try:
+            disable_ssl_validation = config.get_boolean('disable_ssl_validation', 'network')
+
+        except ConfigError:
+            disable_ssl_validation = False
+
+        try:
+            self.download_threads = config.get_int('download_threads', 'network')
+
+        except ConfigError:
+            pass
+
+        self._apply_global_settings(signature[0][0])
+
+        try:
+            fsync = config.get('fsync', 'disk')
+            compression = config.get('compression', 'disk')
+            compression_level = config.get('compression_level', 'disk')
+
+            file_writer_options = {
+                'buffer_size': config.get_int('write_buffer_size', 'disk'),
+                'buffers': config.get_int('write_buffers', 'disk'),
+                'fsync': int(fsync) if fsync.isdigit() else fsync,
+                'preallocate': config.get_boolean('preallocate', 'disk'),
+                'fadvise': config.get_boolean('fadvise', 'disk'),
+                'compression': compression if compression not in ('', 'none') else None,
+                'compression_level': int(compression_level) if compression_level not in ('', 'none') else None,
+            }
+
+            FileWriter.check_options(**file_writer_options)
+            self.file_writer_options = file_writer_options
+
+        except ConfigError:
+            pass
+
+        except (FileWriterError, ValueError) as e:
+            raise DataServerError("Invalid disk settings in config.ini: %s" % e)
+
+        try:
+            object_store_options = {
+                'region': config.get('region', 'object_store'),
+                'part_size': config.get_int('part_size', 'object_store'),
+                'upload_threads': config.get_int('upload_threads', 'object_store'),
+                'max_buffered_parts': config.get_int('max_buffered_parts', 'object_store'),
+                'resume': config.get_boolean('resume', 'object_store'),
+                'disable_ssl_validation': disable_ssl_validation,
+            }
+
+            # Settings that are not configured are taken from the environment
+            for [name, variable] in [['endpoint', 'AWS_ENDPOINT_URL'], ['access_key', 'AWS_ACCESS_KEY_ID'],
+                                     ['secret_key', 'AWS_SECRET_ACCESS_KEY']]:
+                value = config.get(name, 'object_store')
+                object_store_options[name] = value if value not in ('', 'none') else os.environ.get(variable)
+
+            self.object_store_options = object_store_options
+
+        except ConfigError:
+            pass
+
+        except ValueError as e:
+            raise DataServerError("Invalid object store settings in config.ini: %s" % e)
+
+        statistics_file = self._statistics_file_argument
+        if statistics_file is None:
+            try:
+                statistics_file = config.get('statistics_file', 'log')
+
+            except ConfigError:
+                pass
+
+        self.statistics_file = statistics_file if statistics_file not in ('', 'none') else None
+
+        if disable_ssl_validation != self.disable_ssl_validation:
+            self._http_handles = threading.local()
+
         self.api_url = api_url
         self.api_key = api_key
         self.api_email = api_email
+        self.disable_ssl_validation = disable_ssl_validation
 
-        self.transfer_queue = None
+        self._settings_signature = signature
 
-        self.log("ECMWF API python library %s initialised" % config.get('version', 'client'), 'info')
+    @classmethod
+    def _apply_global_settings(cls, config_signature):
+        """
+        Configure the components shared by all servers of the process, the API cache, bandwidth limiter, block scheduler
+        and host coordinator, from the loaded configuration. They are only configured again when the configuration file
+        changed, so creating or refreshing a server does not reset runtime changes made to them.
+
+        :param config_signature: modification time of the loaded configuration file
+        """
+
+        with cls._global_settings_lock:
+            if config_signature == cls._global_settings_signature:
+                return
+
+            try:
+                api_cache.ttl = config.get_int('api_cache_ttl', 'network')
+
+            except ConfigError:
+                pass
+
+            try:
+                bandwidth_limiter.configure(config.get_int('bandwidth_limit', 'network'),
+                                            config.get_float('bandwidth_burst', 'network'),
+                                            parse_schedule(config.get('bandwidth_schedule', 'network')))
+
+            except ConfigError:
+                pass
+
+            except (BandwidthLimiterError, ValueError) as e:
+                raise DataServerError("Invalid bandwidth settings in config.ini: %s" % e)
+
+            try:
+                block_scheduler.configure(config.get_int('download_workers', 'network'),
+                                          config.get('download_policy', 'network'))
+
+            except ConfigError:
+                pass
+
+            except (CustomHttpError, ValueError) as e:
+                raise DataServerError("Invalid download settings in config.ini: %s" % e)
+
+            try:
+                directory = config.get('directory', 'coordination')
+                host_coordinator.configure(directory if directory not in ('', 'none') else None,
+                                           config.get_int('max_requests', 'coordination'),
+                                           config.get_float('submission_rate', 'coordination'),
+                                           config.get_float('submission_burst', 'coordination'))
+
+            except ConfigError:
+                pass
+
+            except (HostCoordinatorError, ValueError) as e:
+                raise DataServerError("Invalid coordination settings in config.ini: %s" % e)
+
+            cls._global_settings_signature = config_signature
+
+    def _get_settings_signature(self):
+        """
+        Determine the state of the sources of the settings, to detect changes without reading them
+
+        :return: tuple with the modification times of the configuration and ~/.ecmwfapirc files, and the credentials in
+            the environment
+        """
+
+        modification_times = []
+
+        for path in (self._config_path, os.path.expanduser("~/.ecmwfapirc")):
+            try:
+                modification_times.append(os.stat(path).st_mtime)
+
+            except OSError:
+                modification_times.append(None)
+
+        return (tuple(modification_times), os.environ.get('ECMWF_API_KEY'), os.environ.get('ECMWF_API_URL'),
+                os.environ.get('ECMWF_API_EMAIL'))
+
+    def _get_http_handle(self):
+        """
+        :return: HTTP handle of the current thread, created on first use
+        """
+
+        handle = getattr(self._http_handles, 'handle', None)
+
+        if handle is None:
+            handle = create_http_handle(30, self.disable_ssl_validation)
+            self._http_handles.handle = handle
+
+        return handle
+
+    def close(self):
+        """
+        Output the queued log messages and stop the writer thread of the build-in log. Called automatically when the
+        server is discarded.
+        """
+
+        if self._close_log is not None:
+            self._close_log()
 
     def log(self, message, level, request_id=None):
         """
@@ -109,11 +360,15 @@ class ECMWFDataServer:
         else:
             self.log_method("[%s] %s" % (level, message))
 
-    def retrieve(self, request_data):
+    def retrieve(self, request_data, control=None):
         """
         Retrieve a dataset with the given parameters
 
-        :param request_data: parameter list for transfer, or list of multiple parameter lists
+        :param request_data: parameter list for transfer, or list of multiple parameter lists. The target can be a list
+            of files, the result is then downloaded once and written to all of them.
+        :param control: optional TransferControl to pause or cancel the transfers. Remaining requests are skipped once
+            the transfers are cancelled.
+        :return: list with the TransferStatistics of the processed requests
         """
 
         if isinstance(request_data, dict):
@@ -122,29 +377,44 @@ class ECMWFDataServer:
         elif not isinstance(request_data, list):
             self.log("The request data object should be a dictionary with the parameters or a list with multiple"
                      "dictionaries for multiple transfers", 'error')
-            return
+            return []
 
         if len(request_data) == 0:
             self.log("No requests were given", 'warning')
-            return
+            return []
+
+        self._refresh_settings()
+
+        statistics = []
 
         for [index, request] in enumerate(request_data):
 
+            if control is not None and control.is_cancelled():
+                break
+
             if len(request_data) > 1:
-                self._process_request(request, index + 1)
+                statistics.append(self._process_request(request, index + 1, control))
 
             else:
-                self._process_request(request, 1)
+                statistics.append(self._process_request(request, 1, control))
+
+        if control is not None and control.is_cancelled():
+            self.log("ECMWFDataServer requests cancelled", 'warning')
+            return statistics
 
         self.log("ECMWFDataServer completed all requests", 'info')
 
-    def retrieve_parallel(self, request_data, parallel_count=None):
+        return statistics
+
+    def retrieve_parallel(self, request_data, parallel_count=None, control=None):
         """
         Retrieve the given datasets in parallel - the different transfers are ran in parallel, but each individual
         dataset is downloaded sequentially
 
         :param request_data: parameter list for transfer, or list of multiple parameter lists
         :param parallel_count: maximum number of parallel / concurrent transfers
+        :param control: optional TransferControl to pause or cancel all transfers
+        :return: list with the TransferStatistics of the processed requests, in the order of the requests
         """
 
         if isinstance(request_data, dict):
@@ -153,11 +423,13 @@ class ECMWFDataServer:
         elif not isinstance(request_data, list):
             self.log("The request data object should be a dictionary with the parameters or a list with multiple"
                      "dictionaries for multiple transfers", 'error')
-            return
+            return []
 
         if len(request_data) == 0:
             self.log("No requests were given", 'warning')
-            return
+            return []
+
+        self._refresh_settings()
 
         # Determine parallel count
         if not isinstance(parallel_count, int):
@@ -168,13 +440,14 @@ class ECMWFDataServer:
                 self.log("No parallel count given and not set in configuration file either", 'error')
 
         self.transfer_queue = queue.Queue()
+        statistics = {}
 
         # Launch the desired number of threads to process the requests
         self.log("Launching %s threads to process transfers" % parallel_count, 'info')
 
         threads = []
         for i in range(parallel_count):
-            t = threading.Thread(target=self._parallel_worker)
+            t = threading.Thread(target=self._parallel_worker, args=(control, statistics))
             t.daemon = True
             t.start()
             threads.append(t)
@@ -186,7 +459,14 @@ class ECMWFDataServer:
             request_id += 1
 
             # Wait 3 seconds to not make too many API calls
-            time.sleep(3)
+            try:
+                if control is not None:
+                    control.sleep(3)
+                else:
+                    time.sleep(3)
+
+            except TransferCancelledError:
+                pass
 
         # Add stop indicators to the queue, 1 for each thread
         for i in range(parallel_count):
@@ -198,20 +478,33 @@ class ECMWFDataServer:
 
         self.log("ECMWFDataServer completed all requests in parallel", 'info')
 
-    def _process_request(self, request_data, request_id):
+        return [statistics[key] for key in sorted(statistics)]
+
+    def _refresh_settings(self):
+        """
+        Refresh the settings before processing requests. The current settings are kept if they can not be reloaded.
+        """
+
+        try:
+            self.refresh()
+
+        except DataServerError as e:
+            self.log("Failed to reload the settings, continuing with the current settings: %s" % e, 'warning')
+
+    def _process_request(self, request_data, request_id, control=None):
         """
         Process the dataset transfer request. Used in both normal and parallel requests.
 
         :param request_data: parameter list for transfer
         :param request_id: identification of requests, used when multiple or parallel requests are initialised to inform
                            the user of the progress and which request is currently processed
+        :param control: optional TransferControl to pause or cancel the transfer
+        :return: TransferStatistics of the request
         """
 
-        try:
-            disable_ssl_validation = config.get_boolean('disable_ssl_validation', 'network')
-
-        except ConfigError:
-            disable_ssl_validation = False
+        stats = TransferStatistics(request_id, request_data.get('dataset'), request_data.get('target'))
+        status = 'completed'
+        error = None
 
         if request_id is not None:
             self.log("Starting request %i" % request_id, 'info', request_id)
@@ -219,18 +512,65 @@ class ECMWFDataServer:
         else:
             self.log("Starting request", 'info', request_id)
 
-        try:
-            connection = ApiConnection(self.api_url, "datasets/%s" % request_data['dataset'], self.api_email,
-                                       self.api_key, self.log, disable_ssl_validation=disable_ssl_validation,
-                                       request_id=request_id)
-            connection.transfer_request(request_data, request_data['target'])
+        # Requests rejected because of the credentials are retried once if the credentials have changed since
+        for attempt in range(2):
+            try:
+                with tracing.span('request', request_id=request_id, dataset=request_data.get('dataset'),
+                                  target=request_data.get('target'), attempt=attempt + 1, payload=request_data):
+                    connection = ApiConnection(self.api_url, "datasets/%s" % request_data['dataset'],
+                                               self.api_email, self.api_key, self.log,
+                                               disable_ssl_validation=self.disable_ssl_validation,
+                                               request_id=request_id, http_handle=self._get_http_handle(),
+                                               download_threads=self.download_threads,
+                                               file_writer_options=self.file_writer_options,
+                                               object_store_options=self.object_store_options)
+                    # The API expects a single target, the other targets only concern the client
+                    target = request_data['target']
+                    payload = dict(request_data, target=target[0]) if isinstance(target, list) else request_data
+
+                    connection.transfer_request(payload, target, control, stats)
+
+            except ApiAuthenticationError as e:
+                api_cache.invalidate(self.api_url, self.api_email, self.api_key)
+
+                try:
+                    if attempt == 0 and self.refresh(True):
+                        self.log("The API credentials have changed, retrying the request", 'warning', request_id)
+                        continue
+
+                except DataServerError as refresh_error:
+                    self.log("Failed to reload the API credentials: %s" % refresh_error, 'warning', request_id)
+
+                self.log("API connection error: %s" % e, 'error', request_id)
+                [status, error] = ['failed', str(e)]
+
+            except ApiConnectionError as e:
+                self.log("API connection error: %s" % e, 'error', request_id)
+                [status, error] = ['failed', str(e)]
+
+            except TransferCancelledError:
+                # Already reported by the API connection
+                status = 'cancelled'
 
-        except ApiConnectionError as e:
-            self.log("API connection error: %s" % e, 'error', request_id)
+            break
 
-    def _parallel_worker(self):
+        stats.finish(status, error)
+
+        if self.statistics_file is not None:
+            try:
+                write_statistics(self.statistics_file, [stats])
+
+            except TransferStatisticsError as e:
+                self.log(str(e), 'warning', request_id)
+
+        return stats
+
+    def _parallel_worker(self, control=None, statistics=None):
         """
         Worker function to process parallel transfers, multiple instances launched in threads
+
+        :param control: optional TransferControl to pause or cancel the transfers
+        :param statistics: optional dictionary in which the TransferStatistics are stored by request ID
         """
 
         if self.transfer_queue is None:
@@ -247,7 +587,13 @@ class ECMWFDataServer:
                 self.log("Invalid transfer item in queue", 'warning')
                 continue
 
-            self._process_request(item[0], item[1])
+            elif control is not None and control.is_cancelled():
+                continue
+
+            stats = self._process_request(item[0], item[1], control)
+
+            if statistics is not None:
+                statistics[item[1]] = stats
 
     def _get_api_key_values(self):
         """
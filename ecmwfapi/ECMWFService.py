@@ -18,6 +18,7 @@ import os
 from .api_connection import *
 from .config import *
 from .log import *
+from .transfer_control import TransferCancelledError
 from .ECMWFDataServer import ECMWFDataServer
 
 
@@ -39,12 +40,13 @@ class ECMWFService(ECMWFDataServer):
 
         self.service = service
 
-    def execute(self, request_data, target):
+    def execute(self, request_data, target, control=None):
         """
         Retrieve a service with the given parameters
 
         :param request_data: parameter list
         :param target: Target of the request
+        :param control: optional TransferControl to pause or cancel the requests
         """
 
         if isinstance(request_data, dict):
@@ -67,6 +69,10 @@ class ECMWFService(ECMWFDataServer):
 
         for [index, request] in enumerate(request_data):
 
+            if control is not None and control.is_cancelled():
+                self.log("ECMWFService requests cancelled", 'warning')
+                return
+
             if len(request_data) == 1:
                 self.log("Starting request", 'info')
 
@@ -76,11 +82,15 @@ class ECMWFService(ECMWFDataServer):
             try:
                 connection = ApiConnection(self.api_url, "services/%s" % self.service, self.api_email,
                                            self.api_key, self.log, disable_ssl_validation=disable_ssl_validation)
-                connection.transfer_request(request, target)
+                connection.transfer_request(request, target, control)
 
             except ApiConnectionError as e:
                 self.log("API connection error: %s" % e, 'error')
 
+            except TransferCancelledError:
+                # Already reported by the API connection
+                pass
+
         self.log("ECMWFService done", 'info')
 
     def retrieve(self, request_data):
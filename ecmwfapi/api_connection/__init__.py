@@ -10,5 +10,6 @@
 # (C) Copyright 2017 Ricardo Persoon.
 
 
+from .api_cache import ApiCache, api_cache
 from .api_connection import ApiConnection
-from .exceptions import ApiConnectionError
+from .exceptions import ApiConnectionError, ApiAuthenticationError
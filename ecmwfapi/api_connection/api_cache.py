@@ -0,0 +1,86 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+import threading
+import time
+
+
+class ApiCache:
+    """
+    Process-wide cache of API lookups that do not depend on the request, such as the user details and the news of a
+    service. Entries are keyed by the API URL and credentials and expire after a fixed number of seconds.
+    """
+
+    def __init__(self, ttl=3600):
+        """
+        :param ttl: number of seconds after which entries expire, caching is disabled if zero
+        """
+
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+
+        # Cached values by key, as [expiry time, value]
+        self._entries = {}
+
+    def get(self, key, fetch, refresh=False):
+        """
+        Get a cached value, or fetch and cache it if it is missing or expired. The value is fetched without holding the
+        lock, so concurrent misses of the same key may fetch it more than once.
+
+        :param key: tuple identifying the value, starting with the API URL, e-mail address and key
+        :param fetch: function without arguments that retrieves the value from the API
+        :param refresh: whether to fetch the value even if it is cached
+        :return: tuple with the value, whether it was fetched, and whether it was fetched and differs from the value
+            cached before
+        """
+
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry is not None and not refresh and entry[0] > now:
+            return entry[1], False, False
+
+        value = fetch()
+
+        if self.ttl > 0:
+            with self._lock:
+                self._entries[key] = [now + self.ttl, value]
+
+        return value, True, entry is None or entry[1] != value
+
+    def invalidate(self, api_url, api_email, api_key):
+        """
+        Drop all entries of the given credentials, for example after the API rejected them
+
+        :param api_url: ECMWF API url
+        :param api_email: e-mail address used to register for the API
+        :param api_key: authentication API key
+        """
+
+        with self._lock:
+            for key in [key for key in self._entries if key[:3] == (api_url, api_email, api_key)]:
+                del self._entries[key]
+
+    def clear(self):
+        """
+        Drop all entries
+        """
+
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared by all API connections of the process
+api_cache = ApiCache()
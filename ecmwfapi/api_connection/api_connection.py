@@ -10,19 +10,37 @@
 # (C) Copyright 2017 Ricardo Persoon.
 
 
-from .exceptions import ApiConnectionError
+from .api_cache import api_cache
+from .exceptions import ApiConnectionError, ApiAuthenticationError
 
+import hashlib
 import json
-import sys
+import os
 import time
 
-from ecmwfapi import custom_http
+from ecmwfapi import custom_http, tracing
+from ecmwfapi.file_writer import FileWriter, FileWriterError, MultiWriter, compressed_path
+from ecmwfapi.host_coordinator import HostCoordinatorError, RequestSlot, host_coordinator
+from ecmwfapi.object_store import ObjectStoreError, S3Writer
+from ecmwfapi.metrics import metrics
+from ecmwfapi.transfer_control import TransferCancelledError
+
+
+_queue_time = metrics.histogram('ecmwfapi_request_queue_seconds',
+                                "Time requests spent queued at the ECMWF API before they became active")
+_api_request_retries = metrics.counter('ecmwfapi_api_request_retries_total', "Number of failed API calls that were "
+                                       "retried")
+_active_downloads = metrics.gauge('ecmwfapi_active_downloads', "Number of downloads in progress")
+_download_throughput = metrics.histogram('ecmwfapi_download_throughput_bytes_per_second',
+                                         "Average throughput of completed downloads",
+                                         buckets=[2 ** exponent for exponent in range(16, 32, 2)])
 
 
 class ApiConnection(object):
 
     def __init__(self, api_url, api_service, api_email, api_key, log, report_news=True, disable_ssl_validation=False,
-                 request_id=None):
+                 request_id=None, http_handle=None, refresh_cache=False, download_threads=1, file_writer_options=None,
+                 object_store_options=None):
         """
         :param api_url: ECMWF API url
         :param api_service: the service that is called at the API
@@ -30,7 +48,17 @@ class ApiConnection(object):
         :param api_key: authentication API key
         :param log: the logging method used. Should accept 2 parameters: the message itself and the logging level, which
             can be one of [info, warning, error]
-        :param report_news: whether to output news messages from the API
+        :param report_news: whether to output news messages from the API. News is only reported when it is retrieved
+            for the first time in the process, or when it changed since.
+        :param http_handle: optional HTTP handle created with custom_http.create_http_handle, reused for the API
+            requests and the download so their connections are kept open
+        :param refresh_cache: whether to retrieve the user details and news from the API, even if they are cached
+        :param download_threads: maximum number of blocks of the result downloaded at the same time. If more than 1, the
+            blocks are downloaded by the process-wide block scheduler instead of over the HTTP handle.
+        :param file_writer_options: optional dictionary with keyword arguments of the FileWriter that writes the result
+            to the target file
+        :param object_store_options: optional dictionary with keyword arguments of the S3Writer that uploads the result
+            to s3://bucket/key targets, including the endpoint and the credentials
         """
 
         self.api_url = api_url
@@ -39,6 +67,7 @@ class ApiConnection(object):
         self.api_service = api_service
         self.log = log
         self.retry = 5
+        self.retries = 0
         self.location = None
         self.done = False
         self.value = True
@@ -46,31 +75,87 @@ class ApiConnection(object):
         self.status = None
         self.disable_ssl_validation = disable_ssl_validation
         self.request_id = request_id
+        self.http_handle = http_handle
+        self.download_threads = download_threads
+        self.file_writer_options = file_writer_options or {}
+        self.object_store_options = object_store_options or {}
 
         self.log("Connecting to ECMWF API at %s" % self.api_url, 'info', self.request_id)
 
-        # Retrieve user details
-        user = self._api_request('%s/who-am-i' % self.api_url)[1]
+        credentials = (self.api_url, self.api_email, self.api_key)
+        user_url = '%s/who-am-i' % self.api_url
+        news_url = '%s/%s/news' % (self.api_url, self.api_service)
+
+        # Retrieve user details, which are shared by all connections with the same credentials
+        [user, fetched, _] = api_cache.get(credentials + ('who-am-i',), lambda: self._api_request(user_url)[1],
+                                           refresh_cache)
+
+        self.cache_status = 'miss' if fetched else 'hit'
+
+        self.user = user
         self.log("Registered as %s" % user['full_name'] or "user '%s'" % user['uid'], 'info', self.request_id)
 
         # Display the news if requested and if available
         if report_news:
-            news = self._api_request('%s/%s/news' % (self.api_url, self.api_service))[1]
-            for item in news['news'].split("\n"):
-                if len(item) > 0:
-                    self.log("News: %s" % item, 'info', self.request_id)
+            [news, _, changed] = api_cache.get(credentials + ('news', self.api_service),
+                                            lambda: self._api_request(news_url)[1], refresh_cache)
 
-    def transfer_request(self, request, target=None):
+            if changed:
+                for item in news['news'].split("\n"):
+                    if len(item) > 0:
+                        self.log("News: %s" % item, 'info', self.request_id)
+
+    def transfer_request(self, request, target=None, control=None, stats=None):
         """
         Transfer a dataset
 
         :param request: dictionary with request data
-        :param target: location to write data to. Outputs to stdout if target == None
+        :param target: location to write data to, or a list of locations to write the same data to. Locations of the
+            form s3://bucket/key are uploaded to object storage. Outputs to stdout if target == None
+        :param control: optional TransferControl to pause or cancel the transfer. When the transfer is cancelled, the
+            request is deleted at the API and TransferCancelledError is raised.
+        :param stats: optional TransferStatistics in which the timing of the request and the download are recorded
         """
 
         status = None
 
-        content = self._api_request('%s/%s/requests' % (self.api_url, self.api_service), 'POST', request)[1]
+        # Wait until the request fits in the host-wide budget of the credentials. The slot is held while the request is
+        # queued or active at the API.
+        try:
+            with tracing.span('coordination_wait', request_id=self.request_id):
+                slot = host_coordinator.acquire((self.api_url, self.api_email, self.api_key), control)
+
+        except HostCoordinatorError as e:
+            self.log("Failed to coordinate the request with the other processes on the host, continuing without: %s"
+                     % e, 'warning', self.request_id)
+            slot = RequestSlot(host_coordinator, None)
+
+        if stats is not None:
+            stats.coordination_wait_duration = slot.waited
+
+        if slot.waited >= 1:
+            self.log("Waited %.1f seconds for the host-wide request limit" % slot.waited, 'info', self.request_id)
+
+        try:
+            content = self._api_request('%s/%s/requests' % (self.api_url, self.api_service), 'POST', request)[1]
+
+        except BaseException:
+            slot.release()
+            raise
+
+        submit_time = time.time()
+
+        queued = content['status'] == 'queued'
+        if not queued:
+            _queue_time.observe(0)
+
+        if stats is not None:
+            stats.submit_time = submit_time
+            stats.cache_status = self.cache_status
+
+            if not queued:
+                stats.active_time = submit_time
+
         self.log("Request submitted", 'info', self.request_id)
         self.log("Request id: %s" % content['name'], 'info', self.request_id)
 
@@ -78,50 +163,230 @@ class ApiConnection(object):
             status = content['status']
             self.log("Request is %s" % status, 'info', self.request_id)
 
-        while not self.done:
-            if content['status'] != status:
-                status = content['status']
-                self.log("Request is %s" % status, 'info', self.request_id)
+        try:
+            while not self.done:
+                if content['status'] != status:
+                    status = content['status']
+                    self.log("Request is %s" % status, 'info', self.request_id)
 
-            time.sleep(self.retry)
+                with tracing.span('poll_wait', request_id=self.request_id, status=status, seconds=self.retry):
+                    if control is not None:
+                        control.sleep(self.retry)
+                    else:
+                        time.sleep(self.retry)
 
-            content = self._api_request(self.location, 'GET')[1]
-            if content['status'] == 'complete':
-                self.done = True
+                content = self._api_request(self.location, 'GET')[1]
+                if content['status'] == 'complete':
+                    self.done = True
 
-        if self.status != status:
-            status = self.status
-            self.log("Request is %s" % status, 'info', self.request_id)
+                    # The result no longer counts against the limits of the API while it is downloaded
+                    slot.release()
+
+                    if stats is not None:
+                        stats.complete_time = time.time()
+
+                if queued and content['status'] != 'queued':
+                    queued = False
+                    _queue_time.observe(time.time() - submit_time)
+
+                    if stats is not None:
+                        stats.active_time = time.time()
+
+            if self.status != status:
+                status = self.status
+                self.log("Request is %s" % status, 'info', self.request_id)
 
-        result = content
+            result = content
 
-        if target:
             if target:
-                file = open(target, "wb")
-            else:
-                file = sys.stdout
+                # Uploads of the result of the same request by an earlier attempt can be resumed
+                resume_token = hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+                self._download(result['href'], target, control, stats, result.get('size'), resume_token)
+
+        except TransferCancelledError:
+            self.log("Request cancelled", 'warning', self.request_id)
+            raise
+
+        finally:
+            # Try to delete the request at the API, which also cancels it if it is still queued or active there. Ignore
+            # exceptions as it does not have any impact.
+            try:
+                self._api_request(self.location, 'DELETE')
+
+            except ApiConnectionError:
+                pass
+
+            slot.release()
+
+            if stats is not None:
+                stats.api_retries = self.retries
+
+    def _download(self, url, target, control=None, stats=None, size=None, resume_token=None):
+        """
+        Download the result of a request to the target file. The file is written by the thread of a FileWriter, so the
+        download does not wait for the disk. Results for s3://bucket/key targets are uploaded with an S3Writer instead.
+        With multiple targets the result is downloaded once and written to all of them, each by its own writer.
+        Compressed results are written to the target with the suffix of the compression method appended, such as
+        .gz, unless the target already ends with it. With multiple target files the result is compressed once, by a
+        writer that hands the compressed data to the writers of the files. Partially written files and uploads are
+        removed if the transfer is cancelled.
+
+        :param url: URL of the result
+        :param target: location to write data to, or a list of locations
+        :param control: optional TransferControl to pause or cancel the download
+        :param stats: optional TransferStatistics in which the download is recorded
+        :param size: expected size of the result as reported by the API, used to preallocate the file
+        :param resume_token: identifier of the result, with which an incomplete upload of it can be resumed, see
+            S3Writer
+        """
+
+        bandwidth_weight = control.bandwidth_weight if control is not None else 1
+        priority = control.priority if control is not None else 0
+
+        targets = target if isinstance(target, list) else [target]
+
+        # Compressed files get the suffix of the compression method, so they are not mistaken for the plain result
+        compression = self.file_writer_options.get('compression')
+        targets = [item if item.startswith('s3://') else compressed_path(item, compression) for item in targets]
+
+        if stats is not None and compression:
+            stats.target = targets if isinstance(target, list) else targets[0]
 
+        files = [item for item in targets if not item.startswith('s3://')]
+        shared_compression = compression and len(files) > 1
+
+        # The files receive data that is compressed already, the size of which is not known in advance
+        file_writer_options = self.file_writer_options
+        if shared_compression:
+            file_writer_options = dict(file_writer_options, compression=None, compression_level=None, preallocate=False)
+
+        writers = []
+        try:
+            for item in targets:
+                if item.startswith('s3://'):
+                    writers.append(S3Writer.from_url(item, resume_token=resume_token, **self.object_store_options))
+
+                else:
+                    writers.append(FileWriter(open(item, "w+b"), size=size, **file_writer_options))
+
+        except (IOError, OSError, ObjectStoreError) as e:
+            for writer in writers:
+                writer.abort()
+
+            raise ApiConnectionError("Failed to open target %s: %s" % (item, e))
+
+        # The writer that compresses the data for all files, otherwise the writer of the first target, which compresses
+        # its own data if compression is enabled
+        compressor = writers[0]
+        sinks = writers
+        sink_names = targets
+
+        if shared_compression:
+            compressor = FileWriter(MultiWriter([writer for writer in writers if isinstance(writer, FileWriter)], files),
+                                    buffer_size=self.file_writer_options.get('buffer_size', 4194304),
+                                    buffers=self.file_writer_options.get('buffers', 2), compression=compression,
+                                    compression_level=self.file_writer_options.get('compression_level'))
+
+            sinks = [compressor] + [writer for writer in writers if isinstance(writer, S3Writer)]
+            sink_names = ['compression'] + [item for item in targets if item.startswith('s3://')]
+
+        file = sinks[0] if len(sinks) == 1 else MultiWriter(sinks, sink_names)
+        _active_downloads.inc()
+
+        try:
             time_start = time.time()
 
             # Transfer the dataset using the robust file transfer
-            transfer_size = custom_http.robust_get_file(result['href'], file,
-                                                        disable_ssl_validation=self.disable_ssl_validation)
+            with tracing.span('download', request_id=self.request_id, target=target) as span:
+                if stats is not None:
+                    stats.download_start_time = time_start
+
+                if self.download_threads > 1:
+                    transfer_size = custom_http.robust_get_file_parallel(
+                        url, file, disable_ssl_validation=self.disable_ssl_validation, threads=self.download_threads,
+                        control=control, stats=stats, log=self._log_transfer, bandwidth_weight=bandwidth_weight,
+                        priority=priority)
+
+                else:
+                    transfer_size = custom_http.robust_get_file(url, file,
+                                                                disable_ssl_validation=self.disable_ssl_validation,
+                                                                control=control, http_handle=self.http_handle,
+                                                                stats=stats, log=self._log_transfer,
+                                                                bandwidth_weight=bandwidth_weight)
+                span.set('bytes', transfer_size)
+
+                with tracing.span('file_close', request_id=self.request_id):
+                    file.close()
 
             time_end = time.time()
 
+            if stats is not None:
+                stats.download_end_time = time_end
+                stats.bytes = transfer_size
+                stats.write_duration = max(writer.write_duration for writer in writers)
+                stats.write_wait_duration = sum(writer.buffer_wait_duration for writer in writers)
+
+                if shared_compression:
+                    stats.write_wait_duration += compressor.buffer_wait_duration
+
+                if compressor.compression:
+                    stats.compression = compressor.compression
+                    stats.compressed_bytes = compressor.file_bytes
+                    stats.compression_duration = compressor.compression_duration
+
+                if len(writers) > 1 or isinstance(writers[0], S3Writer):
+                    stats.sinks = [dict(writer.get_statistics(), name=item) for [item, writer] in zip(targets, writers)]
+
             if time_end > time_start:
                 self.log("Transfer rate %s/s" % self._bytename(transfer_size / (time_end - time_start)), 'info',
                          self.request_id)
+                _download_throughput.observe(transfer_size / (time_end - time_start))
 
-            file.flush()
-            file.close()
+            if compressor.compression and compressor.file_bytes:
+                self.log("Compressed with %s to %s, ratio %.2f, written to %s"
+                         % (compressor.compression, self._bytename(compressor.file_bytes),
+                            compressor.compression_ratio(), ', '.join(files)), 'info', self.request_id)
 
-        # Try to delete the file at the API. Ignore exceptions as it does not have any impact.
-        try:
-            self._api_request(self.location, 'DELETE')
+            for [item, writer] in zip(targets, writers):
+                if isinstance(writer, S3Writer) and writer.resumed_parts > 0:
+                    self.log("Resumed upload %s of %s, %s parts were already uploaded" % (writer.upload_id, item,
+                                                                                         writer.resumed_parts), 'info',
+                             self.request_id)
 
-        except ApiConnectionError:
-            pass
+                if (len(writers) > 1 or isinstance(writer, S3Writer)) and writer.write_duration:
+                    self.log("Write rate to %s %s/s" % (item, self._bytename(writer.file_bytes / writer.write_duration)),
+                             'info', self.request_id)
+
+        except TransferCancelledError:
+            file.abort()
+
+            for [item, writer] in zip(targets, writers):
+                if isinstance(writer, S3Writer):
+                    writer.discard()
+
+                else:
+                    os.remove(item)
+
+            raise
+
+        except custom_http.CustomHttpError as e:
+            file.abort()
+            raise ApiConnectionError("Failed to download the result: %s" % e)
+
+        except (FileWriterError, ObjectStoreError) as e:
+            file.abort()
+            raise ApiConnectionError("Failed to write the result to %s: %s" % (', '.join(targets), e))
+
+        finally:
+            _active_downloads.dec()
+
+    def _log_transfer(self, message, level):
+        """
+        Logging method passed to the file transfer, which adds the request ID to the messages
+        """
+
+        self.log(message, level, self.request_id)
 
     def _api_request(self, url, request_type='GET', payload=None):
         """
@@ -147,41 +412,55 @@ class ApiConnection(object):
         # Construct API request URL
         url = "%s/?offset=%d&limit=500" % (url, self.message_offset)
 
-        while request_tries < 7 and not request_succeeded:
-            try:
-                if request_type == 'GET':
-                    [headers, content] = custom_http.get_request(url, request_headers, timeout=30,
-                                                                 disable_ssl_validation=self.disable_ssl_validation)
+        with tracing.span('api_request', method=request_type, url=url, request_id=self.request_id) as span:
+            while request_tries < 7 and not request_succeeded:
+                try:
+                    if request_type == 'GET':
+                        [headers, content] = custom_http.get_request(url, request_headers, timeout=30,
+                                                                     disable_ssl_validation=self.disable_ssl_validation,
+                                                                     http_handle=self.http_handle)
 
-                elif request_type == 'POST':
+                    elif request_type == 'POST':
 
-                    # Verify that a payload was given
-                    if not payload:
-                        raise ApiConnectionError("No payload given with POST request to %s" % url)
+                        # Verify that a payload was given
+                        if not payload:
+                            raise ApiConnectionError("No payload given with POST request to %s" % url)
 
-                    data = json.dumps(payload).encode('utf-8')
-                    [headers, content] = custom_http.post_request(url, data, request_headers, timeout=30,
-                                                                  disable_ssl_validation=self.disable_ssl_validation)
+                        data = json.dumps(payload).encode('utf-8')
+                        [headers, content] = custom_http.post_request(url, data, request_headers, timeout=30,
+                                                                      disable_ssl_validation=self.disable_ssl_validation,
+                                                                      http_handle=self.http_handle)
 
-                elif request_type == 'DELETE':
-                    [headers, content] = custom_http.delete_request(url, request_headers, timeout=30,
-                                                                    disable_ssl_validation=self.disable_ssl_validation)
+                    elif request_type == 'DELETE':
+                        [headers, content] = custom_http.delete_request(url, request_headers, timeout=30,
+                                                                        disable_ssl_validation=self.disable_ssl_validation,
+                                                                        http_handle=self.http_handle)
 
-                else:
-                    raise ApiConnectionError("Unknown API request type %s" % request_type)
+                    else:
+                        raise ApiConnectionError("Unknown API request type %s" % request_type)
 
-                request_succeeded = True
+                    request_succeeded = True
 
-            except custom_http.CustomHttpError as e:
-                self.log("Api request failed: %s" % e, 'warning', self.request_id)
-                request_tries += 1
+                except custom_http.CustomHttpError as e:
+                    self.log("Api request failed: %s" % e, 'warning', self.request_id)
+                    request_tries += 1
+                    self.retries += 1
+                    _api_request_retries.inc()
 
-                # Wait at least a second before the next try
-                time.sleep(1)
+                    # Wait at least a second before the next try
+                    time.sleep(1)
+
+            span.set('retries', request_tries)
+            if request_succeeded:
+                span.set('status', headers.status)
 
         if not request_succeeded:
             raise ApiConnectionError("Failed to complete API request")
 
+        # Reported separately, so callers can reload the credentials and retry
+        if headers.status in (401, 403):
+            raise ApiAuthenticationError("The API rejected the credentials (HTTP status %s)" % headers.status)
+
         # Decode the response
         try:
             content_raw = content.decode('utf-8')
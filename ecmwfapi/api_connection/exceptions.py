@@ -12,3 +12,7 @@
 
 class ApiConnectionError(Exception):
     pass
+
+
+class ApiAuthenticationError(ApiConnectionError):
+    pass
@@ -0,0 +1,242 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+from background_client.task_registry import TaskRegistryError
+from background_client.task_scheduler import TaskSchedulerError
+from .exceptions import AdmissionControlError, AdmissionRejectedError
+
+import math
+import os
+import queue
+import threading
+
+from ecmwfapi.metrics import metrics
+
+
+_admitted_tasks = metrics.counter('ecmwfapi_admission_admitted_total', "Number of transfers admitted to the task queue")
+_rejected_tasks = metrics.counter('ecmwfapi_admission_rejected_total', "Number of transfers rejected by admission "
+                                  "control, by reason", label_names=('reason',))
+
+
+class AdmissionController:
+    """
+    Decides whether new tasks are accepted in the task queue. Tasks are rejected, instead of waiting for room in the
+    queue, when the queue is full, when the owner has too many queued tasks or when the projected disk usage of the
+    queued and active tasks would leave too little free space on the target file system. Rejections come with a hint
+    of how many seconds to wait before submitting again.
+    """
+
+    def __init__(self, task_queue, task_registry, max_queued_per_owner=0, min_free_disk_space=0, default_task_size=0,
+                 retry_after=60):
+        """
+        Initialise the admission controller
+
+        :param task_queue: task scheduler in which admitted tasks are placed
+        :param task_registry: registry of the tasks, used to determine which disk space reservations are still needed
+            and the rate at which tasks complete
+        :param max_queued_per_owner: maximum number of queued tasks per owner, no limit if zero
+        :param min_free_disk_space: number of bytes that should remain free on the target file system after all
+            admitted tasks have completed, no check if zero
+        :param default_task_size: projected size in bytes of tasks that are submitted without an expected size
+        :param retry_after: number of seconds to suggest waiting if it can not be estimated from the completion rate
+        """
+
+        for value in (max_queued_per_owner, min_free_disk_space, default_task_size):
+            if not isinstance(value, int) or value < 0:
+                raise AdmissionControlError("The admission limits should be non-negative integers")
+
+        self.task_queue = task_queue
+        self.task_registry = task_registry
+        self.max_queued_per_owner = max_queued_per_owner
+        self.min_free_disk_space = min_free_disk_space
+        self.default_task_size = default_task_size
+        self.retry_after = retry_after
+
+        self._lock = threading.Lock()
+
+        # Projected disk usage of admitted tasks by task ID, as [device, target, size]
+        self._reservations = {}
+
+        self._admitted = 0
+        self._rejected = {}
+
+    def admit(self, task_id, owner, target, priority=None, deadline=None, expected_size=None, record=None):
+        """
+        Admit a task and place it in the task queue, or reject it. Never blocks on a full queue. Rejected tasks leave
+        no trace in the task registry, so load shedding does not show up as changes to clients polling for them.
+
+        :param task_id: ID of the task, which should be in the task registry already unless its record is given
+        :param owner: owner of the task
+        :param target: target file of the task, or list of target files
+        :param priority: priority of the task
+        :param deadline: optional epoch timestamp before which the task should be started
+        :param expected_size: expected size of the result in bytes, the default task size is used if None
+        :param record: optional TaskRecord of the task, added to the task registry only once the task is admitted
+        """
+
+        if expected_size is None:
+            expected_size = self.default_task_size
+
+        with self._lock:
+            if self.task_queue.full():
+                self._reject("The task queue is full", 'queue_full', 1)
+
+            if self.max_queued_per_owner > 0:
+                queued = self.task_queue.owner_qsize(owner)
+                if queued >= self.max_queued_per_owner:
+                    self._reject("Owner %s has reached the limit of %s queued transfers"
+                                 % (owner, self.max_queued_per_owner), 'owner_limit',
+                                 queued - self.max_queued_per_owner + 1)
+
+            # Every target is written in full, so each needs room for the result
+            reservations = []
+            if self.min_free_disk_space > 0:
+                for item in (target if isinstance(target, list) else [target]):
+                    if item:
+                        device = self._check_disk_space(item, expected_size, reservations)
+
+                        if device is not None:
+                            reservations.append([device, item, expected_size])
+
+            # Registered and queued while holding the task lock, so a transfer handler that takes the task from the
+            # queue finds its record
+            with self.task_registry.lock(task_id):
+                if record is not None:
+                    self.task_registry.add(record)
+
+                try:
+                    self.task_queue.put(task_id, priority, owner, deadline, block=False)
+
+                except queue.Full:
+                    self._unregister(record)
+                    self._reject("The task queue is full", 'queue_full', 1)
+
+                except TaskSchedulerError:
+                    self._unregister(record)
+                    raise
+
+            if reservations:
+                self._reservations[task_id] = reservations
+
+            self._admitted += 1
+            _admitted_tasks.inc()
+
+    def get_statistics(self):
+        """
+        Get the admission counters and limits
+
+        :return: dictionary with the number of admitted tasks, the number of rejected tasks per reason and the limits
+        """
+
+        with self._lock:
+            self._release_completed()
+
+            return {
+                'admitted': self._admitted,
+                'rejected': dict(self._rejected),
+                'rejected_total': sum(self._rejected.values()),
+                'reserved_disk_space': sum(item[2] for reservations in self._reservations.values()
+                                           for item in reservations),
+                'queued': self.task_queue.qsize(),
+                'max_queued': self.task_queue.maxsize,
+                'max_queued_per_owner': self.max_queued_per_owner,
+                'min_free_disk_space': self.min_free_disk_space,
+            }
+
+    def _check_disk_space(self, target, expected_size, pending=()):
+        """
+        Verify that the target file system has room for the task on top of the projected usage of admitted tasks.
+        Should be called with the lock held.
+
+        :param target: target file of the task
+        :param expected_size: expected size of the result in bytes
+        :param pending: reservations for the other targets of the task, as [device, target, size]
+        :return: device ID of the target file system, or None if it could not be determined
+        """
+
+        directory = os.path.dirname(os.path.abspath(target))
+
+        try:
+            device = os.stat(directory).st_dev
+            file_system = os.statvfs(directory)
+
+        except (OSError, AttributeError):
+            return None
+
+        free_space = file_system.f_bavail * file_system.f_frsize
+
+        self._release_completed()
+
+        # Files of active tasks already occupy part of their projected size
+        projected = 0
+        reservations = [item for items in self._reservations.values() for item in items] + list(pending)
+
+        for [reserved_device, reserved_target, reserved_size] in reservations:
+            if reserved_device == device:
+                try:
+                    projected += max(reserved_size - os.path.getsize(reserved_target), 0)
+
+                except OSError:
+                    projected += reserved_size
+
+        if free_space - projected - expected_size < self.min_free_disk_space:
+            self._reject("Not enough disk space for the transfer: %s bytes free, %s bytes projected for admitted "
+                         "transfers" % (free_space, projected), 'disk_space', None)
+
+        return device
+
+    def _release_completed(self):
+        """
+        Drop the disk space reservations of tasks that are no longer queued or active. Should be called with the lock
+        held.
+        """
+
+        for task_id in list(self._reservations):
+            try:
+                if self.task_registry.get(task_id).task_status in self.task_registry.active_statuses:
+                    continue
+
+            except TaskRegistryError:
+                pass
+
+            del self._reservations[task_id]
+
+    def _unregister(self, record):
+        """
+        Remove the record of a task that could not be queued after all. Should be called with the lock held.
+
+        :param record: TaskRecord added by admit, or None
+        """
+
+        if record is not None:
+            self.task_registry.remove(record.task_id)
+
+    def _reject(self, message, reason, blocking_tasks):
+        """
+        Count and raise a rejection. Should be called with the lock held.
+
+        :param message: description of the rejection
+        :param reason: short identifier of the limit that was reached
+        :param blocking_tasks: number of tasks that have to start before the submission can succeed, used to estimate
+            the retry period. The default retry period is used if None.
+        """
+
+        self._rejected[reason] = self._rejected.get(reason, 0) + 1
+        _rejected_tasks.labels(reason).inc()
+
+        retry_after = self.retry_after
+        if blocking_tasks is not None:
+            rate = self.task_registry.completion_rate()
+            if rate > 0:
+                retry_after = min(max(int(math.ceil(blocking_tasks / rate)), 1), 3600)
+
+        raise AdmissionRejectedError(message, reason, retry_after)
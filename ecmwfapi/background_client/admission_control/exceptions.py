@@ -0,0 +1,29 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+class AdmissionControlError(Exception):
+    pass
+
+
+class AdmissionRejectedError(AdmissionControlError):
+
+    def __init__(self, message, reason, retry_after):
+        """
+        :param message: description of the rejection
+        :param reason: short identifier of the limit that was reached
+        :param retry_after: suggested number of seconds to wait before submitting again
+        """
+
+        AdmissionControlError.__init__(self, message)
+
+        self.reason = reason
+        self.retry_after = retry_after
@@ -1,266 +1,628 @@
-#
-# (C) Copyright 2012-2013 ECMWF.
-#
-# This software is licensed under the terms of the Apache Licence Version 2.0
-# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
-# In applying this licence, ECMWF does not waive the privileges and immunities
-# granted to it by virtue of its status as an intergovernmental organisation nor
-# does it submit to any jurisdiction.
-#
-# (C) Copyright 2017 Ricardo Persoon.
-
-
-import datetime
-import json
-import queue
-import random
-import string
-import threading
-
-from background_client.socket_communication import SocketConnectionError
-from .exceptions import ConnectionHandlerError
-
-
-class ConnectionHandler(threading.Thread):
-
-    def __init__(self, log, connection_queue, allowed_ips, active_task_storage, completed_task_storage, task_queue,
-                 stop):
-        """
-        Initialise connection handler
-
-        :param log: logging handler
-        :param connection_queue: queue to retrieve connections from
-        :param allowed_ips: ips allowed to connect
-        :param active_task_storage: storage of the active tasks
-        :param completed_task_storage: storage of the completed tasks
-        :param task_queue: work queue with new tasks
-        :param stop: method to call when the stop command is received
-        """
-
-        # Initialise the thread
-        threading.Thread.__init__(self)
-
-        if not isinstance(connection_queue, queue.Queue):
-            raise ConnectionHandlerError("No valid queue object passed as connection queue")
-        if not isinstance(allowed_ips, list):
-            raise ConnectionHandlerError("No valid list object passed as allowed ips")
-
-        self.allowed_ips = allowed_ips
-        self.connection_queue = connection_queue
-        self.log = log
-        self.stop = stop
-
-        self.active_task_storage = active_task_storage
-        self.completed_task_storage = completed_task_storage
-        self.task_queue = task_queue
-
-    def run(self):
-        """
-        Main run function of the connection handler. Loops over connections in the queue and places data objects in
-        the data queue
-        """
-
-        # Run until poison pill received
-        while True:
-
-            # Get a new connection from the queue
-            connection = self.connection_queue.get()
-
-            # Poison pill send through None object, end the loop if we get one
-            if connection is None:
-                break
-
-            if connection.get_remote_host() not in self.allowed_ips:
-                self.log.warning("Unauthorized connection from %s" % connection.get_remote_host())
-                continue
-
-            try:
-                message = connection.receive()
-
-            except SocketConnectionError as e:
-                self.log.warning("Error while receiving message: %s" % str(e))
-                continue
-
-            try:
-                message = json.loads(message)
-
-            except (json.decoder.JSONDecodeError, TypeError) as e:
-                self.log.error("Invalid JSON message: %s. Error: %s" % (message, e))
-                exit(-1)
-
-            response = None
-            command_type = None
-            command_data = None
-
-            try:
-                command_type = message['command']
-                command_data = message['data']
-
-            except KeyError as e:
-                response = {
-                    'status': 'error',
-                    'error_message': "Invalid request, no command and / or data passed (%s)" % e
-                }
-
-            if response is None:
-
-                if command_type == 'list_active_transfers':
-
-                    data = self.list_transfers()
-
-                    response = {
-                        'status': 'ok',
-                        'data': data
-                    }
-
-                elif command_type == 'list_completed_transfers':
-
-                    data = self.list_transfers(True)
-
-                    response = {
-                        'status': 'ok',
-                        'data': data
-                    }
-
-                elif command_type == 'add_transfer':
-
-                    try:
-                        task_id = self.add_transfer(command_data)
-
-                        response = {
-                            'status': 'ok',
-                            'data': {
-                                'task_id': task_id
-                            }
-                        }
-
-                    except ConnectionHandlerError as e:
-                        self.log.error("Failed to add transfer: %s" % e)
-
-                        response = {
-                            'status': 'error',
-                            'error_message': "Failed to add the transfer"
-                        }
-
-                elif command_type == 'cancel_transfer':
-
-                    try:
-                        task_id = command_data['task_id']
-
-                    except KeyError:
-                        self.log.error("Failed to cancel transfer: %s" % e)
-
-                        response = {
-                            'status': 'error',
-                            'error_message': "Failed to cancel the transfer. It might be active or completed already."
-                        }
-
-                    else:
-                        try:
-                            self.cancel_transfer(task_id)
-
-                            response = {
-                                'status': 'ok'
-                            }
-
-                        except ConnectionHandlerError as e:
-                            self.log.error("Failed to cancel transfer: %s" % e)
-
-                            response = {
-                                'status': 'error',
-                                'error_message': "Failed to cancel the transfer. It might be active or completed "
-                                                 "already."
-                            }
-
-                elif command_type == 'heartbeat':
-                    response = {
-                        'status': 'ok',
-                        'data': {}
-                    }
-
-                elif command_type == 'stop':
-
-                    self.stop()
-
-                    response = {
-                        'status': 'ok',
-                        'data': {}
-                    }
-
-                else:
-                    response = {
-                        'status': 'error',
-                        'error_message': "Invalid command %s" % command_type
-                    }
-
-            # Json encode the response
-            response = json.dumps(response)
-
-            # Send the response and terminate connection
-            connection.send(response)
-            connection.close()
-
-            self.connection_queue.task_done()
-
-    def list_transfers(self, completed=False):
-        """
-        List the currently active or completed transfers
-        :param completed: whether to list completed or active transfers
-        :return: dictionary with transfers
-        """
-
-        data = []
-
-        if completed:
-            storage = self.completed_task_storage
-        else:
-            storage = self.active_task_storage
-
-        for task_id, item in storage.items():
-            data.append({
-                'task_id': task_id,
-                'task_added': item['task_added'],
-                'task_status': item['task_status'],
-            })
-
-        return data
-
-    def add_transfer(self, data):
-        """
-        Add a transfer to the queue
-
-        :param data: transfer data
-        :return task_id: id of the newly created task
-        """
-
-        task_id = ''.join(random.choice(string.ascii_lowercase) for _ in range(32))
-
-        self.active_task_storage[task_id] = {
-            'task_added': datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S'),
-            'task_status': 'queued',
-            'task_data': data,
-        }
-
-        # Add the task to the queue for processing
-        self.task_queue.put(task_id)
-
-        return task_id
-
-    def cancel_transfer(self, task_id):
-        """
-        Cancel a transfer. Only possible if the transfer is queued and not yet active.
-
-        :param task_id: task ID of transfer to be cancelled
-        :return bool
-        """
-
-        try:
-            if self.active_task_storage[task_id]['task_status'] == 'queued':
-                self.active_task_storage[task_id]['task_status'] = 'cancelled'
-                return True
-
-            else:
-                raise ConnectionHandlerError("No queued transfer found with given transfer ID")
-
-        except (KeyError, IndexError):
-            raise ConnectionHandlerError("No transfer found with given transfer ID")
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+import json
+import queue
+import random
+import string
+import time
+
+from background_client.admission_control import AdmissionController, AdmissionRejectedError
+from background_client.socket_communication import SocketConnectionError
+from background_client.task_registry import TaskRecord, TaskRegistryError
+from background_client.task_scheduler import TaskSchedulerError
+from background_client.worker_pool import WorkerThread, WorkerPoolError
+from ecmwfapi.metrics import metrics
+from ecmwfapi.transfer_control import TransferControl
+from .exceptions import ConnectionHandlerError
+
+
+class ConnectionHandler(WorkerThread):
+
+    def __init__(self, log, connection_queue, allowed_ips, task_registry, task_queue, stop, worker_pools=None,
+                 admission_controller=None):
+        """
+        Initialise connection handler
+
+        :param log: logging handler
+        :param connection_queue: queue to retrieve connections from
+        :param allowed_ips: ips allowed to connect
+        :param task_registry: storage of the active and completed tasks
+        :param task_queue: work queue with new tasks
+        :param stop: method to call when the stop command is received
+        :param worker_pools: dictionary with the worker pools of the background client by name, which can be
+            reconfigured through the socket commands
+        :param admission_controller: AdmissionController that decides whether new transfers are accepted, one without
+            limits other than the queue size is used if None
+        """
+
+        # Initialise the thread
+        WorkerThread.__init__(self)
+
+        if not isinstance(connection_queue, queue.Queue):
+            raise ConnectionHandlerError("No valid queue object passed as connection queue")
+        if not isinstance(allowed_ips, list):
+            raise ConnectionHandlerError("No valid list object passed as allowed ips")
+
+        self.allowed_ips = allowed_ips
+        self.connection_queue = connection_queue
+        self.log = log
+        self.stop = stop
+
+        self.task_registry = task_registry
+        self.task_queue = task_queue
+        self.worker_pools = worker_pools if worker_pools is not None else {}
+
+        if admission_controller is None:
+            admission_controller = AdmissionController(task_queue, task_registry)
+        self.admission_controller = admission_controller
+
+    def run(self):
+        """
+        Main run function of the connection handler. Loops over connections in the queue and places data objects in
+        the data queue
+        """
+
+        # Run until poison pill received or retired by the worker pool
+        while not self.retired:
+
+            # Get a new connection from the queue
+            try:
+                connection = self.connection_queue.get(timeout=self.poll_interval)
+
+            except queue.Empty:
+                continue
+
+            # Poison pill send through None object, end the loop if we get one
+            if connection is None:
+                break
+
+            self.busy = True
+
+            if connection.get_remote_host() not in self.allowed_ips:
+                self.log.warning("Unauthorized connection from %s" % connection.get_remote_host())
+                self.busy = False
+                continue
+
+            try:
+                message = connection.receive()
+
+            except SocketConnectionError as e:
+                self.log.warning("Error while receiving message: %s" % str(e))
+                self.busy = False
+                continue
+
+            try:
+                message = json.loads(message)
+
+            except (json.decoder.JSONDecodeError, TypeError) as e:
+                self.log.error("Invalid JSON message: %s. Error: %s" % (message, e))
+                exit(-1)
+
+            response = None
+            command_type = None
+            command_data = None
+
+            try:
+                command_type = message['command']
+                command_data = message['data']
+
+            except KeyError as e:
+                response = {
+                    'status': 'error',
+                    'error_message': "Invalid request, no command and / or data passed (%s)" % e
+                }
+
+            if response is None:
+
+                if command_type in ('list_active_transfers', 'list_completed_transfers'):
+
+                    try:
+                        # The version is read first, so changes made during the listing are reported again by the
+                        # next change query instead of being missed
+                        version = self.task_registry.version
+                        [data, total] = self.list_transfers(command_type == 'list_completed_transfers', command_data)
+
+                        response = {
+                            'status': 'ok',
+                            'data': data,
+                            'total': total,
+                            'version': version
+                        }
+
+                    except ConnectionHandlerError as e:
+                        response = {
+                            'status': 'error',
+                            'error_message': "Failed to list the transfers: %s" % e
+                        }
+
+                elif command_type == 'list_changes':
+
+                    try:
+                        response = {
+                            'status': 'ok',
+                            'data': self.list_changes(command_data)
+                        }
+
+                    except ConnectionHandlerError as e:
+                        response = {
+                            'status': 'error',
+                            'error_message': "Failed to list the changes: %s" % e
+                        }
+
+                elif command_type == 'get_transfer':
+
+                    try:
+                        response = {
+                            'status': 'ok',
+                            'data': self.get_transfer(command_data['task_id'])
+                        }
+
+                    except (ConnectionHandlerError, KeyError, TypeError):
+                        response = {
+                            'status': 'error',
+                            'error_message': "No transfer found with given transfer ID"
+                        }
+
+                elif command_type == 'add_transfer':
+
+                    try:
+                        task_id = self.add_transfer(command_data)
+
+                        response = {
+                            'status': 'ok',
+                            'data': {
+                                'task_id': task_id
+                            }
+                        }
+
+                    except AdmissionRejectedError as e:
+                        self.log.warning("Rejected transfer: %s" % e)
+
+                        response = {
+                            'status': 'error',
+                            'error_message': "The transfer was rejected: %s" % e,
+                            'reason': e.reason,
+                            'retry_after': e.retry_after
+                        }
+
+                    except ConnectionHandlerError as e:
+                        self.log.error("Failed to add transfer: %s" % e)
+
+                        response = {
+                            'status': 'error',
+                            'error_message': "Failed to add the transfer"
+                        }
+
+                elif command_type == 'cancel_transfer':
+
+                    try:
+                        task_id = command_data['task_id']
+
+                    except (KeyError, TypeError) as e:
+                        self.log.error("Failed to cancel transfer: %s" % e)
+
+                        response = {
+                            'status': 'error',
+                            'error_message': "Failed to cancel the transfer. No transfer ID given."
+                        }
+
+                    else:
+                        try:
+                            self.cancel_transfer(task_id)
+
+                            response = {
+                                'status': 'ok'
+                            }
+
+                        except ConnectionHandlerError as e:
+                            self.log.error("Failed to cancel transfer: %s" % e)
+
+                            response = {
+                                'status': 'error',
+                                'error_message': "Failed to cancel the transfer. It might be completed already."
+                            }
+
+                elif command_type in ('pause_transfer', 'resume_transfer'):
+
+                    action = 'pause' if command_type == 'pause_transfer' else 'resume'
+
+                    try:
+                        if command_type == 'pause_transfer':
+                            self.pause_transfer(command_data['task_id'])
+                        else:
+                            self.resume_transfer(command_data['task_id'])
+
+                        response = {
+                            'status': 'ok'
+                        }
+
+                    except (ConnectionHandlerError, KeyError, TypeError) as e:
+                        self.log.error("Failed to %s transfer: %s" % (action, e))
+
+                        response = {
+                            'status': 'error',
+                            'error_message': "Failed to %s the transfer. It might not be %s." %
+                                             (action, 'active' if action == 'pause' else 'paused')
+                        }
+
+                elif command_type == 'set_priority':
+
+                    try:
+                        self.set_priority(command_data)
+
+                        response = {
+                            'status': 'ok',
+                            'data': {}
+                        }
+
+                    except ConnectionHandlerError as e:
+                        self.log.error("Failed to change transfer priority: %s" % e)
+
+                        response = {
+                            'status': 'error',
+                            'error_message': "Failed to change the priority of the transfer. It might be active or "
+                                             "completed already."
+                        }
+
+                elif command_type == 'get_worker_pools':
+
+                    response = {
+                        'status': 'ok',
+                        'data': self.get_worker_pools()
+                    }
+
+                elif command_type == 'set_worker_pool':
+
+                    try:
+                        self.set_worker_pool(command_data)
+
+                        response = {
+                            'status': 'ok',
+                            'data': self.get_worker_pools()
+                        }
+
+                    except ConnectionHandlerError as e:
+                        self.log.error("Failed to configure worker pool: %s" % e)
+
+                        response = {
+                            'status': 'error',
+                            'error_message': "Failed to configure the worker pool: %s" % e
+                        }
+
+                elif command_type == 'admission_status':
+
+                    response = {
+                        'status': 'ok',
+                        'data': self.admission_controller.get_statistics()
+                    }
+
+                elif command_type == 'metrics':
+
+                    response = {
+                        'status': 'ok',
+                        'data': metrics.render()
+                    }
+
+                elif command_type == 'heartbeat':
+                    response = {
+                        'status': 'ok',
+                        'data': {}
+                    }
+
+                elif command_type == 'stop':
+
+                    self.stop()
+
+                    response = {
+                        'status': 'ok',
+                        'data': {}
+                    }
+
+                else:
+                    response = {
+                        'status': 'error',
+                        'error_message': "Invalid command %s" % command_type
+                    }
+
+            # Json encode the response
+            response = json.dumps(response)
+
+            # Send the response and terminate connection
+            connection.send(response)
+            connection.close()
+
+            self.busy = False
+            self.connection_queue.task_done()
+
+    def list_transfers(self, completed=False, filters=None):
+        """
+        List the currently active or completed transfers
+
+        :param completed: whether to list completed or active transfers
+        :param filters: optional dictionary with the filters 'status' and 'owner', and the pagination settings 'offset'
+            and 'limit'
+        :return: tuple with the list of transfers and the total number of matching transfers
+        """
+
+        if not isinstance(filters, dict):
+            filters = {}
+
+        try:
+            offset = int(filters.get('offset', 0))
+            limit = filters.get('limit')
+            if limit is not None:
+                limit = int(limit)
+
+            [records, total] = self.task_registry.list(completed, filters.get('status'), filters.get('owner'), offset,
+                                                       limit)
+
+        except (TypeError, ValueError, TaskRegistryError) as e:
+            raise ConnectionHandlerError("Invalid filters: %s" % e)
+
+        return [record.to_dict() for record in records], total
+
+    def list_changes(self, data):
+        """
+        List the transfers that were added, updated or removed since a given version of the task registry. Clients can
+        start with version 0, and pass the version returned by the previous call to obtain only the changes since then.
+        If 'reset' is true in the result, the client should discard its state and use the returned tasks instead.
+
+        :param data: dictionary with the version since which to list the changes in 'since'
+        :return: dictionary with the current version, the reset flag, the added and updated transfers, and the IDs of
+            the removed transfers
+        """
+
+        try:
+            since = int(data.get('since', 0))
+
+        except (AttributeError, TypeError, ValueError):
+            raise ConnectionHandlerError("The version should be an integer")
+
+        try:
+            changes = self.task_registry.list_changes(since)
+
+        except TaskRegistryError as e:
+            raise ConnectionHandlerError(str(e))
+
+        changes['added'] = [record.to_dict() for record in changes['added']]
+        changes['updated'] = [record.to_dict() for record in changes['updated']]
+
+        return changes
+
+    def get_transfer(self, task_id):
+        """
+        Get the details of a single transfer
+
+        :param task_id: task ID of the transfer
+        :return: dictionary with the transfer details
+        """
+
+        try:
+            return self.task_registry.snapshot(task_id).to_dict()
+
+        except (TaskRegistryError, TypeError):
+            raise ConnectionHandlerError("No transfer found with given transfer ID")
+
+    def add_transfer(self, data):
+        """
+        Add a transfer to the queue. The data is either the transfer parameters itself, or a dictionary with the
+        transfer parameters in 'transfer_data' and the optional scheduling options 'priority', 'owner', 'deadline' and
+        'expected_size'. The deadline is the number of seconds from now before which the transfer should be started,
+        the expected size is the projected size of the result in bytes used for the disk space check.
+
+        Raises AdmissionRejectedError if the transfer is not admitted, for example because the queue is full.
+
+        :param data: transfer data
+        :return task_id: id of the newly created task
+        """
+
+        if not isinstance(data, dict):
+            raise ConnectionHandlerError("The transfer data should be a dictionary")
+
+        if 'transfer_data' in data:
+            transfer_data = data['transfer_data']
+            priority = data.get('priority')
+            owner = data.get('owner')
+            deadline = data.get('deadline')
+            expected_size = data.get('expected_size')
+
+        else:
+            transfer_data = data
+            priority = None
+            owner = None
+            deadline = None
+            expected_size = None
+
+        if not isinstance(transfer_data, dict):
+            raise ConnectionHandlerError("The transfer parameters should be a dictionary")
+
+        try:
+            if priority is not None:
+                priority = int(priority)
+
+            if deadline is not None:
+                deadline = time.time() + float(deadline)
+
+            if expected_size is not None:
+                expected_size = int(expected_size)
+
+        except (TypeError, ValueError):
+            raise ConnectionHandlerError("The priority, deadline and expected size should be numbers")
+
+        if owner is None:
+            owner = 'default'
+
+        task_id = ''.join(random.choice(string.ascii_lowercase) for _ in range(32))
+
+        if priority is None:
+            priority = self.task_queue.default_priority
+
+        # Downloads share the bandwidth limit and the download workers with the same weights as the owners share the
+        # transfer threads
+        control = TransferControl(self.task_queue.owner_weights.get(str(owner), 1), priority)
+
+        record = TaskRecord(task_id, transfer_data, control, str(owner), priority)
+
+        # The task is only registered and queued for processing once it is admitted, rejections do not change the
+        # registry
+        try:
+            self.admission_controller.admit(task_id, str(owner), transfer_data.get('target'), priority, deadline,
+                                            expected_size, record)
+
+        except (TaskRegistryError, TaskSchedulerError) as e:
+            raise ConnectionHandlerError(str(e))
+
+        return task_id
+
+    def set_priority(self, data):
+        """
+        Change the priority of a queued transfer
+
+        :param data: dictionary with the task_id and the new priority
+        """
+
+        try:
+            task_id = data['task_id']
+            priority = int(data['priority'])
+
+        except (KeyError, TypeError, ValueError):
+            raise ConnectionHandlerError("No task ID or valid priority given")
+
+        try:
+            self.task_queue.set_priority(task_id, priority)
+
+        except TaskSchedulerError as e:
+            raise ConnectionHandlerError(str(e))
+
+        try:
+            self.task_registry.set_priority(task_id, priority)
+
+        except TaskRegistryError:
+            pass
+
+    def cancel_transfer(self, task_id):
+        """
+        Cancel a transfer. Queued transfers are removed from the queue, active and paused transfers are stopped at the
+        next block and deleted at the API.
+
+        :param task_id: task ID of transfer to be cancelled
+        :return bool
+        """
+
+        record = self._get_record(task_id)
+
+        with self.task_registry.lock(task_id):
+            if record.task_status == 'queued' and self.task_queue.remove(task_id):
+                self.task_registry.complete(task_id, 'cancelled')
+                return True
+
+            elif record.task_status in ('queued', 'active', 'paused'):
+                record.task_control.cancel()
+                self.task_registry.set_status(task_id, 'cancelling')
+                return True
+
+            else:
+                raise ConnectionHandlerError("No queued or active transfer found with given transfer ID")
+
+    def pause_transfer(self, task_id):
+        """
+        Pause an active transfer. The transfer keeps its transfer thread, but stops downloading at the next block.
+
+        :param task_id: task ID of transfer to be paused
+        """
+
+        record = self._get_record(task_id)
+
+        with self.task_registry.lock(task_id):
+            if record.task_status != 'active':
+                raise ConnectionHandlerError("No active transfer found with given transfer ID")
+
+            record.task_control.pause()
+            self.task_registry.set_status(task_id, 'paused')
+
+    def resume_transfer(self, task_id):
+        """
+        Resume a paused transfer
+
+        :param task_id: task ID of transfer to be resumed
+        """
+
+        record = self._get_record(task_id)
+
+        with self.task_registry.lock(task_id):
+            if record.task_status != 'paused':
+                raise ConnectionHandlerError("No paused transfer found with given transfer ID")
+
+            record.task_control.resume()
+            self.task_registry.set_status(task_id, 'active')
+
+    def _get_record(self, task_id):
+        """
+        Look up the record of a task
+
+        :param task_id: task ID of the transfer
+        :return: TaskRecord of the transfer
+        """
+
+        try:
+            return self.task_registry.get(task_id)
+
+        except (TaskRegistryError, TypeError):
+            raise ConnectionHandlerError("No transfer found with given transfer ID")
+
+    def get_worker_pools(self):
+        """
+        Get the state of the worker pools
+
+        :return: dictionary with the state of each pool by name
+        """
+
+        return {name: pool.get_status() for name, pool in self.worker_pools.items()}
+
+    def set_worker_pool(self, data):
+        """
+        Reconfigure a worker pool. The data should contain the name of the pool and at least one of the settings
+        'size', 'elastic', 'min_size' or 'max_size'.
+
+        :param data: pool name and settings
+        """
+
+        try:
+            pool = self.worker_pools[data['pool']]
+
+        except (KeyError, TypeError):
+            raise ConnectionHandlerError("No worker pool found with the given name")
+
+        settings = {}
+        for name in ('size', 'min_size', 'max_size'):
+            if name in data:
+                try:
+                    settings[name] = int(data[name])
+
+                except (TypeError, ValueError):
+                    raise ConnectionHandlerError("The setting %s should be an integer" % name)
+
+        if 'elastic' in data:
+            if isinstance(data['elastic'], bool):
+                settings['elastic'] = data['elastic']
+            else:
+                settings['elastic'] = str(data['elastic']).lower() in ('1', 'true', 'yes', 'on')
+
+        if len(settings) == 0:
+            raise ConnectionHandlerError("No worker pool settings given")
+
+        try:
+            pool.configure(**settings)
+
+        except WorkerPoolError as e:
+            raise ConnectionHandlerError(str(e))
@@ -0,0 +1,527 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+from .exceptions import TaskRegistryError
+
+import collections
+import threading
+import time
+
+from ecmwfapi.metrics import metrics
+
+
+_task_duration = metrics.histogram('ecmwfapi_background_task_duration_seconds',
+                                   "Time from submitting a task to its completion, by final status", ('status',))
+
+
+class TaskRecord:
+    """
+    Administration of a single task. Timestamps are stored as epoch seconds and only formatted when listed. The transfer
+    data and control are dropped when the task completes.
+    """
+
+    __slots__ = ('task_id', 'task_status', 'task_owner', 'task_priority', 'task_added', 'task_started',
+                 'task_completed', 'task_data', 'task_control', 'version_added', 'version')
+
+    def __init__(self, task_id, task_data, task_control, task_owner, task_priority, task_status='queued'):
+
+        self.task_id = task_id
+        self.task_status = task_status
+        self.task_owner = task_owner
+        self.task_priority = task_priority
+        self.task_added = time.time()
+        self.task_started = None
+        self.task_completed = None
+        self.task_data = task_data
+        self.task_control = task_control
+
+        # Registry versions at which the task was added and last changed
+        self.version_added = 0
+        self.version = 0
+
+    def snapshot(self):
+        """
+        Copy the record, so it can be read while the original is being changed by other threads
+
+        :return: TaskRecord with the same values
+        """
+
+        record = TaskRecord.__new__(TaskRecord)
+        for name in self.__slots__:
+            setattr(record, name, getattr(self, name))
+
+        return record
+
+    def to_dict(self):
+        """
+        Convert the record to a dictionary that can be serialised to JSON
+
+        :return: dictionary with the task details
+        """
+
+        return {
+            'task_id': self.task_id,
+            'task_added': self._format_time(self.task_added),
+            'task_started': self._format_time(self.task_started),
+            'task_completed': self._format_time(self.task_completed),
+            'task_status': self.task_status,
+            'task_priority': self.task_priority,
+            'task_owner': self.task_owner,
+        }
+
+    @staticmethod
+    def _format_time(timestamp):
+        if timestamp is None:
+            return None
+
+        return time.strftime('%d-%m-%Y %H:%M:%S', time.localtime(timestamp))
+
+
+class TaskRegistry:
+    """
+    Storage of the active and completed tasks of the background client. Tasks can be looked up by ID in constant time,
+    and are indexed by status and owner. The history of completed tasks is bounded by count and by age; the oldest
+    completed tasks are evicted first.
+
+    Every change increases the version of the registry, so clients can poll for the changes since the version they
+    have seen last instead of listing all tasks.
+
+    The registry is shared by the connection and transfer handler threads. The fields of a record are guarded by its
+    task lock, one of a fixed number of striped locks, so reads and updates of different tasks rarely wait for each
+    other. The tables, indexes and version log are guarded by the registry lock, which is only held while they change.
+    Listings select the tasks while holding the registry lock, and then copy each record while holding its task lock.
+    Sequences of operations on one task, such as checking its status and changing it, are made atomic with
+    lock(task_id). Task locks are always taken before the registry lock.
+    """
+
+    # Statuses of tasks that have not completed yet
+    active_statuses = ('queued', 'active', 'paused', 'cancelling')
+
+    def __init__(self, max_completed_tasks=10000, max_completed_age=0, max_removed_changes=10000, lock_stripes=64):
+        """
+        Initialise the task registry
+
+        :param max_completed_tasks: maximum number of completed tasks to keep, no limit if zero
+        :param max_completed_age: maximum number of seconds to keep completed tasks, no limit if zero
+        :param max_removed_changes: number of removed tasks to remember for change queries. Clients that query changes
+            from before the oldest remembered removal have to reload all tasks.
+        :param lock_stripes: number of task locks, tasks are spread over the locks by the hash of their ID
+        """
+
+        if not isinstance(lock_stripes, int) or lock_stripes <= 0:
+            raise TaskRegistryError("The number of lock stripes should be a positive integer")
+
+        self.max_completed_tasks = max_completed_tasks
+        self.max_completed_age = max_completed_age
+
+        self.version = 0
+
+        # Task IDs ordered by the version of their last change, and the (version, task ID) pairs of removed tasks
+        self._changes = collections.OrderedDict()
+        self._removed = collections.deque(maxlen=max_removed_changes)
+        self._removed_floor = 0
+
+        self._tasks = {}
+        self._completed = collections.OrderedDict()
+
+        # Indexes map a status or owner to the IDs of its tasks. Dictionaries are used as ordered sets, so tasks are
+        # listed in the order in which they entered the status or were added.
+        self._status_index = {}
+        self._owner_index = {}
+
+        # Reentrant, so public methods can call each other while holding the lock
+        self._lock = threading.RLock()
+        self._task_locks = [threading.RLock() for _ in range(lock_stripes)]
+
+    def lock(self, task_id):
+        """
+        Get the lock of a task. Holding it guarantees that no other thread changes or copies the task through the
+        registry methods, which take the same lock.
+
+        :param task_id: ID of the task
+        :return: reentrant lock, to be used as context manager
+        """
+
+        return self._task_locks[hash(task_id) % len(self._task_locks)]
+
+    def add(self, record):
+        """
+        Add a new task
+
+        :param record: TaskRecord of the task
+        """
+
+        with self._lock:
+            if record.task_id in self._tasks:
+                raise TaskRegistryError("A task with ID %s exists already" % record.task_id)
+
+            self._tasks[record.task_id] = record
+            self._index_add(self._status_index, record.task_status, record.task_id)
+            self._index_add(self._owner_index, record.task_owner, record.task_id)
+
+            self._changed(record)
+            record.version_added = record.version
+
+    def get(self, task_id):
+        """
+        Look up a task. The record is shared with other threads, use lock(task_id) to read it consistently or use
+        snapshot() instead.
+
+        :param task_id: ID of the task
+        :return: TaskRecord of the task
+        """
+
+        try:
+            return self._tasks[task_id]
+
+        except KeyError:
+            raise TaskRegistryError("No task found with ID %s" % task_id)
+
+    def snapshot(self, task_id):
+        """
+        Get a copy of a task
+
+        :param task_id: ID of the task
+        :return: copy of the TaskRecord of the task
+        """
+
+        with self.lock(task_id):
+            return self.get(task_id).snapshot()
+
+    def set_status(self, task_id, task_status):
+        """
+        Change the status of an active task
+
+        :param task_id: ID of the task
+        :param task_status: the new status, one of the active statuses
+        """
+
+        if task_status not in self.active_statuses:
+            raise TaskRegistryError("Invalid status %s for an active task, use complete() instead" % task_status)
+
+        with self.lock(task_id):
+            record = self.get(task_id)
+
+            # Tasks only complete while holding their lock
+            if task_id in self._completed:
+                raise TaskRegistryError("Task %s has completed already" % task_id)
+
+            if record.task_status != task_status:
+                with self._lock:
+                    self._index_remove(self._status_index, record.task_status, task_id)
+                    self._index_add(self._status_index, task_status, task_id)
+                    self._changed(record)
+
+                record.task_status = task_status
+
+                if task_status == 'active' and record.task_started is None:
+                    record.task_started = time.time()
+
+    def set_priority(self, task_id, task_priority):
+        """
+        Change the priority of a task
+
+        :param task_id: ID of the task
+        :param task_priority: the new priority
+        """
+
+        with self.lock(task_id):
+            record = self.get(task_id)
+            record.task_priority = task_priority
+
+            # Also applies to the scheduling of the blocks of its download
+            if record.task_control is not None:
+                record.task_control.priority = task_priority
+
+            with self._lock:
+                self._changed(record)
+
+    def complete(self, task_id, task_status):
+        """
+        Move a task to the history of completed tasks
+
+        :param task_id: ID of the task
+        :param task_status: final status of the task, for example completed, cancelled or failed
+        """
+
+        if task_status in self.active_statuses:
+            raise TaskRegistryError("Invalid status %s for a completed task" % task_status)
+
+        with self.lock(task_id):
+            record = self.get(task_id)
+
+            if task_id in self._completed:
+                raise TaskRegistryError("Task %s has completed already" % task_id)
+
+            record.task_completed = time.time()
+            record.task_data = None
+            record.task_control = None
+
+            with self._lock:
+                self._index_remove(self._status_index, record.task_status, task_id)
+                self._index_add(self._status_index, task_status, task_id)
+                record.task_status = task_status
+
+                self._completed[task_id] = record
+                self._changed(record)
+                self.evict()
+
+        _task_duration.labels(task_status).observe(record.task_completed - record.task_added)
+
+    def list(self, completed=False, task_status=None, task_owner=None, offset=0, limit=None):
+        """
+        List active or completed tasks, optionally filtered by status and owner. Completed tasks are listed in the order
+        they completed, active tasks in the order they were added, or entered their status when filtering by status.
+
+        :param completed: whether to list completed or active tasks
+        :param task_status: only list tasks with this status
+        :param task_owner: only list tasks of this owner
+        :param offset: number of matching tasks to skip
+        :param limit: maximum number of tasks to return, no limit if None
+        :return: tuple with snapshots of the listed TaskRecords and the total number of matching tasks
+        """
+
+        if offset < 0 or (limit is not None and limit < 0):
+            raise TaskRegistryError("The offset and limit can not be negative")
+
+        with self._lock:
+            self.evict()
+
+            # Start from the smallest candidate set and filter on the remaining criteria
+            if task_status is not None and task_owner is not None:
+                status_ids = self._status_index.get(task_status, {})
+                owner_ids = self._owner_index.get(task_owner, {})
+
+                if len(status_ids) <= len(owner_ids):
+                    candidates = [task_id for task_id in status_ids if task_id in owner_ids]
+                else:
+                    candidates = [task_id for task_id in owner_ids if task_id in status_ids]
+
+                candidates.sort(key=lambda item: self._tasks[item].task_completed or self._tasks[item].task_added)
+
+            elif task_status is not None:
+                candidates = self._status_index.get(task_status, {})
+
+            elif task_owner is not None:
+                candidates = self._owner_index.get(task_owner, {})
+
+                # The owner index is in the order the tasks were added
+                if completed:
+                    candidates = sorted(candidates, key=lambda item: self._tasks[item].task_completed or 0)
+
+            elif completed:
+                candidates = self._completed
+
+            else:
+                # Only the active tasks are visited, not the history of completed tasks
+                candidates = sorted((task_id for task_status in self.active_statuses
+                                     for task_id in self._status_index.get(task_status, {})),
+                                    key=lambda item: self._tasks[item].version_added)
+
+            matches = [task_id for task_id in candidates if (task_id in self._completed) == completed]
+
+            if limit is None:
+                page = matches[offset:]
+            else:
+                page = matches[offset:offset + limit]
+
+        # Only the returned records are copied
+        return self._snapshots(page), len(matches)
+
+    def list_changes(self, since):
+        """
+        List the tasks that were added, updated or removed after the given registry version. The cost depends on the
+        number of changes, not on the number of tasks.
+
+        :param since: registry version the client has seen last, 0 to list all tasks
+        :return: dictionary with the current version, snapshots of the added and updated TaskRecords, the IDs of removed
+            tasks, and whether the client has to reset its state because removals after the version are no longer
+            remembered
+        """
+
+        if not isinstance(since, int) or since < 0:
+            raise TaskRegistryError("The version should be a non-negative integer")
+
+        with self._lock:
+            self.evict()
+
+            reset = since < self._removed_floor or since > self.version
+            if reset:
+                since = 0
+
+            version = self.version
+            added = []
+            updated = []
+
+            for [task_id, task_version] in reversed(self._changes.items()):
+                if task_version <= since:
+                    break
+
+                if self._tasks[task_id].version_added > since:
+                    added.append(task_id)
+                else:
+                    updated.append(task_id)
+
+            removed = []
+
+            if not reset:
+                for [removed_version, task_id] in reversed(self._removed):
+                    if removed_version <= since:
+                        break
+                    removed.append(task_id)
+
+        added.reverse()
+        updated.reverse()
+        removed.reverse()
+
+        # Tasks that change while they are copied are listed again by the next query, as their version is newer
+        return {
+            'version': version,
+            'reset': reset,
+            'added': self._snapshots(added),
+            'updated': self._snapshots(updated),
+            'removed': removed,
+        }
+
+    def remove(self, task_id):
+        """
+        Remove a task from the registry
+
+        :param task_id: ID of the task
+        """
+
+        with self.lock(task_id), self._lock:
+            self._remove(self.get(task_id))
+
+    def count(self, completed=False):
+        """
+        :param completed: whether to count completed or active tasks
+        :return: number of active or completed tasks
+        """
+
+        with self._lock:
+            if completed:
+                return len(self._completed)
+
+            return len(self._tasks) - len(self._completed)
+
+    def status_counts(self):
+        """
+        :return: dictionary with the number of tasks by status, including the completed tasks that are kept
+        """
+
+        with self._lock:
+            return {task_status: len(ids) for task_status, ids in self._status_index.items()}
+
+    def completion_rate(self, window=600):
+        """
+        Determine the rate at which tasks completed recently
+
+        :param window: number of seconds to look back
+        :return: number of completed tasks per second
+        """
+
+        threshold = time.time() - window
+        completed = 0
+
+        with self._lock:
+            for record in reversed(self._completed.values()):
+                if record.task_completed < threshold:
+                    break
+                completed += 1
+
+        return completed / window
+
+    def evict(self):
+        """
+        Remove completed tasks that exceed the configured retention
+        """
+
+        with self._lock:
+            if self.max_completed_age > 0:
+                threshold = time.time() - self.max_completed_age
+
+                while self._completed:
+                    record = next(iter(self._completed.values()))
+                    if record.task_completed >= threshold:
+                        break
+                    self._remove(record)
+
+            if self.max_completed_tasks > 0:
+                for _ in range(len(self._completed) - self.max_completed_tasks):
+                    self._remove(next(iter(self._completed.values())))
+
+    def _snapshots(self, task_ids):
+        """
+        Copy records while holding their task lock. Should be called without the registry lock, which is taken after
+        task locks. Tasks that have been removed meanwhile are left out.
+
+        :param task_ids: IDs of the tasks
+        :return: list of copied TaskRecords
+        """
+
+        records = []
+
+        for task_id in task_ids:
+            with self.lock(task_id):
+                record = self._tasks.get(task_id)
+
+                if record is not None:
+                    records.append(record.snapshot())
+
+        return records
+
+    def _remove(self, record):
+        """
+        Remove a task from the registry and its indexes. Should be called with the registry lock held.
+
+        :param record: TaskRecord of the task
+        """
+
+        self._completed.pop(record.task_id, None)
+        del self._tasks[record.task_id]
+        self._index_remove(self._status_index, record.task_status, record.task_id)
+        self._index_remove(self._owner_index, record.task_owner, record.task_id)
+
+        self.version += 1
+        del self._changes[record.task_id]
+
+        if len(self._removed) == self._removed.maxlen:
+            self._removed_floor = self._removed[0][0]
+        self._removed.append((self.version, record.task_id))
+
+    def _changed(self, record):
+        """
+        Register a change of a task under a new registry version. Should be called with the registry lock held.
+
+        :param record: TaskRecord of the task
+        """
+
+        self.version += 1
+        record.version = self.version
+
+        self._changes[record.task_id] = self.version
+        self._changes.move_to_end(record.task_id)
+
+    @staticmethod
+    def _index_add(index, key, task_id):
+        index.setdefault(key, {})[task_id] = None
+
+    @staticmethod
+    def _index_remove(index, key, task_id):
+        ids = index.get(key)
+
+        if ids is not None:
+            ids.pop(task_id, None)
+
+            if len(ids) == 0:
+                del index[key]
@@ -0,0 +1,386 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+from .exceptions import TaskSchedulerError
+
+import heapq
+import itertools
+import queue
+import threading
+import time
+
+
+class TaskScheduler:
+    """
+    Task queue that hands out tasks by priority, with weighted fair sharing between owners and optional deadlines. It
+    offers the same interface as queue.Queue for the methods used by the background client, so it can be consumed by
+    the transfer handlers directly.
+
+    Tasks are selected as follows:
+    - a task whose deadline is within the deadline margin is handed out first, earliest deadline first
+    - otherwise the highest priority of all queued tasks is determined, and of the owners that have a task with that
+      priority the owner with the lowest virtual time is selected (weighted round robin). Each selection advances the
+      virtual time of the owner by the inverse of its weight.
+    - within an owner, tasks are ordered by priority, deadline and the order in which they were added
+    """
+
+    def __init__(self, maxsize=0, owner_weights=None, deadline_margin=300, default_priority=0):
+        """
+        Initialise the scheduler
+
+        :param maxsize: maximum number of queued tasks, no limit if zero
+        :param owner_weights: dictionary with the fair share weight per owner, owners not listed have weight 1
+        :param deadline_margin: number of seconds before its deadline that a task is handed out with precedence
+        :param default_priority: priority of tasks that are added without a priority
+        """
+
+        self.maxsize = maxsize
+        self.default_priority = default_priority
+        self.owner_weights = dict(owner_weights) if owner_weights is not None else {}
+        self.deadline_margin = deadline_margin
+
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._all_tasks_done = threading.Condition(self._lock)
+
+        # Queued tasks by task ID. Entries are lists of [sort key, sequence number, task ID, owner, deadline]. Heap
+        # entries that are no longer in this dictionary are stale and are skipped when they reach the top of a heap.
+        self._entries = {}
+        self._owner_heaps = {}
+        self._owner_virtual_time = {}
+        self._owner_counts = {}
+        self._deadline_heap = []
+        self._stale_count = 0
+
+        self._sequence = itertools.count()
+        self._virtual_time = 0.0
+        self._unfinished_tasks = 0
+
+    def put(self, task_id, priority=None, owner=None, deadline=None, block=True, timeout=None):
+        """
+        Add a task to the queue
+
+        :param task_id: ID of the task
+        :param priority: numeric priority, tasks with a higher priority are handed out first. The default priority is used
+            if None.
+        :param owner: owner of the task, used for fair sharing between owners
+        :param deadline: optional epoch timestamp before which the task should be started
+        :param block: whether to wait for a free slot if the queue is full
+        :param timeout: maximum number of seconds to wait for a free slot
+        """
+
+        if task_id is None:
+            raise TaskSchedulerError("No task ID given")
+
+        if priority is None:
+            priority = self.default_priority
+
+        with self._not_full:
+            if task_id in self._entries:
+                raise TaskSchedulerError("Task %s is queued already" % task_id)
+
+            if self.maxsize > 0:
+                if not block:
+                    if len(self._entries) >= self.maxsize:
+                        raise queue.Full
+
+                elif timeout is None:
+                    while len(self._entries) >= self.maxsize:
+                        self._not_full.wait()
+
+                else:
+                    end_time = time.time() + timeout
+                    while len(self._entries) >= self.maxsize:
+                        remaining = end_time - time.time()
+                        if remaining <= 0:
+                            raise queue.Full
+                        self._not_full.wait(remaining)
+
+            sequence = next(self._sequence)
+            self._push(self._new_entry(task_id, priority, owner, deadline, sequence))
+            self._owner_counts[owner] = self._owner_counts.get(owner, 0) + 1
+
+            if deadline is not None:
+                heapq.heappush(self._deadline_heap, (deadline, sequence, task_id))
+
+            self._unfinished_tasks += 1
+            self._not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return the next task ID from the queue
+
+        :param block: whether to wait for a task if the queue is empty
+        :param timeout: maximum number of seconds to wait for a task
+        :return: task ID
+        """
+
+        with self._not_empty:
+            if not block:
+                if len(self._entries) == 0:
+                    raise queue.Empty
+
+            elif timeout is None:
+                while len(self._entries) == 0:
+                    self._not_empty.wait()
+
+            else:
+                end_time = time.time() + timeout
+                while len(self._entries) == 0:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self._not_empty.wait(remaining)
+
+            entry = self._select()
+            self._discard(entry)
+            self._not_full.notify()
+
+            return entry[2]
+
+    def set_priority(self, task_id, priority):
+        """
+        Change the priority of a queued task
+
+        :param task_id: ID of the task
+        :param priority: the new priority
+        """
+
+        with self._lock:
+            try:
+                entry = self._entries[task_id]
+
+            except KeyError:
+                raise TaskSchedulerError("No queued task found with given task ID")
+
+            # The old heap entry becomes stale. The sequence number is kept, so the task keeps its position among tasks
+            # with the same priority and its entry in the deadline heap remains valid.
+            self._stale_count += 1
+            self._push(self._new_entry(task_id, priority, entry[3], entry[4], entry[1]))
+            self._compact()
+
+    def remove(self, task_id):
+        """
+        Remove a queued task from the queue
+
+        :param task_id: ID of the task
+        :return: whether the task was queued
+        """
+
+        with self._lock:
+            entry = self._entries.get(task_id)
+
+            if entry is None:
+                return False
+
+            self._discard(entry)
+            self._stale_count += 1
+            self._unfinished_tasks -= 1
+            self._not_full.notify()
+
+            if self._unfinished_tasks == 0:
+                self._all_tasks_done.notify_all()
+            self._compact()
+
+            return True
+
+    def set_owner_weight(self, owner, weight):
+        """
+        Set the fair share weight of an owner
+
+        :param owner: the owner
+        :param weight: positive weight, an owner with weight 2 gets twice as many tasks handed out as one with weight 1
+        """
+
+        if not isinstance(weight, (int, float)) or weight <= 0:
+            raise TaskSchedulerError("The owner weight should be a positive number")
+
+        with self._lock:
+            self.owner_weights[owner] = weight
+
+    def task_done(self):
+        """
+        Indicate that a task retrieved from the queue has been processed
+        """
+
+        with self._lock:
+            if self._unfinished_tasks <= 0:
+                raise ValueError('task_done() called too many times')
+            self._unfinished_tasks -= 1
+
+            if self._unfinished_tasks == 0:
+                self._all_tasks_done.notify_all()
+
+    def join(self):
+        """
+        Wait until all tasks that were added have been processed or removed
+        """
+
+        with self._all_tasks_done:
+            while self._unfinished_tasks > 0:
+                self._all_tasks_done.wait()
+
+    def qsize(self):
+        """
+        :return: number of queued tasks
+        """
+
+        with self._lock:
+            return len(self._entries)
+
+    def owner_qsize(self, owner):
+        """
+        :param owner: owner of the tasks
+        :return: number of queued tasks of the owner
+        """
+
+        with self._lock:
+            return self._owner_counts.get(owner, 0)
+
+    def empty(self):
+        """
+        :return: whether no tasks are queued
+        """
+
+        return self.qsize() == 0
+
+    def full(self):
+        """
+        :return: whether the maximum number of queued tasks has been reached
+        """
+
+        return 0 < self.maxsize <= self.qsize()
+
+    @staticmethod
+    def _new_entry(task_id, priority, owner, deadline, sequence):
+        """
+        Create a queue entry. Ties in priority are broken by deadline and then by insertion order.
+        """
+
+        if not isinstance(priority, (int, float)):
+            raise TaskSchedulerError("The priority should be a number")
+
+        deadline_key = deadline if deadline is not None else float('inf')
+
+        return [(-priority, deadline_key, sequence), sequence, task_id, owner, deadline]
+
+    def _push(self, entry):
+        """
+        Register an entry and add it to the heap of its owner. Should be called with the lock held.
+        """
+
+        owner = entry[3]
+
+        if owner not in self._owner_heaps:
+            self._owner_heaps[owner] = []
+
+            # Owners that (re)join start at the current virtual time, so they can't claim the turns they missed
+            self._owner_virtual_time[owner] = max(self._owner_virtual_time.get(owner, 0.0), self._virtual_time)
+
+        self._entries[entry[2]] = entry
+        heapq.heappush(self._owner_heaps[owner], (entry[0], id(entry), entry))
+
+    def _discard(self, entry):
+        """
+        Unregister an entry, its heap entries become stale. Should be called with the lock held.
+        """
+
+        del self._entries[entry[2]]
+
+        owner = entry[3]
+        self._owner_counts[owner] -= 1
+        if self._owner_counts[owner] == 0:
+            del self._owner_counts[owner]
+
+    def _is_current(self, entry):
+        return self._entries.get(entry[2]) is entry
+
+    def _select(self):
+        """
+        Select the next entry to hand out. Should be called with the lock held and at least one task queued.
+        """
+
+        # Tasks with an imminent deadline take precedence
+        while self._deadline_heap:
+            [deadline, sequence, task_id] = self._deadline_heap[0]
+            entry = self._entries.get(task_id)
+
+            if entry is None or entry[1] != sequence:
+                heapq.heappop(self._deadline_heap)
+                continue
+
+            if deadline - time.time() <= self.deadline_margin:
+                heapq.heappop(self._deadline_heap)
+
+                # The entry in the heap of the owner becomes stale
+                self._stale_count += 1
+                return entry
+
+            break
+
+        # Determine the owners with a task of the highest priority
+        best_key = None
+        candidates = []
+
+        for owner in list(self._owner_heaps):
+            heap = self._owner_heaps[owner]
+
+            while heap and not self._is_current(heap[0][2]):
+                heapq.heappop(heap)
+                self._stale_count -= 1
+
+            if not heap:
+                del self._owner_heaps[owner]
+                continue
+
+            priority_key = heap[0][0][0]
+
+            if best_key is None or priority_key < best_key:
+                best_key = priority_key
+                candidates = [owner]
+            elif priority_key == best_key:
+                candidates.append(owner)
+
+        owner = min(candidates, key=lambda item: self._owner_virtual_time[item])
+
+        self._virtual_time = self._owner_virtual_time[owner]
+        self._owner_virtual_time[owner] += 1.0 / self.owner_weights.get(owner, 1)
+
+        entry = heapq.heappop(self._owner_heaps[owner])[2]
+        if not self._owner_heaps[owner]:
+            del self._owner_heaps[owner]
+
+        return entry
+
+    def _compact(self):
+        """
+        Rebuild the heaps when the number of stale heap entries dominates. Should be called with the lock held.
+        """
+
+        if self._stale_count <= len(self._entries) + 64:
+            return
+
+        for owner in list(self._owner_heaps):
+            heap = [item for item in self._owner_heaps[owner] if self._is_current(item[2])]
+
+            if heap:
+                heapq.heapify(heap)
+                self._owner_heaps[owner] = heap
+            else:
+                del self._owner_heaps[owner]
+
+        self._deadline_heap = [item for item in self._deadline_heap
+                               if item[2] in self._entries and self._entries[item[2]][1] == item[1]]
+        heapq.heapify(self._deadline_heap)
+
+        self._stale_count = 0
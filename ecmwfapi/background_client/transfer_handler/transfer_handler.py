@@ -1,85 +1,172 @@
-#
-# (C) Copyright 2012-2013 ECMWF.
-#
-# This software is licensed under the terms of the Apache Licence Version 2.0
-# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
-# In applying this licence, ECMWF does not waive the privileges and immunities
-# granted to it by virtue of its status as an intergovernmental organisation nor
-# does it submit to any jurisdiction.
-#
-# (C) Copyright 2017 Ricardo Persoon.
-
-
-from .exceptions import TransferHandlerError
-
-import os
-import queue
-import threading
-import sys
-
-# Required to import the ECMWFDataServer
-sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../../..')
-
-from ecmwfapi.ECMWFDataServer import ECMWFDataServer
-
-
-class TransferHandler(threading.Thread):
-
-    def __init__(self, log, active_task_storage, completed_task_storage, task_queue):
-        """
-        Initialise connection handler
-
-        :param log: logging handler
-        :param active_task_storage: storage of the active tasks
-        :param completed_task_storage: storage of the completed tasks
-        :param task_queue: work queue with new tasks
-        """
-
-        # Initialise the thread
-        threading.Thread.__init__(self)
-
-        if not isinstance(active_task_storage, dict):
-            raise TransferHandlerError("The active task storage object should be a dictionary")
-        if not isinstance(completed_task_storage, dict):
-            raise TransferHandlerError("The active task storage object should be a dictionary")
-        if not isinstance(task_queue, queue.Queue):
-            raise TransferHandlerError("The task queue object should be a queue")
-
-        self.log = log
-        self.active_task_storage = active_task_storage
-        self.completed_task_storage = completed_task_storage
-        self.task_queue = task_queue
-
-    def run(self):
-        """
-        Main run function of the connection handler. Loops over connections in the queue and places data objects in
-        the data queue
-        """
-
-        # Run until poison pill received
-        while True:
-
-            # Get a new connection from the queue
-            task = self.task_queue.get()
-
-            # Poison pill send through None object, end the loop if we get one
-            if task is None:
-                break
-
-            if self.active_task_storage[task]['task_status'] == 'cancelled':
-                self.log.info("Skipping cancelled transfer")
-
-            self.active_task_storage[task]['task_status'] = 'active'
-
-            # Process the transfer
-            server = ECMWFDataServer()
-            server.retrieve(self.active_task_storage[task]['task_data'])
-
-            self.completed_task_storage[task] = {
-                'task_added': self.active_task_storage[task]['task_added'],
-                'task_status': 'completed',
-            }
-
-            del self.active_task_storage[task]
-
-            self.task_queue.task_done()
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+from .exceptions import TransferHandlerError
+
+import os
+import queue
+import sys
+
+# Required to import the ECMWFDataServer
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../../..')
+
+from background_client.task_registry import TaskRegistry
+from background_client.task_scheduler import TaskScheduler
+from background_client.worker_pool import WorkerThread
+from ecmwfapi.ECMWFDataServer import ECMWFDataServer
+from ecmwfapi.exceptions import DataServerError
+
+
+class TransferHandler(WorkerThread):
+
+    def __init__(self, log, task_registry, task_queue):
+        """
+        Initialise connection handler
+
+        :param log: logging handler
+        :param task_registry: storage of the active and completed tasks
+        :param task_queue: work queue with new tasks
+        """
+
+        # Initialise the thread
+        WorkerThread.__init__(self)
+
+        if not isinstance(task_registry, TaskRegistry):
+            raise TransferHandlerError("The task registry object should be a task registry")
+        if not isinstance(task_queue, (queue.Queue, TaskScheduler)):
+            raise TransferHandlerError("The task queue object should be a queue or task scheduler")
+
+        self.log = log
+        self.task_registry = task_registry
+        self.task_queue = task_queue
+
+        self.processed_bytes = 0
+        self.current_control = None
+
+        # The data server is kept for the lifetime of the handler, so the configuration, credentials, user details and
+        # API connections are reused by subsequent transfers. It reloads its settings itself when they change.
+        self.server = None
+
+    def get_processed_bytes(self):
+        """
+        Number of bytes transferred by this handler, including the part of the current transfer downloaded so far. The
+        bytes are counted as they are downloaded, so compression and uploads to object storage do not affect them.
+
+        :return: number of bytes
+        """
+
+        processed_bytes = self.processed_bytes
+        current_control = self.current_control
+
+        if current_control is not None:
+            processed_bytes += current_control.processed_bytes
+
+        return processed_bytes
+
+    def run(self):
+        """
+        Main run function of the connection handler. Loops over connections in the queue and places data objects in
+        the data queue
+        """
+
+        try:
+            self._process_tasks()
+
+        finally:
+            if self.server is not None:
+                self.server.close()
+
+    def _process_tasks(self):
+        """
+        Process tasks from the queue until a poison pill is received or the handler is retired
+        """
+
+        # Run until poison pill received or retired by the worker pool
+        while not self.retired:
+
+            # Get a new connection from the queue
+            try:
+                task = self.task_queue.get(timeout=self.poll_interval)
+
+            except queue.Empty:
+                continue
+
+            # Poison pill send through None object, end the loop if we get one
+            if task is None:
+                break
+
+            self.busy = True
+
+            # Cancelling and starting the task should not interleave
+            with self.task_registry.lock(task):
+                record = self.task_registry.get(task)
+                control = record.task_control
+                task_data = record.task_data
+
+                if not control.is_cancelled():
+                    self.task_registry.set_status(task, 'active')
+
+            if control.is_cancelled():
+                self.log.info("Skipping cancelled transfer")
+                self._complete_task(task, 'cancelled')
+                continue
+
+            # Process the transfer
+            self.current_control = control
+            task_status = 'failed'
+
+            try:
+                if self.server is None:
+                    self.server = ECMWFDataServer()
+
+                statistics = self.server.retrieve(task_data, control)
+
+                if control.is_cancelled():
+                    task_status = 'cancelled'
+
+                elif any(stats.status == 'failed' for stats in statistics):
+                    task_status = 'failed'
+
+                else:
+                    task_status = 'completed'
+
+                for stats in statistics:
+                    self.log.info("Transfer statistics: %s" % stats)
+
+            except DataServerError as e:
+                self.log.error("Failed to process transfer: %s" % e)
+
+            # Unexpected errors fail the task, but should not stop the handler
+            except Exception as e:
+                self.log.error("Unexpected error while processing transfer: %s: %s" % (type(e).__name__, e))
+
+            finally:
+                transferred_bytes = self.get_processed_bytes()
+                self.current_control = None
+                self.processed_bytes = transferred_bytes
+
+                self._complete_task(task, task_status)
+
+    def _complete_task(self, task, task_status):
+        """
+        Move a task to the history of completed tasks
+
+        :param task: ID of the task
+        :param task_status: final status of the task
+        """
+
+        try:
+            self.task_registry.complete(task, task_status)
+
+        finally:
+            self.busy = False
+            self.task_queue.task_done()
@@ -0,0 +1,345 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+from .exceptions import WorkerPoolError
+
+import threading
+import time
+
+
+class WorkerThread(threading.Thread):
+    """
+    Base class of the threads managed by a worker pool. Workers poll their work queue with a timeout, so they can be
+    retired without the need to place a poison pill at the end of the queue.
+    """
+
+    # Interval in seconds at which workers check whether they have been retired
+    poll_interval = 1
+
+    def __init__(self):
+
+        # Initialise the thread
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.retired = False
+        self.busy = False
+
+    def retire(self):
+        """
+        Request the worker to stop. A busy worker, or a worker that obtained an item while being retired, finishes that
+        item first.
+        """
+
+        self.retired = True
+
+    def get_processed_bytes(self):
+        """
+        Number of bytes processed by this worker so far, used by the pool to determine the throughput in elastic mode
+
+        :return: number of bytes
+        """
+
+        return 0
+
+
+class WorkerPool:
+    """
+    Manages a resizable group of worker threads that consume the same work queue. In elastic mode the pool grows while
+    the work queue is backed up and the aggregate throughput keeps increasing, and shrinks again when workers are idle.
+    """
+
+    def __init__(self, name, log, worker_factory, work_queue, size, min_size=1, max_size=None, elastic=False,
+                 elastic_interval=30, growth_threshold=0.05):
+        """
+        Initialise the worker pool
+
+        :param name: name of the pool, used in log messages
+        :param log: logging handler
+        :param worker_factory: callable without arguments that returns a new, not yet started, WorkerThread
+        :param work_queue: queue the workers consume, used to determine the backlog in elastic mode
+        :param size: initial number of workers
+        :param min_size: minimum number of workers in elastic mode
+        :param max_size: maximum number of workers in elastic mode, defaults to the initial size
+        :param elastic: whether to resize the pool automatically
+        :param elastic_interval: interval in seconds between evaluations of the pool size in elastic mode
+        :param growth_threshold: minimum relative throughput increase after growing to consider growing again
+        """
+
+        if not callable(worker_factory):
+            raise WorkerPoolError("The worker factory should be callable")
+
+        if max_size is None:
+            max_size = size
+
+        self.name = name
+        self.log = log
+        self.worker_factory = worker_factory
+        self.work_queue = work_queue
+        self.elastic_interval = elastic_interval
+        self.growth_threshold = growth_threshold
+
+        self._validate_limits(size, min_size, max_size)
+
+        self.size = 0
+        self.min_size = min_size
+        self.max_size = max_size
+        self.elastic = elastic
+
+        self._workers = []
+        self._retiring = []
+        self._retired_bytes = 0
+        self._lock = threading.Lock()
+        self._running = False
+        self._elastic_event = threading.Event()
+        self._elastic_thread = None
+        self._initial_size = size
+
+    def start(self):
+        """
+        Start the initial workers and the thread that resizes the pool in elastic mode
+        """
+
+        self._running = True
+        self.resize(self._initial_size)
+
+        self._elastic_thread = threading.Thread(target=self._elastic_loop)
+        self._elastic_thread.daemon = True
+        self._elastic_thread.start()
+
+    def resize(self, size):
+        """
+        Set the number of workers. Surplus workers are retired, idle workers first.
+
+        :param size: the new number of workers
+        """
+
+        if not isinstance(size, int) or size < 1:
+            raise WorkerPoolError("The number of workers should be a positive integer")
+
+        with self._lock:
+            self._prune(False)
+
+            while len(self._workers) < size:
+                self._start_worker()
+
+            if len(self._workers) > size:
+                surplus = sorted(self._workers, key=lambda item: item.busy)[:len(self._workers) - size]
+                for worker in surplus:
+                    worker.retire()
+                    self._workers.remove(worker)
+                    self._retiring.append(worker)
+
+            if self.size == 0:
+                self.log.info("%s pool started with %s workers" % (self.name, size))
+            elif size != self.size:
+                self.log.info("%s pool resized from %s to %s workers" % (self.name, self.size, size))
+
+            self.size = size
+
+    def configure(self, size=None, elastic=None, min_size=None, max_size=None):
+        """
+        Change the pool configuration at runtime. Arguments that are None are left unchanged.
+
+        :param size: number of workers
+        :param elastic: whether to resize the pool automatically
+        :param min_size: minimum number of workers in elastic mode
+        :param max_size: maximum number of workers in elastic mode
+        """
+
+        new_min_size = self.min_size if min_size is None else min_size
+        new_max_size = self.max_size if max_size is None else max_size
+
+        self._validate_limits(size if size is not None else max(min(self.size, new_max_size), new_min_size),
+                              new_min_size, new_max_size)
+
+        self.min_size = new_min_size
+        self.max_size = new_max_size
+
+        if elastic is not None:
+            self.elastic = elastic
+
+        if size is not None:
+            self.resize(size)
+        elif self.elastic and not self.min_size <= self.size <= self.max_size:
+            self.resize(max(min(self.size, self.max_size), self.min_size))
+
+    def get_status(self):
+        """
+        Get a description of the current state of the pool
+
+        :return: dictionary with the pool state
+        """
+
+        with self._lock:
+            self._prune()
+
+            return {
+                'size': self.size,
+                'busy': sum(1 for worker in self._workers if worker.busy),
+                'elastic': self.elastic,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+            }
+
+    def stop(self):
+        """
+        Retire all workers and wait for them to finish their current item
+        """
+
+        self._running = False
+        self._elastic_event.set()
+
+        with self._lock:
+            workers = self._workers + self._retiring
+            for worker in workers:
+                worker.retire()
+            self._workers = []
+            self._retiring = []
+
+        for worker in workers:
+            worker.join()
+
+        if self._elastic_thread is not None:
+            self._elastic_thread.join()
+
+    def _validate_limits(self, size, min_size, max_size):
+        """
+        Verify the pool size parameters
+
+        :param size: number of workers
+        :param min_size: minimum number of workers in elastic mode
+        :param max_size: maximum number of workers in elastic mode
+        """
+
+        for value in (size, min_size, max_size):
+            if not isinstance(value, int) or value < 1:
+                raise WorkerPoolError("The number of workers should be a positive integer")
+
+        if min_size > max_size:
+            raise WorkerPoolError("The minimum number of workers can not be more than the maximum")
+
+    def _start_worker(self):
+        """
+        Create and start a worker. Should be called with the lock held.
+        """
+
+        try:
+            worker = self.worker_factory()
+
+        except Exception as e:
+            raise WorkerPoolError("Failed to create a worker: %s" % e)
+
+        if not isinstance(worker, WorkerThread):
+            raise WorkerPoolError("The worker factory did not return a worker thread")
+
+        worker.start()
+        self._workers.append(worker)
+
+    def _prune(self, replace=True):
+        """
+        Remove workers that have stopped from the administration. Workers that stopped without being retired are
+        replaced, so the pool keeps its size. Should be called with the lock held.
+
+        :param replace: whether to replace the workers that stopped unexpectedly
+        """
+
+        for workers in (self._workers, self._retiring):
+            for worker in [item for item in workers if not item.is_alive()]:
+                self._retired_bytes += worker.get_processed_bytes()
+                workers.remove(worker)
+
+        if not replace or not self._running:
+            return
+
+        while len(self._workers) < self.size:
+            self.log.warning("A worker of the %s pool stopped unexpectedly, starting a replacement" % self.name)
+
+            try:
+                self._start_worker()
+
+            except WorkerPoolError as e:
+                self.log.error("Failed to replace a worker of the %s pool: %s" % (self.name, e))
+                break
+
+    def _processed_bytes(self):
+        """
+        Total number of bytes processed by all current and former workers of the pool
+
+        :return: number of bytes
+        """
+
+        with self._lock:
+            return self._retired_bytes + sum(worker.get_processed_bytes()
+                                             for worker in self._workers + self._retiring)
+
+    def _elastic_loop(self):
+        """
+        Periodically replace workers that stopped unexpectedly, and evaluate the pool size in elastic mode. The pool
+        grows by one worker per interval while work is queued and all workers are busy, as long as the previous growth
+        step increased the throughput; a worker that did not increase the throughput is removed again. It shrinks by
+        one worker per interval while the queue is empty and workers are idle.
+        """
+
+        previous_bytes = self._processed_bytes()
+        previous_time = time.time()
+        throughput_before_growth = None
+        saturated = False
+
+        while self._running:
+            self._elastic_event.wait(self.elastic_interval)
+            self._elastic_event.clear()
+
+            if not self._running:
+                break
+
+            with self._lock:
+                self._prune()
+
+            current_bytes = self._processed_bytes()
+            current_time = time.time()
+            throughput = (current_bytes - previous_bytes) / max(current_time - previous_time, 0.001)
+            previous_bytes = current_bytes
+            previous_time = current_time
+
+            if not self.elastic:
+                throughput_before_growth = None
+                saturated = False
+                continue
+
+            status = self.get_status()
+            backlog = self.work_queue.qsize()
+
+            # Judge the last growth step: if the throughput did not scale, remove the added worker again and stop
+            # growing until the backlog clears
+            if throughput_before_growth is not None:
+                if throughput < throughput_before_growth * (1 + self.growth_threshold):
+                    saturated = True
+                    self.log.info("%s pool throughput did not scale beyond %s workers"
+                                  % (self.name, status['size'] - 1))
+
+                    if status['size'] > self.min_size:
+                        self.resize(status['size'] - 1)
+                        status = self.get_status()
+
+                throughput_before_growth = None
+
+            if backlog > 0 and status['busy'] >= status['size']:
+                if not saturated and status['size'] < self.max_size:
+                    throughput_before_growth = throughput
+                    self.resize(status['size'] + 1)
+
+            elif backlog == 0:
+                saturated = False
+
+                if status['busy'] < status['size'] and status['size'] > self.min_size:
+                    self.resize(status['size'] - 1)
@@ -0,0 +1,378 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+from .exceptions import BandwidthLimiterError
+
+import collections
+import threading
+import time
+
+from ecmwfapi.metrics import metrics
+
+
+_throttled_time = metrics.counter('ecmwfapi_bandwidth_throttled_seconds_total', "Time download threads waited for the "
+                                  "bandwidth limit")
+
+
+class BandwidthLimiter:
+    """
+    Token bucket that limits the combined download rate of all transfers in the process. Each transfer takes a share of
+    the rate in proportion to its weight, relative to the weights of the other active transfers, and waits before every
+    block until its share allows the block. Unused bandwidth accumulates for at most burst seconds. A transfer is active
+    while it waits for its share, and for idle seconds after its last block, so that the rate of a transfer that stopped
+    drawing tokens, for example while it is blocked on the disk or on other transfers in the block scheduler, goes to
+    the transfers that still download.
+
+    The rate can follow a time-of-day schedule, a list of [start minute, end minute, rate] windows in local time. The
+    rate of the first window containing the current time applies, and the default rate outside the windows. A window
+    that ends before it starts wraps around midnight. A rate of zero means no limit.
+    """
+
+    def __init__(self, rate=0, burst=1.0, schedule=None, window=10, idle=1.0):
+        """
+        :param rate: default rate in bytes per second, no limit if zero
+        :param burst: number of seconds of unused bandwidth a transfer can accumulate
+        :param schedule: list of [start minute, end minute, rate] windows, see parse_schedule
+        :param window: number of seconds over which the achieved rate is measured
+        :param idle: number of seconds after its last block a transfer keeps its share of the rate
+        """
+
+        self._lock = threading.Lock()
+        self._shares = set()
+        self.idle = idle
+
+        # Bytes admitted per second, to determine the achieved rate
+        self._history = collections.deque()
+        self.window = window
+
+        self.rate = 0
+        self.burst = 1.0
+        self.schedule = []
+        self.configure(rate, burst, schedule)
+
+        metrics.gauge('ecmwfapi_bandwidth_limit_bytes_per_second', "Configured download rate limit, 0 if unlimited",
+                      function=self.current_rate)
+        metrics.gauge('ecmwfapi_bandwidth_achieved_bytes_per_second', "Download rate admitted by the bandwidth limiter "
+                      "over the measurement window", function=self.achieved_rate)
+
+    def configure(self, rate=None, burst=None, schedule=None):
+        """
+        Change the settings, which apply to the transfers in progress as well. Settings that are None are not changed.
+
+        :param rate: default rate in bytes per second, no limit if zero
+        :param burst: number of seconds of unused bandwidth a transfer can accumulate
+        :param schedule: list of [start minute, end minute, rate] windows
+        """
+
+        if rate is not None and (not isinstance(rate, (int, float)) or rate < 0):
+            raise BandwidthLimiterError("The rate should be a non-negative number")
+
+        if burst is not None and (not isinstance(burst, (int, float)) or burst <= 0):
+            raise BandwidthLimiterError("The burst should be a positive number of seconds")
+
+        if schedule is not None:
+            for window in schedule:
+                if len(window) != 3 or not all(isinstance(value, (int, float)) for value in window) or \
+                        not 0 <= window[0] < 1440 or not 0 <= window[1] <= 1440 or window[2] < 0:
+                    raise BandwidthLimiterError("Invalid schedule window %s" % (window,))
+
+        with self._lock:
+            if rate is not None:
+                self.rate = rate
+            if burst is not None:
+                self.burst = burst
+            if schedule is not None:
+                self.schedule = [list(window) for window in schedule]
+
+    def current_rate(self, now=None):
+        """
+        :param now: epoch timestamp, the current time if None
+        :return: rate limit in bytes per second at the given time, 0 if unlimited
+        """
+
+        schedule = self.schedule
+        if not schedule:
+            return self.rate
+
+        local_time = time.localtime(now)
+        minute = local_time.tm_hour * 60 + local_time.tm_min
+
+        for [start, end, rate] in schedule:
+            if start <= minute < end or (end < start and (minute >= start or minute < end)):
+                return rate
+
+        return self.rate
+
+    def achieved_rate(self):
+        """
+        :return: average rate in bytes per second admitted over the measurement window
+        """
+
+        now = time.time()
+
+        with self._lock:
+            self._prune(now)
+            return sum(item[1] for item in self._history) / float(self.window)
+
+    def transfer(self, weight=1):
+        """
+        Register a transfer. Use the result as context manager, or close it when the transfer ends.
+
+        :param weight: weight of the transfer relative to the other transfers
+        :return: BandwidthShare of the transfer
+        """
+
+        if not isinstance(weight, (int, float)) or weight <= 0:
+            raise BandwidthLimiterError("The weight of a transfer should be a positive number")
+
+        share = BandwidthShare(self, weight)
+
+        with self._lock:
+            self._refill(time.time())
+            self._shares.add(share)
+
+        return share
+
+    def get_statistics(self):
+        """
+        :return: dictionary with the configured and achieved rate, and the number of transfers in progress and active
+        """
+
+        now = time.time()
+
+        with self._lock:
+            active = sum(1 for share in self._shares if share.active_until >= now)
+
+        return {
+            'configured_rate': self.current_rate(),
+            'achieved_rate': self.achieved_rate(),
+            'transfers': len(self._shares),
+            'active_transfers': active,
+            'burst': self.burst,
+        }
+
+    def _release(self, share):
+        with self._lock:
+            if share in self._shares:
+                self._refill(time.time())
+                self._shares.remove(share)
+
+    def _admit(self, share, size, wait=True):
+        """
+        Take tokens for a block of the given share
+
+        :param wait: whether the block is admitted on credit, to be downloaded after the returned delay. Otherwise the
+            block is only admitted while the share has no debt, and nothing is taken if it is not admitted.
+        :return: number of seconds to wait before downloading the block, or until the block can be admitted
+        """
+
+        now = time.time()
+        rate = self.current_rate(now)
+
+        with self._lock:
+            if not wait and rate > 0:
+                share_rate = self._share_rate(share, rate, now)
+                self._refill_share(share, now, share_rate)
+
+                if share.tokens < 0:
+                    delay = -share.tokens / share_rate
+                    share.active_until = now + delay + self.idle
+                    return delay
+
+            second = int(now)
+            if self._history and self._history[-1][0] == second:
+                self._history[-1][1] += size
+            else:
+                self._history.append([second, size])
+                self._prune(now)
+
+            if rate <= 0:
+                share.updated = now
+                share.active_until = now + self.idle
+                return 0.0
+
+            share_rate = self._share_rate(share, rate, now)
+            self._refill_share(share, now, share_rate)
+            share.tokens -= size
+
+            delay = -share.tokens / share_rate if share.tokens < 0 and wait else 0.0
+            share.active_until = now + delay + self.idle
+
+            return delay
+
+    def _share_rate(self, share, rate, now):
+        """
+        Rate of the share relative to the weights of the active shares, the share itself counting as active. Called with
+        the lock held.
+        """
+
+        weight = share.weight
+
+        for other in self._shares:
+            if other is not share and other.active_until >= now:
+                weight += other.weight
+
+        return rate * share.weight / weight
+
+    def _refill_share(self, share, now, share_rate):
+        share.tokens = min(share.tokens + (now - share.updated) * share_rate, share_rate * self.burst)
+        share.updated = now
+
+    def _refill(self, now):
+        """
+        Add the tokens earned so far to all shares, before the weights change. Called with the lock held.
+        """
+
+        rate = self.current_rate(now)
+
+        for share in self._shares:
+            if rate > 0:
+                self._refill_share(share, now, self._share_rate(share, rate, now))
+            else:
+                share.updated = now
+
+    def _prune(self, now):
+        while self._history and self._history[0][0] <= now - self.window:
+            self._history.popleft()
+
+
+class BandwidthShare:
+    """
+    Share of a transfer in the bandwidth limiter
+    """
+
+    def __init__(self, limiter, weight):
+
+        self.limiter = limiter
+        self.weight = weight
+        self.tokens = 0.0
+        self.updated = time.time()
+
+        # Time until which the share counts in the division of the rate, it is idle before its first block
+        self.active_until = 0.0
+
+        self.bytes = 0
+        self.throttled_time = 0.0
+        self.blocked_since = None
+        self.closed = False
+
+        self._lock = threading.Lock()
+
+    def acquire(self, size, control=None):
+        """
+        Wait until the share allows a block of the given size. Can be called from multiple download threads.
+
+        :param size: size of the block in bytes
+        :param control: optional TransferControl, the wait is interrupted when the transfer is cancelled
+        :return: number of seconds waited
+        """
+
+        delay = self.limiter._admit(self, size)
+
+        with self._lock:
+            self.bytes += size
+            self.throttled_time += delay
+
+        if delay > 0:
+            _throttled_time.inc(delay)
+
+            if control is not None:
+                control.sleep(delay)
+            else:
+                time.sleep(delay)
+
+        return delay
+
+    def try_acquire(self, size):
+        """
+        Take a block of the given size if the share allows it now, without waiting. Used by shared download workers,
+        which should not sleep on behalf of a throttled download.
+
+        :param size: size of the block in bytes
+        :return: 0 if the block may be downloaded, otherwise the number of seconds until it may be
+        """
+
+        delay = self.limiter._admit(self, size, False)
+        now = time.time()
+
+        with self._lock:
+            if delay > 0:
+                if self.blocked_since is None:
+                    self.blocked_since = now
+
+                return delay
+
+            self.bytes += size
+
+            # The time the download was skipped counts as throttled
+            if self.blocked_since is not None:
+                throttled = now - self.blocked_since
+                self.blocked_since = None
+                self.throttled_time += throttled
+                _throttled_time.inc(throttled)
+
+        return 0.0
+
+    def close(self):
+        """
+        Release the share, the other transfers take over its bandwidth
+        """
+
+        self.closed = True
+        self.limiter._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.close()
+        return False
+
+
+def parse_schedule(value):
+    """
+    Parse a schedule setting, a comma separated list of HH:MM-HH:MM=rate windows, for example
+    08:00-18:00=10485760,18:00-08:00=0
+
+    :param value: the setting
+    :return: list of [start minute, end minute, rate] windows
+    """
+
+    schedule = []
+
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+
+        try:
+            [times, rate] = item.split('=')
+            [start, end] = [_parse_minute(moment) for moment in times.split('-')]
+            schedule.append([start, end, int(rate)])
+
+        except ValueError:
+            raise BandwidthLimiterError("Invalid schedule window '%s', expected HH:MM-HH:MM=rate" % item)
+
+    return schedule
+
+
+def _parse_minute(moment):
+    [hours, minutes] = [int(part) for part in moment.strip().split(':')]
+
+    if not 0 <= hours <= 24 or not 0 <= minutes < 60 or hours * 60 + minutes > 1440:
+        raise ValueError("Invalid time %s" % moment)
+
+    return hours * 60 + minutes
+
+
+# Shared by all downloads of the process
+bandwidth_limiter = BandwidthLimiter()
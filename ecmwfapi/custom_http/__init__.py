@@ -10,5 +10,6 @@
 # (C) Copyright 2017 Ricardo Persoon.
 
 
+from .block_scheduler import BlockScheduler, ScheduledTransfer, block_scheduler
 from .custom_http import *
-from .exceptions import CustomHttpError
+from .exceptions import CustomHttpError, IntegrityError
@@ -0,0 +1,368 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+from .exceptions import CustomHttpError
+
+import collections
+import threading
+import time
+
+from ecmwfapi.metrics import metrics
+from ecmwfapi.transfer_control import TransferCancelledError
+
+
+class BlockScheduler:
+    """
+    Pool of download workers shared by all parallel downloads of the process. Every download registers its blocks, and
+    each worker that becomes free takes the next block of one of the downloads, selected by the policy:
+
+    - shortest_remaining: the download with the fewest bytes left, so small results are not held up by large ones
+    - fair_share: the download that received the fewest bytes relative to its weight
+    - priority: the download with the highest priority, and of those the one with the fewest bytes left
+
+    A download never has more than its own maximum number of blocks in progress, and workers do not fetch blocks too far
+    ahead of the block the download writes next, which bounds the memory used for blocks waiting to be written. Paused
+    downloads, and downloads that are throttled by the bandwidth limiter, are skipped, so they do not hold on to
+    workers. Workers keep their connections open between blocks, at most connections_per_worker of them, so the number
+    of connections is bounded by the number of workers.
+    """
+
+    policies = ('shortest_remaining', 'fair_share', 'priority')
+
+    # Connections each worker keeps open, for the most recently used connection keys
+    connections_per_worker = 4
+
+    def __init__(self, workers=8, policy='shortest_remaining'):
+        """
+        :param workers: number of download workers, started when they are first needed
+        :param policy: one of the policies
+        """
+
+        self._condition = threading.Condition()
+        self._transfers = []
+        self._worker_count = 0
+        self._busy_workers = 0
+
+        self.workers = 0
+        self.policy = None
+        self.configure(workers, policy)
+
+        metrics.gauge('ecmwfapi_block_scheduler_transfers', "Number of downloads registered at the block scheduler",
+                      function=lambda: len(self._transfers))
+        metrics.gauge('ecmwfapi_block_scheduler_busy_workers', "Number of block scheduler workers downloading a block",
+                      function=lambda: self._busy_workers)
+
+    def configure(self, workers=None, policy=None):
+        """
+        Change the settings. Settings that are None are not changed. Surplus workers stop after their current block.
+
+        :param workers: number of download workers
+        :param policy: one of the policies
+        """
+
+        if workers is not None and (not isinstance(workers, int) or workers < 1):
+            raise CustomHttpError("The number of download workers should be a positive integer")
+
+        if policy is not None and policy not in self.policies:
+            raise CustomHttpError("Unknown block scheduling policy %s, expected one of %s"
+                                  % (policy, ', '.join(self.policies)))
+
+        with self._condition:
+            if workers is not None:
+                self.workers = workers
+            if policy is not None:
+                self.policy = policy
+
+            self._condition.notify_all()
+
+    def add_transfer(self, blocks, fetch, connect, connection_key=None, control=None, max_workers=5, priority=0,
+                     weight=1, admit=None):
+        """
+        Register a download
+
+        :param blocks: list of [block ID, first byte, last byte], in the order in which the blocks are written
+        :param fetch: function that downloads a block, called with the connection, block ID, first and last byte
+        :param connect: function without arguments that creates a connection for the download
+        :param connection_key: downloads with the same key can use each other's connections
+        :param control: optional TransferControl, blocks are not handed out while the download is paused or cancelled
+        :param max_workers: maximum number of blocks of the download in progress at the same time
+        :param priority: priority of the download for the priority policy
+        :param weight: weight of the download for the fair share policy
+        :param admit: optional function called with the size of the next block before it is handed out, which returns
+            0 if the block may be fetched now and otherwise the number of seconds until it may be, such as
+            BandwidthShare.try_acquire. The download is skipped meanwhile.
+        :return: ScheduledTransfer, which has to be closed after the download
+        """
+
+        if not isinstance(max_workers, int) or max_workers < 1:
+            raise CustomHttpError("The number of threads should be a positive integer")
+
+        if not isinstance(weight, (int, float)) or weight <= 0:
+            raise CustomHttpError("The weight of a download should be a positive number")
+
+        transfer = ScheduledTransfer(self, blocks, fetch, connect, connection_key, control, max_workers, priority,
+                                     weight, admit)
+
+        with self._condition:
+            # New downloads start at the lowest virtual time of the active ones, so they do not take over all workers
+            # to catch up
+            if self._transfers:
+                transfer.virtual_time = min(item.virtual_time for item in self._transfers)
+
+            self._transfers.append(transfer)
+
+            while self._worker_count < self.workers:
+                self._worker_count += 1
+                threading.Thread(target=self._work, name='block-scheduler', daemon=True).start()
+
+            self._condition.notify_all()
+
+        return transfer
+
+    def get_statistics(self):
+        """
+        :return: dictionary with the number of workers, busy workers, downloads and queued blocks
+        """
+
+        with self._condition:
+            return {
+                'policy': self.policy,
+                'workers': self._worker_count,
+                'busy_workers': self._busy_workers,
+                'transfers': len(self._transfers),
+                'queued_blocks': sum(len(item.pending) for item in self._transfers),
+            }
+
+    def _remove(self, transfer):
+        with self._condition:
+            if transfer in self._transfers:
+                self._transfers.remove(transfer)
+
+            transfer.pending.clear()
+            transfer.results.clear()
+            self._condition.notify_all()
+
+    def _select(self):
+        """
+        Select the download of which the next block is fetched, and admit the block. Called with the lock held.
+
+        :return: ScheduledTransfer, or None if no download has a block that can be fetched
+        """
+
+        now = time.time()
+        candidates = [item for item in self._transfers if item.ready(now)]
+
+        while candidates:
+            if self.policy == 'fair_share':
+                transfer = min(candidates, key=lambda item: item.virtual_time)
+
+            elif self.policy == 'priority':
+                transfer = min(candidates, key=lambda item: (-item.priority, item.remaining_bytes))
+
+            else:
+                transfer = min(candidates, key=lambda item: item.remaining_bytes)
+
+            if transfer.admit is None:
+                return transfer
+
+            block = transfer.pending[0]
+            delay = transfer.admit(block[2] - block[1] + 1)
+
+            if delay <= 0:
+                return transfer
+
+            # Throttled, the next download gets the worker
+            transfer.throttled_until = now + delay
+            candidates.remove(transfer)
+
+        return None
+
+    def _wait_time(self):
+        """
+        :return: number of seconds until a throttled download can be checked again, at most 1. Called with the lock
+            held.
+        """
+
+        now = time.time()
+        wait = 1.0
+
+        for item in self._transfers:
+            if item.pending and item.throttled_until > now:
+                wait = min(wait, item.throttled_until - now)
+
+        return max(wait, 0.001)
+
+    def _work(self):
+        """
+        Worker thread, fetches blocks until there are more workers than configured
+        """
+
+        connections = collections.OrderedDict()
+
+        while True:
+            with self._condition:
+                transfer = None
+
+                while transfer is None:
+                    if self._worker_count > self.workers:
+                        self._worker_count -= 1
+                        return
+
+                    transfer = self._select()
+
+                    # Paused and throttled downloads are not announced when they can continue, so check again
+                    if transfer is None:
+                        self._condition.wait(self._wait_time())
+
+                block = transfer.pending.popleft()
+                size = block[2] - block[1] + 1
+
+                transfer.in_progress += 1
+                transfer.virtual_time += size / float(transfer.weight)
+                self._busy_workers += 1
+
+            try:
+                if transfer.connection_key in connections:
+                    connections.move_to_end(transfer.connection_key)
+
+                else:
+                    connections[transfer.connection_key] = transfer.connect()
+
+                    while len(connections) > self.connections_per_worker:
+                        _close(connections.popitem(last=False)[1])
+
+                content = transfer.fetch(connections[transfer.connection_key], block[0], block[1], block[2])
+
+            except Exception as e:
+                # Handed to the download, which raises it when it reaches the block
+                content = e
+
+            with self._condition:
+                transfer.in_progress -= 1
+                transfer.remaining_bytes -= size
+                self._busy_workers -= 1
+
+                if not transfer.closed:
+                    transfer.results[block[0]] = content
+
+                self._condition.notify_all()
+
+
+class ScheduledTransfer:
+    """
+    Download registered at a BlockScheduler
+    """
+
+    def __init__(self, scheduler, blocks, fetch, connect, connection_key, control, max_workers, priority, weight,
+                 admit=None):
+
+        self.scheduler = scheduler
+        self.pending = collections.deque(blocks)
+        self.fetch = fetch
+        self.connect = connect
+        self.connection_key = connection_key
+        self.control = control
+        self.max_workers = max_workers
+        self.priority = priority
+        self.weight = weight
+        self.admit = admit
+
+        # Time until which the download is skipped because its bandwidth share is used up
+        self.throttled_until = 0.0
+
+        self.remaining_bytes = sum(block[2] - block[1] + 1 for block in blocks)
+        self.in_progress = 0
+        self.virtual_time = 0.0
+        self.results = {}
+        self.closed = False
+
+        # Blocks are only fetched up to this distance ahead of the block that is written next
+        self.next_block = blocks[0][0] if blocks else 0
+        self.read_ahead = 2 * max_workers
+
+    def ready(self, now=None):
+        """
+        :param now: current time, to check whether the download is still throttled
+        :return: whether a worker can fetch the next block of the download. Called with the lock held.
+        """
+
+        if not self.pending or self.in_progress >= self.max_workers:
+            return False
+
+        if now is not None and now < self.throttled_until:
+            return False
+
+        if self.control is not None and (self.control.is_paused() or self.control.is_cancelled()):
+            return False
+
+        return self.pending[0][0] < self.next_block + self.read_ahead
+
+    def get(self, block_id):
+        """
+        Wait for a block. Blocks have to be requested in order.
+
+        :param block_id: ID of the block
+        :return: content of the block
+        """
+
+        condition = self.scheduler._condition
+
+        with condition:
+            self.next_block = block_id
+            condition.notify_all()
+
+            while block_id not in self.results:
+                if self.control is not None and self.control.is_cancelled():
+                    raise TransferCancelledError("The transfer was cancelled")
+
+                condition.wait(1)
+
+            content = self.results.pop(block_id)
+            self.next_block = block_id + 1
+            condition.notify_all()
+
+        # Blocks that could not be downloaded are stored as the error that occurred
+        if isinstance(content, Exception):
+            raise content
+
+        return content
+
+    def close(self):
+        """
+        Unregister the download. Blocks that are still being fetched are discarded.
+        """
+
+        self.closed = True
+        self.scheduler._remove(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.close()
+        return False
+
+
+def _close(connection):
+    """
+    Close the connections of an evicted HTTP handle
+    """
+
+    try:
+        connection.close()
+
+    except Exception:
+        pass
+
+
+# Shared by all parallel downloads of the process
+block_scheduler = BlockScheduler()
@@ -10,24 +10,62 @@
 # (C) Copyright 2017 Ricardo Persoon.
 
 
-from .exceptions import CustomHttpError
-
-import concurrent.futures
+from .block_scheduler import block_scheduler
+from .exceptions import CustomHttpError, IntegrityError
+from ecmwfapi import tracing
+from ecmwfapi.bandwidth_limiter import bandwidth_limiter
+from ecmwfapi.metrics import metrics
+
+import base64
+import binascii
+import contextlib
+import hashlib
 import httplib2
+import re
 import socket
-import sys
 import time
 
 
-# Python 2 backwards compatibility: queue module called Queue in python 2
-if sys.version_info > (3, 0):
-    import queue
+_blocks_downloaded = metrics.counter('ecmwfapi_blocks_downloaded_total', "Number of downloaded blocks")
+_block_retries = metrics.counter('ecmwfapi_block_retries_total', "Number of failed block downloads that were retried")
+_block_duration = metrics.histogram('ecmwfapi_block_duration_seconds', "Duration of block downloads")
+_bytes_written = metrics.counter('ecmwfapi_written_bytes_total', "Number of downloaded bytes written to files")
+_invalid_blocks = metrics.counter('ecmwfapi_invalid_blocks_total', "Number of downloaded blocks that failed validation "
+                                  "and were fetched again")
+_file_digest_mismatches = metrics.counter('ecmwfapi_file_digest_mismatches_total', "Number of downloaded files of "
+                                          "which the digest differed from the digest announced by the server")
+_rewritten_blocks = metrics.counter('ecmwfapi_rewritten_blocks_total', "Number of blocks that changed when they were "
+                                    "fetched again after a file digest mismatch, and were rewritten")
+
+# Attempts per block for transport errors, and for responses that fail validation
+_block_attempts = 7
+_invalid_block_attempts = 3
+
+# Digest algorithms in order of preference, by their name in the Digest header
+_digest_algorithms = [['sha-512', 'sha512'], ['sha-256', 'sha256'], ['sha', 'sha1'], ['md5', 'md5']]
+
+_content_range_pattern = re.compile(r'^bytes\s+(\d+)-(\d+)/(\d+|\*)$')
+_md5_etag_pattern = re.compile(r'^[0-9a-fA-F]{32}$')
+
+
+def create_http_handle(timeout=30, disable_ssl_validation=False):
+    """
+    Create an HTTP handle that does not follow redirects. A handle keeps its connections open, so passing the same
+    handle to subsequent requests to the same host saves setting up a new connection each time. Handles should not be
+    shared between threads.
+
+    :param timeout: timeout of requests in seconds
+    :param disable_ssl_validation: whether to disable SSL validation in httplib2
+    :return: httplib2.Http object
+    """
+
+    h = httplib2.Http(timeout=timeout, disable_ssl_certificate_validation=disable_ssl_validation)
+    h.follow_redirects = False
 
-else:
-    import Queue as queue
+    return h
 
 
-def get_request(url, headers=None, timeout=30, disable_ssl_validation=False):
+def get_request(url, headers=None, timeout=30, disable_ssl_validation=False, http_handle=None):
     """
     Retrieve contents of a page, passing any exceptions. Does not follow redirects.
 
@@ -35,12 +73,13 @@ def get_request(url, headers=None, timeout=30, disable_ssl_validation=False):
     :param headers: request headers
     :param timeout: timeout of request in seconds
     :param disable_ssl_validation: whether to disable SSL validation in httplib2
+    :param http_handle: optional handle created with create_http_handle to reuse its connections, the timeout and SSL
+        validation settings of the handle apply instead
     :return: page data
     """
 
     try:
-        h = httplib2.Http(timeout=timeout, disable_ssl_certificate_validation=disable_ssl_validation)
-        h.follow_redirects = False
+        h = http_handle if http_handle is not None else create_http_handle(timeout, disable_ssl_validation)
         resp, content = h.request(url, 'GET', '', headers=headers)
 
     except (httplib2.ServerNotFoundError, ConnectionResetError, ConnectionAbortedError, ConnectionRefusedError,
@@ -54,7 +93,7 @@ def get_request(url, headers=None, timeout=30, disable_ssl_validation=False):
     return [resp, content]
 
 
-def post_request(url, data, headers=None, timeout=30, disable_ssl_validation=False):
+def post_request(url, data, headers=None, timeout=30, disable_ssl_validation=False, http_handle=None):
     """
     Retrieve contents of a page with a POST request and one payload data object, passing any exceptions.  Does not
     follow redirects.
@@ -64,6 +103,8 @@ def post_request(url, data, headers=None, timeout=30, disable_ssl_validation=Fal
     :param headers: request headers
     :param timeout: timeout of request in seconds
     :param disable_ssl_validation: whether to disable SSL validation in httplib2
+    :param http_handle: optional handle created with create_http_handle to reuse its connections, the timeout and SSL
+        validation settings of the handle apply instead
     :return: page data
     """
 
@@ -73,8 +114,7 @@ def post_request(url, data, headers=None, timeout=30, disable_ssl_validation=Fal
     headers['Content-type'] = 'application/x-www-form-urlencoded'
 
     try:
-        h = httplib2.Http(timeout=timeout, disable_ssl_certificate_validation=disable_ssl_validation)
-        h.follow_redirects = False
+        h = http_handle if http_handle is not None else create_http_handle(timeout, disable_ssl_validation)
         resp, content = h.request(url, 'POST', data, headers=headers)
 
     except (httplib2.ServerNotFoundError, ConnectionResetError, ConnectionAbortedError, ConnectionRefusedError,
@@ -88,7 +128,7 @@ def post_request(url, data, headers=None, timeout=30, disable_ssl_validation=Fal
     return [resp, content]
 
 
-def delete_request(url, headers=None, timeout=30, disable_ssl_validation=False):
+def delete_request(url, headers=None, timeout=30, disable_ssl_validation=False, http_handle=None):
     """
     Retrieve contents of a page, passing any exceptions. Does not follow redirects.
 
@@ -96,12 +136,13 @@ def delete_request(url, headers=None, timeout=30, disable_ssl_validation=False):
     :param headers: request headers
     :param timeout: timeout of request in seconds
     :param disable_ssl_validation: whether to disable SSL validation in httplib2
+    :param http_handle: optional handle created with create_http_handle to reuse its connections, the timeout and SSL
+        validation settings of the handle apply instead
     :return: page data
     """
 
     try:
-        h = httplib2.Http(timeout=timeout, disable_ssl_certificate_validation=disable_ssl_validation)
-        h.follow_redirects = False
+        h = http_handle if http_handle is not None else create_http_handle(timeout, disable_ssl_validation)
         resp, content = h.request(url, 'DELETE', '', headers=headers)
 
     except (httplib2.ServerNotFoundError, ConnectionResetError, ConnectionAbortedError, ConnectionRefusedError,
@@ -115,7 +156,8 @@ def delete_request(url, headers=None, timeout=30, disable_ssl_validation=False):
     return [resp, content]
 
 
-def robust_get_file(url, file_handle, block_size=1048576, timeout=20, disable_ssl_validation=False):
+def robust_get_file(url, file_handle, block_size=1048576, timeout=20, disable_ssl_validation=False, control=None,
+                    http_handle=None, stats=None, log=None, verify=True, bandwidth_weight=1):
     """
     Download an object in a robust way using HTTP partial downloading
 
@@ -124,7 +166,19 @@ def robust_get_file(url, file_handle, block_size=1048576, timeout=20, disable_ss
     :param block_size: size of individual download chunks during partial downloading
     :param timeout: timeout in seconds till individual block downloads are failed
     :param disable_ssl_validation: whether to disable SSL validation in httplib2
-    :return: None
+    :param control: optional TransferControl, checked before every block to pause or cancel the download
+    :param http_handle: optional handle created with create_http_handle to reuse its connections, the timeout and SSL
+        validation settings of the handle apply instead
+    :param stats: optional TransferStatistics in which the block latencies and retries are recorded
+    :param log: optional logging method accepting a message and a log level, used to report retries. The retries are
+        printed if not specified.
+    :param verify: whether to compute the digest of the file while it is written, and compare it with the digest
+        announced by the server. If they differ and the file handle is rewritable, see FileWriter.rewrite, the blocks
+        that were not verified with a digest of their range are fetched again and the blocks that changed are
+        rewritten. Raises IntegrityError if the digest still differs.
+    :param bandwidth_weight: share of the process-wide bandwidth limit given to this download, relative to the other
+        downloads in progress
+    :return: size of the file in bytes
     """
 
     # Verify block size parameter
@@ -143,8 +197,17 @@ def robust_get_file(url, file_handle, block_size=1048576, timeout=20, disable_ss
     elif timeout > 86400:
         raise CustomHttpError("The timeout can not be more than 86400 seconds")
 
+    with _bandwidth_share(bandwidth_weight, stats) as bandwidth:
+        return _robust_get_file(url, file_handle, block_size, timeout, disable_ssl_validation, control, http_handle,
+                                stats, log, verify, bandwidth)
+
+
+def _robust_get_file(url, file_handle, block_size, timeout, disable_ssl_validation, control, http_handle, stats, log,
+                     verify, bandwidth):
+
     # Define HTTP handler
-    http_handle = httplib2.Http(timeout=timeout, disable_ssl_certificate_validation=disable_ssl_validation)
+    if http_handle is None:
+        http_handle = httplib2.Http(timeout=timeout, disable_ssl_certificate_validation=disable_ssl_validation)
 
     # Retrieve header first in order to determine file size
     connected = False
@@ -152,11 +215,15 @@ def robust_get_file(url, file_handle, block_size=1048576, timeout=20, disable_ss
     headers = None
 
     while not connected:
+        if control is not None:
+            control.check()
+
         if connection_retries > 0:
-            print("Failed to retrieve header information, retry %s of 5" % connection_retries)
+            _report(log, "Failed to retrieve header information, retry %s of 5" % connection_retries)
 
         try:
-            headers, _ = http_handle.request(url, 'HEAD', '', headers={})
+            with tracing.span('head', url=url, retries=connection_retries):
+                headers, _ = http_handle.request(url, 'HEAD', '', headers={})
             connected = True
 
         except httplib2.ServerNotFoundError as e:
@@ -172,28 +239,40 @@ def robust_get_file(url, file_handle, block_size=1048576, timeout=20, disable_ss
     try:
         content_length = int(headers['content-length'])
 
-    except KeyError:
+    except (KeyError, ValueError):
         raise CustomHttpError("Content length not set")
 
-    block_start = 0
-    block_end = block_size
+    file_digest = _FileDigest(_get_digest(headers, True)) if verify else None
 
-    if block_end > content_length:
-        block_end = content_length - 1
+    for [block_id, block_start, block_end] in _block_ranges(content_length, block_size):
 
-    while content_length > block_start and block_end != block_start:
+        if control is not None:
+            control.check()
 
-        file_handle.write(_get_block(http_handle, url, block_start, block_end))
-        block_start = block_end + 1
-        block_end += block_size
+        bandwidth.acquire(block_end - block_start + 1, control)
 
-        if block_end >= content_length:
-            block_end = content_length - 1
+        [block, verified] = _get_block(http_handle, url, block_start, block_end, block_id, stats, log, content_length)
+
+        with tracing.span('write', block_id=block_id, bytes=len(block)):
+            file_handle.write(block)
+
+            if file_digest is not None:
+                file_digest.update(block, block_start, verified)
+
+        _bytes_written.inc(len(block))
+
+        if control is not None:
+            control.add_processed_bytes(len(block))
+
+    if file_digest is not None:
+        file_digest.verify(url, stats, _repair_method(file_handle, http_handle, url, control, stats, log,
+                                                      content_length, bandwidth))
 
     return content_length
 
 
-def robust_get_file_parallel(url, file_handle, block_size=1048576, timeout=20, disable_ssl_validation=False, threads=5):
+def robust_get_file_parallel(url, file_handle, block_size=1048576, timeout=20, disable_ssl_validation=False, threads=5,
+                             control=None, stats=None, log=None, verify=True, bandwidth_weight=1, priority=0):
     """
     Download an object in a robust way using HTTP partial downloading, and process multiple blocks in parallel
 
@@ -202,8 +281,20 @@ def robust_get_file_parallel(url, file_handle, block_size=1048576, timeout=20, d
     :param block_size: size of individual download chunks during partial downloading
     :param timeout: timeout in seconds till individual block downloads are failed
     :param disable_ssl_validation: whether to disable SSL validation in httplib2
-    :param threads: number of threads to download blocks
-    :return: None
+    :param threads: maximum number of blocks downloaded at the same time. The blocks are downloaded by the workers of
+        the process-wide block_scheduler, which also serve the other parallel downloads.
+    :param control: optional TransferControl, checked before every block to pause or cancel the download
+    :param stats: optional TransferStatistics in which the block latencies and retries are recorded
+    :param log: optional logging method accepting a message and a log level, used to report retries. The retries are
+        printed if not specified.
+    :param verify: whether to compute the digest of the file while it is written, and compare it with the digest
+        announced by the server. If they differ and the file handle is rewritable, see FileWriter.rewrite, the blocks
+        that were not verified with a digest of their range are fetched again and the blocks that changed are
+        rewritten. Raises IntegrityError if the digest still differs.
+    :param bandwidth_weight: share of the process-wide bandwidth limit given to this download, relative to the other
+        downloads in progress. Also the weight of the download in the fair_share policy of the block scheduler.
+    :param priority: priority of the download in the priority policy of the block scheduler
+    :return: size of the file in bytes
     """
 
     # Verify block size parameter
@@ -222,16 +313,13 @@ def robust_get_file_parallel(url, file_handle, block_size=1048576, timeout=20, d
     elif timeout > 86400:
         raise CustomHttpError("The timeout can not be more than 86400 seconds")
 
-    # Define block result storage
-    result_blocks = {}
+    with _bandwidth_share(bandwidth_weight, stats) as bandwidth:
+        return _robust_get_file_parallel(url, file_handle, block_size, timeout, disable_ssl_validation, threads,
+                                         control, stats, log, verify, bandwidth, priority, bandwidth_weight)
 
-    # Define work queue
-    work_queue = queue.Queue()
 
-    # Launch worker threads
-    thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
-    for i in range(threads):
-        thread_pool.submit(_thread_download, work_queue, result_blocks, url, timeout, disable_ssl_validation)
+def _robust_get_file_parallel(url, file_handle, block_size, timeout, disable_ssl_validation, threads, control, stats,
+                              log, verify, bandwidth, priority, weight):
 
     # Define HTTP handler
     http_handle = httplib2.Http(timeout=timeout, disable_ssl_certificate_validation=disable_ssl_validation)
@@ -242,11 +330,15 @@ def robust_get_file_parallel(url, file_handle, block_size=1048576, timeout=20, d
     headers = None
 
     while not connected:
+        if control is not None:
+            control.check()
+
         if connection_retries > 0:
-            print("Failed to retrieve header information, retry %s of 5" % connection_retries)
+            _report(log, "Failed to retrieve header information, retry %s of 5" % connection_retries)
 
         try:
-            headers, _ = http_handle.request(url, 'HEAD', '', headers={})
+            with tracing.span('head', url=url, retries=connection_retries):
+                headers, _ = http_handle.request(url, 'HEAD', '', headers={})
             connected = True
 
         except httplib2.ServerNotFoundError as e:
@@ -262,94 +354,372 @@ def robust_get_file_parallel(url, file_handle, block_size=1048576, timeout=20, d
     try:
         content_length = int(headers['content-length'])
 
-    except KeyError:
+    except (KeyError, ValueError):
         raise CustomHttpError("Content length not set")
 
-    block_start = 0
-    block_end = block_size
+    file_digest = _FileDigest(_get_digest(headers, True)) if verify else None
 
-    if block_end > content_length:
-        block_end = content_length - 1
+    # The blocks are fetched by worker threads, their spans belong to the download span of this thread
+    parent_span = tracing.current_span()
 
-    block_id = 0
-    while content_length > block_start and block_end != block_start:
+    def fetch(connection, block_id, block_start, block_end):
+        return _get_block(connection, url, block_start, block_end, block_id, stats, log, content_length, parent_span)
 
-        work_queue.put([block_id, block_start, block_end])
+    def connect():
+        return httplib2.Http(timeout=timeout, disable_ssl_certificate_validation=disable_ssl_validation)
 
-        block_start = block_end + 1
-        block_end += block_size
+    blocks = list(_block_ranges(content_length, block_size))
 
-        if block_end >= content_length:
-            block_end = content_length - 1
+    # The blocks are fetched by the workers of the process-wide block scheduler, which skip the download while its
+    # bandwidth share is used up instead of waiting for it
+    admit = bandwidth.try_acquire if bandwidth is not None else None
 
-        block_id += 1
+    with block_scheduler.add_transfer(blocks, fetch, connect, (timeout, disable_ssl_validation), control, threads,
+                                      priority, weight, admit) as transfer:
 
-    # Insert poison pills in queue
-    for _ in range(threads):
-        work_queue.put(None)
+        # Write all result blocks to the result file
+        for [block_id, block_start, _] in blocks:
+            if control is not None:
+                control.check()
 
-    # Write all result blocks to the result file
-    written_block_id = 0
-    while written_block_id < block_id:
+            [block, verified] = transfer.get(block_id)
 
-        written = False
-        while not written:
+            with tracing.span('write', block_id=block_id, bytes=len(block)):
+                file_handle.write(block)
 
-            try:
-                file_handle.write(result_blocks[written_block_id])
-                written = True
-                result_blocks.pop(written_block_id)
-                written_block_id += 1
+                if file_digest is not None:
+                    file_digest.update(block, block_start, verified)
+
+            _bytes_written.inc(len(block))
 
-            except KeyError:
-                time.sleep(0.1)
+            if control is not None:
+                control.add_processed_bytes(len(block))
+
+    # The blocks are fetched again one by one, the workers of the block scheduler are not needed for that
+    if file_digest is not None:
+        file_digest.verify(url, stats, _repair_method(file_handle, connect(), url, control, stats, log, content_length,
+                                                      bandwidth))
 
     return content_length
 
 
-def _get_block(http_handle, url, block_start, block_end):
+@contextlib.contextmanager
+def _bandwidth_share(weight, stats=None):
+    """
+    Register a download with the process-wide bandwidth limiter, and record the limit and the time the download waited
+    for it in the statistics
+    """
+
+    share = bandwidth_limiter.transfer(weight)
+
+    try:
+        yield share
+
+    finally:
+        share.close()
+
+        if stats is not None:
+            stats.configured_rate = bandwidth_limiter.current_rate()
+            stats.throttled_duration = share.throttled_time
+
+
+def _report(log, message):
+    """
+    Report a retry through the given logging method, or print it if there is none
+    """
+
+    if log is None:
+        print(message)
+    else:
+        log(message, 'warning')
+
+
+def _block_ranges(content_length, block_size):
+    """
+    Split a file in blocks
+
+    :param content_length: size of the file in bytes
+    :param block_size: size of the blocks in bytes, the last block may be smaller
+    :return: generator of [block ID, first byte, last byte] of the blocks, with inclusive byte positions
+    """
+
+    for [block_id, block_start] in enumerate(range(0, content_length, block_size)):
+        yield [block_id, block_start, min(block_start + block_size, content_length) - 1]
+
+
+def _get_digest(headers, whole_file=False):
+    """
+    Determine the digest of a response body announced by the server, from the Digest or Content-MD5 header. For the
+    whole file an ETag that is a plain MD5 checksum is used as well.
+
+    :param headers: response headers
+    :param whole_file: whether the headers describe the whole file rather than a range of it
+    :return: list of [hashlib algorithm name, expected hexadecimal digest], or None if no digest is announced
+    """
+
+    digests = {}
+
+    for item in (headers.get('digest') or '').split(','):
+        [name, _, value] = item.strip().partition('=')
+        digests[name.strip().lower()] = value.strip()
+
+    if headers.get('content-md5'):
+        digests.setdefault('md5', headers['content-md5'].strip())
+
+    for [name, algorithm] in _digest_algorithms:
+        if digests.get(name):
+            try:
+                return [algorithm, binascii.hexlify(base64.b64decode(digests[name], validate=True)).decode('ascii')]
+
+            except (binascii.Error, ValueError):
+                continue
+
+    if whole_file:
+        etag = (headers.get('etag') or '').strip()
+        if etag.startswith('W/'):
+            return None
+
+        etag = etag.strip('"')
+        if _md5_etag_pattern.match(etag):
+            return ['md5', etag.lower()]
+
+    return None
+
+
+def _validate_block(response, content, block_start, block_end, content_length=None):
+    """
+    Verify that a response contains exactly the requested range. Raises IntegrityError if it does not, and
+    CustomHttpError if the response is an error.
+
+    :param response: response headers
+    :param content: response body
+    :param block_start: first byte of the requested range
+    :param block_end: last byte of the requested range
+    :param content_length: size of the whole file, if known
+    :return: whether the content was verified with a digest of the range announced by the server
+    """
+
+    if response.status == 206:
+        content_range = response.get('content-range')
+
+        if content_range is not None:
+            match = _content_range_pattern.match(content_range.strip())
+
+            if match is None or int(match.group(1)) != block_start or int(match.group(2)) != block_end or \
+                    (content_length is not None and match.group(3) != '*' and int(match.group(3)) != content_length):
+                raise IntegrityError("Received range %s instead of bytes %s-%s" % (content_range, block_start,
+                                                                                    block_end))
+
+    elif response.status == 200:
+        # The whole file is only acceptable if that is what was requested
+        if block_start != 0 or (content_length is not None and block_end != content_length - 1):
+            raise IntegrityError("The server ignored the range request")
+
+    # Server errors are retried like transport errors
+    else:
+        raise CustomHttpError("Unexpected HTTP status %s" % response.status)
+
+    if len(content) != block_end - block_start + 1:
+        raise IntegrityError("Received %s bytes instead of %s" % (len(content), block_end - block_start + 1))
+
+    digest = _get_digest(response)
+    if digest is not None and hashlib.new(digest[0], content).hexdigest() != digest[1]:
+        raise IntegrityError("The %s digest of the block differs from the digest announced by the server" % digest[0])
+
+    return digest is not None
+
+
+class _FileDigest:
+    """
+    Digest of a file computed while its blocks are written in order. If the server announced a digest of the file, the
+    ranges of the blocks are recorded as well, so the blocks can be checked one by one if the digest of the file
+    differs from it.
+    """
+
+    def __init__(self, expected):
+        """
+        :param expected: [algorithm, hexadecimal digest] announced by the server, or None. MD5 is computed if None.
+        """
+
+        self.expected = expected
+        self.algorithm = expected[0] if expected is not None else 'md5'
+        self.hash = hashlib.new(self.algorithm)
+
+        # Per block [first byte, last byte, whether it was verified with a digest of the range], only if there is a
+        # digest to compare with
+        self.blocks = []
+
+    def update(self, block, block_start, verified=False):
+        """
+        :param block: content of the next block
+        :param block_start: position of the block in the file
+        :param verified: whether the block was verified with a digest of its range announced by the server
+        """
+
+        if self.expected is not None:
+            self.blocks.append([block_start, block_start + len(block) - 1, verified])
+
+        self.hash.update(block)
+
+    def verify(self, url, stats=None, repair=None):
+        """
+        Compare the digest with the announced digest and record it in the statistics. Raises IntegrityError if they
+        differ.
+
+        :param url: URL of the file, for the error message
+        :param stats: optional TransferStatistics
+        :param repair: optional method called with the digest if it differs, which fetches blocks again and rewrites
+            the ones that changed, see _repair_file
+        """
+
+        digest = self.hash.hexdigest()
+        verified = None if self.expected is None else digest == self.expected[1]
+
+        if verified is False:
+            _file_digest_mismatches.inc()
+
+            if repair is not None and repair(self):
+                digest = self.hash.hexdigest()
+                verified = digest == self.expected[1]
+
+        if stats is not None:
+            stats.digest = '%s:%s' % (self.algorithm, digest)
+            stats.verified = verified
+
+        if verified is False:
+            raise IntegrityError("The %s digest of %s is %s, the server announced %s"
+                                 % (self.algorithm, url, digest, self.expected[1]))
+
+
+def _repair_method(file_handle, http_handle, url, control, stats, log, content_length, bandwidth):
+    """
+    :return: method that repairs a downloaded file of which the digest differs, see _repair_file, or None if the file
+        handle can not rewrite data, such as compressed files and uploads
+    """
+
+    if not getattr(file_handle, 'rewritable', False):
+        return None
+
+    def fetch(block_start, block_end):
+        if control is not None:
+            control.check()
+
+        bandwidth.acquire(block_end - block_start + 1, control)
+
+        return _get_block(http_handle, url, block_start, block_end, None, stats, log, content_length)
+
+    return lambda file_digest: _repair_file(file_digest, file_handle, fetch, log)
+
+
+def _repair_file(file_digest, file_handle, fetch, log=None):
+    """
+    Fetch the blocks of a file that were not verified with a digest of their range again, and rewrite the blocks that
+    differ from the file. The digest of the file is then recomputed by reading the file back.
+
+    :param file_digest: _FileDigest of the file
+    :param file_handle: rewritable file handle with rewrite and read_range methods, such as FileWriter
+    :param fetch: function that downloads a block, called with the first and last byte, returning [content, verified]
+    :param log: optional logging method
+    :return: whether any block changed
+    """
+
+    changed = False
+
+    for block in file_digest.blocks:
+        [block_start, block_end, verified] = block
+
+        if verified:
+            continue
+
+        [content, verified] = fetch(block_start, block_end)
+        block[2] = verified
+
+        if content != file_handle.read_range(block_start, block_end - block_start + 1):
+            _report(log, "Bytes %s-%s changed when they were fetched again, rewriting them" % (block_start, block_end))
+            _rewritten_blocks.inc()
+
+            file_handle.rewrite(block_start, content)
+            changed = True
+
+    if not changed:
+        return False
+
+    file_hash = hashlib.new(file_digest.algorithm)
+
+    for [block_start, block_end, _] in file_digest.blocks:
+        file_hash.update(file_handle.read_range(block_start, block_end - block_start + 1))
+
+    file_digest.hash = file_hash
+
+    return True
+
+
+def _get_block(http_handle, url, block_start, block_end, block_id=None, stats=None, log=None, content_length=None,
+               parent_span=None):
+    """
+    Download a block, retrying transport errors and responses that fail validation, each with their own number of
+    attempts
+
+    :param parent_span: optional span of the download, for blocks that are fetched by another thread
+    :return: [content, whether the content was verified with a digest of the range announced by the server]
+    """
+
     headers = {
         'Range': 'bytes=%s-%s' % (block_start, block_end)
     }
 
     content = None
+    verified = False
     completed = False
     try_count = 0
+    invalid_count = 0
 
-    while not completed and try_count < 7:
-        try:
-            resp, content = http_handle.request(url, 'GET', '', headers)
-            completed = True
+    with tracing.span('get_block', parent_span, block_id=block_id, block_start=block_start,
+                      block_end=block_end) as span:
+        while not completed and try_count < _block_attempts:
+            start_time = time.time()
 
-        except Exception as e:
-            print("Failed a block, retrying (%s)" % e)
-            try_count += 1
+            try:
+                resp, content = http_handle.request(url, 'GET', '', headers)
+                verified = _validate_block(resp, content, block_start, block_end, content_length)
 
-    if not completed:
-        raise CustomHttpError("Downloading of block failed after 7 retries")
+                completed = True
 
-    return content
+                _blocks_downloaded.inc()
+                _block_duration.observe(time.time() - start_time)
 
+                if stats is not None:
+                    stats.add_block(time.time() - start_time, len(content))
 
-def _thread_download(work_queue, result_blocks, url, timeout, disable_ssl_validation):
-    """
-    Download a block and save result in provided dictionary. Called by the thread pool.
+            # The server sent a response, but not the requested data
+            except IntegrityError as e:
+                _report(log, "Received an invalid block, retrying (%s)" % e)
+                invalid_count += 1
 
-    :param work_queue: queue object to obtain work items from
-    :param result_blocks: dictionary to store block in
-    :param url: url to download from
-    :param timeout: http timeout
-    :param disable_ssl_validation: whether to disable SSL validation in httplib2
-    """
+                _invalid_blocks.inc()
+                _block_retries.inc()
 
-    # Initialise HTTP handle
-    http_handle = httplib2.Http(timeout=timeout, disable_ssl_certificate_validation=disable_ssl_validation)
+                if stats is not None:
+                    stats.add_block_retry()
+
+                if invalid_count >= _invalid_block_attempts:
+                    raise IntegrityError("Bytes %s-%s of %s failed validation %s times: %s"
+                                         % (block_start, block_end, url, invalid_count, e))
 
-    while True:
-        work = work_queue.get()
+            except Exception as e:
+                _report(log, "Failed a block, retrying (%s)" % e)
+                try_count += 1
 
-        # Stop if receiving poison pill
-        if work is None:
-            return
+                _block_retries.inc()
+
+                if stats is not None:
+                    stats.add_block_retry()
+
+        span.set('retries', try_count + invalid_count)
+        if completed:
+            span.set('bytes', len(content))
+
+    if not completed:
+        raise CustomHttpError("Downloading of block failed after %s retries" % _block_attempts)
 
-        result_blocks[work[0]] = _get_block(http_handle, url, work[1], work[2])
+    return [content, verified]
@@ -12,3 +12,7 @@
 
 class CustomHttpError(Exception):
     pass
+
+
+class IntegrityError(CustomHttpError):
+    pass
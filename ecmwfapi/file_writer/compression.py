@@ -0,0 +1,113 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+from .exceptions import FileWriterError
+
+import bz2
+import lzma
+import zlib
+
+# Optional, enables zstd compression
+try:
+    import zstandard
+
+except ImportError:
+    zstandard = None
+
+
+# Compressor factories by name. A factory is called with the compression level, or None for the default level, and
+# returns an object with a compress method that takes data and returns the compressed data produced so far, and a
+# flush method that returns the end of the compressed stream.
+compressors = {}
+
+# File name suffixes of the compression methods by name
+suffixes = {}
+
+
+def register_compressor(name, factory, suffix):
+    """
+    Make a compression method available to FileWriter
+
+    :param name: name of the method, as used in the compression setting
+    :param factory: function that creates a compressor, see compressors
+    :param suffix: file name suffix of files compressed with the method, such as .gz
+    """
+
+    compressors[name] = factory
+    suffixes[name] = suffix
+
+
+def compressed_path(path, name):
+    """
+    Name of the file to which data compressed with a method is written, so the file is not mistaken for the
+    uncompressed data
+
+    :param path: target file
+    :param name: name of a registered compression method, or None
+    :return: the path with the suffix of the method appended, unless it already ends with it
+    """
+
+    if not name:
+        return path
+
+    try:
+        suffix = suffixes[name]
+
+    except KeyError:
+        raise FileWriterError("Unknown compression %s, expected one of %s" % (name, ', '.join(sorted(compressors))))
+
+    return path if path.endswith(suffix) else path + suffix
+
+
+def create_compressor(name, level=None):
+    """
+    :param name: name of a registered compression method
+    :param level: compression level, or None for the default level of the method
+    :return: new compressor
+    """
+
+    try:
+        factory = compressors[name]
+
+    except KeyError:
+        raise FileWriterError("Unknown compression %s, expected one of %s" % (name, ', '.join(sorted(compressors))))
+
+    try:
+        return factory(level)
+
+    except (TypeError, ValueError, lzma.LZMAError) as e:
+        raise FileWriterError("Invalid level %s for %s compression: %s" % (level, name, e))
+
+
+def _gzip(level):
+    # A window size of 16 + 15 bits makes zlib write a gzip header and trailer
+    return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level, zlib.DEFLATED, 31)
+
+
+def _bz2(level):
+    return bz2.BZ2Compressor(9 if level is None else level)
+
+
+def _lzma(level):
+    return lzma.LZMACompressor(preset=level)
+
+
+def _zstd(level):
+    return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+
+
+register_compressor('gzip', _gzip, '.gz')
+register_compressor('bz2', _bz2, '.bz2')
+register_compressor('lzma', _lzma, '.xz')
+
+if zstandard is not None:
+    register_compressor('zstd', _zstd, '.zst')
@@ -0,0 +1,477 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+from .compression import create_compressor
+from .exceptions import FileWriterError
+
+import os
+import queue
+import threading
+import time
+
+from ecmwfapi.metrics import metrics
+
+
+_write_duration = metrics.counter('ecmwfapi_file_writer_write_seconds_total', "Time spent writing downloaded data to "
+                                  "disk by the writer threads")
+_compression_duration = metrics.counter('ecmwfapi_file_writer_compression_cpu_seconds_total', "Processor time spent "
+                                        "compressing downloaded data")
+_buffer_wait_duration = metrics.counter('ecmwfapi_file_writer_buffer_wait_seconds_total', "Time downloads waited for "
+                                        "a free write buffer because the disk could not keep up")
+
+
+class FileWriter:
+    """
+    Writes a file from a dedicated thread, so a slow disk does not stall the download. Written data is collected in a
+    pool of buffers of buffer_size bytes, and each full buffer is handed to the writer thread as one write at an
+    offset that is a multiple of the buffer size. Blocks of at least the buffer size that arrive while no data is
+    buffered are handed over without copying. When all buffers are waiting to be written, write blocks until the writer
+    thread catches up, which bounds the memory used to buffers * buffer_size.
+
+    The file is optionally preallocated with posix_fallocate, and with fadvise the kernel is told the file is written
+    sequentially, and the synced parts are dropped from the page cache. Where the platform or file system does not
+    support these hints they are skipped.
+
+    The data can be compressed on the way, by the writer thread so it does not slow down the download. The compressors of
+    the standard library release the GIL while compressing, so the compression runs in parallel with the download.
+
+    Data that was written already can be replaced with rewrite and read back with read_range, if the file is
+    uncompressed and opened for reading and writing.
+
+    Instead of a file, the writer can write to another writer, such as a MultiWriter of FileWriters, so data written to
+    several files is compressed only once.
+    """
+
+    fsync_policies = ('none', 'close')
+
+    def __init__(self, file_handle, buffer_size=4194304, buffers=2, fsync='none', preallocate=False, fadvise=False,
+                 size=None, compression=None, compression_level=None):
+        """
+        :param file_handle: file opened for binary writing, closed when the writer is closed, or a writer with write,
+            flush, close and abort methods, which is aborted when the writer is aborted
+        :param buffer_size: size of the write buffers in bytes
+        :param buffers: number of write buffers, at least 2 so one can be filled while the other is written
+        :param fsync: none to leave syncing to the operating system, close to sync the file when it is closed, or a
+            number of bytes after which the file is synced each time
+        :param preallocate: whether to allocate the expected size on disk before writing
+        :param fadvise: whether to advise the kernel about the sequential writes and drop synced data from the cache
+        :param size: expected size of the file in bytes, used to preallocate it
+        :param compression: optional name of a registered compression method, see register_compressor
+        :param compression_level: compression level, the default level of the method if None
+        """
+
+        self.check_options(buffer_size, buffers, fsync, compression, compression_level)
+
+        self.file_handle = file_handle
+        self.buffer_size = buffer_size
+        self.buffers = buffers
+        self.fsync = fsync
+        self.fadvise = fadvise
+
+        # Time spent writing by the writer thread, and time write waited for a free buffer
+        self.bytes_written = 0
+        self.write_duration = 0.0
+        self.buffer_wait_duration = 0.0
+
+        # Bytes written to the file, which differs from the bytes written to the writer if the data is compressed, and
+        # the processor time spent compressing
+        self.file_bytes = 0
+        self.compression = compression
+        self.compression_duration = 0.0
+        self._compressor = create_compressor(compression, compression_level) if compression else None
+
+        self.closed = False
+
+        self._free_buffers = queue.Queue()
+        self._allocated_buffers = 0
+        self._pending = queue.Queue(maxsize=buffers)
+        self._buffer = None
+        self._buffer_length = 0
+        self._thread = None
+        self._error = None
+        self._synced = 0
+        self._preallocated = False
+
+        self._fileno = self._get_fileno()
+
+        # Positions in the data map to positions in the file only if the data is not compressed
+        self.rewritable = self._fileno is not None and not compression and self._is_readable() and \
+            hasattr(os, 'pwrite') and hasattr(os, 'pread')
+        self._start = self.file_handle.tell() if self.rewritable else 0
+
+        if self._fileno is not None and fadvise:
+            self._advise(0, 0, 'POSIX_FADV_SEQUENTIAL')
+
+        # The size of compressed data is not known in advance
+        if self._fileno is not None and preallocate and size and not compression and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self._fileno, 0, size)
+                self._preallocated = True
+
+            except OSError:
+                pass
+
+    @classmethod
+    def check_options(cls, buffer_size=4194304, buffers=2, fsync='none', compression=None, compression_level=None, **_):
+        """
+        Validate writer settings, raises FileWriterError if they are invalid
+        """
+
+        if not isinstance(buffer_size, int) or buffer_size < 4096:
+            raise FileWriterError("The buffer size should be at least 4096 bytes")
+
+        if not isinstance(buffers, int) or buffers < 2:
+            raise FileWriterError("The number of buffers should be at least 2")
+
+        if fsync not in cls.fsync_policies and (not isinstance(fsync, int) or fsync < 1):
+            raise FileWriterError("The fsync policy should be one of %s, or a positive number of bytes"
+                                  % ', '.join(cls.fsync_policies))
+
+        if compression:
+            create_compressor(compression, compression_level)
+
+    def write(self, data):
+        """
+        Write data. Raises FileWriterError if an earlier write failed.
+
+        :param data: bytes-like object
+        :return: number of bytes written
+        """
+
+        self._check()
+
+        view = memoryview(data)
+        length = len(view)
+
+        while len(view) > 0:
+            # Hand over whole buffers of data directly if nothing is buffered, keeping the writes aligned
+            if self._buffer_length == 0 and len(view) >= self.buffer_size:
+                direct = len(view) - len(view) % self.buffer_size
+                self._submit(view[:direct], direct, False)
+                view = view[direct:]
+                continue
+
+            if self._buffer is None:
+                self._buffer = self._take_buffer()
+
+            size = min(len(view), self.buffer_size - self._buffer_length)
+            self._buffer[self._buffer_length:self._buffer_length + size] = view[:size]
+            self._buffer_length += size
+            view = view[size:]
+
+            if self._buffer_length == self.buffer_size:
+                self._submit(self._buffer, self._buffer_length, True)
+                self._buffer = None
+                self._buffer_length = 0
+
+        return length
+
+    def flush(self):
+        """
+        Wait until all data written so far is written to the file
+        """
+
+        self._check()
+
+        if self._buffer_length > 0:
+            self._submit(self._buffer, self._buffer_length, True)
+            self._buffer = None
+            self._buffer_length = 0
+
+        self._stop()
+        self._check()
+
+        self.file_handle.flush()
+
+    def close(self):
+        """
+        Write the remaining data, sync the file according to the fsync policy and close it. Raises FileWriterError if
+        writing failed, the file is closed regardless.
+        """
+
+        if self.closed:
+            return
+
+        try:
+            self.flush()
+
+            if self._compressor is not None:
+                self._write(self._compressor.flush())
+
+            # Drop the allocated space that was not used, in case the file turned out smaller than expected
+            if self._preallocated:
+                self.file_handle.truncate(self.file_bytes)
+
+            if self._fileno is not None and self.fsync != 'none':
+                self._sync()
+
+        except BaseException:
+            self.abort()
+            raise
+
+        self._finish(self.file_handle.close)
+
+    def abort(self):
+        """
+        Stop writing and close the file, discarding data that has not been written yet
+        """
+
+        if self.closed:
+            return
+
+        self._finish(getattr(self.file_handle, 'abort', self.file_handle.close))
+
+    def _finish(self, close_handle):
+        """
+        Stop the writer thread and close the file handle
+
+        :param close_handle: method that closes the file handle
+        """
+
+        self.closed = True
+
+        if self._error is None:
+            self._error = FileWriterError("The writer was aborted")
+
+        self._stop()
+        self._buffer = None
+        close_handle()
+
+    def rewrite(self, offset, data):
+        """
+        Replace data that was written before, after writing the data written so far. Raises FileWriterError if the
+        writer is not rewritable.
+
+        :param offset: position of the data in the data written to the writer
+        :param data: bytes-like object with the new data
+        """
+
+        if not self.rewritable:
+            raise FileWriterError("The writer can not rewrite data, the file is compressed or not opened for reading")
+
+        self.flush()
+
+        view = memoryview(data)
+        while len(view) > 0:
+            written = os.pwrite(self._fileno, view, self._start + offset)
+            view = view[written:]
+            offset += written
+
+    def read_range(self, offset, length):
+        """
+        Read data that was written before, after writing the data written so far. Raises FileWriterError if the
+        writer is not rewritable.
+
+        :param offset: position of the data in the data written to the writer
+        :param length: number of bytes to read
+        :return: bytes read, fewer than length at the end of the file
+        """
+
+        if not self.rewritable:
+            raise FileWriterError("The writer can not read data back, the file is compressed or not opened for reading")
+
+        self.flush()
+
+        parts = []
+        while length > 0:
+            part = os.pread(self._fileno, length, self._start + offset)
+            if not part:
+                break
+
+            parts.append(part)
+            offset += len(part)
+            length -= len(part)
+
+        return b''.join(parts)
+
+    def compression_ratio(self):
+        """
+        :return: size of the data written to the writer divided by the size of the file, None if nothing was written
+        """
+
+        return self.bytes_written / float(self.file_bytes) if self.file_bytes else None
+
+    def get_statistics(self):
+        """
+        :return: dictionary with the bytes written to the file, the time spent writing, the write throughput in bytes
+            per second and the time write waited for a free buffer
+        """
+
+        return {
+            'bytes': self.file_bytes,
+            'write_duration': self.write_duration,
+            'throughput': self.file_bytes / self.write_duration if self.write_duration else None,
+            'wait_duration': self.buffer_wait_duration,
+        }
+
+    def tell(self):
+        """
+        :return: number of bytes written to the writer so far
+        """
+
+        return self.bytes_written + self._pending_bytes() + self._buffer_length
+
+    def _check(self):
+        if self.closed:
+            raise FileWriterError("The writer is closed")
+
+        if self._error is not None:
+            raise FileWriterError("Failed to write to the file: %s" % self._error)
+
+    def _take_buffer(self):
+        try:
+            return self._free_buffers.get_nowait()
+
+        except queue.Empty:
+            pass
+
+        if self._allocated_buffers < self.buffers:
+            self._allocated_buffers += 1
+            return bytearray(self.buffer_size)
+
+        wait_start = time.time()
+
+        try:
+            while True:
+                try:
+                    return self._free_buffers.get(timeout=1)
+
+                except queue.Empty:
+                    self._check()
+
+        finally:
+            self.buffer_wait_duration += time.time() - wait_start
+            _buffer_wait_duration.inc(time.time() - wait_start)
+
+    def _submit(self, buffer, length, reuse):
+        """
+        Hand data over to the writer thread, started when it is first needed
+
+        :param buffer: buffer or memoryview with the data
+        :param length: number of bytes of the buffer to write
+        :param reuse: whether the buffer is returned to the pool after it is written
+        """
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work, name='file-writer', daemon=True)
+            self._thread.start()
+
+        wait_start = time.time()
+
+        while True:
+            try:
+                self._pending.put([buffer, length, reuse], timeout=1)
+                break
+
+            except queue.Full:
+                self._check()
+
+        if time.time() - wait_start > 0.001:
+            self.buffer_wait_duration += time.time() - wait_start
+            _buffer_wait_duration.inc(time.time() - wait_start)
+
+    def _pending_bytes(self):
+        with self._pending.mutex:
+            return sum(item[1] for item in self._pending.queue if item is not None)
+
+    def _stop(self):
+        """
+        Stop the writer thread after the buffers handed over so far
+        """
+
+        if self._thread is not None:
+            self._pending.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _work(self):
+        """
+        Writer thread
+        """
+
+        while True:
+            item = self._pending.get()
+
+            if item is None:
+                return
+
+            [buffer, length, reuse] = item
+
+            # After an error the remaining data is discarded, and reported by the next write
+            if self._error is None:
+                try:
+                    data = buffer if length == len(buffer) else memoryview(buffer)[:length]
+
+                    if self._compressor is not None:
+                        compression_start = time.thread_time()
+                        data = self._compressor.compress(data)
+                        self.compression_duration += time.thread_time() - compression_start
+                        _compression_duration.inc(time.thread_time() - compression_start)
+
+                    self._write(data)
+                    self.bytes_written += length
+
+                except Exception as e:
+                    self._error = e
+
+            if reuse:
+                self._free_buffers.put(buffer)
+
+    def _write(self, data):
+        """
+        Write data to the file, and sync it according to the fsync policy
+        """
+
+        write_start = time.time()
+
+        self.file_handle.write(data)
+        self.file_bytes += len(data)
+
+        if isinstance(self.fsync, int) and self.file_bytes - self._synced >= self.fsync:
+            self._sync()
+
+        self.write_duration += time.time() - write_start
+        _write_duration.inc(time.time() - write_start)
+
+    def _sync(self):
+        self.file_handle.flush()
+        os.fsync(self._fileno)
+
+        # Synced pages are clean, so they can be dropped from the page cache
+        if self.fadvise:
+            self._advise(self._synced, self.file_bytes - self._synced, 'POSIX_FADV_DONTNEED')
+
+        self._synced = self.file_bytes
+
+    def _advise(self, offset, length, advice):
+        if not hasattr(os, 'posix_fadvise'):
+            return
+
+        try:
+            os.posix_fadvise(self._fileno, offset, length, getattr(os, advice))
+
+        except OSError:
+            pass
+
+    def _is_readable(self):
+        try:
+            return self.file_handle.readable()
+
+        except (AttributeError, OSError, ValueError):
+            return False
+
+    def _get_fileno(self):
+        try:
+            return self.file_handle.fileno()
+
+        except (AttributeError, OSError, ValueError):
+            return None
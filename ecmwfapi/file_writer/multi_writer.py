@@ -0,0 +1,100 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+from .exceptions import FileWriterError
+
+
+class MultiWriter:
+    """
+    Writes the same data to several writers, for example one FileWriter per target file. Each writer has its own
+    buffers and writer thread, so a slow destination can lag behind the others until its buffers are full, without
+    holding up the download. The data is handed to every writer without copying.
+
+    The writers do not compress the data themselves when it is compressed: a compressing FileWriter writes to the
+    MultiWriter instead, so the data is compressed once for all writers.
+    """
+
+    def __init__(self, writers, names=None):
+        """
+        :param writers: list of writers with write, flush, close and abort methods, such as FileWriter
+        :param names: optional names of the writers used in the statistics, for example the target files
+        """
+
+        if not writers:
+            raise FileWriterError("At least one writer is required")
+
+        self.writers = list(writers)
+        self.names = list(names) if names is not None else [str(index) for index in range(len(self.writers))]
+
+        self.rewritable = all(getattr(writer, 'rewritable', False) for writer in self.writers)
+
+    def write(self, data):
+        """
+        Write data to all writers
+
+        :param data: bytes-like object, which should not be changed afterwards as the writers may still refer to it
+        :return: number of bytes written
+        """
+
+        for writer in self.writers:
+            writer.write(data)
+
+        return len(data)
+
+    def rewrite(self, offset, data):
+        """
+        Replace data that was written before in all writers, which should all be rewritable
+        """
+
+        for writer in self.writers:
+            writer.rewrite(offset, data)
+
+    def read_range(self, offset, length):
+        """
+        Read data that was written before, from the first writer
+        """
+
+        return self.writers[0].read_range(offset, length)
+
+    def flush(self):
+        for writer in self.writers:
+            writer.flush()
+
+    def close(self):
+        """
+        Close all writers. If closing any of them fails, the others are closed regardless and the first error is
+        raised.
+        """
+
+        error = None
+
+        for writer in self.writers:
+            try:
+                writer.close()
+
+            except Exception as e:
+                if error is None:
+                    error = e
+
+        if error is not None:
+            raise error
+
+    def abort(self):
+        for writer in self.writers:
+            writer.abort()
+
+    def get_statistics(self):
+        """
+        :return: list with the statistics of each writer, see FileWriter.get_statistics, with its name added
+        """
+
+        return [dict(writer.get_statistics(), name=name) for [name, writer] in zip(self.names, self.writers)]
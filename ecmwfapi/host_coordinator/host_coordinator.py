@@ -0,0 +1,373 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+from .exceptions import HostCoordinatorError
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from ecmwfapi.metrics import metrics
+
+try:
+    import fcntl
+
+except ImportError:
+    fcntl = None
+
+
+_wait_time = metrics.counter('ecmwfapi_coordination_wait_seconds_total', "Time requests waited for the host-wide "
+                             "request limit and submission rate")
+
+
+class HostCoordinator:
+    """
+    Shares a budget of requests in flight at the ECMWF API and a submission rate between all processes on the host that
+    use the same credentials, such as independent scripts and the background client. The state is kept in a directory
+    per credential, without any service:
+
+    - Each request in flight holds an exclusive lock on one of max_requests slot files. The operating system releases
+      the locks of a process that exits, so a crashed process does not leak its slots.
+    - Submissions take a token from a bucket stored in a state file, which is read and updated while the file is
+      locked. The bucket refills at submission_rate requests per minute, up to submission_burst requests.
+
+    Without file locking, on platforms that lack fcntl, the budget is only shared by the threads of the process.
+    """
+
+    def __init__(self, directory=None, max_requests=0, submission_rate=0, submission_burst=1, poll_interval=0.5):
+        """
+        :param directory: directory with the state of all credentials, ~/.ecmwfapi/coordination if None
+        :param max_requests: maximum number of requests in flight per credential on the host, no limit if zero
+        :param submission_rate: maximum number of submissions per minute per credential on the host, no limit if zero
+        :param submission_burst: number of submissions that can be made at once after a quiet period
+        :param poll_interval: maximum number of seconds between attempts to take a slot
+        """
+
+        self._lock = threading.Lock()
+
+        # Slot files locked by this process, and the number of slots held and the wait time for the statistics
+        self._held = set()
+        self.held_slots = 0
+        self.waited_time = 0.0
+
+        self.directory = None
+        self.max_requests = 0
+        self.submission_rate = 0
+        self.submission_burst = 1
+        self.poll_interval = poll_interval
+        self.configure(directory, max_requests, submission_rate, submission_burst)
+
+        metrics.gauge('ecmwfapi_coordination_request_slots', "Number of host-wide request slots held by the process",
+                      function=lambda: self.held_slots)
+
+    def configure(self, directory=None, max_requests=None, submission_rate=None, submission_burst=None):
+        """
+        Change the settings, which apply to the next requests. Settings that are None are not changed, except the
+        directory which is reset to the default.
+
+        :param directory: directory with the state of all credentials, ~/.ecmwfapi/coordination if None
+        :param max_requests: maximum number of requests in flight per credential on the host, no limit if zero
+        :param submission_rate: maximum number of submissions per minute per credential on the host, no limit if zero
+        :param submission_burst: number of submissions that can be made at once after a quiet period
+        """
+
+        if max_requests is not None and (not isinstance(max_requests, int) or max_requests < 0):
+            raise HostCoordinatorError("The maximum number of requests should be a non-negative integer")
+
+        if submission_rate is not None and (not isinstance(submission_rate, (int, float)) or submission_rate < 0):
+            raise HostCoordinatorError("The submission rate should be a non-negative number")
+
+        if submission_burst is not None and (not isinstance(submission_burst, (int, float)) or submission_burst < 1):
+            raise HostCoordinatorError("The submission burst should be at least 1")
+
+        with self._lock:
+            self.directory = directory or os.path.join(os.path.expanduser('~'), '.ecmwfapi', 'coordination')
+            if max_requests is not None:
+                self.max_requests = max_requests
+            if submission_rate is not None:
+                self.submission_rate = submission_rate
+            if submission_burst is not None:
+                self.submission_burst = submission_burst
+
+    def acquire(self, credentials, control=None):
+        """
+        Wait for a request slot and a submission token of the credentials. Use the result as context manager, or release
+        it when the request is no longer in flight at the API.
+
+        :param credentials: tuple with the API URL, e-mail address and key
+        :param control: optional TransferControl, the wait is interrupted when the transfer is cancelled
+        :return: RequestSlot
+        """
+
+        slot = RequestSlot(self, None)
+
+        # The state directory is not needed when nothing is limited
+        if self.max_requests <= 0 and self.submission_rate <= 0:
+            return slot
+
+        start_time = time.time()
+        directory = self._get_directory(credentials)
+        slot.directory = directory
+
+        delay = self.poll_interval / 8
+
+        try:
+            # The slot is taken first, so the submission token is not spent while the request cannot be made
+            while not self._take_slot(slot):
+                self._sleep(delay, control)
+                delay = min(delay * 2, self.poll_interval)
+
+            while True:
+                delay = self._take_token(directory)
+                if delay <= 0:
+                    break
+
+                self._sleep(min(delay, self.poll_interval), control)
+
+        except BaseException:
+            slot.release()
+            raise
+
+        slot.waited = time.time() - start_time
+
+        with self._lock:
+            self.waited_time += slot.waited
+
+        if slot.waited > 0:
+            _wait_time.inc(slot.waited)
+
+        return slot
+
+    def in_flight(self, credentials):
+        """
+        :param credentials: tuple with the API URL, e-mail address and key
+        :return: number of requests with the credentials in flight on the host
+        """
+
+        directory = self._get_directory(credentials)
+        count = 0
+
+        for index in range(self.max_requests):
+            path = os.path.join(directory, 'slot-%s' % index)
+
+            with self._lock:
+                if path in self._held:
+                    count += 1
+                    continue
+
+            file = self._lock_file(path)
+            if file is None:
+                count += 1
+            else:
+                os.close(file)
+
+        return count
+
+    def get_statistics(self):
+        """
+        :return: dictionary with the settings, the number of slots held by the process, and the total time waited
+        """
+
+        return {
+            'directory': self.directory,
+            'max_requests': self.max_requests,
+            'submission_rate': self.submission_rate,
+            'held_slots': self.held_slots,
+            'waited_time': self.waited_time,
+            'file_locking': fcntl is not None,
+        }
+
+    def _get_directory(self, credentials):
+        """
+        :return: state directory of the credentials, named by a digest so the key is not exposed
+        """
+
+        digest = hashlib.sha256('\n'.join(str(item) for item in credentials).encode('utf-8')).hexdigest()[:16]
+        directory = os.path.join(self.directory, digest)
+
+        try:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+
+        except OSError as e:
+            raise HostCoordinatorError("Failed to create the coordination directory %s: %s" % (directory, e))
+
+        return directory
+
+    def _take_slot(self, slot):
+        """
+        Try to lock a free slot file of the directory of the slot
+
+        :return: whether a slot was taken, or True if the number of requests is not limited
+        """
+
+        max_requests = self.max_requests
+        if max_requests <= 0:
+            return True
+
+        for index in range(max_requests):
+            path = os.path.join(slot.directory, 'slot-%s' % index)
+
+            with self._lock:
+                if path in self._held:
+                    continue
+                self._held.add(path)
+
+            file = self._lock_file(path)
+
+            if file is None:
+                with self._lock:
+                    self._held.discard(path)
+                continue
+
+            # Record the holder for diagnostics
+            try:
+                os.ftruncate(file, 0)
+                os.write(file, ('%s %s\n' % (os.getpid(), time.time())).encode('ascii'))
+
+            except OSError:
+                pass
+
+            slot.path = path
+            slot.file = file
+
+            with self._lock:
+                self.held_slots += 1
+
+            return True
+
+        return False
+
+    def _take_token(self, directory):
+        """
+        Take a submission token from the bucket of the directory
+
+        :return: 0 if a token was taken, otherwise the number of seconds until one is available
+        """
+
+        rate = self.submission_rate / 60.0
+        if rate <= 0:
+            return 0
+
+        path = os.path.join(directory, 'submissions')
+
+        try:
+            file = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        except OSError as e:
+            raise HostCoordinatorError("Failed to open %s: %s" % (path, e))
+
+        try:
+            with self._lock:
+                if fcntl is not None:
+                    fcntl.flock(file, fcntl.LOCK_EX)
+
+                try:
+                    state = json.loads(os.read(file, 4096).decode('ascii') or '{}')
+                    [tokens, updated] = [float(state['tokens']), float(state['updated'])]
+
+                except (KeyError, TypeError, ValueError):
+                    [tokens, updated] = [self.submission_burst, 0.0]
+
+                now = time.time()
+                tokens = min(tokens + max(now - updated, 0) * rate, self.submission_burst)
+
+                if tokens < 1:
+                    return (1 - tokens) / rate
+
+                os.lseek(file, 0, os.SEEK_SET)
+                os.ftruncate(file, 0)
+                os.write(file, json.dumps({'tokens': tokens - 1, 'updated': now}).encode('ascii'))
+
+                return 0
+
+        except OSError as e:
+            raise HostCoordinatorError("Failed to update %s: %s" % (path, e))
+
+        finally:
+            os.close(file)
+
+    @staticmethod
+    def _lock_file(path):
+        """
+        :return: descriptor of the file locked exclusively, or None if another process holds the lock
+        """
+
+        try:
+            file = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        except OSError as e:
+            raise HostCoordinatorError("Failed to open %s: %s" % (path, e))
+
+        if fcntl is not None:
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+            except OSError:
+                os.close(file)
+                return None
+
+        return file
+
+    @staticmethod
+    def _sleep(seconds, control):
+        if control is not None:
+            control.sleep(seconds)
+        else:
+            time.sleep(seconds)
+
+    def _release(self, slot):
+        with self._lock:
+            self._held.discard(slot.path)
+            self.held_slots -= 1
+
+
+class RequestSlot:
+    """
+    Slot of a request in flight in the host coordinator
+    """
+
+    def __init__(self, coordinator, directory):
+
+        self.coordinator = coordinator
+        self.directory = directory
+        self.path = None
+        self.file = None
+
+        # Number of seconds waited for the slot and the submission token
+        self.waited = 0.0
+
+    def release(self):
+        """
+        Release the slot, so another request can be made. Can be called more than once.
+        """
+
+        file = self.file
+        if file is None:
+            return
+
+        self.file = None
+
+        # Closing the file releases the lock
+        os.close(file)
+        self.coordinator._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.release()
+        return False
+
+
+host_coordinator = HostCoordinator()
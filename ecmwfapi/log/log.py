@@ -10,21 +10,147 @@
 # (C) Copyright 2017 Ricardo Persoon.
 
 
+from .exceptions import LogError
+
+import atexit
+import collections
+import json
+import logging
+import queue
+import sys
+import threading
 import time
+import weakref
+
+from ecmwfapi.config import config, ConfigError
+from ecmwfapi.metrics import metrics
+
+
+_dropped_messages = metrics.counter('ecmwfapi_log_messages_dropped_total', "Number of log messages that were not "
+                                    "output because the log queue was full")
+_suppressed_messages = metrics.counter('ecmwfapi_log_messages_suppressed_total', "Number of repeated log messages that "
+                                       "were not output")
+
+# Logs with a writer thread, flushed when the interpreter exits
+_open_logs = weakref.WeakSet()
 
 
 class Log:
+    """
+    Logs info, warning and error messages. Messages are formatted and output by a writer thread, so logging threads
+    never wait for the output. Only the most recent messages of each type are retained, and a message that is repeated
+    within the repeat interval is output once, followed by the number of times it was suppressed.
+
+    Messages are output as text or JSON lines to stdout, or forwarded to the standard library logger given by
+    logger_name.
+    """
 
-    def __init__(self, display_info_messages=True, display_warning_messages=True, display_error_messages=True):
+    output_formats = ('text', 'json', 'logging')
 
-        self.info_messages = []
-        self.warning_messages = []
-        self.error_messages = []
+    _levels = {
+        'info': logging.INFO,
+        'warning': logging.WARNING,
+        'error': logging.ERROR
+    }
+
+    def __init__(self, display_info_messages=True, display_warning_messages=True, display_error_messages=True,
+                 history_size=1000, repeat_interval=10, output_format='text', asynchronous=True, queue_size=10000,
+                 logger_name='ecmwfapi'):
+        """
+        Initialise the log
+
+        :param display_info_messages: whether to output info messages
+        :param display_warning_messages: whether to output warning messages
+        :param display_error_messages: whether to output error messages
+        :param history_size: number of messages of each type that are retained, no limit if zero
+        :param repeat_interval: number of seconds during which a repeated message is suppressed, messages are not
+            suppressed if zero
+        :param output_format: one of [text, json, logging]
+        :param asynchronous: whether messages are output by a writer thread. If not, messages are output by the logging
+            thread.
+        :param queue_size: maximum number of messages waiting for output, further messages are dropped until there is
+            room again
+        :param logger_name: name of the standard library logger used for the logging output format
+        """
+
+        if output_format not in self.output_formats:
+            raise LogError("The output format should be one of %s" % ', '.join(self.output_formats))
+
+        if not isinstance(queue_size, int) or queue_size < 1:
+            raise LogError("The log queue size should be a positive integer")
 
         self.display_info_messages = display_info_messages
         self.display_warning_messages = display_warning_messages
         self.display_error_messages = display_error_messages
 
+        self.repeat_interval = repeat_interval
+        self.output_format = output_format
+        self.asynchronous = asynchronous
+        self.logger = logging.getLogger(logger_name)
+
+        self.info_messages = None
+        self.warning_messages = None
+        self.error_messages = None
+        self.set_history_size(history_size)
+
+        self._lock = threading.Lock()
+
+        # Time and number of suppressed repetitions of recently output messages, by [level, message]
+        self._recent = {}
+
+        self._queue = queue.Queue(queue_size)
+        self._dropped = 0
+        self._writer = None
+
+    def set_history_size(self, history_size):
+        """
+        Change the number of messages of each type that are retained. The most recent messages are kept.
+
+        :param history_size: number of messages, no limit if zero
+        """
+
+        if not isinstance(history_size, int) or history_size < 0:
+            raise LogError("The history size should be a non-negative integer")
+
+        maxlen = history_size if history_size > 0 else None
+
+        self.info_messages = collections.deque(self.info_messages or (), maxlen)
+        self.warning_messages = collections.deque(self.warning_messages or (), maxlen)
+        self.error_messages = collections.deque(self.error_messages or (), maxlen)
+
+    def load_settings(self):
+        """
+        Apply the settings in the log section of the loaded configuration file. Settings that are not configured keep
+        their current value.
+        """
+
+        settings = [
+            ['display_info_messages', config.get_boolean],
+            ['display_warning_messages', config.get_boolean],
+            ['display_error_messages', config.get_boolean],
+            ['repeat_interval', config.get_int],
+            ['output_format', config.get],
+            ['asynchronous', config.get_boolean],
+        ]
+
+        for [name, getter] in settings:
+            try:
+                value = getter(name, 'log')
+
+            except (ConfigError, ValueError):
+                continue
+
+            if name == 'output_format' and value not in self.output_formats:
+                raise LogError("The output format should be one of %s" % ', '.join(self.output_formats))
+
+            setattr(self, name, value)
+
+        try:
+            self.set_history_size(config.get_int('history_size', 'log'))
+
+        except (ConfigError, ValueError):
+            pass
+
     def log(self, message, log_type='info'):
         """
         General logging function that supports all three logging options: info, warning and error. Can be passed as a
@@ -49,11 +175,11 @@ class Log:
         :return: none
         """
 
-        if self.display_info_messages:
-            print('[Info]     %s - %s' % (time.strftime("%d-%m-%Y %H:%M:%S"), message))
-
         self.info_messages.append(message)
 
+        if self.display_info_messages:
+            self._output('info', message)
+
     def warning(self, message):
         """
         Logs a warning message and outputs as specified in configuration
@@ -62,11 +188,11 @@ class Log:
         :return: none
         """
 
-        if self.display_warning_messages:
-            print('[Warning]  %s - %s' % (time.strftime("%d-%m-%Y %H:%M:%S"), message))
-
         self.warning_messages.append(message)
 
+        if self.display_warning_messages:
+            self._output('warning', message)
+
     def error(self, message):
         """
         Logs an error message and outputs as specified in configuration
@@ -75,34 +201,188 @@ class Log:
         :return: none
         """
 
-        if self.display_error_messages:
-            print('[Error]    %s - %s' % (time.strftime("%d-%m-%Y %H:%M:%S"), message))
-
         self.error_messages.append(message)
 
+        if self.display_error_messages:
+            self._output('error', message)
+
     def get_info_messages(self):
         """
         Obtain the list of info messages logged so far
 
-        :return: list with all logged info messages
+        :return: list with the retained info messages
         """
 
-        return self.info_messages
+        return list(self.info_messages)
 
     def get_warning_messages(self):
         """
         Obtain the list of warning messages logged so far
 
-        :return: list with all logged info messages
+        :return: list with the retained warning messages
         """
 
-        return self.warning_messages
+        return list(self.warning_messages)
 
     def get_error_messages(self):
         """
         Obtain the list of error messages logged so far
 
-        :return: list with all logged info messages
+        :return: list with the retained error messages
+        """
+
+        return list(self.error_messages)
+
+    def flush(self):
+        """
+        Wait until all queued messages have been output
+        """
+
+        if self._writer is not None:
+            self._queue.join()
+
+    def close(self):
+        """
+        Output the queued messages and stop the writer thread. A writer thread is started again if messages are logged
+        afterwards.
+        """
+
+        with self._lock:
+            writer = self._writer
+            self._writer = None
+
+        if writer is None:
+            return
+
+        # The writer stops at the sentinel, after the messages queued before it
+        self._queue.put(None)
+
+        if writer is not threading.current_thread():
+            writer.join()
+
+        _open_logs.discard(self)
+
+    def _output(self, level, message):
+        """
+        Output a message, unless it is a repetition of a recent message
+
+        :param level: one of [info, warning, error]
+        :param message: the message
+        """
+
+        timestamp = time.time()
+        records = []
+
+        with self._lock:
+            if self.repeat_interval > 0:
+                key = (level, message)
+                recent = self._recent.get(key)
+
+                if recent is not None and timestamp - recent[0] < self.repeat_interval:
+                    recent[1] += 1
+                    _suppressed_messages.inc()
+                    return
+
+                if recent is not None and recent[1] > 0:
+                    records.append([timestamp, level, "Previous message repeated %s times: %s" % (recent[1], message)])
+
+                self._recent[key] = [timestamp, 0]
+                if len(self._recent) > 1024:
+                    self._prune(timestamp)
+
+            records.append([timestamp, level, message])
+
+            if self.asynchronous and self._writer is None:
+                self._start_writer()
+
+        for record in records:
+            if not self.asynchronous:
+                self._write(record)
+                continue
+
+            try:
+                self._queue.put_nowait(record)
+
+            except queue.Full:
+                with self._lock:
+                    self._dropped += 1
+                _dropped_messages.inc()
+
+    def _prune(self, timestamp):
+        """
+        Forget messages that are no longer suppressed. Repetitions that were suppressed are not reported. Should be
+        called with the lock held.
+
+        :param timestamp: current time
+        """
+
+        for key in [key for [key, recent] in self._recent.items() if timestamp - recent[0] >= self.repeat_interval]:
+            del self._recent[key]
+
+    def _start_writer(self):
+        """
+        Start the writer thread. Should be called with the lock held.
+        """
+
+        self._writer = threading.Thread(target=self._run_writer, name='LogWriter', daemon=True)
+        self._writer.start()
+        _open_logs.add(self)
+
+    def _run_writer(self):
+        """
+        Output queued messages, and report messages that were dropped while the queue was full
+        """
+
+        while True:
+            record = self._queue.get()
+
+            if record is None:
+                self._queue.task_done()
+                break
+
+            try:
+                self._write(record)
+
+                with self._lock:
+                    [dropped, self._dropped] = [self._dropped, 0]
+
+                if dropped > 0:
+                    self._write([time.time(), 'warning', "%s log messages were dropped" % dropped])
+
+            except Exception:
+                # The log should never stop the client
+                pass
+
+            finally:
+                self._queue.task_done()
+
+    def _write(self, record):
         """
+        Output a single message in the configured format
+
+        :param record: list of [timestamp, level, message]
+        """
+
+        [timestamp, level, message] = record
+
+        if self.output_format == 'logging':
+            self.logger.log(self._levels[level], message)
+
+        elif self.output_format == 'json':
+            print(json.dumps({'time': timestamp, 'level': level, 'message': message}))
+
+        else:
+            print('%-10s %s - %s' % ('[%s]' % level.capitalize(), time.strftime("%d-%m-%Y %H:%M:%S",
+                                                                               time.localtime(timestamp)), message))
+
+
+@atexit.register
+def _flush_logs():
+    """
+    Output the queued messages of all logs before the interpreter exits
+    """
+
+    for log_handle in list(_open_logs):
+        log_handle.flush()
 
-        return self.error_messages
+    sys.stdout.flush()
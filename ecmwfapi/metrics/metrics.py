@@ -0,0 +1,493 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+from .exceptions import MetricsError
+
+import bisect
+import http.server
+import math
+import re
+import threading
+import weakref
+
+
+class _ThreadCells:
+    """
+    Values of a metric kept per thread. Every thread only updates its own cell, so updates need no lock; the values
+    are summed over all cells when the metric is collected. The cell of a thread that exits is added to a base cell
+    and dropped, so short-lived threads do not accumulate cells.
+    """
+
+    def __init__(self, new_cell, merge):
+        """
+        :param new_cell: function without arguments that creates an empty cell
+        :param merge: function that adds the values of the second cell to the first
+        """
+
+        self._new_cell = new_cell
+        self._merge = merge
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._base = new_cell()
+
+        # Cells of the live threads by the ID of their owner
+        self.cells = {}
+
+    def get(self):
+        """
+        :return: cell of the current thread, created on first use
+        """
+
+        try:
+            return self._local.owner.cell
+
+        except AttributeError:
+            owner = _CellOwner(self._new_cell())
+            self._local.owner = owner
+
+            with self._lock:
+                self.cells[id(owner)] = owner.cell
+
+            # The thread-local owner is released when the thread exits
+            weakref.finalize(owner, self._retire, id(owner))
+
+            return owner.cell
+
+    def snapshot(self):
+        """
+        :return: list with the cells of all threads, and a copy of the cell with the values of exited threads
+        """
+
+        with self._lock:
+            base = self._new_cell()
+            self._merge(base, self._base)
+
+            return [base] + list(self.cells.values())
+
+    def _retire(self, key):
+        with self._lock:
+            self._merge(self._base, self.cells.pop(key))
+
+
+class _CellOwner:
+    """
+    Thread-local holder of a cell, of which the lifetime ends with the thread
+    """
+
+    __slots__ = ('cell', '__weakref__')
+
+    def __init__(self, cell):
+        self.cell = cell
+
+
+class _Metric:
+    """
+    Base class of the metric types. A metric with label names has a child metric per combination of label values.
+    """
+
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names=(), label_values=()):
+
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.label_values = tuple(label_values)
+
+        self._children = {}
+        self._children_lock = threading.Lock()
+
+    def labels(self, *label_values):
+        """
+        Get the child metric for the given label values
+
+        :param label_values: one value for each label name
+        :return: metric of the same type
+        """
+
+        label_values = tuple(str(value) for value in label_values)
+
+        child = self._children.get(label_values)
+        if child is not None:
+            return child
+
+        if len(label_values) != len(self.label_names):
+            raise MetricsError("Metric %s expects the labels %s" % (self.name, ', '.join(self.label_names)))
+
+        with self._children_lock:
+            child = self._children.get(label_values)
+
+            if child is None:
+                child = self._new_child(label_values)
+                self._children[label_values] = child
+
+            return child
+
+    def collect(self):
+        """
+        :return: list of (suffix, labels, value) samples, where labels is a list of (name, value) pairs
+        """
+
+        if self.label_names and not self.label_values:
+            with self._children_lock:
+                children = list(self._children.values())
+
+            samples = []
+            for child in children:
+                samples.extend(child.collect())
+
+            return samples
+
+        return self._collect()
+
+    def _labels(self, extra=()):
+        return list(zip(self.label_names, self.label_values)) + list(extra)
+
+    def _new_child(self, label_values):
+        raise NotImplementedError
+
+    def _collect(self):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """
+    Monotonically increasing value, such as a number of events or bytes
+    """
+
+    metric_type = 'counter'
+
+    def __init__(self, name, documentation, label_names=(), label_values=()):
+
+        _Metric.__init__(self, name, documentation, label_names, label_values)
+
+        self._cells = _ThreadCells(lambda: [0], _merge_counter)
+
+    def inc(self, amount=1):
+        """
+        Increase the counter. Does not take a lock, so it can be called on hot paths.
+
+        :param amount: non-negative amount to add
+        """
+
+        self._cells.get()[0] += amount
+
+    def get(self):
+        """
+        :return: current value of the counter
+        """
+
+        return sum(cell[0] for cell in self._cells.snapshot())
+
+    def _new_child(self, label_values):
+        return Counter(self.name, self.documentation, self.label_names, label_values)
+
+    def _collect(self):
+        return [('', self._labels(), self.get())]
+
+
+class Gauge(_Metric):
+    """
+    Value that can go up and down. Either set explicitly, or determined by a function when the metrics are collected.
+    """
+
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, label_names=(), label_values=(), function=None):
+        """
+        :param function: optional function without arguments that returns the value. For a gauge with label names it
+            returns a dictionary with the value by tuple of label values.
+        """
+
+        _Metric.__init__(self, name, documentation, label_names, label_values)
+
+        self.function = function
+
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    def get(self):
+        """
+        :return: current value of the gauge
+        """
+
+        if self.function is not None:
+            return self.function()
+
+        return self._value
+
+    def collect(self):
+
+        if self.function is not None and self.label_names:
+            return [('', list(zip(self.label_names, [str(item) for item in label_values])), value)
+                    for label_values, value in sorted(self.function().items())]
+
+        return _Metric.collect(self)
+
+    def _new_child(self, label_values):
+        return Gauge(self.name, self.documentation, self.label_names, label_values)
+
+    def _collect(self):
+        return [('', self._labels(), self.get())]
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values, such as durations, counted in cumulative buckets
+    """
+
+    metric_type = 'histogram'
+
+    # Buckets suitable for durations in seconds
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+    def __init__(self, name, documentation, label_names=(), label_values=(), buckets=None):
+        """
+        :param buckets: increasing upper bounds of the buckets, an infinite bucket is added
+        """
+
+        _Metric.__init__(self, name, documentation, label_names, label_values)
+
+        buckets = tuple(sorted(buckets if buckets is not None else self.default_buckets))
+        if len(buckets) == 0 or buckets[-1] != math.inf:
+            buckets += (math.inf,)
+
+        self.buckets = buckets
+
+        # Cells are [bucket counts, sum, count]
+        self._cells = _ThreadCells(lambda: [[0] * len(self.buckets), 0.0, 0], _merge_histogram)
+
+    def observe(self, value):
+        """
+        Record an observation. Does not take a lock, so it can be called on hot paths.
+
+        :param value: observed value
+        """
+
+        cell = self._cells.get()
+        cell[0][bisect.bisect_left(self.buckets, value)] += 1
+        cell[1] += value
+        cell[2] += 1
+
+    def _new_child(self, label_values):
+        return Histogram(self.name, self.documentation, self.label_names, label_values, self.buckets)
+
+    def _collect(self):
+
+        counts = [0] * len(self.buckets)
+        total = 0.0
+        count = 0
+
+        for cell in self._cells.snapshot():
+            for index, value in enumerate(cell[0]):
+                counts[index] += value
+            total += cell[1]
+            count += cell[2]
+
+        samples = []
+        cumulative = 0
+
+        for bound, value in zip(self.buckets, counts):
+            cumulative += value
+            samples.append(('_bucket', self._labels([('le', _format_value(bound))]), cumulative))
+
+        samples.append(('_sum', self._labels(), total))
+        samples.append(('_count', self._labels(), count))
+
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Collection of metrics that can be rendered in the Prometheus text format. Metrics are registered once by name;
+    registering a name again returns the existing metric, so modules can declare the metrics they update.
+    """
+
+    _name_pattern = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*$')
+
+    def __init__(self):
+
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register(Counter, name, documentation, label_names)
+
+    def gauge(self, name, documentation, label_names=(), function=None):
+        gauge = self._register(Gauge, name, documentation, label_names)
+
+        if function is not None:
+            gauge.function = function
+
+        return gauge
+
+    def histogram(self, name, documentation, label_names=(), buckets=None):
+        return self._register(Histogram, name, documentation, label_names, buckets=buckets)
+
+    def get(self, name):
+        """
+        :param name: name of the metric
+        :return: the metric, or None if it is not registered
+        """
+
+        return self._metrics.get(name)
+
+    def render(self):
+        """
+        Render all metrics in the Prometheus text exposition format
+
+        :return: string with the metrics
+        """
+
+        with self._lock:
+            registered = sorted(self._metrics.items())
+
+        lines = []
+
+        for [name, metric] in registered:
+            lines.append('# HELP %s %s' % (name, metric.documentation.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE %s %s' % (name, metric.metric_type))
+
+            for [suffix, labels, value] in metric.collect():
+                if labels:
+                    label_text = ','.join('%s="%s"' % (label, _escape_label(label_value))
+                                          for label, label_value in labels)
+                    lines.append('%s%s{%s} %s' % (name, suffix, label_text, _format_value(value)))
+                else:
+                    lines.append('%s%s %s' % (name, suffix, _format_value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric_class, name, documentation, label_names, **options):
+
+        if not self._name_pattern.match(name):
+            raise MetricsError("Invalid metric name %s" % name)
+
+        with self._lock:
+            metric = self._metrics.get(name)
+
+            if metric is None:
+                metric = metric_class(name, documentation, label_names, **options)
+                self._metrics[name] = metric
+
+            elif not isinstance(metric, metric_class) or metric.label_names != tuple(label_names):
+                raise MetricsError("Metric %s is registered already with another type or labels" % name)
+
+            return metric
+
+
+class MetricsServer:
+    """
+    HTTP server that serves the metrics of a registry in the Prometheus text format on /metrics
+    """
+
+    def __init__(self, registry, host='127.0.0.1', port=9464):
+        """
+        :param registry: MetricsRegistry to serve
+        :param host: address to listen on
+        :param port: port to listen on
+        """
+
+        self.registry = registry
+        self.host = host
+        self.port = port
+
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """
+        Start serving in a background thread
+        """
+
+        registry = self.registry
+
+        class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+
+                body = registry.render().encode('utf-8')
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._server = http.server.ThreadingHTTPServer((self.host, self.port), MetricsRequestHandler)
+
+        except OSError as e:
+            raise MetricsError("Failed to serve the metrics on %s:%s: %s" % (self.host, self.port, e))
+
+        self._server.daemon_threads = True
+
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop serving
+        """
+
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _merge_counter(cell, other):
+    cell[0] += other[0]
+
+
+def _merge_histogram(cell, other):
+    for index, value in enumerate(other[0]):
+        cell[0][index] += value
+    cell[1] += other[1]
+    cell[2] += other[2]
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+
+    return str(value)
+
+
+# Registry shared by all modules of the process
+metrics = MetricsRegistry()
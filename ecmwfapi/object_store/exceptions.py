@@ -0,0 +1,26 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+class ObjectStoreError(Exception):
+    pass
+
+
+class ObjectStoreRequestError(ObjectStoreError):
+    """
+    Error response of the object store
+    """
+
+    def __init__(self, message, status=None, code=None):
+        super(ObjectStoreRequestError, self).__init__(message)
+
+        self.status = status
+        self.code = code
@@ -0,0 +1,277 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+from .exceptions import ObjectStoreError, ObjectStoreRequestError
+
+import base64
+import hashlib
+import hmac
+import httplib2
+import socket
+import time
+import xml.etree.ElementTree as ElementTree
+
+from urllib.parse import quote, urlsplit
+
+
+class S3Client:
+    """
+    Minimal client for the multipart upload API of S3 and S3-compatible object stores, such as MinIO and Ceph. Requests
+    are signed with AWS signature version 4 and use path-style addresses (endpoint/bucket/key), which all S3-compatible
+    stores support. Instances are not thread-safe; create one per thread.
+    """
+
+    def __init__(self, endpoint, access_key, secret_key, region='us-east-1', timeout=60, disable_ssl_validation=False,
+                 retries=5):
+        """
+        :param endpoint: URL of the object store, for example https://s3.eu-west-1.amazonaws.com
+        :param access_key: access key ID
+        :param secret_key: secret access key
+        :param region: region used in the signatures
+        :param timeout: timeout of requests in seconds
+        :param disable_ssl_validation: whether to disable SSL validation in httplib2
+        :param retries: number of times requests are retried after connection errors and server errors
+        """
+
+        parts = urlsplit(endpoint)
+        if parts.scheme not in ('http', 'https') or not parts.netloc:
+            raise ObjectStoreError("Invalid object store endpoint %s" % endpoint)
+
+        self.endpoint = endpoint.rstrip('/')
+        self.host = parts.netloc
+        self.base_path = parts.path.rstrip('/')
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.retries = retries
+
+        # Number of requests that were retried
+        self.retried_requests = 0
+
+        self.http_handle = httplib2.Http(timeout=timeout, disable_ssl_certificate_validation=disable_ssl_validation)
+        self.http_handle.follow_redirects = False
+
+    def create_multipart_upload(self, bucket, key):
+        """
+        :return: ID of the new upload
+        """
+
+        content = self._request('POST', bucket, key, {'uploads': ''})[1]
+
+        return _find_text(_parse(content), 'UploadId')
+
+    def upload_part(self, bucket, key, upload_id, part_number, data):
+        """
+        Upload a part. The object store verifies the data with the MD5 digest.
+
+        :param part_number: number of the part, from 1
+        :param data: content of the part
+        :return: ETag of the part
+        """
+
+        headers = {'content-md5': base64.b64encode(hashlib.md5(data).digest()).decode('ascii')}
+        response = self._request('PUT', bucket, key, {'partNumber': str(part_number), 'uploadId': upload_id}, data,
+                                 headers)[0]
+
+        return response.get('etag')
+
+    def list_parts(self, bucket, key, upload_id):
+        """
+        :return: dictionary with [ETag, size] of the uploaded parts by part number
+        """
+
+        parts = {}
+        marker = None
+
+        while True:
+            query = {'uploadId': upload_id}
+            if marker is not None:
+                query['part-number-marker'] = marker
+
+            result = _parse(self._request('GET', bucket, key, query)[1])
+
+            for part in _find_all(result, 'Part'):
+                parts[int(_find_text(part, 'PartNumber'))] = [_find_text(part, 'ETag'), int(_find_text(part, 'Size'))]
+
+            if _find_text(result, 'IsTruncated') != 'true':
+                return parts
+
+            marker = _find_text(result, 'NextPartNumberMarker')
+
+    def list_multipart_uploads(self, bucket, key):
+        """
+        :return: IDs of the incomplete uploads of the key, oldest first
+        """
+
+        result = _parse(self._request('GET', bucket, None, {'uploads': '', 'prefix': key})[1])
+
+        uploads = [[_find_text(upload, 'Initiated') or '', _find_text(upload, 'UploadId')]
+                   for upload in _find_all(result, 'Upload') if _find_text(upload, 'Key') == key]
+
+        return [upload_id for [_, upload_id] in sorted(uploads)]
+
+    def complete_multipart_upload(self, bucket, key, upload_id, parts):
+        """
+        :param parts: list of [part number, ETag] in order
+        :return: ETag of the object
+        """
+
+        body = ''.join('<Part><PartNumber>%s</PartNumber><ETag>%s</ETag></Part>' % (number, etag)
+                       for [number, etag] in parts)
+        body = ('<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % body).encode('utf-8')
+
+        content = self._request('POST', bucket, key, {'uploadId': upload_id}, body)[1]
+
+        # The store may report an error in a successful response after it started sending it
+        result = _parse(content)
+        if _local_name(result.tag) == 'Error':
+            raise ObjectStoreRequestError("Failed to complete the upload: %s" % _find_text(result, 'Message'), 200,
+                                          _find_text(result, 'Code'))
+
+        return _find_text(result, 'ETag')
+
+    def abort_multipart_upload(self, bucket, key, upload_id):
+        self._request('DELETE', bucket, key, {'uploadId': upload_id})
+
+    def put_object(self, bucket, key, data):
+        """
+        Upload a complete object in a single request
+
+        :return: ETag of the object
+        """
+
+        headers = {'content-md5': base64.b64encode(hashlib.md5(data).digest()).decode('ascii')}
+
+        return self._request('PUT', bucket, key, None, data, headers)[0].get('etag')
+
+    def _request(self, method, bucket, key=None, query=None, body=b'', headers=None):
+        """
+        Make a signed request. Retries after connection errors and server errors.
+
+        :return: list with the response headers and content
+        """
+
+        path = '%s/%s' % (self.base_path, bucket)
+        if key is not None:
+            path += '/' + key
+
+        path = quote(path, safe='/~')
+        query_string = '&'.join('%s=%s' % (quote(name, safe='-_.~'), quote(value, safe='-_.~'))
+                                for [name, value] in sorted((query or {}).items()))
+
+        url = self.endpoint[:len(self.endpoint) - len(self.base_path)] + path
+        if query_string:
+            url += '?' + query_string
+
+        error = None
+
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                self.retried_requests += 1
+                time.sleep(min(2 ** (attempt - 1), 30))
+
+            request_headers = self._sign(method, path, query_string, body, headers or {})
+
+            try:
+                response, content = self.http_handle.request(url, method, body, headers=request_headers)
+
+            except (httplib2.HttpLib2Error, socket.error, OSError) as e:
+                error = ObjectStoreError("Request to %s failed: %s" % (url, e))
+                continue
+
+            if response.status < 300:
+                return [response, content]
+
+            code = None
+            message = content.decode('utf-8', 'replace')[:200]
+
+            try:
+                result = _parse(content)
+                code = _find_text(result, 'Code')
+                message = _find_text(result, 'Message') or code or message
+
+            except ObjectStoreError:
+                pass
+
+            error = ObjectStoreRequestError("The object store returned HTTP status %s for %s %s: %s"
+                                            % (response.status, method, path, message), response.status, code)
+
+            # Client errors are not resolved by retrying
+            if response.status < 500:
+                break
+
+        raise error
+
+    def _sign(self, method, path, query_string, body, headers):
+        """
+        Add the AWS signature version 4 to the headers of a request
+
+        :return: the headers to send
+        """
+
+        now = time.gmtime()
+        amz_date = time.strftime('%Y%m%dT%H%M%SZ', now)
+        date = amz_date[:8]
+
+        headers = dict(headers)
+        headers['host'] = self.host
+        headers['x-amz-date'] = amz_date
+        headers['x-amz-content-sha256'] = hashlib.sha256(body).hexdigest()
+
+        signed_headers = ';'.join(sorted(headers))
+        canonical_headers = ''.join('%s:%s\n' % (name, headers[name].strip()) for name in sorted(headers))
+
+        canonical_request = '\n'.join([method, path, query_string, canonical_headers, signed_headers,
+                                       headers['x-amz-content-sha256']])
+
+        scope = '%s/%s/s3/aws4_request' % (date, self.region)
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                                    hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+
+        signing_key = ('AWS4' + self.secret_key).encode('utf-8')
+        for item in (date, self.region, 's3', 'aws4_request'):
+            signing_key = hmac.new(signing_key, item.encode('utf-8'), hashlib.sha256).digest()
+
+        signature = hmac.new(signing_key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+
+        headers['authorization'] = 'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s' \
+                                   % (self.access_key, scope, signed_headers, signature)
+
+        # httplib2 adds the host header itself
+        del headers['host']
+
+        return headers
+
+
+def _parse(content):
+    try:
+        return ElementTree.fromstring(content)
+
+    except ElementTree.ParseError as e:
+        raise ObjectStoreError("Failed to parse the response of the object store: %s" % e)
+
+
+def _local_name(tag):
+    # S3 responses use a namespace, S3-compatible stores do not always
+    return tag.rsplit('}', 1)[-1]
+
+
+def _find_all(element, name):
+    return [child for child in element if _local_name(child.tag) == name]
+
+
+def _find_text(element, name):
+    for child in element:
+        if _local_name(child.tag) == name:
+            return child.text
+
+    return None
@@ -0,0 +1,479 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+from .exceptions import ObjectStoreError
+from .s3_client import S3Client
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+
+from urllib.parse import urlsplit
+
+from ecmwfapi.metrics import metrics
+
+
+_uploaded_bytes = metrics.counter('ecmwfapi_object_store_uploaded_bytes_total', "Number of bytes uploaded to object "
+                                  "storage")
+_uploaded_parts = metrics.counter('ecmwfapi_object_store_uploaded_parts_total', "Number of multipart upload parts "
+                                  "uploaded to object storage")
+_resumed_parts = metrics.counter('ecmwfapi_object_store_resumed_parts_total', "Number of parts that were already "
+                                 "uploaded by an earlier attempt and were not uploaded again")
+
+# Smallest part size accepted by S3, except for the last part
+minimum_part_size = 5242880
+
+
+class S3Writer:
+    """
+    Streams written data into an object with a multipart upload. Written data is collected into parts of part_size
+    bytes, and each complete part is uploaded by a pool of upload threads while the download continues. At most
+    max_buffered_parts parts are waiting for or in upload; beyond that write blocks, so the memory used is bounded by
+    about (max_buffered_parts + 1) * part_size. Objects smaller than one part are uploaded with a single request.
+
+    If resume is enabled and the writer has a resume token, the ID of its upload is recorded with the token in a state
+    file. A later writer of the same object with the same token continues that upload, if it is still incomplete:
+    parts of which the size and MD5 digest match the data are not uploaded again. Uploads of the object started by
+    others, or for other data, are never continued. Incomplete uploads are kept when the writer fails, so the next
+    attempt can resume them; they can be removed with discard.
+    """
+
+    def __init__(self, bucket, key, endpoint, access_key, secret_key, region='us-east-1', part_size=8388608,
+                 upload_threads=4, max_buffered_parts=None, resume=True, timeout=60, disable_ssl_validation=False,
+                 resume_token=None, state_directory=None):
+        """
+        :param bucket: name of the bucket
+        :param key: key of the object
+        :param endpoint: URL of the object store
+        :param access_key: access key ID
+        :param secret_key: secret access key
+        :param region: region used in the signatures
+        :param part_size: size of the parts in bytes, at least 5 MiB
+        :param upload_threads: number of parts uploaded at the same time
+        :param max_buffered_parts: maximum number of parts waiting for or in upload, twice the upload threads if None
+        :param resume: whether to continue an incomplete upload of the object, and keep incomplete uploads on failure
+        :param timeout: timeout of requests in seconds
+        :param disable_ssl_validation: whether to disable SSL validation in httplib2
+        :param resume_token: identifier of the data, such as a digest of the request it is the result of. Only uploads
+            started with the same token are resumed, none if None.
+        :param state_directory: directory with the state files of resumable uploads, ~/.ecmwfapi/uploads if None
+        """
+
+        if not endpoint or not access_key or not secret_key:
+            raise ObjectStoreError("The object store endpoint and credentials are not configured")
+
+        if not isinstance(part_size, int) or part_size < minimum_part_size:
+            raise ObjectStoreError("The part size should be at least %s bytes" % minimum_part_size)
+
+        if not isinstance(upload_threads, int) or upload_threads < 1:
+            raise ObjectStoreError("The number of upload threads should be a positive integer")
+
+        if max_buffered_parts is None:
+            max_buffered_parts = 2 * upload_threads
+
+        if not isinstance(max_buffered_parts, int) or max_buffered_parts < 1:
+            raise ObjectStoreError("The number of buffered parts should be a positive integer")
+
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.upload_threads = upload_threads
+        self.resume = resume
+        self.resume_token = resume_token
+        self.state_directory = state_directory or os.path.join(os.path.expanduser('~'), '.ecmwfapi', 'uploads')
+
+        self.upload_id = None
+        self.parts = {}
+        self.resumed_parts = 0
+        self.closed = False
+
+        # Counterparts of the FileWriter statistics. The write duration is the time during which parts were uploaded.
+        self.compression = None
+        self.compression_duration = 0.0
+        self.bytes_written = 0
+        self.file_bytes = 0
+        self.write_duration = 0.0
+        self.buffer_wait_duration = 0.0
+
+        self._client_options = [endpoint, access_key, secret_key, region, timeout, disable_ssl_validation]
+        self._clients = threading.local()
+        self._created_clients = []
+
+        # Data of the part being collected, as a list of views of the written data, joined once the part is complete
+        self._chunks = []
+        self._part_length = 0
+        self._part_number = 1
+        self._existing_parts = {}
+        self._slots = threading.BoundedSemaphore(max_buffered_parts)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._error = None
+        self._upload_start = None
+        self._upload_end = None
+
+    @classmethod
+    def from_url(cls, url, **options):
+        """
+        :param url: s3://bucket/key URL of the object
+        :param options: other arguments of S3Writer
+        :return: S3Writer for the object
+        """
+
+        parts = urlsplit(url)
+        key = parts.path.lstrip('/')
+
+        if parts.scheme != 's3' or not parts.netloc or not key:
+            raise ObjectStoreError("Invalid object URL %s, expected s3://bucket/key" % url)
+
+        return cls(parts.netloc, key, **options)
+
+    def write(self, data):
+        """
+        Write data. Raises ObjectStoreError if an earlier upload failed.
+
+        :param data: bytes-like object
+        :return: number of bytes written
+        """
+
+        self._check()
+
+        view = memoryview(data)
+        length = len(view)
+        self.bytes_written += length
+
+        while len(view) > 0:
+            size = min(len(view), self.part_size - self._part_length)
+            self._chunks.append(view[:size])
+            self._part_length += size
+            view = view[size:]
+
+            if self._part_length == self.part_size:
+                self._submit(self._take_part())
+
+        return length
+
+    def flush(self):
+        """
+        Parts are uploaded as soon as they are complete, data of an incomplete part is kept until the writer is closed
+        """
+
+        self._check()
+
+    def close(self):
+        """
+        Upload the remaining data and complete the upload. Raises ObjectStoreError if the upload failed.
+        """
+
+        if self.closed:
+            return
+
+        self._check()
+
+        try:
+            if self.upload_id is None:
+                self._put_object()
+
+            else:
+                # An upload needs at least one part, which can be empty if it is the only one
+                if self._part_length or self._part_number == 1:
+                    self._submit(self._take_part())
+
+                self._wait()
+                self._check()
+
+                with self._lock:
+                    parts = sorted(self.parts.items())
+
+                self._client().complete_multipart_upload(self.bucket, self.key, self.upload_id, parts)
+                self._remove_state()
+
+        except ObjectStoreError:
+            self.abort()
+            raise
+
+        self.closed = True
+        self._wait()
+
+    def abort(self):
+        """
+        Stop uploading. The incomplete upload is kept to be resumed if resume is enabled, otherwise it is removed.
+        """
+
+        if self.closed:
+            return
+
+        self.closed = True
+
+        if self._error is None:
+            self._error = ObjectStoreError("The writer was aborted")
+
+        self._wait()
+
+        if not self.resume:
+            self.discard()
+
+    def discard(self):
+        """
+        Remove the incomplete upload and the parts uploaded so far, for example when the transfer is cancelled
+        """
+
+        self.closed = True
+
+        if self._error is None:
+            self._error = ObjectStoreError("The writer was aborted")
+
+        self._wait()
+
+        if self.upload_id is not None:
+            try:
+                self._client().abort_multipart_upload(self.bucket, self.key, self.upload_id)
+
+            except ObjectStoreError:
+                pass
+
+            self._remove_state()
+            self.upload_id = None
+
+    def get_statistics(self):
+        """
+        :return: dictionary with the bytes uploaded, the upload duration and throughput, the time write waited for a
+            free part buffer, the upload ID, the number of parts, the number of resumed parts and the number of retried
+            requests
+        """
+
+        with self._lock:
+            return {
+                'bytes': self.file_bytes,
+                'write_duration': self.write_duration,
+                'throughput': self.file_bytes / self.write_duration if self.write_duration else None,
+                'wait_duration': self.buffer_wait_duration,
+                'upload_id': self.upload_id,
+                'parts': len(self.parts),
+                'resumed_parts': self.resumed_parts,
+                'retries': sum(client.retried_requests for client in self._created_clients),
+            }
+
+    def _check(self):
+        if self._error is not None:
+            raise ObjectStoreError("Failed to upload s3://%s/%s: %s" % (self.bucket, self.key, self._error))
+
+        if self.closed:
+            raise ObjectStoreError("The writer is closed")
+
+    def _client(self):
+        """
+        :return: S3Client of the current thread
+        """
+
+        client = getattr(self._clients, 'client', None)
+
+        if client is None:
+            client = S3Client(*self._client_options)
+            self._clients.client = client
+
+            with self._lock:
+                self._created_clients.append(client)
+
+        return client
+
+    def _start(self):
+        """
+        Start a multipart upload, or continue the incomplete upload recorded in the state file with the same resume
+        token
+        """
+
+        client = self._client()
+        resumable = self.resume and self.resume_token is not None
+
+        if resumable:
+            state = self._read_state()
+
+            if state is not None and state.get('token') == self.resume_token and \
+                    state.get('upload_id') in client.list_multipart_uploads(self.bucket, self.key):
+                self.upload_id = state['upload_id']
+                self._existing_parts = client.list_parts(self.bucket, self.key, self.upload_id)
+                return
+
+        self.upload_id = client.create_multipart_upload(self.bucket, self.key)
+
+        if resumable:
+            self._write_state()
+
+    def _state_path(self):
+        """
+        :return: path of the state file of the object, named after a digest of the endpoint, bucket and key
+        """
+
+        name = hashlib.sha256(('%s\n%s\n%s' % (self._client_options[0], self.bucket, self.key)).encode()).hexdigest()
+
+        return os.path.join(self.state_directory, name + '.json')
+
+    def _read_state(self):
+        """
+        :return: dictionary with the bucket, key, upload ID and resume token of the last upload of the object, or None
+            if there is no readable state
+        """
+
+        try:
+            with open(self._state_path()) as file:
+                state = json.load(file)
+
+        except (OSError, ValueError):
+            return None
+
+        if not isinstance(state, dict) or state.get('bucket') != self.bucket or state.get('key') != self.key:
+            return None
+
+        return state
+
+    def _write_state(self):
+        """
+        Record the upload ID with the resume token. The upload continues without it if the state can not be written,
+        it just can not be resumed.
+        """
+
+        path = self._state_path()
+
+        try:
+            os.makedirs(self.state_directory, exist_ok=True)
+
+            with open(path + '.tmp', 'w') as file:
+                json.dump({'bucket': self.bucket, 'key': self.key, 'upload_id': self.upload_id,
+                           'token': self.resume_token}, file)
+
+            os.replace(path + '.tmp', path)
+
+        except OSError:
+            pass
+
+    def _remove_state(self):
+        """
+        Remove the state file once the upload is completed or removed, if it still refers to this upload
+        """
+
+        state = self._read_state()
+
+        if state is not None and state.get('upload_id') == self.upload_id:
+            try:
+                os.remove(self._state_path())
+
+            except OSError:
+                pass
+
+    def _take_part(self):
+        """
+        :return: data of the part being collected, which is then reset
+        """
+
+        part = b''.join(self._chunks)
+        self._chunks = []
+        self._part_length = 0
+
+        return part
+
+    def _submit(self, data):
+        """
+        Hand a part to the upload threads, waiting for a free slot if the maximum number of parts is buffered
+        """
+
+        if self.upload_id is None:
+            self._start()
+
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.upload_threads)
+
+        wait_start = time.time()
+
+        while not self._slots.acquire(timeout=1):
+            if self._error is not None:
+                self._check()
+
+        self.buffer_wait_duration += time.time() - wait_start
+
+        self._executor.submit(self._upload, self._part_number, data)
+        self._part_number += 1
+
+    def _upload(self, part_number, data):
+        """
+        Upload a part, called by the upload threads
+        """
+
+        try:
+            if self._error is not None:
+                return
+
+            start = time.time()
+
+            with self._lock:
+                if self._upload_start is None:
+                    self._upload_start = start
+
+            existing = self._existing_parts.get(part_number)
+
+            if existing is not None and existing[1] == len(data) and \
+                    existing[0].strip('"') == hashlib.md5(data).hexdigest():
+                etag = existing[0]
+                resumed = True
+
+            else:
+                etag = self._client().upload_part(self.bucket, self.key, self.upload_id, part_number, data)
+                resumed = False
+
+            if etag is None:
+                raise ObjectStoreError("The object store did not return the ETag of part %s" % part_number)
+
+            with self._lock:
+                self.parts[part_number] = etag
+                self.file_bytes += len(data)
+                self._upload_end = max(self._upload_end or 0, time.time())
+                self.write_duration = self._upload_end - self._upload_start
+
+                if resumed:
+                    self.resumed_parts += 1
+
+            if resumed:
+                _resumed_parts.inc()
+
+            else:
+                _uploaded_parts.inc()
+                _uploaded_bytes.inc(len(data))
+
+        except Exception as e:
+            with self._lock:
+                if self._error is None:
+                    self._error = e
+
+        finally:
+            self._slots.release()
+
+    def _put_object(self):
+        start = time.time()
+
+        data = self._take_part()
+        self._client().put_object(self.bucket, self.key, data)
+
+        self.file_bytes = len(data)
+        self.write_duration = time.time() - start
+
+        _uploaded_bytes.inc(len(data))
+
+    def _wait(self):
+        """
+        Wait for the uploads in progress
+        """
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
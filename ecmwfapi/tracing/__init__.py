@@ -0,0 +1,16 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+from .tracing import Span, add_hook, current_span, remove_hook, span, tracing_enabled
+from .chrome_trace import ChromeTraceExporter
+from .session_recorder import SessionRecorder
+from .exceptions import TracingError
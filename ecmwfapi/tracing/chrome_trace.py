@@ -0,0 +1,98 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+from .exceptions import TracingError
+from .tracing import add_hook, remove_hook
+
+import json
+import os
+import threading
+
+
+class ChromeTraceExporter:
+    """
+    Tracing hook that records the completed spans and writes them as a Chrome trace / Perfetto JSON timeline, which can
+    be opened in chrome://tracing or https://ui.perfetto.dev. Each thread is shown as a separate track.
+
+    Usage:
+
+        exporter = ChromeTraceExporter('trace.json')
+        exporter.start()
+        server.retrieve(...)
+        exporter.stop()
+    """
+
+    def __init__(self, path, max_events=1000000):
+        """
+        :param path: file to write the trace to
+        :param max_events: maximum number of spans to keep, later spans are dropped
+        """
+
+        self.path = path
+        self.max_events = max_events
+        self.dropped_events = 0
+
+        self._events = []
+        self._lock = threading.Lock()
+        self._process_id = os.getpid()
+
+    def start(self):
+        """
+        Register the exporter, so it receives the spans
+        """
+
+        add_hook(self)
+
+    def stop(self):
+        """
+        Unregister the exporter and write the trace
+        """
+
+        remove_hook(self)
+        self.write()
+
+    def span_start(self, span):
+        pass
+
+    def span_end(self, span):
+
+        event = {
+            'name': span.name,
+            'cat': span.name.split('.')[0],
+            'ph': 'X',
+            'ts': span.start_time * 1000000,
+            'dur': (span.end_time - span.start_time) * 1000000,
+            'pid': self._process_id,
+            'tid': span.thread_id,
+            'args': dict(span.attributes, span_id=span.span_id, parent_id=span.parent_id),
+        }
+
+        with self._lock:
+            if len(self._events) < self.max_events:
+                self._events.append(event)
+            else:
+                self.dropped_events += 1
+
+    def write(self):
+        """
+        Write the spans recorded so far to the trace file
+        """
+
+        with self._lock:
+            events = list(self._events)
+
+        try:
+            with open(self.path, 'w') as file:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file, default=str)
+
+        except (IOError, OSError) as e:
+            raise TracingError("Failed to write the trace to %s: %s" % (self.path, e))
@@ -0,0 +1,213 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+from .exceptions import TracingError
+from .tracing import add_hook, remove_hook
+
+import json
+import threading
+import time
+
+
+class SessionRecorder:
+    """
+    Tracing hook that records the shape of the requests made through ECMWFDataServer: when they were started, the
+    request parameters, how long they were queued and active at the API, the retry-after values, the API latency, the
+    size of the result and the latency and retries of each block. The session can be replayed by a local server to
+    benchmark the client against a realistic workload.
+
+    Usage:
+
+        recorder = SessionRecorder('session.json', include_payloads=False)
+        recorder.start()
+        server.retrieve(...)
+        recorder.stop()
+    """
+
+    version = 1
+
+    def __init__(self, path=None, include_payloads=True, max_requests=100000):
+        """
+        :param path: file to write the session to when the recorder is stopped
+        :param include_payloads: whether to record the request parameters. If not, only the dataset is recorded.
+        :param max_requests: maximum number of requests to keep, later requests are dropped
+        """
+
+        self.path = path
+        self.include_payloads = include_payloads
+        self.max_requests = max_requests
+        self.dropped_requests = 0
+
+        self.start_time = None
+
+        self._lock = threading.Lock()
+
+        # Requests in progress by the ID of their request span, and the requests they belong to by span ID
+        self._active = {}
+        self._span_requests = {}
+        self._completed = []
+
+    def start(self):
+        """
+        Register the recorder, so it receives the spans
+        """
+
+        self.start_time = time.time()
+        add_hook(self)
+
+    def stop(self):
+        """
+        Unregister the recorder and write the session if a path was given
+        """
+
+        remove_hook(self)
+
+        if self.path is not None:
+            self.write()
+
+    def span_start(self, span):
+
+        with self._lock:
+            if span.name == 'request':
+                if self.start_time is None:
+                    self.start_time = span.start_time
+
+                payload = None
+                if self.include_payloads and isinstance(span.attributes.get('payload'), dict):
+                    payload = {key: value for [key, value] in span.attributes['payload'].items() if key != 'target'}
+
+                record = {
+                    'start': span.start_time,
+                    'dataset': span.attributes.get('dataset'),
+                    'payload': payload,
+                    'submit_time': None,
+                    'submit_latency': None,
+                    'statuses': [],
+                    'retry_after': [],
+                    'poll_latencies': [],
+                    'size': None,
+                    'blocks': [],
+                }
+
+                self._active[span.span_id] = record
+                self._span_requests[span.span_id] = record
+                return
+
+            record = self._span_requests.get(span.parent_id)
+            if record is None:
+                return
+
+            self._span_requests[span.span_id] = record
+
+            if span.name == 'poll_wait':
+                self._set_status(record, span.attributes.get('status'), span.start_time)
+                record['retry_after'].append(span.attributes.get('seconds'))
+
+            elif span.name == 'download':
+                self._set_status(record, 'complete', span.start_time)
+
+    def span_end(self, span):
+
+        with self._lock:
+            record = self._span_requests.pop(span.span_id, None)
+            if record is None:
+                return
+
+            if span.name == 'api_request':
+                method = span.attributes.get('method')
+
+                if method == 'POST' and record['submit_time'] is None:
+                    record['submit_time'] = span.end_time
+                    record['submit_latency'] = span.duration()
+
+                elif method == 'GET' and record['submit_time'] is not None:
+                    record['poll_latencies'].append(span.duration())
+
+            elif span.name == 'get_block':
+                record['blocks'].append([span.duration(), span.attributes.get('bytes', 0),
+                                         span.attributes.get('retries', 0)])
+
+            elif span.name == 'download':
+                record['size'] = span.attributes.get('bytes')
+
+            elif span.name == 'request':
+                del self._active[span.span_id]
+
+                if len(self._completed) >= self.max_requests:
+                    self.dropped_requests += 1
+                    return
+
+                self._completed.append(self._finish(record, span))
+
+    def get_session(self):
+        """
+        :return: dictionary with the recorded requests, ordered by start time
+        """
+
+        with self._lock:
+            requests = [dict(record, offset=record['offset'] - self.start_time)
+                        for record in sorted(self._completed, key=lambda item: item['offset'])]
+
+            session = {
+                'version': self.version,
+                'recorded_at': self.start_time,
+                'requests': requests,
+            }
+
+            return json.loads(json.dumps(session))
+
+    def write(self, path=None):
+        """
+        Write the session as JSON
+
+        :param path: file to write to, the path of the recorder is used if None
+        """
+
+        path = path if path is not None else self.path
+        if path is None:
+            raise TracingError("No file given to write the session to")
+
+        session = self.get_session()
+
+        try:
+            with open(path, 'w') as file:
+                json.dump(session, file)
+
+        except (OSError, TypeError, ValueError) as e:
+            raise TracingError("Failed to write session to %s: %s" % (path, e))
+
+    @staticmethod
+    def _set_status(record, status, timestamp):
+        if status is not None and (not record['statuses'] or record['statuses'][-1][0] != status):
+            record['statuses'].append([status, timestamp])
+
+    @staticmethod
+    def _finish(record, span):
+        """
+        Convert a completed request to its recorded form, with times relative to the submission of the request
+        """
+
+        submit_time = record['submit_time'] if record['submit_time'] is not None else span.end_time
+
+        return {
+            'offset': record['start'],
+            'dataset': record['dataset'],
+            'payload': record['payload'],
+            'status': 'failed' if 'error' in span.attributes else 'completed',
+            'duration': span.duration(),
+            'submit_latency': record['submit_latency'],
+            'statuses': [[status, max(timestamp - submit_time, 0)] for [status, timestamp] in record['statuses']],
+            'retry_after': record['retry_after'],
+            'poll_latencies': record['poll_latencies'],
+            'size': record['size'],
+            'blocks': record['blocks'],
+        }
@@ -0,0 +1,189 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+from .exceptions import TracingError
+
+import itertools
+import threading
+import time
+
+
+# Registered hooks. The list is replaced instead of changed, so it can be iterated without a lock.
+_hooks = []
+_hooks_lock = threading.Lock()
+
+_span_ids = itertools.count(1)
+_local = threading.local()
+
+
+class Span:
+    """
+    Timed section of a transfer, such as an API call or a block download. Spans are created with span() and used as
+    context manager; the registered hooks are called when the span starts and ends. Spans started while another span is
+    active in the same thread are its children, unless another parent is given.
+    """
+
+    __slots__ = ('name', 'attributes', 'span_id', 'parent_id', 'thread_id', 'start_time', 'end_time', '_hooks')
+
+    def __init__(self, name, attributes, hooks, parent=None):
+
+        self.name = name
+        self.attributes = attributes
+        self.span_id = next(_span_ids)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.thread_id = threading.get_ident()
+        self.start_time = None
+        self.end_time = None
+        self._hooks = hooks
+
+    def set(self, name, value):
+        """
+        Set an attribute of the span, for example the number of bytes once they are known
+
+        :param name: name of the attribute
+        :param value: value of the attribute
+        """
+
+        self.attributes[name] = value
+
+    def duration(self):
+        """
+        :return: duration of the span in seconds, or None if it has not ended
+        """
+
+        if self.end_time is None:
+            return None
+
+        return self.end_time - self.start_time
+
+    def __enter__(self):
+
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+
+        if stack and self.parent_id is None:
+            self.parent_id = stack[-1].span_id
+
+        stack.append(self)
+        self.start_time = time.time()
+
+        for hook in self._hooks:
+            hook.span_start(self)
+
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+
+        self.end_time = time.time()
+
+        if exception_type is not None:
+            self.attributes['error'] = exception_type.__name__
+
+        stack = _local.stack
+        if stack and stack[-1] is self:
+            stack.pop()
+
+        for hook in self._hooks:
+            hook.span_end(self)
+
+        return False
+
+
+class _NullSpan:
+    """
+    Span returned when no hooks are registered, which does nothing
+    """
+
+    __slots__ = ()
+
+    def set(self, name, value):
+        pass
+
+    def duration(self):
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+def span(name, parent=None, **attributes):
+    """
+    Create a span, to be used as context manager around the traced section. When no hooks are registered a shared span
+    that does nothing is returned, so tracing costs a single check.
+
+    :param name: name of the span, for example api_request or get_block
+    :param parent: optional Span to use as parent instead of the active span of the thread, for work that is handed to
+        other threads, see current_span
+    :param attributes: attributes of the span, for example the request ID or the block ID
+    :return: Span
+    """
+
+    hooks = _hooks
+    if not hooks:
+        return _null_span
+
+    return Span(name, attributes, hooks, parent)
+
+
+def current_span():
+    """
+    :return: the innermost active span of the current thread, or None if there is none or tracing is disabled
+    """
+
+    stack = getattr(_local, 'stack', None)
+
+    return stack[-1] if stack else None
+
+
+def tracing_enabled():
+    """
+    :return: whether any hooks are registered
+    """
+
+    return len(_hooks) > 0
+
+
+def add_hook(hook):
+    """
+    Register a hook. Hooks are objects with the methods span_start(span) and span_end(span), which are called in the
+    thread that runs the span, so they should return quickly.
+
+    :param hook: the hook
+    """
+
+    global _hooks
+
+    if not callable(getattr(hook, 'span_start', None)) or not callable(getattr(hook, 'span_end', None)):
+        raise TracingError("A tracing hook should have the methods span_start and span_end")
+
+    with _hooks_lock:
+        _hooks = _hooks + [hook]
+
+
+def remove_hook(hook):
+    """
+    Unregister a hook
+
+    :param hook: the hook
+    """
+
+    global _hooks
+
+    with _hooks_lock:
+        _hooks = [item for item in _hooks if item is not hook]
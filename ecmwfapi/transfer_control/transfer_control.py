@@ -0,0 +1,108 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+from .exceptions import TransferCancelledError
+
+import threading
+
+
+class TransferControl:
+    """
+    Cancellation token for transfers. It is passed along with a transfer and checked by the transfer code at safe points,
+    such as between status polls and between downloaded blocks. Another thread can use it to cancel, pause or resume the
+    transfer.
+    """
+
+    def __init__(self, bandwidth_weight=1, priority=0):
+        """
+        :param bandwidth_weight: share of the process-wide bandwidth limit given to the download of the transfer,
+            relative to the other downloads in progress
+        :param priority: priority of the download when the download workers are shared by priority
+        """
+
+        self.bandwidth_weight = bandwidth_weight
+        self.priority = priority
+
+        # Bytes of the result downloaded and handed to the writers so far, before compression, for progress reporting
+        self.processed_bytes = 0
+
+        self._cancelled = threading.Event()
+        self._running = threading.Event()
+        self._running.set()
+
+    def cancel(self):
+        """
+        Cancel the transfer. A paused transfer is woken up so it can stop.
+        """
+
+        self._cancelled.set()
+        self._running.set()
+
+    def pause(self):
+        """
+        Pause the transfer at the next check
+        """
+
+        if not self._cancelled.is_set():
+            self._running.clear()
+
+    def resume(self):
+        """
+        Resume a paused transfer
+        """
+
+        self._running.set()
+
+    def is_cancelled(self):
+        """
+        :return: whether the transfer has been cancelled
+        """
+
+        return self._cancelled.is_set()
+
+    def is_paused(self):
+        """
+        :return: whether the transfer has been paused
+        """
+
+        return not self._running.is_set()
+
+    def check(self):
+        """
+        Check point for the transfer. Blocks while the transfer is paused, and raises TransferCancelledError if the
+        transfer has been cancelled.
+        """
+
+        self._running.wait()
+
+        if self._cancelled.is_set():
+            raise TransferCancelledError("The transfer was cancelled")
+
+    def add_processed_bytes(self, size):
+        """
+        Record downloaded bytes that were handed to the writers. Called by the thread that writes the result.
+
+        :param size: number of bytes
+        """
+
+        self.processed_bytes += size
+
+    def sleep(self, seconds):
+        """
+        Sleep for the given number of seconds, or until the transfer is cancelled. Afterwards the transfer is checked,
+        so this blocks while the transfer is paused.
+
+        :param seconds: number of seconds to sleep
+        """
+
+        self._cancelled.wait(seconds)
+        self.check()
@@ -0,0 +1,264 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+from .exceptions import TransferStatisticsError
+
+import csv
+import itertools
+import json
+import math
+import os
+import threading
+import time
+
+
+class TransferStatistics:
+    """
+    Statistics of a single request, filled in while the request is processed and returned by ECMWFDataServer.retrieve.
+    Durations are in seconds, throughputs in bytes per second.
+    """
+
+    # Fields in the order in which they are written to statistics files
+    fields = ('request_id', 'dataset', 'target', 'status', 'error', 'submit_time', 'queue_duration', 'active_duration',
+              'download_duration', 'total_duration', 'bytes', 'block_count', 'api_retries', 'block_retries',
+              'block_latency_p50', 'block_latency_p95', 'block_latency_p99', 'average_throughput', 'peak_throughput',
+              'cache_status', 'digest', 'verified', 'configured_rate', 'throttled_duration',
+              'write_duration', 'write_wait_duration', 'compression', 'compressed_bytes', 'compression_ratio',
+              'compression_duration', 'sinks', 'coordination_wait_duration')
+
+    def __init__(self, request_id=None, dataset=None, target=None):
+
+        self.request_id = request_id
+        self.dataset = dataset
+        self.target = target
+        self.status = None
+        self.error = None
+
+        self.start_time = time.time()
+        self.submit_time = None
+        self.active_time = None
+        self.complete_time = None
+        self.download_start_time = None
+        self.download_end_time = None
+        self.end_time = None
+
+        self.bytes = 0
+        self.api_retries = 0
+        self.block_retries = 0
+        self.cache_status = None
+
+        # Digest of the downloaded file as algorithm:hexdigest, and whether it matched the digest announced by the
+        # server, None if the server did not announce one
+        self.digest = None
+        self.verified = None
+
+        # Process-wide bandwidth limit when the download finished, 0 if unlimited, and the time the download waited for
+        # it
+        self.configured_rate = None
+        self.throttled_duration = 0.0
+
+        # Time the writer thread spent writing the file, and time the download waited for it because the disk could
+        # not keep up
+        self.write_duration = None
+        self.write_wait_duration = None
+
+        # Compression method of the target file, its size, and the processor time spent compressing
+        self.compression = None
+        self.compressed_bytes = None
+        self.compression_duration = None
+
+        # Write statistics per target if the result was written to multiple targets, see MultiWriter.get_statistics
+        self.sinks = None
+
+        # Time the request waited for the host-wide request limit and submission rate of the credentials
+        self.coordination_wait_duration = None
+
+        # Latency and size of each downloaded block, as (seconds, bytes)
+        self.blocks = []
+
+        self._lock = threading.Lock()
+
+    def add_block(self, latency, size):
+        """
+        Record a downloaded block. Can be called from multiple download threads.
+
+        :param latency: number of seconds the download of the block took
+        :param size: size of the block in bytes
+        """
+
+        with self._lock:
+            self.blocks.append((latency, size))
+
+    def add_block_retry(self):
+        """
+        Record a failed block download that is retried
+        """
+
+        with self._lock:
+            self.block_retries += 1
+
+    def finish(self, status, error=None):
+        """
+        Mark the request as finished
+
+        :param status: final status of the request, for example completed, failed or cancelled
+        :param error: optional description of the error that made the request fail
+        """
+
+        self.status = status
+        self.error = error
+        self.end_time = time.time()
+
+    def block_latency_percentile(self, percentile):
+        """
+        :param percentile: percentile between 0 and 100
+        :return: block latency at the percentile in seconds, or None if no blocks were downloaded
+        """
+
+        with self._lock:
+            latencies = sorted(item[0] for item in self.blocks)
+
+        if not latencies:
+            return None
+
+        # Nearest rank
+        return latencies[max(int(math.ceil(percentile / 100 * len(latencies))) - 1, 0)]
+
+    def to_dict(self):
+        """
+        :return: dictionary with the statistics, as written to statistics files
+        """
+
+        with self._lock:
+            blocks = list(self.blocks)
+
+        download_duration = _duration(self.download_start_time, self.download_end_time)
+
+        average_throughput = None
+        if download_duration:
+            average_throughput = self.bytes / download_duration
+
+        block_throughputs = [size / latency for latency, size in blocks if latency > 0]
+        peak_throughput = max(block_throughputs) if block_throughputs else None
+
+        return {
+            'request_id': self.request_id,
+            'dataset': self.dataset,
+            'target': self.target,
+            'status': self.status,
+            'error': self.error,
+            'submit_time': self.submit_time,
+            'queue_duration': _duration(self.submit_time, self.active_time or self.complete_time),
+            'active_duration': _duration(self.active_time or self.submit_time, self.complete_time),
+            'download_duration': download_duration,
+            'total_duration': _duration(self.start_time, self.end_time),
+            'bytes': self.bytes,
+            'block_count': len(blocks),
+            'api_retries': self.api_retries,
+            'block_retries': self.block_retries,
+            'block_latency_p50': self.block_latency_percentile(50),
+            'block_latency_p95': self.block_latency_percentile(95),
+            'block_latency_p99': self.block_latency_percentile(99),
+            'average_throughput': average_throughput,
+            'peak_throughput': peak_throughput,
+            'cache_status': self.cache_status,
+            'digest': self.digest,
+            'verified': self.verified,
+            'configured_rate': self.configured_rate,
+            'throttled_duration': self.throttled_duration,
+            'write_duration': self.write_duration,
+            'write_wait_duration': self.write_wait_duration,
+            'compression': self.compression,
+            'compressed_bytes': self.compressed_bytes,
+            'compression_ratio': self.bytes / float(self.compressed_bytes) if self.compressed_bytes else None,
+            'compression_duration': self.compression_duration,
+            'sinks': self.sinks,
+            'coordination_wait_duration': self.coordination_wait_duration,
+        }
+
+    def __repr__(self):
+        return 'TransferStatistics(%s)' % ', '.join('%s=%r' % item for item in self.to_dict().items())
+
+
+_write_lock = threading.Lock()
+
+
+def write_statistics(path, statistics):
+    """
+    Append statistics records to a file for offline analysis. Files ending with .csv are written as CSV with a header
+    row, one column per field; other files as JSON lines, one object per line. A CSV file with a header of other fields,
+    written by another version, is left as it is, and the records are appended to name.1.csv, or the first of
+    name.2.csv, name.3.csv, etc. that is new or has the same fields.
+
+    :param path: file to append to
+    :param statistics: list of TransferStatistics
+    :return: file the records were appended to
+    """
+
+    records = [item.to_dict() for item in statistics]
+
+    with _write_lock:
+        try:
+            if path.lower().endswith('.csv'):
+                path = _csv_path(path)
+                write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+
+                with open(path, 'a', newline='') as file:
+                    writer = csv.DictWriter(file, TransferStatistics.fields)
+
+                    if write_header:
+                        writer.writeheader()
+
+                    # Values with a structure, such as the targets and the sinks, are stored in a column as JSON
+                    writer.writerows({key: json.dumps(value) if isinstance(value, (list, dict)) else value
+                                      for [key, value] in record.items()} for record in records)
+
+            else:
+                with open(path, 'a') as file:
+                    for record in records:
+                        file.write(json.dumps(record) + '\n')
+
+        except (IOError, OSError) as e:
+            raise TransferStatisticsError("Failed to write the transfer statistics to %s: %s" % (path, e))
+
+    return path
+
+
+def _csv_path(path):
+    """
+    :param path: CSV file to append statistics to
+    :return: the file, or the first of the numbered alternatives, that does not exist, is empty or has a header with
+        the current fields
+    """
+
+    fields = list(TransferStatistics.fields)
+    candidate = path
+
+    for index in itertools.count(1):
+        try:
+            with open(candidate, newline='') as file:
+                header = next(csv.reader(file), None)
+
+        except FileNotFoundError:
+            header = None
+
+        if header is None or header == fields:
+            return candidate
+
+        candidate = '%s.%s%s' % (path[:-4], index, path[-4:])
+
+
+def _duration(start, end):
+    if start is None or end is None:
+        return None
+
+    return end - start
@@ -26,6 +26,6 @@ setup(
     url="https://software.ecmwf.int/stash/projects/PRDEL/repos/ecmwf-api-client/browse",
     package_data={'ecmwfapi': ['config.ini']},
 
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*', 'tests', 'tests.*']),
     zip_safe=False,
 )
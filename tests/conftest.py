@@ -0,0 +1,19 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+import os
+import sys
+
+# The background client packages are imported relative to the ecmwfapi directory
+root = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, root)
+sys.path.append(os.path.join(root, 'ecmwfapi'))
@@ -0,0 +1,130 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+import queue
+
+import pytest
+
+from background_client.admission_control import AdmissionControlError, AdmissionController, AdmissionRejectedError
+from background_client.connection_handler import ConnectionHandler
+from background_client.task_registry import TaskRecord, TaskRegistry, TaskRegistryError
+from background_client.task_scheduler import TaskScheduler
+
+
+def create_controller(maxsize=0, **options):
+    registry = TaskRegistry()
+    scheduler = TaskScheduler(maxsize=maxsize)
+
+    return AdmissionController(scheduler, registry, **options), registry, scheduler
+
+
+def submit(controller, registry, task_id, owner='alice', target=None, expected_size=None):
+    controller.admit(task_id, owner, target, expected_size=expected_size,
+                     record=TaskRecord(task_id, {}, None, owner, 0))
+
+
+def test_admitted_tasks_are_queued():
+    [controller, registry, scheduler] = create_controller()
+    submit(controller, registry, 'a')
+
+    assert scheduler.get(block=False) == 'a'
+    assert registry.get('a').task_status == 'queued'
+    assert controller.get_statistics()['admitted'] == 1
+
+
+def test_rejected_tasks_are_not_registered():
+    [controller, registry, _] = create_controller(maxsize=1)
+    submit(controller, registry, 'a')
+    version = registry.version
+
+    with pytest.raises(AdmissionRejectedError):
+        submit(controller, registry, 'b')
+
+    with pytest.raises(TaskRegistryError):
+        registry.get('b')
+
+    assert registry.version == version
+
+
+def test_rejected_transfers_leave_the_changes_unchanged():
+    class Log:
+        def info(self, message):
+            pass
+
+        warning = error = info
+
+    registry = TaskRegistry(max_removed_changes=1)
+    handler = ConnectionHandler(Log(), queue.Queue(), [], registry, TaskScheduler(maxsize=1), lambda: None)
+    handler.add_transfer({'target': None})
+    changes = registry.list_changes(0)
+
+    for _ in range(3):
+        with pytest.raises(AdmissionRejectedError):
+            handler.add_transfer({'target': None})
+
+    assert registry.list_changes(changes['version']) == {'version': changes['version'], 'reset': False, 'added': [],
+                                                          'updated': [], 'removed': []}
+
+
+def test_full_queue_is_rejected_without_blocking():
+    [controller, registry, _] = create_controller(maxsize=1, retry_after=30)
+    submit(controller, registry, 'a')
+
+    with pytest.raises(AdmissionRejectedError) as error:
+        submit(controller, registry, 'b')
+
+    assert error.value.reason == 'queue_full'
+    assert error.value.retry_after == 30
+
+    statistics = controller.get_statistics()
+    assert statistics['rejected'] == {'queue_full': 1}
+    assert statistics['rejected_total'] == 1
+
+
+def test_owner_limit_only_applies_to_the_owner():
+    [controller, registry, scheduler] = create_controller(max_queued_per_owner=1)
+    submit(controller, registry, 'a1', owner='alice')
+    submit(controller, registry, 'b1', owner='bob')
+
+    with pytest.raises(AdmissionRejectedError) as error:
+        submit(controller, registry, 'a2', owner='alice')
+
+    assert error.value.reason == 'owner_limit'
+    assert scheduler.qsize() == 2
+
+
+def test_disk_space_is_reserved_for_admitted_tasks(tmp_path):
+    [controller, registry, _] = create_controller(min_free_disk_space=1, default_task_size=1)
+    target = str(tmp_path / 'result')
+
+    submit(controller, registry, 'small', target=target)
+    assert controller.get_statistics()['reserved_disk_space'] == 1
+
+    with pytest.raises(AdmissionRejectedError) as error:
+        submit(controller, registry, 'huge', target=target, expected_size=2 ** 62)
+
+    assert error.value.reason == 'disk_space'
+
+
+def test_reservations_are_released_when_tasks_complete(tmp_path):
+    [controller, registry, _] = create_controller(min_free_disk_space=1)
+    submit(controller, registry, 'a', target=[str(tmp_path / 'x'), str(tmp_path / 'y')], expected_size=100)
+
+    assert controller.get_statistics()['reserved_disk_space'] == 200
+
+    registry.complete('a', 'completed')
+    assert controller.get_statistics()['reserved_disk_space'] == 0
+
+
+def test_invalid_limits_are_rejected():
+    with pytest.raises(AdmissionControlError):
+        create_controller(max_queued_per_owner=-1)
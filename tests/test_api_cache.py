@@ -0,0 +1,129 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+import importlib
+
+import pytest
+
+from ecmwfapi.api_connection import ApiCache, ApiConnection, api_cache
+
+
+credentials = ('https://api.ecmwf.int/v1', 'user@example.com', 'key')
+
+
+class Clock:
+    """
+    Replaces the time module of the cache, so entries expire without waiting
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(importlib.import_module('ecmwfapi.api_connection.api_cache'), 'time', clock)
+
+    return clock
+
+
+def test_values_are_fetched_once_until_they_expire(clock):
+    cache = ApiCache(ttl=60)
+    fetched = []
+
+    def fetch():
+        fetched.append(1)
+        return {'uid': 'user'}
+
+    assert cache.get(credentials + ('who-am-i',), fetch) == ({'uid': 'user'}, True, True)
+    assert cache.get(credentials + ('who-am-i',), fetch) == ({'uid': 'user'}, False, False)
+
+    clock.now += 61
+
+    # Fetched again, but unchanged
+    assert cache.get(credentials + ('who-am-i',), fetch) == ({'uid': 'user'}, True, False)
+    assert len(fetched) == 2
+
+
+def test_refresh_fetches_and_reports_changes(clock):
+    cache = ApiCache()
+    cache.get(credentials + ('news', 'mars'), lambda: {'news': 'old'})
+
+    assert cache.get(credentials + ('news', 'mars'), lambda: {'news': 'new'}, refresh=True) == \
+        ({'news': 'new'}, True, True)
+    assert cache.get(credentials + ('news', 'mars'), lambda: {'news': 'newer'})[0] == {'news': 'new'}
+
+
+def test_zero_ttl_disables_caching(clock):
+    cache = ApiCache(ttl=0)
+    fetched = []
+
+    for _ in range(2):
+        cache.get(credentials + ('who-am-i',), lambda: fetched.append(1))
+
+    assert len(fetched) == 2
+
+
+def test_invalidate_only_drops_the_entries_of_the_credentials(clock):
+    cache = ApiCache()
+    other = ('https://api.ecmwf.int/v1', 'other@example.com', 'key')
+
+    cache.get(credentials + ('who-am-i',), lambda: 'user')
+    cache.get(credentials + ('news', 'mars'), lambda: 'news')
+    cache.get(other + ('who-am-i',), lambda: 'other')
+
+    cache.invalidate(*credentials)
+
+    assert cache.get(credentials + ('who-am-i',), lambda: 'user')[1]
+    assert cache.get(credentials + ('news', 'mars'), lambda: 'news')[1]
+    assert not cache.get(other + ('who-am-i',), lambda: 'other')[1]
+
+    cache.clear()
+    assert cache.get(other + ('who-am-i',), lambda: 'other')[1]
+
+
+def test_connections_with_the_same_credentials_share_the_lookups(monkeypatch):
+    requests = []
+    messages = []
+
+    def api_request(self, url, request_type='GET', payload=None):
+        requests.append(url)
+
+        if url.endswith('who-am-i'):
+            return {}, {'full_name': 'User', 'uid': 'user'}
+
+        return {}, {'news': 'Maintenance on Monday'}
+
+    monkeypatch.setattr(ApiConnection, '_api_request', api_request)
+    api_cache.clear()
+
+    try:
+        connections = [ApiConnection(credentials[0], 'datasets/interim', credentials[1], credentials[2],
+                                     lambda message, level, request_id=None: messages.append(message))
+                       for _ in range(2)]
+
+        assert len(requests) == 2
+        assert [connection.cache_status for connection in connections] == ['miss', 'hit']
+
+        # The news is only reported when it is first retrieved
+        assert messages.count("News: Maintenance on Monday") == 1
+
+        ApiConnection(credentials[0], 'datasets/interim', credentials[1], credentials[2],
+                      lambda message, level, request_id=None: None, refresh_cache=True)
+        assert len(requests) == 4
+
+    finally:
+        api_cache.clear()
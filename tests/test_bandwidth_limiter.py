@@ -0,0 +1,113 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+import time
+
+import pytest
+
+from ecmwfapi.bandwidth_limiter import BandwidthLimiter, BandwidthLimiterError, parse_schedule
+
+
+def test_unlimited_rate_never_delays():
+    limiter = BandwidthLimiter(rate=0)
+
+    with limiter.transfer() as share:
+        assert share.acquire(10 ** 9) == 0
+        assert share.try_acquire(10 ** 9) == 0
+
+
+def test_try_acquire_skips_a_share_in_debt_without_taking_tokens():
+    limiter = BandwidthLimiter(rate=1000)
+
+    with limiter.transfer() as share:
+        # The first block is admitted on credit
+        assert share.try_acquire(500) == 0
+
+        delay = share.try_acquire(500)
+        assert 0.4 < delay <= 0.5
+        assert share.bytes == 500
+        assert share.blocked_since is not None
+
+
+def test_rate_is_shared_by_weight():
+    limiter = BandwidthLimiter(rate=1000)
+
+    with limiter.transfer(1) as light, limiter.transfer(3) as heavy:
+        light.try_acquire(250)
+        heavy.try_acquire(250)
+
+        # The light share gets 250 bytes per second, the heavy share 750
+        assert light.try_acquire(1) == pytest.approx(1.0, rel=0.05)
+        assert heavy.try_acquire(1) == pytest.approx(1 / 3.0, rel=0.05)
+
+
+def test_closed_shares_leave_their_bandwidth_to_the_others():
+    limiter = BandwidthLimiter(rate=1000)
+
+    with limiter.transfer() as share:
+        other = limiter.transfer()
+        other.close()
+
+        share.try_acquire(500)
+        assert share.try_acquire(1) == pytest.approx(0.5, rel=0.05)
+
+    assert limiter.get_statistics()['transfers'] == 0
+
+
+def test_idle_shares_leave_their_bandwidth_to_the_active_shares():
+    limiter = BandwidthLimiter(rate=1000, idle=0.2)
+
+    with limiter.transfer() as active, limiter.transfer() as idle:
+        active.try_acquire(500)
+
+        # The idle share has not drawn tokens, so the active share gets the full rate
+        assert active.try_acquire(1) == pytest.approx(0.5, rel=0.05)
+        assert limiter.get_statistics()['active_transfers'] == 1
+
+        # Once both draw tokens, they split the rate
+        idle.try_acquire(250)
+        assert idle.try_acquire(1) == pytest.approx(0.5, rel=0.05)
+        assert limiter.get_statistics()['active_transfers'] == 2
+
+        # The share counts while it waits for its debt, and for the idle time after
+        time.sleep(0.8)
+        active.try_acquire(1)
+        assert limiter.get_statistics()['active_transfers'] == 1
+
+
+def test_schedule_windows():
+    schedule = parse_schedule('08:00-18:00=100, 22:00-02:00=50')
+    assert schedule == [[480, 1080, 100], [1320, 120, 50]]
+
+    limiter = BandwidthLimiter(rate=10, schedule=schedule)
+
+    def at(hour):
+        return time.mktime(time.localtime()[:3] + (hour, 30, 0, 0, 0, -1))
+
+    assert [limiter.current_rate(at(hour)) for hour in (10, 20, 23, 1)] == [100, 10, 50, 50]
+
+    with pytest.raises(BandwidthLimiterError):
+        parse_schedule('08:00=100')
+
+    with pytest.raises(BandwidthLimiterError):
+        parse_schedule('25:00-26:00=100')
+
+
+def test_invalid_settings_are_rejected():
+    with pytest.raises(BandwidthLimiterError):
+        BandwidthLimiter(rate=-1)
+
+    with pytest.raises(BandwidthLimiterError):
+        BandwidthLimiter(burst=0)
+
+    with pytest.raises(BandwidthLimiterError):
+        BandwidthLimiter().transfer(0)
@@ -0,0 +1,154 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+import threading
+
+import pytest
+
+from ecmwfapi.custom_http import BlockScheduler, CustomHttpError
+from ecmwfapi.transfer_control import TransferControl
+
+
+class Recorder:
+    """
+    Fetch function that records the order in which blocks are fetched. Blocks of the gate transfer wait until the gate
+    is opened, so the other transfers are all registered before the worker selects among them.
+    """
+
+    def __init__(self):
+        self.order = []
+        self.gate = threading.Event()
+
+    def fetch(self, name):
+        def fetch(connection, block_id, block_start, block_end):
+            if name == 'gate':
+                self.gate.wait(5)
+
+            self.order.append((name, block_id))
+            return b'%s-%s' % (name.encode(), str(block_id).encode())
+
+        return fetch
+
+
+def blocks(count, size=100):
+    return [[index, index * size, (index + 1) * size - 1] for index in range(count)]
+
+
+def run(policy, transfers):
+    """
+    :param transfers: list of [name, number of blocks, keyword arguments of add_transfer]
+    :return: order in which the blocks were fetched, after the gate
+    """
+
+    scheduler = BlockScheduler(workers=1, policy=policy)
+    recorder = Recorder()
+
+    # The gate is selected first by every policy: it has the smallest block and the highest priority
+    gate = scheduler.add_transfer(blocks(1, 1), recorder.fetch('gate'), object, priority=100)
+    registered = [[name, count, scheduler.add_transfer(blocks(count), recorder.fetch(name), object, **options)]
+                  for [name, count, options] in transfers]
+    recorder.gate.set()
+
+    gate.get(0)
+    gate.close()
+
+    for [name, count, transfer] in registered:
+        with transfer:
+            assert [transfer.get(block_id) for block_id in range(count)] == \
+                [b'%s-%s' % (name.encode(), str(block_id).encode()) for block_id in range(count)]
+
+    assert recorder.order[0] == ('gate', 0)
+
+    return [name for [name, _] in recorder.order[1:]]
+
+
+def test_shortest_remaining_serves_small_downloads_first():
+    assert run('shortest_remaining', [['large', 3, {}], ['small', 1, {}]]) == ['small', 'large', 'large', 'large']
+
+
+def test_priority_policy_serves_high_priority_downloads_first():
+    assert run('priority', [['low', 1, {'priority': 0}], ['high', 2, {'priority': 5}]]) == ['high', 'high', 'low']
+
+
+def test_fair_share_alternates_by_weight():
+    order = run('fair_share', [['light', 3, {'weight': 1}], ['heavy', 6, {'weight': 2}]])
+
+    assert order[:3].count('heavy') == 2
+    assert sorted(order) == ['heavy'] * 6 + ['light'] * 3
+
+
+def test_throttled_downloads_are_skipped():
+    scheduler = BlockScheduler(workers=1)
+    recorder = Recorder()
+    recorder.gate.set()
+
+    throttled = scheduler.add_transfer(blocks(1), recorder.fetch('throttled'), object, admit=lambda size: 60)
+    with scheduler.add_transfer(blocks(2), recorder.fetch('free'), object) as free:
+        free.get(0)
+        free.get(1)
+
+    throttled.close()
+    assert recorder.order == [('free', 0), ('free', 1)]
+
+
+def test_paused_downloads_are_skipped():
+    scheduler = BlockScheduler(workers=1)
+    recorder = Recorder()
+    recorder.gate.set()
+    control = TransferControl()
+    control.pause()
+
+    paused = scheduler.add_transfer(blocks(1), recorder.fetch('paused'), object, control=control)
+    with scheduler.add_transfer(blocks(1), recorder.fetch('free'), object) as free:
+        free.get(0)
+
+    assert recorder.order == [('free', 0)]
+
+    control.resume()
+    with paused:
+        assert paused.get(0) == b'paused-0'
+
+
+def test_fetch_errors_are_raised_by_get():
+    def fetch(connection, block_id, block_start, block_end):
+        raise CustomHttpError("Failed block %s" % block_id)
+
+    with BlockScheduler(workers=1).add_transfer(blocks(1), fetch, object) as transfer:
+        with pytest.raises(CustomHttpError):
+            transfer.get(0)
+
+
+def test_connections_are_reused_per_key_and_bounded():
+    scheduler = BlockScheduler(workers=1)
+    scheduler.connections_per_worker = 1
+    created = []
+
+    def connect():
+        created.append(object())
+        return created[-1]
+
+    def fetch(connection, block_id, block_start, block_end):
+        return connection
+
+    for key in ('a', 'a', 'b'):
+        with scheduler.add_transfer(blocks(2), fetch, connect, connection_key=key) as transfer:
+            assert transfer.get(0) is transfer.get(1)
+
+    assert len(created) == 2
+
+
+def test_invalid_settings_are_rejected():
+    with pytest.raises(CustomHttpError):
+        BlockScheduler(workers=0)
+
+    with pytest.raises(CustomHttpError):
+        BlockScheduler(policy='random')
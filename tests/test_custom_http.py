@@ -0,0 +1,161 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+import base64
+import hashlib
+import importlib
+import os
+
+import pytest
+
+from ecmwfapi import custom_http
+from ecmwfapi.custom_http import CustomHttpError, IntegrityError
+from ecmwfapi.file_writer import FileWriter
+
+
+data = os.urandom(10000)
+
+
+class Response(dict):
+
+    def __init__(self, status, headers):
+        dict.__init__(self, headers)
+        self.status = status
+
+
+class FakeHttp:
+    """
+    HTTP handle serving data with range requests. Blocks starting at the corrupt offsets are corrupted the first time
+    they are sent, and every response is cut short if truncate is set.
+    """
+
+    def __init__(self, corrupt=(), truncate=False, block_digests=False, status=206, file_digest=True):
+        self.corrupt = set(corrupt)
+        self.truncate = truncate
+        self.block_digests = block_digests
+        self.file_digest = file_digest
+        self.status = status
+        self.requests = []
+
+    def request(self, url, method, body, headers):
+        if method == 'HEAD':
+            headers = {'content-length': str(len(data))}
+
+            if self.file_digest:
+                headers['etag'] = '"%s"' % hashlib.md5(data).hexdigest()
+
+            return Response(200, headers), b''
+
+        [start, end] = [int(value) for value in headers['Range'][len('bytes='):].split('-')]
+        self.requests.append(start)
+
+        content = data[start:end + 1]
+        response_headers = {'content-range': 'bytes %s-%s/%s' % (start, end, len(data))}
+
+        if self.block_digests:
+            response_headers['digest'] = 'md5=' + base64.b64encode(hashlib.md5(content).digest()).decode()
+
+        if start in self.corrupt:
+            self.corrupt.discard(start)
+            content = bytes([content[0] ^ 1]) + content[1:]
+
+        if self.truncate:
+            content = content[:-1]
+
+        return Response(self.status, response_headers), content
+
+
+def download(tmp_path, http, mode='w+b', block_size=1024):
+    path = str(tmp_path / 'result')
+    writer = FileWriter(open(path, mode))
+
+    try:
+        custom_http.robust_get_file('http://server/result', writer, block_size=block_size, http_handle=http,
+                                    log=lambda message, level: None)
+        writer.close()
+
+    finally:
+        writer.abort()
+
+    return open(path, 'rb').read()
+
+
+def test_download_is_verified(tmp_path):
+    http = FakeHttp()
+
+    assert download(tmp_path, http) == data
+    assert len(http.requests) == 10
+
+
+def test_corrupt_block_is_fetched_again_and_rewritten(tmp_path):
+    http = FakeHttp(corrupt=[2048])
+
+    assert download(tmp_path, http) == data
+
+    # All blocks are fetched once more to find the block that changed, the file is not downloaded from scratch
+    assert len(http.requests) == 20
+
+
+def test_blocks_verified_by_their_digest_are_not_fetched_again(tmp_path):
+    http = FakeHttp(corrupt=[2048], block_digests=True)
+
+    assert download(tmp_path, http) == data
+    assert http.requests.count(2048) == 2
+    assert len(http.requests) == 11
+
+
+def test_blocks_are_only_recorded_if_there_is_a_file_digest_to_compare_with():
+    file_digest_class = importlib.import_module('ecmwfapi.custom_http.custom_http')._FileDigest
+
+    for expected in (None, ['md5', hashlib.md5(data).hexdigest()]):
+        file_digest = file_digest_class(expected)
+        file_digest.update(data[:5000], 0)
+        file_digest.update(data[5000:], 5000, True)
+
+        assert file_digest.hash.hexdigest() == hashlib.md5(data).hexdigest()
+        assert file_digest.blocks == ([] if expected is None else [[0, 4999, False], [5000, 9999, True]])
+
+
+def test_corrupt_blocks_without_a_file_digest_are_not_detected(tmp_path):
+    http = FakeHttp(corrupt=[2048], file_digest=False)
+
+    assert download(tmp_path, http) != data
+    assert len(http.requests) == 10
+
+
+def test_digest_mismatch_is_raised_if_the_file_can_not_be_rewritten(tmp_path):
+    with pytest.raises(IntegrityError):
+        download(tmp_path, FakeHttp(corrupt=[0]), mode='wb')
+
+
+def test_invalid_blocks_have_their_own_retry_budget(tmp_path):
+    http = FakeHttp(truncate=True)
+
+    with pytest.raises(IntegrityError):
+        download(tmp_path, http)
+
+    assert len(http.requests) == 3
+
+
+def test_server_errors_are_retried_as_transport_errors(tmp_path):
+    http = FakeHttp(status=500)
+
+    with pytest.raises(CustomHttpError) as error:
+        download(tmp_path, http)
+
+    assert not isinstance(error.value, IntegrityError)
+    assert len(http.requests) == 7
+
+
+def test_invalid_block_size_is_rejected(tmp_path):
+    with pytest.raises(CustomHttpError):
+        download(tmp_path, FakeHttp(), block_size=100)
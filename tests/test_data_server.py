@@ -0,0 +1,158 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+import threading
+import time
+
+import pytest
+
+from background_client.task_registry import TaskRecord, TaskRegistry
+from background_client.task_scheduler import TaskScheduler
+from background_client.transfer_handler import transfer_handler
+from ecmwfapi import ECMWFDataServer
+from ecmwfapi.bandwidth_limiter import bandwidth_limiter
+from ecmwfapi.transfer_control import TransferControl
+
+
+class Log:
+
+    def __init__(self):
+        self.messages = []
+
+    def info(self, message):
+        self.messages.append(message)
+
+    warning = error = info
+
+
+@pytest.fixture
+def credentials(monkeypatch, tmp_path):
+    """
+    Credentials in the environment, without a ~/.ecmwfapirc file
+    """
+
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setenv('ECMWF_API_URL', 'https://api.ecmwf.int/v1')
+    monkeypatch.setenv('ECMWF_API_KEY', 'first')
+    monkeypatch.setenv('ECMWF_API_EMAIL', 'user@example.com')
+
+
+def create_server():
+    return ECMWFDataServer(custom_log=lambda message, level: None, custom_log_level=True)
+
+
+def test_transfer_handler_reuses_one_server(monkeypatch):
+    servers = []
+
+    class Server:
+
+        def __init__(self):
+            self.requests = []
+            self.closed = False
+            servers.append(self)
+
+        def retrieve(self, request, control):
+            self.requests.append(request)
+            return []
+
+        def close(self):
+            self.closed = True
+
+    monkeypatch.setattr(transfer_handler, 'ECMWFDataServer', Server)
+
+    registry = TaskRegistry()
+    scheduler = TaskScheduler()
+    handler = transfer_handler.TransferHandler(Log(), registry, scheduler)
+
+    for task_id in ('a', 'b'):
+        registry.add(TaskRecord(task_id, {'dataset': task_id}, TransferControl(), 'alice', 0))
+        scheduler.put(task_id)
+
+    handler.poll_interval = 0.01
+    handler.start()
+
+    while registry.count(completed=True) < 2:
+        time.sleep(0.01)
+
+    handler.retire()
+    handler.join()
+
+    assert len(servers) == 1
+    assert servers[0].requests == [{'dataset': 'a'}, {'dataset': 'b'}]
+    assert servers[0].closed
+    assert [registry.get(task_id).task_status for task_id in ('a', 'b')] == ['completed', 'completed']
+
+
+def test_settings_are_only_reloaded_when_their_sources_change(credentials, monkeypatch):
+    server = create_server()
+    loads = []
+    load_settings = server._load_settings
+    monkeypatch.setattr(server, '_load_settings', lambda: loads.append(1) or load_settings())
+
+    assert not server.refresh()
+    assert loads == []
+
+    monkeypatch.setenv('ECMWF_API_KEY', 'second')
+
+    assert server.refresh()
+    assert server.api_key == 'second'
+    assert not server.refresh()
+    assert len(loads) == 1
+
+    # Forced reloads, for example after an authentication error, report whether the credentials changed
+    assert not server.refresh(True)
+    assert len(loads) == 2
+
+
+def test_shared_components_are_only_configured_when_the_configuration_changes(credentials, monkeypatch):
+    configured = []
+    monkeypatch.setattr(bandwidth_limiter, 'configure', lambda *arguments: configured.append(arguments))
+    monkeypatch.setattr(ECMWFDataServer, '_global_settings_signature', None)
+
+    server = create_server()
+    assert len(configured) == 1
+
+    # Other servers and reloads of the credentials leave the shared components alone
+    create_server()
+    monkeypatch.setenv('ECMWF_API_KEY', 'second')
+    assert server.refresh()
+    assert server.refresh(True) is False
+    assert len(configured) == 1
+
+    # A changed configuration file is applied again
+    monkeypatch.setattr(ECMWFDataServer, '_global_settings_signature', 0)
+    server.refresh(True)
+    assert len(configured) == 2
+
+
+def test_http_handles_are_kept_per_thread(credentials):
+    server = create_server()
+    handle = server._get_http_handle()
+    handles = []
+
+    thread = threading.Thread(target=lambda: handles.append(server._get_http_handle()))
+    thread.start()
+    thread.join()
+
+    assert server._get_http_handle() is handle
+    assert handles[0] is not handle
+
+
+def test_failed_reloads_keep_the_current_settings(credentials, monkeypatch):
+    server = create_server()
+
+    for name in ('ECMWF_API_URL', 'ECMWF_API_KEY', 'ECMWF_API_EMAIL'):
+        monkeypatch.delenv(name)
+
+    server._refresh_settings()
+
+    assert server.api_key == 'first'
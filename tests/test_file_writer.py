@@ -0,0 +1,153 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+import gzip
+import os
+
+import pytest
+
+from ecmwfapi.file_writer import FileWriter, FileWriterError, MultiWriter, compressed_path, suffixes
+
+
+data = os.urandom(100000)
+
+
+def write_chunks(writer, content, size=7001):
+    for start in range(0, len(content), size):
+        writer.write(content[start:start + size])
+
+
+def test_chunks_of_any_size_are_written_in_order(tmp_path):
+    path = str(tmp_path / 'result')
+
+    writer = FileWriter(open(path, 'wb'), buffer_size=4096)
+    write_chunks(writer, data)
+    writer.write(data[:10000])
+    assert writer.tell() == len(data) + 10000
+    writer.close()
+
+    assert open(path, 'rb').read() == data + data[:10000]
+    assert writer.file_bytes == writer.bytes_written == len(data) + 10000
+
+
+def test_preallocated_file_is_truncated_to_its_size(tmp_path):
+    path = str(tmp_path / 'result')
+
+    writer = FileWriter(open(path, 'wb'), preallocate=True, size=len(data) * 2, fsync='close')
+    writer.write(data)
+    writer.close()
+
+    assert os.path.getsize(path) == len(data)
+
+
+def test_compressed_writing(tmp_path):
+    path = str(tmp_path / 'result.gz')
+
+    writer = FileWriter(open(path, 'wb'), buffer_size=4096, compression='gzip', compression_level=1)
+    write_chunks(writer, data)
+    writer.close()
+
+    assert gzip.open(path).read() == data
+    assert writer.file_bytes == os.path.getsize(path)
+    assert writer.compression_ratio() == len(data) / float(writer.file_bytes)
+
+
+def test_compressed_path_appends_the_suffix_once():
+    assert compressed_path('out.grib', 'gzip') == 'out.grib.gz'
+    assert compressed_path('out.grib.gz', 'gzip') == 'out.grib.gz'
+    assert compressed_path('out.grib', 'lzma') == 'out.grib.xz'
+    assert compressed_path('out.grib', None) == 'out.grib'
+    assert set(suffixes) >= {'gzip', 'bz2', 'lzma'}
+
+    with pytest.raises(FileWriterError):
+        compressed_path('out.grib', 'rar')
+
+
+def test_rewrite_and_read_range(tmp_path):
+    path = str(tmp_path / 'result')
+
+    writer = FileWriter(open(path, 'w+b'))
+    writer.write(data)
+    assert writer.rewritable
+
+    writer.rewrite(1000, b'x' * 100)
+    assert writer.read_range(990, 20) == data[990:1000] + b'x' * 10
+    writer.write(b'tail')
+    writer.close()
+
+    assert open(path, 'rb').read() == data[:1000] + b'x' * 100 + data[1100:] + b'tail'
+
+
+def test_compressed_and_write_only_files_are_not_rewritable(tmp_path):
+    write_only = FileWriter(open(str(tmp_path / 'a'), 'wb'))
+    compressed = FileWriter(open(str(tmp_path / 'b'), 'w+b'), compression='gzip')
+
+    for writer in (write_only, compressed):
+        assert not writer.rewritable
+
+        with pytest.raises(FileWriterError):
+            writer.rewrite(0, b'x')
+
+        writer.abort()
+
+
+def test_multi_writer_writes_every_target(tmp_path):
+    paths = [str(tmp_path / name) for name in ('a', 'b')]
+
+    writer = MultiWriter([FileWriter(open(path, 'w+b'), buffer_size=4096) for path in paths], paths)
+    write_chunks(writer, data)
+    assert writer.rewritable
+    writer.rewrite(0, b'head')
+    writer.close()
+
+    for path in paths:
+        assert open(path, 'rb').read() == b'head' + data[4:]
+
+    assert [item['name'] for item in writer.get_statistics()] == paths
+
+
+def test_data_is_compressed_once_for_multiple_targets(tmp_path):
+    paths = [str(tmp_path / name) for name in ('a.gz', 'b.gz')]
+    files = [FileWriter(open(path, 'w+b')) for path in paths]
+
+    writer = FileWriter(MultiWriter(files, paths), compression='gzip')
+    write_chunks(writer, data)
+    writer.close()
+
+    for [path, file] in zip(paths, files):
+        assert gzip.open(path).read() == data
+        assert file.file_bytes == writer.file_bytes
+        assert file.compression_duration == 0
+
+
+def test_abort_closes_all_targets(tmp_path):
+    files = [FileWriter(open(str(tmp_path / name), 'wb')) for name in ('a', 'b')]
+
+    writer = FileWriter(MultiWriter(files), compression='bz2')
+    writer.write(data)
+    writer.abort()
+
+    assert all(file.closed for file in files)
+
+    with pytest.raises(FileWriterError):
+        writer.write(data)
+
+
+def test_invalid_options_are_rejected():
+    with pytest.raises(FileWriterError):
+        FileWriter.check_options(buffer_size=1)
+
+    with pytest.raises(FileWriterError):
+        FileWriter.check_options(fsync='sometimes')
+
+    with pytest.raises(FileWriterError):
+        FileWriter.check_options(compression='gzip', compression_level=42)
@@ -0,0 +1,99 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+import os
+import threading
+import time
+
+import pytest
+
+from ecmwfapi.host_coordinator import HostCoordinator, HostCoordinatorError
+from ecmwfapi.host_coordinator.host_coordinator import fcntl
+from ecmwfapi.transfer_control import TransferCancelledError, TransferControl
+
+
+credentials = ('https://api.ecmwf.int/v1', 'user@example.com', 'key')
+
+
+def test_nothing_is_coordinated_without_limits(tmp_path):
+    directory = tmp_path / 'coordination'
+    coordinator = HostCoordinator(str(directory))
+
+    with coordinator.acquire(credentials) as slot:
+        assert slot.waited == 0
+
+    assert not directory.exists()
+
+
+def test_requests_wait_for_a_free_slot(tmp_path):
+    coordinator = HostCoordinator(str(tmp_path), max_requests=1, poll_interval=0.05)
+    first = coordinator.acquire(credentials)
+
+    assert coordinator.in_flight(credentials) == 1
+    assert coordinator.get_statistics()['held_slots'] == 1
+
+    threading.Timer(0.2, first.release).start()
+
+    with coordinator.acquire(credentials) as second:
+        assert second.waited >= 0.1
+
+    assert coordinator.in_flight(credentials) == 0
+
+
+@pytest.mark.skipif(fcntl is None, reason="slots are only shared between processes with file locking")
+def test_slots_locked_by_other_processes_are_not_taken(tmp_path):
+    coordinator = HostCoordinator(str(tmp_path), max_requests=1, poll_interval=0.05)
+
+    # A separate open file description holds the lock like another process would
+    path = os.path.join(coordinator._get_directory(credentials), 'slot-0')
+    file = os.open(path, os.O_RDWR | os.O_CREAT)
+    fcntl.flock(file, fcntl.LOCK_EX)
+
+    try:
+        assert coordinator.in_flight(credentials) == 1
+
+        control = TransferControl()
+        threading.Timer(0.2, control.cancel).start()
+
+        with pytest.raises(TransferCancelledError):
+            coordinator.acquire(credentials, control)
+
+    finally:
+        os.close(file)
+
+    assert coordinator.get_statistics()['held_slots'] == 0
+
+
+def test_submissions_are_rate_limited(tmp_path):
+    coordinator = HostCoordinator(str(tmp_path), submission_rate=600, poll_interval=0.05)
+
+    start = time.time()
+    coordinator.acquire(credentials).release()
+    coordinator.acquire(credentials).release()
+
+    assert time.time() - start >= 0.05
+
+
+def test_unusable_directory_raises(tmp_path):
+    parent = tmp_path / 'file'
+    parent.write_text('')
+
+    with pytest.raises(HostCoordinatorError):
+        HostCoordinator(str(parent / 'coordination'), max_requests=1).acquire(credentials)
+
+
+def test_invalid_settings_are_rejected(tmp_path):
+    with pytest.raises(HostCoordinatorError):
+        HostCoordinator(str(tmp_path), max_requests=-1)
+
+    with pytest.raises(HostCoordinatorError):
+        HostCoordinator(str(tmp_path), submission_burst=0)
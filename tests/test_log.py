@@ -0,0 +1,125 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+import json
+import logging
+import threading
+import time
+
+import pytest
+
+from ecmwfapi.log import Log, LogError
+
+
+class BlockedLog(Log):
+    """
+    Log of which the writer thread waits for the release event before it outputs a message
+    """
+
+    def __init__(self, **options):
+        Log.__init__(self, **options)
+        self.release = threading.Event()
+        self.written = []
+
+    def _write(self, record):
+        self.release.wait(5)
+        self.written.append(record[2])
+
+
+def test_messages_are_output_by_the_writer_thread(capsys):
+    log = Log(output_format='json')
+    log.info("first")
+    log.error("second")
+
+    assert log._writer is not None and log._writer is not threading.current_thread()
+    log.close()
+    assert log._writer is None
+
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [[line['level'], line['message']] for line in lines] == [['info', 'first'], ['error', 'second']]
+
+
+def test_synchronous_log_outputs_immediately(capsys):
+    log = Log(asynchronous=False)
+    log.warning("now")
+
+    assert log._writer is None
+    assert '[Warning]' in capsys.readouterr().out
+
+
+def test_messages_are_dropped_when_the_queue_is_full():
+    log = BlockedLog(queue_size=1, repeat_interval=0)
+
+    log.info("written")
+    while log._queue.qsize() > 0:
+        time.sleep(0.001)
+
+    # The writer waits on the first message, the second fills the queue and the third is dropped
+    log.info("queued")
+    log.info("dropped")
+    assert log._dropped == 1
+
+    log.release.set()
+    log.close()
+
+    assert log.written == ["written", "1 log messages were dropped", "queued"]
+
+    # Dropped messages are still retained in the history
+    assert log.get_info_messages() == ["written", "queued", "dropped"]
+
+
+def test_repeated_messages_are_suppressed_and_counted():
+    log = BlockedLog(repeat_interval=10)
+    log.release.set()
+
+    for _ in range(3):
+        log.warning("retrying")
+    log.info("retrying")
+
+    # Once the interval passed, the next repetition reports the number of suppressed messages
+    log._recent[('warning', "retrying")][0] -= 10
+    log.warning("retrying")
+    log.close()
+
+    assert log.written == ["retrying", "retrying", "Previous message repeated 2 times: retrying", "retrying"]
+
+
+def test_history_keeps_the_most_recent_messages():
+    log = Log(history_size=2, asynchronous=False, display_info_messages=False)
+
+    for index in range(3):
+        log.info(str(index))
+
+    assert log.get_info_messages() == ['1', '2']
+
+    log.set_history_size(1)
+    assert log.get_info_messages() == ['2']
+
+    with pytest.raises(LogError):
+        log.set_history_size(-1)
+
+
+def test_messages_are_forwarded_to_the_standard_logger(caplog):
+    log = Log(output_format='logging', asynchronous=False, logger_name='ecmwfapi.test')
+
+    with caplog.at_level(logging.INFO, logger='ecmwfapi.test'):
+        log.error("failed")
+
+    assert [(record.levelno, record.getMessage()) for record in caplog.records] == [(logging.ERROR, "failed")]
+
+
+def test_invalid_settings_are_rejected():
+    with pytest.raises(LogError):
+        Log(output_format='xml')
+
+    with pytest.raises(LogError):
+        Log(queue_size=0)
@@ -0,0 +1,128 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+import gc
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from ecmwfapi.metrics import MetricsError, MetricsRegistry, MetricsServer
+
+
+def run_threads(count, function):
+    threads = [threading.Thread(target=function) for _ in range(count)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_counter_sums_the_cells_of_all_threads():
+    counter = MetricsRegistry().counter('events_total', "Events")
+
+    def increment():
+        for _ in range(1000):
+            counter.inc()
+
+    run_threads(8, increment)
+    counter.inc(5)
+
+    assert counter.get() == 8005
+
+
+def test_cells_of_exited_threads_are_folded_into_the_base_cell():
+    counter = MetricsRegistry().counter('events_total', "Events")
+
+    run_threads(20, lambda: counter.inc(2))
+    gc.collect()
+
+    assert counter.get() == 40
+    assert len(counter._cells.cells) == 0
+
+
+def test_histogram_counts_cumulative_buckets():
+    histogram = MetricsRegistry().histogram('duration_seconds', "Durations", buckets=[1, 10])
+
+    for value in (0.5, 1, 5, 100):
+        histogram.observe(value)
+
+    samples = {(suffix, tuple(labels)): value for [suffix, labels, value] in histogram.collect()}
+
+    assert samples[('_bucket', (('le', '1'),))] == 2
+    assert samples[('_bucket', (('le', '10'),))] == 3
+    assert samples[('_bucket', (('le', '+Inf'),))] == 4
+    assert samples[('_sum', ())] == 106.5
+    assert samples[('_count', ())] == 4
+
+
+def test_render_uses_the_prometheus_text_format():
+    registry = MetricsRegistry()
+    registry.counter('requests_total', "Requests by status", ('status',)).labels('ok').inc(3)
+    registry.gauge('queued', "Queued tasks", function=lambda: 7)
+    registry.gauge('workers', "Workers by pool", ('pool',), function=lambda: {('transfer',): 2})
+    registry.counter('escaped_total', "Escaped", ('path',)).labels('a"b\\c\n').inc()
+
+    assert registry.render().split('\n') == [
+        '# HELP escaped_total Escaped',
+        '# TYPE escaped_total counter',
+        'escaped_total{path="a\\"b\\\\c\\n"} 1',
+        '# HELP queued Queued tasks',
+        '# TYPE queued gauge',
+        'queued 7',
+        '# HELP requests_total Requests by status',
+        '# TYPE requests_total counter',
+        'requests_total{status="ok"} 3',
+        '# HELP workers Workers by pool',
+        '# TYPE workers gauge',
+        'workers{pool="transfer"} 2',
+        '',
+    ]
+
+
+def test_registering_a_name_again_returns_the_same_metric():
+    registry = MetricsRegistry()
+    counter = registry.counter('events_total', "Events", ('kind',))
+
+    assert registry.counter('events_total', "Events", ('kind',)) is counter
+    assert registry.get('events_total') is counter
+
+    with pytest.raises(MetricsError):
+        registry.gauge('events_total', "Events")
+
+    with pytest.raises(MetricsError):
+        registry.counter('invalid name', "Invalid")
+
+    with pytest.raises(MetricsError):
+        counter.labels('a', 'b')
+
+
+def test_server_serves_the_metrics():
+    registry = MetricsRegistry()
+    registry.counter('events_total', "Events").inc()
+
+    server = MetricsServer(registry, port=0)
+    server.start()
+
+    try:
+        url = 'http://127.0.0.1:%s' % server._server.server_address[1]
+        body = urllib.request.urlopen(url + '/metrics', timeout=5).read().decode()
+
+        assert 'events_total 1\n' in body
+
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + '/other', timeout=5)
+
+    finally:
+        server.stop()
@@ -0,0 +1,111 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+import os
+
+import pytest
+
+from benchmarks.mock_s3_server import MockS3Server
+from ecmwfapi.object_store import ObjectStoreError, S3Writer
+
+
+part_size = 5242880
+data = os.urandom(2 * part_size + 1000)
+
+
+@pytest.fixture
+def server():
+    server = MockS3Server().start()
+
+    try:
+        yield server
+
+    finally:
+        server.stop()
+
+
+def create_writer(server, tmp_path, key='result', **options):
+    return S3Writer('bucket', key, server.url, server.access_key, server.secret_key, part_size=part_size,
+                    state_directory=str(tmp_path), **options)
+
+
+def upload(writer, content=data, chunk_size=1000003):
+    for start in range(0, len(content), chunk_size):
+        writer.write(content[start:start + chunk_size])
+
+    writer.close()
+
+
+def test_small_objects_are_uploaded_with_one_request(server, tmp_path):
+    writer = create_writer(server, tmp_path)
+    upload(writer, b'small')
+
+    assert server.get_object('bucket', 'result') == b'small'
+    assert writer.upload_id is None
+
+
+def test_large_objects_are_uploaded_in_parts(server, tmp_path):
+    writer = create_writer(server, tmp_path, resume_token='request')
+    upload(writer)
+
+    assert server.get_object('bucket', 'result') == data
+    assert writer.get_statistics()['parts'] == 3
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_upload_of_the_same_request_is_resumed(server, tmp_path):
+    server.fail_after_parts = 1
+    writer = create_writer(server, tmp_path, resume_token='request', upload_threads=1)
+
+    with pytest.raises(ObjectStoreError):
+        upload(writer)
+
+    server.fail_after_parts = None
+    retry = create_writer(server, tmp_path, resume_token='request')
+    upload(retry)
+
+    assert retry.upload_id == writer.upload_id
+    assert retry.resumed_parts >= 1
+    assert server.get_object('bucket', 'result') == data
+
+
+def test_upload_of_another_request_is_not_resumed(server, tmp_path):
+    server.fail_after_parts = 1
+    writer = create_writer(server, tmp_path, resume_token='first', upload_threads=1)
+
+    with pytest.raises(ObjectStoreError):
+        upload(writer)
+
+    server.fail_after_parts = None
+    other = create_writer(server, tmp_path, resume_token='second')
+    upload(other)
+
+    assert other.upload_id != writer.upload_id
+    assert other.resumed_parts == 0
+
+
+def test_uploads_started_by_others_are_not_resumed(server, tmp_path):
+    foreign = server.create_upload('bucket', 'result')
+
+    writer = create_writer(server, tmp_path, resume_token='request')
+    upload(writer)
+
+    assert writer.upload_id != foreign
+    assert server.get_object('bucket', 'result') == data
+
+
+def test_invalid_object_urls_are_rejected():
+    with pytest.raises(ObjectStoreError):
+        S3Writer.from_url('s3://bucket', endpoint='http://localhost', access_key='key', secret_key='secret')
+
+    with pytest.raises(ObjectStoreError):
+        S3Writer('bucket', 'key', None, None, None)
@@ -0,0 +1,179 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+import time
+
+import pytest
+
+from background_client.task_registry import TaskRecord, TaskRegistry, TaskRegistryError
+
+
+def add_tasks(registry, *task_ids, owner='alice'):
+    for task_id in task_ids:
+        registry.add(TaskRecord(task_id, {}, None, owner, 0))
+
+
+def ids(records):
+    return [record.task_id for record in records]
+
+
+def test_list_changes_from_zero_lists_all_tasks():
+    registry = TaskRegistry()
+    add_tasks(registry, 'a', 'b')
+
+    changes = registry.list_changes(0)
+
+    assert changes['version'] == registry.version
+    assert not changes['reset']
+    assert ids(changes['added']) == ['a', 'b']
+    assert changes['updated'] == [] and changes['removed'] == []
+
+
+def test_list_changes_separates_added_and_updated_tasks():
+    registry = TaskRegistry()
+    add_tasks(registry, 'a', 'b')
+    version = registry.version
+
+    registry.set_status('a', 'active')
+    add_tasks(registry, 'c')
+
+    changes = registry.list_changes(version)
+
+    assert ids(changes['added']) == ['c']
+    assert ids(changes['updated']) == ['a']
+    assert changes['updated'][0].task_status == 'active'
+    assert registry.list_changes(changes['version'])['added'] == []
+
+
+def test_list_changes_reports_evicted_tasks_as_removed():
+    registry = TaskRegistry(max_completed_tasks=1)
+    add_tasks(registry, 'a', 'b')
+    version = registry.version
+
+    registry.complete('a', 'completed')
+    registry.complete('b', 'failed')
+
+    changes = registry.list_changes(version)
+
+    assert changes['removed'] == ['a']
+    assert ids(changes['updated']) == ['b']
+
+
+def test_list_changes_resets_clients_behind_the_removed_floor():
+    registry = TaskRegistry(max_removed_changes=2)
+    add_tasks(registry, 't0', 't1', 't2', 't3')
+    before_removals = registry.version
+
+    registry.remove('t0')
+    after_first_removal = registry.version
+    registry.remove('t1')
+    registry.remove('t2')
+
+    # The removal of t0 is forgotten, so clients that have not seen it have to reload
+    changes = registry.list_changes(before_removals)
+    assert changes['reset']
+    assert ids(changes['added']) == ['t3']
+    assert changes['removed'] == []
+
+    changes = registry.list_changes(after_first_removal)
+    assert not changes['reset']
+    assert changes['removed'] == ['t1', 't2']
+
+
+def test_list_changes_resets_clients_ahead_of_the_registry():
+    registry = TaskRegistry()
+    add_tasks(registry, 'a')
+
+    changes = registry.list_changes(registry.version + 10)
+
+    assert changes['reset']
+    assert ids(changes['added']) == ['a']
+
+
+def test_list_changes_rejects_invalid_versions():
+    with pytest.raises(TaskRegistryError):
+        TaskRegistry().list_changes(-1)
+
+
+def test_retention_by_count_evicts_the_oldest_completed_tasks():
+    registry = TaskRegistry(max_completed_tasks=2)
+    add_tasks(registry, 'a', 'b', 'c')
+
+    for task_id in ('a', 'b', 'c'):
+        registry.complete(task_id, 'completed')
+
+    assert registry.count(completed=True) == 2
+    assert ids(registry.list(completed=True)[0]) == ['b', 'c']
+
+    with pytest.raises(TaskRegistryError):
+        registry.get('a')
+
+
+def test_retention_by_age_evicts_expired_completed_tasks():
+    registry = TaskRegistry(max_completed_age=60)
+    add_tasks(registry, 'old', 'new', 'active')
+
+    registry.complete('old', 'completed')
+    registry.complete('new', 'completed')
+    registry.get('old').task_completed = time.time() - 120
+
+    registry.evict()
+
+    assert ids(registry.list(completed=True)[0]) == ['new']
+    assert ids(registry.list()[0]) == ['active']
+
+
+def test_list_filters_by_status_and_owner_with_paging():
+    registry = TaskRegistry()
+    add_tasks(registry, 'a1', 'a2', 'a3', owner='alice')
+    add_tasks(registry, 'b1', owner='bob')
+    registry.set_status('a2', 'active')
+
+    assert ids(registry.list(task_owner='alice')[0]) == ['a1', 'a2', 'a3']
+    assert ids(registry.list(task_status='queued', task_owner='alice')[0]) == ['a1', 'a3']
+
+    [page, total] = registry.list(task_owner='alice', offset=1, limit=1)
+    assert ids(page) == ['a2'] and total == 3
+
+
+def test_active_tasks_are_listed_in_the_order_they_were_added():
+    registry = TaskRegistry()
+    add_tasks(registry, 'a', 'b', 'c', 'd')
+    registry.set_status('a', 'active')
+    registry.set_status('c', 'paused')
+    registry.complete('b', 'completed')
+
+    assert ids(registry.list()[0]) == ['a', 'c', 'd']
+    assert registry.list(offset=1, limit=1)[1] == 3
+
+
+def test_completed_tasks_of_an_owner_are_listed_in_the_order_they_completed():
+    registry = TaskRegistry()
+    add_tasks(registry, 'a', 'b', 'c')
+    registry.complete('c', 'completed')
+    registry.complete('a', 'failed')
+    registry.get('a').task_completed = registry.get('c').task_completed + 1
+
+    assert ids(registry.list(completed=True, task_owner='alice')[0]) == ['c', 'a']
+    assert ids(registry.list(completed=True)[0]) == ['c', 'a']
+
+
+def test_completed_tasks_can_not_change_status():
+    registry = TaskRegistry()
+    add_tasks(registry, 'a')
+    registry.complete('a', 'cancelled')
+
+    with pytest.raises(TaskRegistryError):
+        registry.set_status('a', 'active')
+
+    with pytest.raises(TaskRegistryError):
+        registry.complete('a', 'completed')
@@ -0,0 +1,160 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+import queue
+import threading
+import time
+
+import pytest
+
+from background_client.task_scheduler import TaskScheduler, TaskSchedulerError
+
+
+def drain(scheduler):
+    tasks = []
+
+    while not scheduler.empty():
+        tasks.append(scheduler.get(block=False))
+
+    return tasks
+
+
+def test_higher_priority_first_then_insertion_order():
+    scheduler = TaskScheduler()
+    scheduler.put('low', priority=0)
+    scheduler.put('high', priority=5)
+    scheduler.put('low2', priority=0)
+    scheduler.put('high2', priority=5)
+
+    assert drain(scheduler) == ['high', 'high2', 'low', 'low2']
+
+
+def test_round_robin_between_owners():
+    scheduler = TaskScheduler()
+
+    for index in range(3):
+        scheduler.put('a%s' % index, owner='alice')
+    for index in range(3):
+        scheduler.put('b%s' % index, owner='bob')
+
+    assert drain(scheduler) == ['a0', 'b0', 'a1', 'b1', 'a2', 'b2']
+
+
+def test_weighted_round_robin_follows_owner_weights():
+    scheduler = TaskScheduler(owner_weights={'alice': 2})
+
+    for index in range(6):
+        scheduler.put('a%s' % index, owner='alice')
+        scheduler.put('b%s' % index, owner='bob')
+
+    first = [scheduler.get(block=False) for _ in range(6)]
+
+    assert sum(1 for task in first if task.startswith('a')) == 4
+    assert sum(1 for task in first if task.startswith('b')) == 2
+
+
+def test_priority_takes_precedence_over_fair_share():
+    scheduler = TaskScheduler()
+    scheduler.put('a0', owner='alice', priority=1)
+    scheduler.put('a1', owner='alice', priority=1)
+    scheduler.put('b0', owner='bob')
+
+    assert drain(scheduler) == ['a0', 'a1', 'b0']
+
+
+def test_imminent_deadline_goes_first():
+    scheduler = TaskScheduler(deadline_margin=60)
+    scheduler.put('urgent', priority=0, deadline=time.time() + 10)
+    scheduler.put('important', priority=10)
+    scheduler.put('later', priority=0, deadline=time.time() + 3600)
+
+    assert drain(scheduler) == ['urgent', 'important', 'later']
+
+
+def test_earliest_deadline_first_among_imminent_deadlines():
+    scheduler = TaskScheduler(deadline_margin=60)
+    scheduler.put('second', deadline=time.time() + 20)
+    scheduler.put('first', deadline=time.time() + 10)
+
+    assert drain(scheduler) == ['first', 'second']
+
+
+def test_deadline_breaks_ties_within_priority():
+    scheduler = TaskScheduler(deadline_margin=0)
+    scheduler.put('none')
+    scheduler.put('late', deadline=time.time() + 7200)
+    scheduler.put('early', deadline=time.time() + 3600)
+
+    assert drain(scheduler) == ['early', 'late', 'none']
+
+
+def test_set_priority_and_remove():
+    scheduler = TaskScheduler()
+    scheduler.put('a')
+    scheduler.put('b')
+    scheduler.put('c')
+
+    scheduler.set_priority('c', 1)
+    assert scheduler.remove('a')
+    assert not scheduler.remove('a')
+
+    assert drain(scheduler) == ['c', 'b']
+
+    with pytest.raises(TaskSchedulerError):
+        scheduler.set_priority('a', 1)
+
+
+def test_queue_interface_limits():
+    scheduler = TaskScheduler(maxsize=1)
+    scheduler.put('a', owner='alice')
+
+    assert scheduler.full()
+    assert scheduler.owner_qsize('alice') == 1
+
+    with pytest.raises(queue.Full):
+        scheduler.put('b', block=False)
+
+    with pytest.raises(queue.Full):
+        scheduler.put('b', timeout=0.01)
+
+    with pytest.raises(TaskSchedulerError):
+        scheduler.put('a')
+
+    assert scheduler.get(timeout=1) == 'a'
+
+    with pytest.raises(queue.Empty):
+        scheduler.get(timeout=0.01)
+
+    scheduler.task_done()
+
+    with pytest.raises(ValueError):
+        scheduler.task_done()
+
+
+def test_join_waits_until_queued_tasks_are_processed_or_removed():
+    scheduler = TaskScheduler()
+    scheduler.join()
+
+    for task_id in ('a', 'b'):
+        scheduler.put(task_id)
+
+    joined = threading.Event()
+    thread = threading.Thread(target=lambda: (scheduler.join(), joined.set()))
+    thread.start()
+
+    assert scheduler.get() == 'a'
+    scheduler.task_done()
+    assert not joined.wait(0.05)
+
+    assert scheduler.remove('b')
+    assert joined.wait(1)
+    thread.join()
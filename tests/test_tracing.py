@@ -0,0 +1,198 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+import importlib
+import io
+import json
+import os
+import threading
+
+import pytest
+
+from ecmwfapi import custom_http, tracing
+from ecmwfapi.tracing import ChromeTraceExporter, SessionRecorder, TracingError
+
+
+class Hook:
+
+    def __init__(self):
+        self.events = []
+
+    def span_start(self, span):
+        self.events.append(('start', span.name, span.parent_id))
+
+    def span_end(self, span):
+        self.events.append(('end', span.name, span.duration() is not None))
+
+
+@pytest.fixture
+def hook():
+    hook = Hook()
+    tracing.add_hook(hook)
+
+    try:
+        yield hook
+
+    finally:
+        tracing.remove_hook(hook)
+
+
+def test_spans_do_nothing_without_hooks():
+    assert not tracing.tracing_enabled()
+
+    with tracing.span('request', request_id=1) as span:
+        span.set('bytes', 10)
+
+    assert span is tracing.span('other')
+    assert span.duration() is None
+
+
+def test_hooks_receive_nested_spans(hook):
+    assert tracing.tracing_enabled()
+
+    with tracing.span('request') as request:
+        with tracing.span('api_request') as api_request:
+            api_request.set('status', 200)
+
+    assert hook.events == [('start', 'request', None), ('start', 'api_request', request.span_id),
+                           ('end', 'api_request', True), ('end', 'request', True)]
+    assert api_request.attributes == {'status': 200}
+
+
+def test_errors_are_recorded_and_raised(hook):
+    with pytest.raises(ValueError):
+        with tracing.span('request') as span:
+            raise ValueError("failed")
+
+    assert span.attributes['error'] == 'ValueError'
+
+    # The failed span is no longer the parent of new spans
+    with tracing.span('next') as span:
+        assert span.parent_id is None
+
+
+def test_removed_hooks_are_not_called():
+    hook = Hook()
+    tracing.add_hook(hook)
+    tracing.remove_hook(hook)
+
+    with tracing.span('request'):
+        pass
+
+    assert hook.events == []
+
+    with pytest.raises(TracingError):
+        tracing.add_hook(object())
+
+
+def test_chrome_trace_exporter_writes_the_spans(tmp_path):
+    path = str(tmp_path / 'trace.json')
+    exporter = ChromeTraceExporter(path, max_events=1)
+    exporter.start()
+
+    with tracing.span('request', request_id=1):
+        pass
+
+    with tracing.span('dropped'):
+        pass
+
+    exporter.stop()
+
+    events = json.load(open(path))['traceEvents']
+    assert [event['name'] for event in events] == ['request']
+    assert events[0]['ph'] == 'X' and events[0]['args']['request_id'] == 1
+    assert exporter.dropped_events == 1
+
+
+def test_session_recorder_records_the_shape_of_requests():
+    recorder = SessionRecorder(include_payloads=False)
+    recorder.start()
+
+    try:
+        with tracing.span('request', dataset='interim', payload={'param': '2t', 'target': 'out'}):
+            with tracing.span('api_request', method='POST'):
+                pass
+            with tracing.span('poll_wait', status='queued', seconds=5):
+                pass
+            with tracing.span('download') as download:
+                with tracing.span('get_block') as block:
+                    block.set('bytes', 100)
+                download.set('bytes', 100)
+
+    finally:
+        recorder.stop()
+
+    [request] = recorder.get_session()['requests']
+
+    assert request['dataset'] == 'interim' and request['payload'] is None
+    assert request['status'] == 'completed'
+    assert request['retry_after'] == [5]
+    assert [status for [status, _] in request['statuses']] == ['queued', 'complete']
+    assert request['size'] == 100
+    assert [block[1] for block in request['blocks']] == [100]
+
+
+def test_spans_of_other_threads_can_have_an_explicit_parent(hook):
+    with tracing.span('download') as download:
+        parent = tracing.current_span()
+
+        def work():
+            with tracing.span('get_block', parent):
+                pass
+
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+
+    assert parent is download
+    assert ('start', 'get_block', download.span_id) in hook.events
+    assert tracing.current_span() is None
+
+
+def test_blocks_fetched_by_the_block_scheduler_are_recorded_with_their_request(monkeypatch):
+    data = os.urandom(10000)
+
+    class Response(dict):
+        status = 206
+
+    class Http:
+
+        def __init__(self, **options):
+            pass
+
+        def request(self, url, method, body, headers):
+            if method == 'HEAD':
+                return Response({'content-length': str(len(data))}), b''
+
+            [start, end] = [int(value) for value in headers['Range'][len('bytes='):].split('-')]
+
+            return Response({'content-range': 'bytes %s-%s/%s' % (start, end, len(data))}), data[start:end + 1]
+
+    monkeypatch.setattr(importlib.import_module('ecmwfapi.custom_http.custom_http').httplib2, 'Http', Http)
+
+    recorder = SessionRecorder()
+    recorder.start()
+    result = io.BytesIO()
+
+    try:
+        with tracing.span('request', dataset='interim'):
+            with tracing.span('download'):
+                custom_http.robust_get_file_parallel('http://server/result', result, block_size=1024, threads=4,
+                                                     log=lambda message, level: None, verify=False)
+
+    finally:
+        recorder.stop()
+
+    assert result.getvalue() == data
+
+    [request] = recorder.get_session()['requests']
+    assert sorted(block[1] for block in request['blocks']) == [784] + [1024] * 9
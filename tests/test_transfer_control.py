@@ -0,0 +1,196 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+import json
+import queue
+import threading
+import time
+
+import pytest
+
+from background_client.connection_handler import ConnectionHandler, ConnectionHandlerError
+from background_client.task_registry import TaskRegistry
+from background_client.task_scheduler import TaskScheduler
+from ecmwfapi.transfer_control import TransferCancelledError, TransferControl
+
+
+class Log:
+
+    def info(self, message):
+        pass
+
+    warning = error = info
+
+
+class Connection:
+    """
+    Socket connection that receives a single command and keeps the response
+    """
+
+    def __init__(self, command, data):
+        self.message = json.dumps({'command': command, 'data': data})
+        self.response = None
+
+    def get_remote_host(self):
+        return '127.0.0.1'
+
+    def receive(self):
+        return self.message
+
+    def send(self, response):
+        self.response = json.loads(response)
+
+    def close(self):
+        pass
+
+
+def create_handler():
+    registry = TaskRegistry()
+    scheduler = TaskScheduler()
+    handler = ConnectionHandler(Log(), queue.Queue(), ['127.0.0.1'], registry, scheduler, lambda: None)
+
+    return handler, registry, scheduler
+
+
+def start(handler, registry, scheduler):
+    """
+    Add a transfer and take it from the queue like a transfer handler would
+
+    :return: task ID and TransferControl of the active transfer
+    """
+
+    task_id = handler.add_transfer({'target': None})
+    assert scheduler.get(block=False) == task_id
+    registry.set_status(task_id, 'active')
+
+    return task_id, registry.get(task_id).task_control
+
+
+def send(handler, command, data):
+    connection = Connection(command, data)
+    handler.connection_queue.put(connection)
+    handler.connection_queue.put(None)
+    handler.run()
+
+    return connection.response
+
+
+def test_check_blocks_while_paused_and_raises_when_cancelled():
+    control = TransferControl()
+    control.pause()
+    assert control.is_paused()
+
+    checked = threading.Event()
+
+    def check():
+        try:
+            control.check()
+        except TransferCancelledError:
+            pass
+        checked.set()
+
+    threading.Thread(target=check, daemon=True).start()
+    assert not checked.wait(0.1)
+
+    # Cancelling wakes up the paused transfer, so it can stop
+    control.cancel()
+    assert checked.wait(1)
+    assert not control.is_paused()
+
+    control.pause()
+    assert not control.is_paused()
+
+    with pytest.raises(TransferCancelledError):
+        control.check()
+
+
+def test_sleep_returns_early_when_cancelled():
+    control = TransferControl()
+    threading.Timer(0.05, control.cancel).start()
+
+    start_time = time.time()
+    with pytest.raises(TransferCancelledError):
+        control.sleep(5)
+
+    assert time.time() - start_time < 1
+
+
+def test_queued_transfers_are_cancelled_immediately():
+    [handler, registry, scheduler] = create_handler()
+    task_id = handler.add_transfer({'target': None})
+
+    handler.cancel_transfer(task_id)
+
+    assert registry.get(task_id).task_status == 'cancelled'
+    assert scheduler.empty()
+
+
+def test_active_transfers_are_cancelled_through_their_control():
+    [handler, registry, scheduler] = create_handler()
+    [task_id, control] = start(handler, registry, scheduler)
+
+    handler.cancel_transfer(task_id)
+
+    assert control.is_cancelled()
+    assert registry.get(task_id).task_status == 'cancelling'
+
+    with pytest.raises(ConnectionHandlerError):
+        handler.cancel_transfer(task_id)
+
+
+def test_active_transfers_are_paused_and_resumed():
+    [handler, registry, scheduler] = create_handler()
+    [task_id, control] = start(handler, registry, scheduler)
+
+    handler.pause_transfer(task_id)
+    assert control.is_paused()
+    assert registry.get(task_id).task_status == 'paused'
+
+    with pytest.raises(ConnectionHandlerError):
+        handler.pause_transfer(task_id)
+
+    handler.resume_transfer(task_id)
+    assert not control.is_paused()
+    assert registry.get(task_id).task_status == 'active'
+
+    with pytest.raises(ConnectionHandlerError):
+        handler.resume_transfer(task_id)
+
+
+def test_paused_transfers_can_be_cancelled():
+    [handler, registry, scheduler] = create_handler()
+    [task_id, control] = start(handler, registry, scheduler)
+
+    handler.pause_transfer(task_id)
+    handler.cancel_transfer(task_id)
+
+    assert control.is_cancelled() and not control.is_paused()
+    assert registry.get(task_id).task_status == 'cancelling'
+
+
+def test_socket_commands_control_transfers():
+    [handler, registry, scheduler] = create_handler()
+    [task_id, control] = start(handler, registry, scheduler)
+
+    assert send(handler, 'pause_transfer', {'task_id': task_id})['status'] == 'ok'
+    assert control.is_paused()
+
+    assert send(handler, 'pause_transfer', {'task_id': task_id})['status'] == 'error'
+
+    assert send(handler, 'resume_transfer', {'task_id': task_id})['status'] == 'ok'
+    assert not control.is_paused()
+
+    assert send(handler, 'cancel_transfer', {'task_id': task_id})['status'] == 'ok'
+    assert control.is_cancelled()
+
+    assert send(handler, 'cancel_transfer', {})['status'] == 'error'
+    assert send(handler, 'resume_transfer', {'task_id': 'unknown'})['status'] == 'error'
@@ -0,0 +1,95 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+import csv
+import json
+
+import pytest
+
+from ecmwfapi.transfer_statistics import TransferStatistics, TransferStatisticsError, write_statistics
+
+
+def create_statistics(request_id=1):
+    stats = TransferStatistics(request_id, 'interim', ['a', 'b'])
+    stats.submit_time = 100.0
+    stats.active_time = 160.0
+    stats.complete_time = 200.0
+    stats.download_start_time = 200.0
+    stats.download_end_time = 210.0
+    stats.bytes = 1000
+
+    for latency in (0.1, 0.2, 0.3, 0.4):
+        stats.add_block(latency, 250)
+
+    stats.finish('completed')
+
+    return stats
+
+
+def test_durations_throughput_and_percentiles():
+    record = create_statistics().to_dict()
+
+    assert list(record) == list(TransferStatistics.fields)
+    assert record['queue_duration'] == 60
+    assert record['active_duration'] == 40
+    assert record['download_duration'] == 10
+    assert record['average_throughput'] == 100
+    assert record['peak_throughput'] == 2500
+    assert record['block_count'] == 4
+    assert [record['block_latency_p50'], record['block_latency_p95']] == [0.2, 0.4]
+
+
+def test_empty_statistics_have_no_percentiles():
+    stats = TransferStatistics()
+
+    assert stats.block_latency_percentile(50) is None
+    assert stats.to_dict()['average_throughput'] is None
+
+
+def test_csv_files_have_one_header(tmp_path):
+    path = str(tmp_path / 'statistics.csv')
+
+    assert write_statistics(path, [create_statistics(1)]) == path
+    write_statistics(path, [create_statistics(2)])
+
+    rows = list(csv.DictReader(open(path, newline='')))
+
+    assert [row['request_id'] for row in rows] == ['1', '2']
+    assert json.loads(rows[0]['target']) == ['a', 'b']
+
+
+def test_csv_files_with_other_fields_are_not_appended_to(tmp_path):
+    path = tmp_path / 'statistics.csv'
+    path.write_text('request_id,status\n1,completed\n')
+    (tmp_path / 'statistics.1.csv').write_text('request_id\n')
+
+    written = write_statistics(str(path), [create_statistics()])
+
+    assert written == str(tmp_path / 'statistics.2.csv')
+    assert path.read_text() == 'request_id,status\n1,completed\n'
+    assert next(csv.reader(open(written, newline=''))) == list(TransferStatistics.fields)
+
+    # The next records go to the same file
+    assert write_statistics(str(path), [create_statistics()]) == written
+
+
+def test_other_files_are_written_as_json_lines(tmp_path):
+    path = str(tmp_path / 'statistics.jsonl')
+
+    write_statistics(path, [create_statistics(1), create_statistics(2)])
+
+    assert [json.loads(line)['request_id'] for line in open(path)] == [1, 2]
+
+
+def test_unwritable_files_raise(tmp_path):
+    with pytest.raises(TransferStatisticsError):
+        write_statistics(str(tmp_path / 'missing' / 'statistics.csv'), [create_statistics()])
@@ -0,0 +1,209 @@
+#
+# (C) Copyright 2012-2013 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# (C) Copyright 2017 Ricardo Persoon.
+
+
+import queue
+import time
+
+import pytest
+
+from background_client.worker_pool import WorkerPool, WorkerPoolError, WorkerThread
+
+
+class Log:
+
+    def __init__(self):
+        self.messages = []
+
+    def info(self, message):
+        self.messages.append(message)
+
+    warning = error = info
+
+
+class Worker(WorkerThread):
+    """
+    Worker that processes items of the work queue by sleeping for the number of seconds in the item. Every item counts
+    as 100 processed bytes. A worker stops without being retired when it gets the item 'crash'.
+    """
+
+    poll_interval = 0.01
+
+    def __init__(self, work_queue):
+        WorkerThread.__init__(self)
+        self.work_queue = work_queue
+        self.processed_bytes = 0
+
+    def get_processed_bytes(self):
+        return self.processed_bytes
+
+    def run(self):
+        while not self.retired:
+            try:
+                item = self.work_queue.get(timeout=self.poll_interval)
+
+            except queue.Empty:
+                continue
+
+            if item == 'crash':
+                return
+
+            self.busy = True
+            time.sleep(item)
+            self.processed_bytes += 100
+            self.busy = False
+
+
+def create_pool(size=2, **options):
+    work_queue = queue.Queue()
+    pool = WorkerPool('test', Log(), lambda: Worker(work_queue), work_queue, size, **options)
+
+    return pool, work_queue
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+
+    return True
+
+
+def test_resize_starts_and_retires_workers():
+    [pool, _] = create_pool(size=2)
+    pool.start()
+
+    try:
+        assert pool.get_status()['size'] == 2
+        assert len(pool._workers) == 2
+
+        pool.resize(4)
+        assert len(pool._workers) == 4
+
+        retired = list(pool._workers)
+        pool.resize(1)
+        assert len(pool._workers) == 1
+        assert sum(1 for worker in retired if worker.retired) == 3
+        assert wait_for(lambda: not any(worker.is_alive() for worker in retired if worker.retired))
+
+        with pytest.raises(WorkerPoolError):
+            pool.resize(0)
+
+    finally:
+        pool.stop()
+
+
+def test_idle_workers_are_retired_first():
+    [pool, work_queue] = create_pool(size=2)
+    pool.start()
+
+    try:
+        work_queue.put(0.5)
+        assert wait_for(lambda: any(worker.busy for worker in pool._workers))
+        busy = [worker for worker in pool._workers if worker.busy][0]
+
+        pool.resize(1)
+        assert pool._workers == [busy]
+
+    finally:
+        pool.stop()
+
+
+def test_prune_replaces_workers_that_stopped_unexpectedly():
+    [pool, work_queue] = create_pool(size=2)
+    pool.start()
+
+    try:
+        crashed = list(pool._workers)
+        work_queue.put('crash')
+        assert wait_for(lambda: sum(1 for worker in crashed if not worker.is_alive()) == 1)
+
+        with pool._lock:
+            pool._prune()
+
+        assert len(pool._workers) == 2
+        assert all(worker.is_alive() for worker in pool._workers)
+        assert any("stopped unexpectedly" in message for message in pool.log.messages)
+
+    finally:
+        pool.stop()
+
+
+def test_prune_keeps_the_bytes_of_stopped_workers():
+    [pool, work_queue] = create_pool(size=1)
+    pool.start()
+
+    try:
+        work_queue.put(0)
+        assert wait_for(lambda: pool._processed_bytes() == 100)
+
+        pool.resize(2)
+        pool.resize(1)
+        assert wait_for(lambda: not pool._retiring or not pool._retiring[0].is_alive())
+
+        with pool._lock:
+            pool._prune()
+
+        assert pool._processed_bytes() == 100
+
+    finally:
+        pool.stop()
+
+
+def test_elastic_pool_grows_with_a_backlog_and_shrinks_when_idle():
+    [pool, work_queue] = create_pool(size=1, min_size=1, max_size=3, elastic=True, elastic_interval=0.05,
+                                     growth_threshold=-1)
+
+    for _ in range(40):
+        work_queue.put(0.02)
+
+    pool.start()
+
+    try:
+        assert wait_for(lambda: pool.size > 1)
+        assert wait_for(lambda: work_queue.empty())
+        assert wait_for(lambda: pool.size == 1)
+
+    finally:
+        pool.stop()
+
+
+def test_elastic_loop_replaces_stopped_workers_without_elastic_mode():
+    [pool, work_queue] = create_pool(size=1, elastic_interval=0.05)
+    pool.start()
+
+    try:
+        first = pool._workers[0]
+        work_queue.put('crash')
+
+        assert wait_for(lambda: pool._workers and pool._workers[0] is not first)
+        assert pool.size == 1
+
+    finally:
+        pool.stop()
+
+
+def test_configure_validates_and_clamps_the_size():
+    [pool, _] = create_pool(size=3)
+    pool.start()
+
+    try:
+        pool.configure(elastic=True, max_size=2)
+        assert pool.size == 2
+
+        with pytest.raises(WorkerPoolError):
+            pool.configure(min_size=3)
+
+    finally:
+        pool.stop()